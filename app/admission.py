@@ -0,0 +1,288 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+from fastapi.responses import JSONResponse
+from app.metrics import ADMISSION_REJECTED
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Priority classes a client can request with the X-Priority header, higher values are admitted first
+PRIORITIES = {"low": 0, "normal": 1, "high": 2}
+PRIORITY_HEADER = b"x-priority"
+
+
+class AdmissionRejected(RuntimeError):
+    """Raised when a request is not admitted because its endpoint group is overloaded."""
+
+    def __init__(self, name: str, reason: str, status_code: int, retry_after: float):
+        super().__init__(f"{name} is overloaded ({reason}), retry later")
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AIMDLimiter:
+    """
+    A concurrency limit that adapts to the observed latency with additive increase, multiplicative decrease.
+
+    While requests finish within the target latency and the limit is in use, it grows by about one per
+    limit's worth of completions. When a request is slower than the target or fails, it shrinks by the
+    decrease factor, so the backlog drains instead of every request slowing down together.
+
+    Attributes:
+    - min_limit (int): The lowest limit.
+    - max_limit (int): The highest limit.
+    - target_latency (float): Seconds a request may take before the limit shrinks, 0 for a fixed limit.
+    - decrease (float): The factor the limit is multiplied with on a slow or failed request.
+    """
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 64, target_latency: float = 1.0,
+                 decrease: float = 0.75):
+        """
+        Initialize the AIMDLimiter.
+
+        Parameters:
+        - initial (int): The starting limit.
+        - min_limit (int): The lowest limit.
+        - max_limit (int): The highest limit.
+        - target_latency (float): Seconds a request may take before the limit shrinks, 0 for a fixed limit.
+        - decrease (float): The factor the limit is multiplied with on a slow or failed request.
+        """
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise ValueError("Expected 1 <= min_limit <= initial <= max_limit")
+        if not 0 < decrease < 1:
+            raise ValueError("decrease must be between 0 and 1")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self._limit = float(initial)
+
+    @property
+    def limit(self) -> int:
+        """The number of requests that may run concurrently."""
+        return int(self._limit)
+
+    def record(self, latency: float, failed: bool = False, in_flight: int = 0) -> None:
+        """
+        Adapt the limit to a finished request.
+
+        Parameters:
+        - latency (float): Seconds the request took.
+        - failed (bool): Whether the request failed from overload, e.g. with a 503 or an unhandled error.
+        - in_flight (int): The number of requests that were running, including this one.
+        """
+        if not self.target_latency:
+            return
+        if failed or latency > self.target_latency:
+            self._limit = max(float(self.min_limit), self._limit * self.decrease)
+        elif in_flight * 2 >= self.limit:
+            # Only grow while the limit is actually used, otherwise an idle period would lift it to max_limit
+            self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+
+
+class AdmissionController:
+    """
+    Admits requests of an endpoint group up to the limiter's concurrency limit and queues a bounded number more.
+
+    Queued requests are admitted by priority, then in arrival order. A request that finds the queue full is
+    rejected at once with 429, unless it has a higher priority than a queued request, which is then shed with
+    503 instead. A queued request that is not admitted within the queue timeout is rejected with 503. All
+    rejections carry a Retry-After hint. Runs on the event loop, not thread-safe.
+
+    Attributes:
+    - name (str): The name of the endpoint group.
+    - limiter (AIMDLimiter): The concurrency limit.
+    - max_queue (int): The maximum number of waiting requests.
+    - queue_timeout (float): Seconds a request may wait for admission, 0 to wait until admitted.
+    - retry_after (float): Seconds a rejected client is asked to wait before retrying.
+    """
+
+    def __init__(self, name: str, limiter: AIMDLimiter, max_queue: int = 64, queue_timeout: float = 5.0,
+                 retry_after: float = 1.0):
+        """
+        Initialize the AdmissionController.
+
+        Parameters:
+        - name (str): The name of the endpoint group.
+        - limiter (AIMDLimiter): The concurrency limit.
+        - max_queue (int): The maximum number of waiting requests, 0 to reject when the limit is reached.
+        - queue_timeout (float): Seconds a request may wait for admission, 0 to wait until admitted.
+        - retry_after (float): Seconds a rejected client is asked to wait before retrying.
+        """
+        self.name = name
+        self.limiter = limiter
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    @property
+    def in_flight(self) -> int:
+        """The number of admitted requests that are running."""
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of requests waiting for admission."""
+        return len(self._waiters)
+
+    async def acquire(self, priority: int = PRIORITIES["normal"]) -> None:
+        """
+        Wait until the request is admitted. Every successful acquire must be followed by release().
+
+        Parameters:
+        - priority (int): The priority class of the request.
+
+        Raises:
+        - AdmissionRejected: If the request is rejected or shed.
+        """
+        if self._in_flight < self.limiter.limit and not self._waiters:
+            self._in_flight += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            # The last entry of the heap is not necessarily the lowest one, search it
+            lowest = max(self._waiters) if self._waiters else None
+            if lowest is None or -lowest[0] >= priority:
+                raise self._reject("queue full", 429)
+            self._waiters.remove(lowest)
+            heapq.heapify(self._waiters)
+            if not lowest[2].done():
+                lowest[2].set_exception(self._reject("shed for higher priority", 503))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (-priority, next(self._order), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout or None)
+        except asyncio.TimeoutError:
+            self._discard(entry)
+            raise self._reject("queue timeout", 503)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Admitted just as the client went away, hand the slot on
+                self._in_flight -= 1
+                self._admit_waiters()
+            else:
+                self._discard(entry)
+            raise
+
+    def release(self, latency: float, failed: bool = False) -> None:
+        """
+        Finish an admitted request, adapt the limit and admit waiting requests.
+
+        Parameters:
+        - latency (float): Seconds the request took.
+        - failed (bool): Whether the request failed from overload.
+        """
+        self.limiter.record(latency, failed, self._in_flight)
+        self._in_flight -= 1
+        self._admit_waiters()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+        - Dict[str, int]: The current limit, running and waiting requests.
+        """
+        return {"limit": self.limiter.limit, "in_flight": self._in_flight, "queued": len(self._waiters)}
+
+    def _admit_waiters(self) -> None:
+        """Admit the highest-priority waiters while the limit allows."""
+        while self._waiters and self._in_flight < self.limiter.limit:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._in_flight += 1
+            future.set_result(None)
+
+    def _reject(self, reason: str, status_code: int) -> AdmissionRejected:
+        """Count a rejection and build its exception."""
+        ADMISSION_REJECTED.inc(group=self.name, reason=reason)
+        return AdmissionRejected(self.name, reason, status_code, self.retry_after)
+
+    def _discard(self, entry: tuple) -> None:
+        """Remove a waiter that gave up."""
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+
+
+def request_priority(headers: List[Tuple[bytes, bytes]]) -> int:
+    """
+    Read the priority class of a request from its X-Priority header.
+
+    Parameters:
+    - headers (List[Tuple[bytes, bytes]]): The raw ASGI headers.
+
+    Returns:
+    - int: The priority; unknown or missing classes count as normal.
+    """
+    for name, value in headers:
+        if name == PRIORITY_HEADER:
+            return PRIORITIES.get(value.decode("latin-1").strip().lower(), PRIORITIES["normal"])
+    return PRIORITIES["normal"]
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware that puts requests to the guarded paths through the admission controller of their group.
+    Requests are admitted before their body is read, and hold their slot until the response is fully sent.
+    The limiter is fed the time to the first response byte, so streaming responses are judged by how soon
+    they start rather than by how long the client keeps reading. Paths without a controller, such as
+    /health, /ready and /metrics, are never queued or rejected.
+    """
+
+    def __init__(self, app, controllers: Optional[Dict[str, AdmissionController]] = None):
+        """
+        Initialize the AdmissionMiddleware.
+
+        Parameters:
+        - app (ASGIApp): The wrapped application.
+        - controllers (Dict[str, AdmissionController]): The controller per request path.
+        """
+        self.app = app
+        self.controllers = controllers or {}
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controllers.get(scope["path"]) if scope["type"] == "http" else None
+        if controller is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await controller.acquire(request_priority(scope["headers"]))
+        except AdmissionRejected as e:
+            logger.warning(f"Rejecting request to {scope['path']}: {str(e)}")
+            response = JSONResponse(
+                status_code=e.status_code, content={"detail": str(e)},
+                headers={"Retry-After": str(max(1, int(e.retry_after)))},
+            )
+            await response(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = [None]
+        first_byte = [None]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            elif first_byte[0] is None and (message.get("body") or not message.get("more_body", False)):
+                first_byte[0] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            latency = (first_byte[0] or time.perf_counter()) - started
+            # Client errors and failed inputs say nothing about load; a 503 or a crash before the response does
+            controller.release(latency, failed=status_code[0] in (None, 503))
@@ -0,0 +1,517 @@
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+from typing import AsyncIterable, AsyncIterator, List, Optional, Tuple
+import aiofiles
+import numpy as np
+from fastapi import UploadFile
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000  # Whisper expects 16 kHz mono
+BYTES_PER_SAMPLE = 2  # s16le
+CHUNK_SIZE = 1024 * 1024
+SPLIT_SEARCH_SECONDS = 2.0  # How far back from a window end to look for a quiet split point
+SPLIT_FRAME_SECONDS = 0.02
+
+# Containers that may store their index at the end of the file and cannot be demuxed from a pipe
+SEEKABLE_CONTAINERS = {".m4a", ".mp4", ".mov", ".3gp", ".3g2"}
+
+
+class AudioDecodeError(RuntimeError):
+    """Raised when an upload cannot be decoded to audio."""
+
+
+def parse_wav_header(head: bytes) -> Optional[Tuple[int, int, Optional[int]]]:
+    """
+    Check whether a buffer starts with a WAV header that can be decoded without ffmpeg.
+    Only 16-bit PCM at 16 kHz qualifies, everything else needs ffmpeg for resampling.
+
+    Parameters:
+    - head (bytes): The first bytes of the file.
+
+    Returns:
+    - Optional[Tuple[int, int, Optional[int]]]: The offset of the sample data, the number of channels and the
+      size of the data chunk in bytes, or None. The size is None if the header leaves it open, as WAVs
+      written to a pipe do; the samples then run to the end of the file.
+    """
+    if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return None
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(head):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", head, offset)
+        body = offset + 8
+        if chunk_id == b"fmt " and body + 16 <= len(head):
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", head, body)
+            fmt = (audio_format, channels, sample_rate, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            audio_format, channels, sample_rate, bits = fmt
+            if audio_format != 1 or bits != 16 or sample_rate != SAMPLE_RATE or channels < 1:
+                return None
+            return body, channels, None if chunk_size in (0, 0xFFFFFFFF) else chunk_size
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def pcm_to_float32(pcm: bytes) -> np.ndarray:
+    """
+    Convert s16le PCM bytes to a float32 waveform in [-1, 1].
+
+    Parameters:
+    - pcm (bytes): The PCM samples.
+
+    Returns:
+    - np.ndarray: The waveform.
+    """
+    audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+    audio /= 32768.0
+    return audio
+
+
+async def iter_pcm(file: UploadFile, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Stream an upload and yield 16 kHz mono s16le PCM blocks as they are decoded.
+    16-bit PCM WAV at 16 kHz is decoded in-process, everything else is piped through ffmpeg. Containers
+    that need seeking (e.g. m4a with the index at the end) fall back to a temporary file if ffmpeg cannot
+    decode them from a pipe.
+
+    Parameters:
+    - file (UploadFile): The uploaded audio file.
+    - chunk_size (int): The number of bytes read from the upload at a time.
+
+    Yields:
+    - bytes: Blocks of PCM samples. Blocks always contain whole samples.
+
+    Raises:
+    - AudioDecodeError: If the upload cannot be decoded.
+    """
+    head = await file.read(chunk_size)
+    wav = parse_wav_header(head)
+    if wav is not None:
+        async for block in _iter_wav(file, head, *wav, chunk_size=chunk_size):
+            yield block
+        return
+    decoded = False
+    try:
+        async for block in _iter_ffmpeg(file, head, chunk_size=chunk_size):
+            decoded = True
+            yield block
+    except AudioDecodeError:
+        suffix = os.path.splitext(file.filename or "")[-1].lower()
+        # Once PCM was yielded the caller has used it, starting over would repeat the audio
+        if decoded or suffix not in SEEKABLE_CONTAINERS:
+            raise
+        logger.info(f"Decoding {suffix} from a pipe failed, retrying from a temporary file")
+        await file.seek(0)
+        async for block in _iter_via_tempfile(file, suffix, chunk_size=chunk_size):
+            yield block
+
+
+async def decode_upload(file: UploadFile, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
+    """
+    Decode an uploaded audio file in memory to a 16 kHz mono float32 waveform.
+    The upload is streamed chunk by chunk into the decoder, there is no temporary file and no full copy
+    of the encoded bytes, except for containers that need seeking (see iter_pcm).
+
+    Parameters:
+    - file (UploadFile): The uploaded audio file.
+    - chunk_size (int): The number of bytes read from the upload at a time.
+
+    Returns:
+    - np.ndarray: The waveform, ready to be passed to Whisper.
+
+    Raises:
+    - AudioDecodeError: If the upload cannot be decoded.
+    """
+    pcm = bytearray()
+    async for block in iter_pcm(file, chunk_size=chunk_size):
+        pcm.extend(block)
+    return pcm_to_float32(pcm)
+
+
+async def hash_upload(file: UploadFile, chunk_size: int = CHUNK_SIZE) -> Tuple[str, int]:
+    """
+    Compute the SHA-256 of an upload before it is decoded, so a cached result is found without decoding.
+    FastAPI spools uploads to memory or a temporary file; it is read in the default executor and rewound
+    for the decoder.
+
+    Parameters:
+    - file (UploadFile): The uploaded file.
+    - chunk_size (int): The number of bytes read at a time.
+
+    Returns:
+    - Tuple[str, int]: The hex digest and the size of the upload in bytes.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _hash_file, file.file, chunk_size)
+
+
+def _hash_file(file, chunk_size: int) -> Tuple[str, int]:
+    """Hash a file object from its start and rewind it."""
+    file.seek(0)
+    hasher = hashlib.sha256()
+    nbytes = 0
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        nbytes += len(chunk)
+    file.seek(0)
+    return hasher.hexdigest(), nbytes
+
+
+async def iter_windows(pcm_blocks: AsyncIterable[bytes], window_seconds: float = 30.0
+                       ) -> AsyncIterator[Tuple[float, np.ndarray]]:
+    """
+    Group a stream of PCM blocks into windows of at most window_seconds.
+    Windows are cut at the quietest frame near their end so words are not split across windows,
+    the remainder is carried into the next window. Memory stays bounded by the window size.
+
+    Parameters:
+    - pcm_blocks (AsyncIterable[bytes]): 16 kHz mono s16le PCM blocks, e.g. from iter_pcm.
+    - window_seconds (float): The maximum window length in seconds.
+
+    Yields:
+    - Tuple[float, np.ndarray]: The offset of the window in seconds and its float32 waveform.
+    """
+    window_bytes = int(window_seconds * SAMPLE_RATE) * BYTES_PER_SAMPLE
+    pending = bytearray()
+    offset = 0
+    async for block in pcm_blocks:
+        pending.extend(block)
+        while len(pending) >= window_bytes:
+            window = pcm_to_float32(pending[:window_bytes])
+            cut = find_split_point(window)
+            yield offset / SAMPLE_RATE, window[:cut]
+            offset += cut
+            del pending[:cut * BYTES_PER_SAMPLE]
+    if pending:
+        yield offset / SAMPLE_RATE, pcm_to_float32(pending)
+
+
+def find_split_point(window: np.ndarray) -> int:
+    """
+    Find the quietest frame in the last SPLIT_SEARCH_SECONDS of a window.
+
+    Parameters:
+    - window (np.ndarray): The float32 waveform.
+
+    Returns:
+    - int: The sample index to cut the window at.
+    """
+    frame = int(SPLIT_FRAME_SECONDS * SAMPLE_RATE)
+    search = min(int(SPLIT_SEARCH_SECONDS * SAMPLE_RATE), len(window) // 2) // frame * frame
+    if search == 0:
+        return len(window)
+    tail = window[len(window) - search:].reshape(-1, frame)
+    quietest = int(np.argmin(np.square(tail).mean(axis=1)))
+    return len(window) - search + quietest * frame + frame // 2
+
+
+class SpeechTimeline:
+    """
+    Maps times in audio whose silences were cut out back to the original recording.
+
+    Attributes:
+    - pieces (np.ndarray): One row per kept region: its start in the trimmed audio, its start in the
+      original audio and its length, all in samples.
+    - original_samples (int): The length of the original audio.
+    - kept_samples (int): The length of the trimmed audio.
+    """
+
+    def __init__(self, pieces: np.ndarray, original_samples: int, kept_samples: int):
+        self.pieces = pieces
+        self.original_samples = original_samples
+        self.kept_samples = kept_samples
+
+    @classmethod
+    def identity(cls, samples: int) -> "SpeechTimeline":
+        """A timeline of audio that was not trimmed."""
+        return cls(np.array([[0, 0, samples]], dtype=np.int64), samples, samples)
+
+    @property
+    def skipped_seconds(self) -> float:
+        """The seconds of audio that were cut out."""
+        return (self.original_samples - self.kept_samples) / SAMPLE_RATE
+
+    def to_original(self, seconds: float) -> float:
+        """
+        Map a time in the trimmed audio to the original audio.
+
+        Parameters:
+        - seconds (float): The time in the trimmed audio.
+
+        Returns:
+        - float: The time in the original audio. Times in a gap between regions map to the end of the region before.
+        """
+        sample = seconds * SAMPLE_RATE
+        row = max(0, int(np.searchsorted(self.pieces[:, 0], sample, side="right")) - 1)
+        kept_start, original_start, length = self.pieces[row]
+        return float(original_start + min(max(sample - kept_start, 0), length)) / SAMPLE_RATE
+
+
+class SilenceTrimmer:
+    """
+    Cuts silence out of a waveform before it is transcribed, so Whisper only decodes the speech.
+
+    Speech is detected with a vectorized energy pass: the waveform is split into frames, and a frame counts
+    as speech if it is louder than a threshold derived from the noise floor of the recording (its quiet
+    frames) and its peak, but never below threshold_db. Pauses shorter than min_silence_seconds are kept,
+    bursts shorter than min_speech_seconds are dropped, and every region is padded so word onsets survive.
+    The regions are joined with short silent gaps, which keep Whisper's segment boundaries.
+
+    An energy detector removes silence and quiet noise; music is as loud as speech and is kept.
+
+    Attributes:
+    - threshold_db (float): The level in dBFS below which a frame is always silence.
+    - margin_db (float): How far above the noise floor (and below the peak) the threshold lies.
+    - min_speech_seconds (float): Shorter speech regions are dropped.
+    - min_silence_seconds (float): Shorter silences are kept.
+    - padding_seconds (float): Audio kept before and after every speech region.
+    - gap_seconds (float): The silence inserted between the kept regions.
+    - frame_seconds (float): The length of an analysis frame.
+    """
+
+    def __init__(self, threshold_db: float = -50.0, margin_db: float = 10.0, min_speech_seconds: float = 0.25,
+                 min_silence_seconds: float = 1.0, padding_seconds: float = 0.2, gap_seconds: float = 0.2,
+                 frame_seconds: float = 0.03):
+        """
+        Initialize the SilenceTrimmer.
+
+        Parameters:
+        - threshold_db (float): The level in dBFS below which a frame is always silence.
+        - margin_db (float): How far above the noise floor (and below the peak) the threshold lies.
+        - min_speech_seconds (float): Shorter speech regions are dropped.
+        - min_silence_seconds (float): Shorter silences are kept.
+        - padding_seconds (float): Audio kept before and after every speech region.
+        - gap_seconds (float): The silence inserted between the kept regions.
+        - frame_seconds (float): The length of an analysis frame.
+        """
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.min_speech_seconds = min_speech_seconds
+        self.min_silence_seconds = min_silence_seconds
+        self.padding_seconds = padding_seconds
+        self.gap_seconds = gap_seconds
+        self.frame_seconds = frame_seconds
+
+    def options(self) -> dict:
+        """The settings that change the transcript, e.g. for cache keys."""
+        return {
+            "vad": [self.threshold_db, self.margin_db, self.min_speech_seconds, self.min_silence_seconds,
+                    self.padding_seconds, self.gap_seconds, self.frame_seconds],
+        }
+
+    def speech_regions(self, audio: np.ndarray) -> List[Tuple[int, int]]:
+        """
+        Detect the regions of a waveform that contain speech.
+
+        Parameters:
+        - audio (np.ndarray): A 16 kHz mono float32 waveform.
+
+        Returns:
+        - List[Tuple[int, int]]: The start and end sample of every speech region, in order and not overlapping.
+        """
+        frame = max(1, int(self.frame_seconds * SAMPLE_RATE))
+        count = -(-len(audio) // frame)
+        if count == 0:
+            return []
+        frames = np.zeros(count * frame, dtype=np.float32)
+        frames[:len(audio)] = audio
+        level = 10 * np.log10(np.square(frames.reshape(count, frame)).mean(axis=1) + 1e-10)
+        floor, peak = np.percentile(level, 10), level.max()
+        threshold = max(self.threshold_db, min(floor + self.margin_db, peak - self.margin_db))
+
+        starts, ends = _runs(level > threshold)
+        # Bridge short pauses, then drop short bursts such as clicks
+        starts, ends = _merge(starts, ends, self.min_silence_seconds / self.frame_seconds)
+        keep = (ends - starts) >= self.min_speech_seconds / self.frame_seconds
+        starts, ends = starts[keep], ends[keep]
+
+        padding = int(self.padding_seconds * SAMPLE_RATE)
+        starts = np.maximum(starts * frame - padding, 0)
+        ends = np.minimum(ends * frame + padding, len(audio))
+        starts, ends = _merge(starts, ends, 1)
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def trim(self, audio: np.ndarray) -> Tuple[np.ndarray, SpeechTimeline]:
+        """
+        Cut the silence out of a waveform.
+
+        Parameters:
+        - audio (np.ndarray): A 16 kHz mono float32 waveform.
+
+        Returns:
+        - Tuple[np.ndarray, SpeechTimeline]: The speech regions joined by short gaps (empty if there is no
+          speech, the input itself if there is nothing to cut) and the map back to the original times.
+        """
+        regions = self.speech_regions(audio)
+        if len(regions) == 1 and regions[0] == (0, len(audio)):
+            return audio, SpeechTimeline.identity(len(audio))
+
+        gap = int(self.gap_seconds * SAMPLE_RATE)
+        pieces = np.zeros((max(1, len(regions)), 3), dtype=np.int64)
+        parts = []
+        position = 0
+        for row, (start, end) in enumerate(regions):
+            if parts:
+                parts.append(np.zeros(gap, dtype=np.float32))
+                position += gap
+            pieces[row] = (position, start, end - start)
+            parts.append(audio[start:end])
+            position += end - start
+        trimmed = np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+        if len(trimmed) >= len(audio):
+            # The gaps would add more than was cut
+            return audio, SpeechTimeline.identity(len(audio))
+        return trimmed, SpeechTimeline(pieces, len(audio), len(trimmed))
+
+
+def _runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the start and end indices of the runs of True in a boolean array."""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _merge(starts: np.ndarray, ends: np.ndarray, min_gap: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge consecutive runs that are separated by less than min_gap."""
+    if len(starts) < 2:
+        return starts, ends
+    separate = (starts[1:] - ends[:-1]) >= min_gap
+    return starts[np.concatenate(([True], separate))], ends[np.concatenate((separate, [True]))]
+
+
+async def _iter_wav(file: UploadFile, head: bytes, data_offset: int, channels: int, data_size: Optional[int],
+                    chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Yield the samples of a 16 kHz PCM WAV upload, down-mixed to mono. Reading stops at the end of the data
+    chunk, so chunks after it (e.g. LIST metadata) are not decoded as samples.
+    """
+    frame_size = BYTES_PER_SAMPLE * channels
+    pending = head[data_offset:] if data_size is None else head[data_offset:data_offset + data_size]
+    remaining = None if data_size is None else data_size - len(pending)
+    while True:
+        usable = len(pending) - len(pending) % frame_size
+        if usable:
+            yield _downmix(pending[:usable], channels)
+            pending = pending[usable:]
+        if remaining == 0:
+            break
+        chunk = await file.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        pending += chunk
+
+
+def _downmix(pcm: bytes, channels: int) -> bytes:
+    """Average interleaved s16le channels into one."""
+    if channels == 1:
+        return pcm
+    frames = np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels)
+    return frames.mean(axis=1, dtype=np.float32).astype(np.int16).tobytes()
+
+
+def _ffmpeg_command(source: str) -> list:
+    """Build the ffmpeg command that decodes a source to 16 kHz mono s16le on stdout."""
+    return [
+        "ffmpeg", "-loglevel", "error", "-threads", "0", "-i", source,
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "pipe:1",
+    ]
+
+
+async def _read_pcm(stream: asyncio.StreamReader, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Yield ffmpeg's PCM output in blocks of whole samples."""
+    pending = b""
+    while True:
+        block = await stream.read(chunk_size)
+        if not block:
+            break
+        block = pending + block
+        usable = len(block) - len(block) % BYTES_PER_SAMPLE
+        pending = block[usable:]
+        if usable:
+            yield block[:usable]
+
+
+async def _iter_ffmpeg(file: UploadFile, head: bytes, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Pipe the upload through ffmpeg and yield the decoded PCM while it is being written."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *_ffmpeg_command("pipe:0"),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError as e:
+        raise AudioDecodeError(f"ffmpeg is not installed: {str(e)}")
+
+    async def feed():
+        try:
+            chunk = head
+            while chunk:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+                chunk = await file.read(chunk_size)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg gave up on the input, the error is reported through its exit code
+            pass
+        finally:
+            process.stdin.close()
+
+    feeder = asyncio.create_task(feed())
+    stderr = asyncio.create_task(process.stderr.read())
+    try:
+        async for block in _read_pcm(process.stdout, chunk_size):
+            yield block
+        await feeder
+        returncode = await process.wait()
+        if returncode != 0:
+            message = (await stderr).decode(errors="replace").strip()
+            raise AudioDecodeError(f"Failed to decode audio: {message}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        feeder.cancel()
+        stderr.cancel()
+
+
+async def _iter_via_tempfile(file: UploadFile, suffix: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Write the upload to a temporary file and yield the PCM ffmpeg decodes from it, for containers that need seeking."""
+    async with aiofiles.tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_audio_file:
+        while chunk := await file.read(chunk_size):
+            await temp_audio_file.write(chunk)
+        temp_audio_file_path = temp_audio_file.name
+    try:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *_ffmpeg_command(temp_audio_file_path),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError as e:
+            raise AudioDecodeError(f"ffmpeg is not installed: {str(e)}")
+        stderr = asyncio.create_task(process.stderr.read())
+        try:
+            async for block in _read_pcm(process.stdout, chunk_size):
+                yield block
+            returncode = await process.wait()
+            if returncode != 0:
+                message = (await stderr).decode(errors="replace").strip()
+                raise AudioDecodeError(f"Failed to decode audio: {message}")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr.cancel()
+    finally:
+        os.remove(temp_audio_file_path)
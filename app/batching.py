@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a job is submitted to a batcher whose queue is full."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} queue is full, retry later")
+        self.retry_after = retry_after
+
+
+class MicroBatcher:
+    """
+    Queue jobs from the event loop and run them in micro-batches on a dedicated worker thread.
+
+    The worker takes the first queued job and then waits up to max_wait_ms for more jobs, until
+    max_batch_size jobs are collected. The handler is called once per batch and returns one result per job.
+    If a batch fails, its jobs are retried one by one so a single bad input does not fail the others.
+
+    Attributes:
+    - handler (Callable[[List[Any]], Sequence[Any]]): Function that processes a batch of jobs.
+    - max_batch_size (int): The maximum number of jobs per batch.
+    - max_wait_ms (float): How long the worker waits for a batch to fill up.
+    - max_queue_size (int): The maximum number of queued jobs before submissions are rejected.
+    - retry_after (float): Seconds a rejected client is asked to wait before retrying.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[Any]], Sequence[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10,
+        max_queue_size: int = 64,
+        retry_after: float = 1,
+        name: str = "batcher",
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_queue_size < 1:
+            raise ValueError("max_queue_size must be at least 1")
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        self.name = name
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=max_queue_size)
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of jobs waiting for the worker."""
+        return self._queue.qsize()
+
+    @property
+    def in_flight(self) -> int:
+        """The number of jobs in the batch the worker is currently processing."""
+        return self._in_flight
+
+    def submit_nowait(self, job: Any) -> "asyncio.Future":
+        """
+        Queue a job and return a future for its result. Must be called from the event loop.
+
+        Parameters:
+        - job (Any): The job to process.
+
+        Returns:
+        - asyncio.Future: A future resolved with the job's result.
+
+        Raises:
+        - QueueFullError: If the queue is full.
+        """
+        self._ensure_worker()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait((job, future, loop))
+        except queue.Full:
+            raise QueueFullError(self.name, self.retry_after)
+        return future
+
+    async def submit(self, job: Any) -> Any:
+        """
+        Queue a job and wait for its result.
+
+        Parameters:
+        - job (Any): The job to process.
+
+        Returns:
+        - Any: The result returned by the handler for this job.
+
+        Raises:
+        - QueueFullError: If the queue is full.
+        """
+        return await self.submit_nowait(job)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the worker after the queued jobs are processed.
+
+        Parameters:
+        - timeout (float): Seconds to wait for the worker to finish.
+        """
+        with self._start_lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            self._queue.put(None)
+            worker.join(timeout)
+
+    def _ensure_worker(self) -> None:
+        """Start the worker thread on first use."""
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def _collect(self) -> Optional[list]:
+        """Block for the first job, then gather more until the batch is full or the wait time is over."""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # Keep the stop signal for the next round so this batch still completes
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self) -> None:
+        """Worker loop."""
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # Skip jobs whose caller went away while they were queued
+            batch = [entry for entry in batch if not entry[1].cancelled()]
+            if not batch:
+                continue
+            self._in_flight = len(batch)
+            try:
+                self._process(batch)
+            finally:
+                self._in_flight = 0
+
+    def _process(self, batch: list) -> None:
+        """Run the handler on a batch and resolve the futures."""
+        jobs = [job for job, _, _ in batch]
+        try:
+            results = list(self.handler(jobs))
+            if len(results) != len(jobs):
+                raise RuntimeError(f"{self.name} handler returned {len(results)} results for {len(jobs)} jobs")
+        except Exception as e:
+            if len(batch) > 1:
+                logger.warning(f"{self.name} batch of {len(batch)} failed, retrying jobs individually: {str(e)}")
+                for entry in batch:
+                    self._process([entry])
+                return
+            results = [e]
+
+        for (_, future, loop), result in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve, future, result)
+
+
+def _resolve(future: "asyncio.Future", result: Any) -> None:
+    """Set a result or exception on a future unless the caller cancelled it."""
+    if future.cancelled():
+        return
+    if isinstance(result, BaseException):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class TranscriptionScheduler(MicroBatcher):
+    """
+    Micro-batching scheduler for Whisper transcription.
+    Jobs are audio inputs accepted by WhisperTranscriber.transcribe_batch, results are transcripts.
+    A job can also be a callable taking the transcriber (e.g. a window of a streamed recording that needs
+    timestamped segments); it runs on the same worker after the batch it was collected with.
+    """
+
+    def __init__(self, transcriber, max_batch_size: int = 8, max_wait_ms: float = 10,
+                 max_queue_size: int = 64, retry_after: float = 1):
+        """
+        Initialize the TranscriptionScheduler.
+
+        Parameters:
+        - transcriber (WhisperTranscriber): The transcriber that processes the batches.
+        - max_batch_size (int): The maximum number of clips per batch.
+        - max_wait_ms (float): How long the worker waits for a batch to fill up.
+        - max_queue_size (int): The maximum number of queued clips before requests get a 503.
+        - retry_after (float): Seconds a rejected client is asked to wait before retrying.
+        """
+        self.transcriber = transcriber
+        super().__init__(
+            self._transcribe,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            max_queue_size=max_queue_size,
+            retry_after=retry_after,
+            name="transcription-scheduler",
+        )
+
+    def _transcribe(self, jobs: List[Any]) -> List[Any]:
+        """Transcribe the audio jobs in one batch, then run the callable jobs, and return the results in job order."""
+        results: List[Any] = [None] * len(jobs)
+        clips = [index for index, job in enumerate(jobs) if not callable(job)]
+        if clips:
+            texts = list(self.transcriber.transcribe_batch([jobs[index] for index in clips]))
+            if len(texts) != len(clips):
+                raise RuntimeError(f"transcribe_batch returned {len(texts)} transcripts for {len(clips)} clips")
+            for index, text in zip(clips, texts):
+                results[index] = text
+        for index, job in enumerate(jobs):
+            if callable(job):
+                results[index] = job(self.transcriber)
+        return results
+
+
+class SimilarityBatcher(MicroBatcher):
+    """
+    Coalesces concurrent similarity searches into one embedding batch and one multi-query lookup per database.
+    Jobs are (db, query, k) tuples, results are lists of documents.
+    """
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 2,
+                 max_queue_size: int = 256, retry_after: float = 1):
+        """
+        Initialize the SimilarityBatcher.
+
+        Parameters:
+        - max_batch_size (int): The maximum number of queries per batch.
+        - max_wait_ms (float): How long the worker waits for a batch to fill up.
+        - max_queue_size (int): The maximum number of queued queries before requests get a 503.
+        - retry_after (float): Seconds a rejected client is asked to wait before retrying.
+        """
+        super().__init__(
+            self._search,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            max_queue_size=max_queue_size,
+            retry_after=retry_after,
+            name="similarity-batcher",
+        )
+
+    @staticmethod
+    def _search(jobs: List[tuple]) -> List[Any]:
+        """Run one batched search per database and fan the results back out in job order."""
+        groups: Dict[int, List[int]] = {}
+        for index, (db, _, _) in enumerate(jobs):
+            groups.setdefault(id(db), []).append(index)
+
+        results: List[Any] = [None] * len(jobs)
+        for indices in groups.values():
+            db = jobs[indices[0]][0]
+            documents = db.similarity_search_batch([jobs[i][1] for i in indices], [jobs[i][2] for i in indices])
+            for index, docs in zip(indices, documents):
+                results[index] = docs
+        return results
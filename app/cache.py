@@ -0,0 +1,643 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    A thread-safe in-memory LRU cache with optional entry, size and TTL limits.
+
+    Attributes:
+    - max_entries (int): The maximum number of entries, 0 for unlimited.
+    - max_bytes (int): The maximum total size of the entries, 0 for unlimited.
+    - ttl_seconds (float): How long an entry stays valid, 0 for forever.
+    - hits (int): The number of successful lookups.
+    - misses (int): The number of failed lookups.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 0, ttl_seconds: float = 0,
+                 sizeof: Callable[[Any], int] = lambda value: 1):
+        """
+        Initialize the LRUCache.
+
+        Parameters:
+        - max_entries (int): The maximum number of entries, 0 for unlimited.
+        - max_bytes (int): The maximum total size of the entries as measured by sizeof, 0 for unlimited.
+        - ttl_seconds (float): How long an entry stays valid, 0 for forever.
+        - sizeof (Callable[[Any], int]): Function that returns the size of a value in bytes.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """
+        Look up a value and mark it as most recently used.
+
+        Parameters:
+        - key (Any): The key to look up.
+        - default (Any): The value returned on a miss.
+
+        Returns:
+        - Any: The cached value or default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds and time.monotonic() - entry[1] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Any, value: Any) -> None:
+        """
+        Store a value, evicting least recently used entries if the limits are exceeded.
+        Values larger than max_bytes are not stored.
+
+        Parameters:
+        - key (Any): The key to store the value under.
+        - value (Any): The value.
+        """
+        size = self.sizeof(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic(), size)
+            self._bytes += size
+            while (self.max_entries and len(self._entries) > self.max_entries) or \
+                    (self.max_bytes and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+        - Dict[str, Any]: Hits, misses, hit ratio, number of entries and their total size.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    def _remove(self, key: Any) -> None:
+        """Remove an entry. Caller holds the lock."""
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+
+class DiskCache:
+    """
+    A persistent key/value cache for JSON-serializable values in a SQLite file,
+    with size and TTL limits. Least recently accessed entries are evicted first.
+
+    Attributes:
+    - path (str): The path of the SQLite file.
+    - max_bytes (int): The maximum total size of the stored values, 0 for unlimited.
+    - ttl_seconds (float): How long an entry stays valid, 0 for forever.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 0, ttl_seconds: float = 0):
+        """
+        Initialize the DiskCache, creating the database file if necessary.
+
+        Parameters:
+        - path (str): The path of the SQLite file.
+        - max_bytes (int): The maximum total size of the stored values, 0 for unlimited.
+        - ttl_seconds (float): How long an entry stays valid, 0 for forever.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._connection.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a value.
+
+        Parameters:
+        - key (str): The key to look up.
+
+        Returns:
+        - Optional[Any]: The cached value or None.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Store a value and evict expired and least recently accessed entries over the size limit.
+
+        Parameters:
+        - key (str): The key to store the value under.
+        - value (Any): A JSON-serializable value.
+        """
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            if self.ttl_seconds:
+                self._connection.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl_seconds,))
+            if self.max_bytes:
+                total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+                if total > self.max_bytes:
+                    victims = []
+                    for victim, size in self._connection.execute("SELECT key, size FROM cache ORDER BY accessed"):
+                        if total <= self.max_bytes:
+                            break
+                        victims.append((victim,))
+                        total -= size
+                    self._connection.executemany("DELETE FROM cache WHERE key = ?", victims)
+            self._connection.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+        - Dict[str, Any]: Hits, misses, number of entries and their total size.
+        """
+        with self._lock:
+            entries, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
+
+
+class TranscriptionCache:
+    """
+    Content-addressed cache for transcription results.
+    Results are keyed by the SHA-256 of the uploaded bytes, the model size and the decode options.
+    Lookups go to the in-memory LRU tier first and then to the optional on-disk tier;
+    disk hits are promoted to memory.
+
+    Attributes:
+    - memory (LRUCache): The in-memory tier.
+    - disk (Optional[DiskCache]): The on-disk tier.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 0,
+                 disk_path: Optional[str] = None, disk_max_bytes: int = 0):
+        """
+        Initialize the TranscriptionCache.
+
+        Parameters:
+        - max_entries (int): The maximum number of results kept in memory.
+        - max_bytes (int): The maximum size of the results kept in memory.
+        - ttl_seconds (float): How long a result stays valid in both tiers, 0 for forever.
+        - disk_path (str): Path of the SQLite file for the on-disk tier, None to keep results in memory only.
+        - disk_max_bytes (int): The maximum size of the on-disk tier, 0 for unlimited.
+        """
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl_seconds=ttl_seconds,
+                               sizeof=lambda result: len(json.dumps(result)))
+        self.disk = DiskCache(disk_path, max_bytes=disk_max_bytes, ttl_seconds=ttl_seconds) if disk_path else None
+        self.bytes_hashed = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(digest: str, model_size: str, options: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Build the cache key for a transcription.
+
+        Parameters:
+        - digest (str): The hex SHA-256 of the audio bytes.
+        - model_size (str): The Whisper model size.
+        - options (Dict[str, Any]): Decode options that change the result.
+
+        Returns:
+        - str: The cache key.
+        """
+        return f"{digest}:{model_size}:{json.dumps(options or {}, sort_keys=True)}"
+
+    def get(self, key: str, nbytes: int = 0) -> Optional[Any]:
+        """
+        Look up a transcription result.
+
+        Parameters:
+        - key (str): The cache key.
+        - nbytes (int): The size of the upload, counted as saved work on a hit.
+
+        Returns:
+        - Optional[Any]: The cached result or None.
+        """
+        result = self.memory.get(key)
+        if result is None and self.disk is not None:
+            result = self.disk.get(key)
+            if result is not None:
+                self.memory.put(key, result)
+        if result is not None:
+            self.bytes_saved += nbytes
+        return result
+
+    def put(self, key: str, result: Any) -> None:
+        """
+        Store a transcription result in all tiers.
+
+        Parameters:
+        - key (str): The cache key.
+        - result (Any): A JSON-serializable result, e.g. the transcript with the seconds cut out as silence.
+        """
+        self.memory.put(key, result)
+        if self.disk is not None:
+            self.disk.put(key, result)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+        - Dict[str, Any]: Statistics of both tiers and the number of upload bytes hashed and served from cache.
+        """
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+            "bytes_hashed": self.bytes_hashed,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+
+class SemanticCache:
+    """
+    A cache that answers lookups with the value of the most similar stored key vector.
+    Vectors are L2-normalized and kept in one preallocated float32 matrix, so a lookup is a single
+    matrix-vector product. When the cache is full, the least recently used slot is overwritten.
+
+    Attributes:
+    - max_entries (int): The number of slots.
+    - threshold (float): The minimum cosine similarity for a hit.
+    - ttl_seconds (float): How long an entry stays valid, 0 for forever.
+    """
+
+    def __init__(self, dimension: int, max_entries: int = 1024, threshold: float = 0.95, ttl_seconds: float = 0):
+        """
+        Initialize the SemanticCache.
+
+        Parameters:
+        - dimension (int): The length of the key vectors.
+        - max_entries (int): The number of slots.
+        - threshold (float): The minimum cosine similarity for a hit.
+        - ttl_seconds (float): How long an entry stays valid, 0 for forever.
+        """
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._vectors = np.zeros((max_entries, dimension), dtype=np.float32)
+        self._created = np.zeros(max_entries, dtype=np.float64)
+        self._accessed = np.full(max_entries, -np.inf, dtype=np.float64)
+        self._namespaces = np.full(max_entries, -1, dtype=np.int32)  # -1 marks an empty slot
+        self._namespace_ids: Dict[Any, int] = {}
+        self._values: list = [None] * max_entries
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._namespaces >= 0))
+
+    def get(self, namespace: Any, vector: np.ndarray) -> Optional[Any]:
+        """
+        Return the value of the most similar vector in the namespace, if it is similar enough.
+
+        Parameters:
+        - namespace (Any): Only entries stored under the same namespace (e.g. the model name) are considered.
+        - vector (np.ndarray): The query vector.
+
+        Returns:
+        - Optional[Any]: The cached value or None.
+        """
+        query = _normalize(vector)
+        now = time.monotonic()
+        with self._lock:
+            namespace_id = self._namespace_ids.get(namespace)
+            if namespace_id is None:
+                self.misses += 1
+                return None
+            scores = self._vectors @ query
+            valid = self._namespaces == namespace_id
+            if self.ttl_seconds:
+                valid &= now - self._created <= self.ttl_seconds
+            scores[~valid] = -np.inf
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                self.misses += 1
+                return None
+            self._accessed[slot] = now
+            self.hits += 1
+            return self._values[slot]
+
+    def put(self, namespace: Any, vector: np.ndarray, value: Any) -> None:
+        """
+        Store a value under a key vector, overwriting the least recently used slot.
+
+        Parameters:
+        - namespace (Any): The namespace of the entry.
+        - vector (np.ndarray): The key vector.
+        - value (Any): The value.
+        """
+        now = time.monotonic()
+        with self._lock:
+            slot = int(np.argmin(self._accessed))
+            self._vectors[slot] = _normalize(vector)
+            self._created[slot] = now
+            self._accessed[slot] = now
+            self._namespaces[slot] = self._namespace_ids.setdefault(namespace, len(self._namespace_ids))
+            self._values[slot] = value
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+        - Dict[str, Any]: Hits, misses, hit ratio and number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+        }
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    """Return the vector as float32 with unit length."""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class ChatResponseCache:
+    """
+    Two-tier cache for chat responses.
+    The exact tier is keyed on the model name and the normalized prompt (case and whitespace folded).
+    The optional semantic tier embeds the prompt and returns the response of a previous prompt whose
+    embedding has a cosine similarity above the threshold.
+
+    Attributes:
+    - exact (LRUCache): The exact-match tier.
+    - semantic (Optional[SemanticCache]): The semantic tier, created on the first embedded prompt.
+    - embedding_function (Embeddings): The embedding model for the semantic tier, None to disable it.
+    """
+
+    def __init__(self, embedding_function=None, max_entries: int = 1024, ttl_seconds: float = 3600,
+                 similarity_threshold: float = 0.95):
+        """
+        Initialize the ChatResponseCache.
+
+        Parameters:
+        - embedding_function (Embeddings): An embedding model with embed_query, e.g. the one of ChromaDBHandler.
+          None disables the semantic tier.
+        - max_entries (int): The maximum number of responses per tier.
+        - ttl_seconds (float): How long a response stays valid, 0 for forever.
+        - similarity_threshold (float): The minimum cosine similarity for a semantic hit.
+        """
+        self.embedding_function = embedding_function
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.exact = LRUCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.semantic: Optional[SemanticCache] = None
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """
+        Normalize a prompt for the exact tier.
+
+        Parameters:
+        - prompt (str): The prompt.
+
+        Returns:
+        - str: The prompt with case and whitespace folded.
+        """
+        return " ".join(prompt.split()).casefold()
+
+    def get_exact(self, model_name: str, prompt: str) -> Optional[str]:
+        """
+        Look up a response in the exact tier.
+
+        Parameters:
+        - model_name (str): The chat model name.
+        - prompt (str): The prompt.
+
+        Returns:
+        - Optional[str]: The cached response or None.
+        """
+        return self.exact.get((model_name, self.normalize(prompt)))
+
+    def embed(self, prompt: str) -> Optional[np.ndarray]:
+        """
+        Embed a prompt for the semantic tier. Runs the embedding model, so call it off the event loop.
+
+        Parameters:
+        - prompt (str): The prompt.
+
+        Returns:
+        - Optional[np.ndarray]: The embedding, or None if the semantic tier is disabled.
+        """
+        if self.embedding_function is None:
+            return None
+        return np.asarray(self.embedding_function.embed_query(self.normalize(prompt)), dtype=np.float32)
+
+    def get_semantic(self, model_name: str, vector: Optional[np.ndarray]) -> Optional[str]:
+        """
+        Look up a response in the semantic tier.
+
+        Parameters:
+        - model_name (str): The chat model name.
+        - vector (np.ndarray): The prompt embedding from embed().
+
+        Returns:
+        - Optional[str]: The cached response or None.
+        """
+        if vector is None or self.semantic is None:
+            return None
+        return self.semantic.get(model_name, vector)
+
+    def put(self, model_name: str, prompt: str, response: str, vector: Optional[np.ndarray] = None) -> None:
+        """
+        Store a response in the exact tier and, if an embedding is given, in the semantic tier.
+
+        Parameters:
+        - model_name (str): The chat model name.
+        - prompt (str): The prompt.
+        - response (str): The generated response.
+        - vector (np.ndarray): The prompt embedding from embed().
+        """
+        self.exact.put((model_name, self.normalize(prompt)), response)
+        if vector is not None:
+            if self.semantic is None:
+                self.semantic = SemanticCache(len(vector), max_entries=self.max_entries,
+                                              threshold=self.similarity_threshold, ttl_seconds=self.ttl_seconds)
+            self.semantic.put(model_name, vector, response)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+        - Dict[str, Any]: Statistics of both tiers and the overall hit ratio.
+        """
+        exact = self.exact.stats()
+        semantic = self.semantic.stats() if self.semantic is not None else None
+        # Every lookup goes to the exact tier first, the semantic tier only sees its misses
+        lookups = exact["hits"] + exact["misses"]
+        hits = exact["hits"] + (semantic["hits"] if semantic else 0)
+        return {
+            "exact": exact,
+            "semantic": semantic,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
+
+
+class EmbeddingCache:
+    """
+    A bounded LRU cache of query embeddings.
+    Vectors are stored in one preallocated float32 matrix per embedding model instead of Python lists,
+    entries are keyed by the embedding model name and the query text.
+
+    Attributes:
+    - max_entries (int): The maximum number of vectors per embedding model.
+    - hits (int): The number of successful lookups.
+    - misses (int): The number of failed lookups.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """
+        Initialize the EmbeddingCache.
+
+        Parameters:
+        - max_entries (int): The maximum number of vectors per embedding model.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._pools: Dict[str, np.ndarray] = {}
+        self._slots: Dict[str, "OrderedDict[str, int]"] = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, model_name: str, texts: List[str]) -> Tuple[Optional[np.ndarray], List[int]]:
+        """
+        Look up the embeddings of several texts.
+
+        Parameters:
+        - model_name (str): The embedding model name.
+        - texts (List[str]): The texts.
+
+        Returns:
+        - Tuple[Optional[np.ndarray], List[int]]: A (len(texts), dimension) matrix with the cached rows filled in
+          (None if the model has no cached vectors yet) and the indices of the texts that were not cached.
+        """
+        with self._lock:
+            pool = self._pools.get(model_name)
+            if pool is None:
+                self.misses += len(texts)
+                return None, list(range(len(texts)))
+            slots = self._slots[model_name]
+            vectors = np.empty((len(texts), pool.shape[1]), dtype=np.float32)
+            missing = []
+            for index, text in enumerate(texts):
+                slot = slots.get(text)
+                if slot is None:
+                    missing.append(index)
+                    continue
+                slots.move_to_end(text)
+                vectors[index] = pool[slot]
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+            return vectors, missing
+
+    def put_many(self, model_name: str, texts: List[str], vectors: np.ndarray) -> None:
+        """
+        Store the embeddings of several texts, overwriting the least recently used slots when full.
+
+        Parameters:
+        - model_name (str): The embedding model name.
+        - texts (List[str]): The texts.
+        - vectors (np.ndarray): A (len(texts), dimension) matrix of embeddings.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            pool = self._pools.get(model_name)
+            if pool is None:
+                pool = self._pools[model_name] = np.empty((self.max_entries, vectors.shape[1]), dtype=np.float32)
+                self._slots[model_name] = OrderedDict()
+            slots = self._slots[model_name]
+            for text, vector in zip(texts, vectors):
+                slot = slots.pop(text, None)
+                if slot is None:
+                    slot = len(slots) if len(slots) < self.max_entries else slots.popitem(last=False)[1]
+                slots[text] = slot
+                pool[slot] = vector
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+        - Dict[str, Any]: Hits, misses, hit ratio, number of entries and the size of the vector pools.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": sum(len(slots) for slots in self._slots.values()),
+            "bytes": sum(pool.nbytes for pool in self._pools.values()),
+        }
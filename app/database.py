@@ -1,8 +1,33 @@
 import os
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import TextLoader
-from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-from langchain_text_splitters import CharacterTextSplitter
+import hashlib
+import json
+import logging
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from langchain_core.documents import Document
+from app.cache import EmbeddingCache
+from app.embedding_pool import ParallelEmbedder
+from app.metrics import track_stage
+from app.registry import embedding_registry
+from app.sharding import ShardedVectorStore
+from app.snapshot import Snapshot, SnapshotError, live_rows, write_snapshot
+from app.splitter import StreamingTextSplitter, tokenizer_length
+from app.vector_index import EXPORT_PAGE_SIZE, VectorStore
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+VECTOR_BACKENDS = ("chroma", "numpy", "sharded")
+
+# The subdirectory of the persist directory holding the shards of the sharded backend
+VECTOR_SHARDS_DIR = "vector_shards"
+
+# What chunk_size and chunk_overlap are measured in
+CHUNK_UNITS = ("characters", "tokens")
+
+# Records the snapshot the persisted database was last brought to, so deltas are only applied to their base
+SNAPSHOT_STATE_FILE = "snapshot.json"
 
 class ChromaDBHandler:
     """
@@ -10,16 +35,54 @@ class ChromaDBHandler:
 
     Attributes:
     - model_name (str): The name of the sentence transformer model to use.
-    - chunk_size (int): The maximum number of characters in a chunk.
-    - chunk_overlap (int): The number of characters to overlap between chunks.
+    - chunk_size (int): The maximum number of characters (or tokens) in a chunk.
+    - chunk_overlap (int): The number of characters (or tokens) to overlap between chunks.
     - persist_directory (str): The directory to persist the database to.
+    - query_cache_size (int): The number of query embeddings kept in memory, 0 to disable the cache.
+    - ingest_batch_size (int): The number of chunks embedded and upserted at a time during ingestion.
+    - ingest_workers (int): The number of embedding worker processes for ingest_files, 0 to embed in-process.
+    - vector_store (Union[VectorStore, ShardedVectorStore]): The index searches go through, in-process or split
+      across shard processes, None to search Chroma directly. Ingestions update it in place.
+    - revision (int): Incremented whenever an ingestion adds or removes chunks, to invalidate derived caches.
+    - snapshot_id (str): The ID of the last snapshot imported, None if the database changed since or never imported one.
+    - registry (ModelRegistry): The registry the embedding model is taken from, the process-wide one by default.
     """
-    def __init__(self, model_name, persist_directory, chunk_size, chunk_overlap):
+    def __init__(self, model_name, persist_directory, chunk_size, chunk_overlap, query_cache_size: int = 1024,
+                 ingest_batch_size: int = 64, ingest_workers: int = 0, vector_backend: str = "chroma",
+                 ivf_threshold: int = 10000, ivf_probes: int = 8, vector_precision: str = "float32",
+                 vector_shards: int = 2, shard_timeout: float = 1.0, chunk_unit: str = "characters",
+                 registry=None):
+        self.model_name = model_name
         self.persist_directory = persist_directory
-        self.embedding_function = SentenceTransformerEmbeddings(model_name=model_name)
-        self.text_splitter = CharacterTextSplitter(separator='\n', chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        # The model is shared through the registry, so it is loaded once per process (or once before forking)
+        self.registry = registry if registry is not None else embedding_registry
+        self.embedding_function = self.registry.get(model_name)
+        self.query_cache = EmbeddingCache(max_entries=query_cache_size)
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_workers = ingest_workers
+        if vector_backend not in VECTOR_BACKENDS:
+            raise ValueError(f"Unknown vector backend {vector_backend!r}, expected one of {VECTOR_BACKENDS}")
+        self.vector_store = None
+        if vector_backend == "numpy":
+            self.vector_store = VectorStore(
+                os.path.join(persist_directory, "vector_index"), ivf_threshold=ivf_threshold, n_probe=ivf_probes,
+                precision=vector_precision,
+            )
+        elif vector_backend == "sharded":
+            self.vector_store = ShardedVectorStore(
+                os.path.join(persist_directory, VECTOR_SHARDS_DIR), shards=vector_shards, ivf_threshold=ivf_threshold,
+                n_probe=ivf_probes, precision=vector_precision, timeout=shard_timeout,
+            )
+        if chunk_unit not in CHUNK_UNITS:
+            raise ValueError(f"Unknown chunk unit {chunk_unit!r}, expected one of {CHUNK_UNITS}")
+        # Token sizes are counted with the embedding model's own tokenizer, so chunks fit its input length
+        length_function = tokenizer_length(self.embedding_function) if chunk_unit == "tokens" else len
+        self.text_splitter = StreamingTextSplitter(chunk_size, chunk_overlap, length_function=length_function)
         self.db = None
         self.docs = None
+        self.revision = 0
+        self.snapshot_id = self._read_snapshot_id()
+        self._sync_thread = None
         self._initialize_db()
 
     def _initialize_db(self):
@@ -39,6 +102,7 @@ class ChromaDBHandler:
         Parameters:
         - file_path (str): The path to the document file.
         """
+        from langchain_community.document_loaders import TextLoader
         try:
             loader = TextLoader(file_path)
             documents = loader.load()
@@ -56,6 +120,7 @@ class ChromaDBHandler:
         if self.docs is None:
             print("No documents loaded. Please load documents first.")
             return
+        from langchain_chroma import Chroma
         self.db = Chroma.from_documents(self.docs, self.embedding_function)
 
     def similarity_search(self, query, k=3):
@@ -72,7 +137,67 @@ class ChromaDBHandler:
         if self.db is None:
             print("Database not initialized. Please create or load the database first.")
             return []
-        return self.db.similarity_search(query, k=k)
+        embedding = self.embed_queries([query])[0]
+        with track_stage("vector_search"):
+            if self.vector_store is not None:
+                return self.vector_store.search(embedding[None, :], k)[0]
+            return self.db.similarity_search_by_vector(embedding.tolist(), k=k)
+
+    def embed_queries(self, queries: Sequence[str]) -> np.ndarray:
+        """
+        Embeds queries, taking repeated queries from the query cache.
+        Only queries that are not cached go through the embedding model, in one batch.
+
+        Parameters:
+        - queries (Sequence[str]): The queries to embed.
+
+        Returns:
+        - np.ndarray: A float32 matrix with one embedding per query.
+        """
+        queries = list(queries)
+        vectors, missing = self.query_cache.get_many(self.model_name, queries)
+        if missing:
+            # Embed each distinct missing query once
+            texts = list(dict.fromkeys(queries[index] for index in missing))
+            with track_stage("query_embedding"):
+                computed = np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+            self.query_cache.put_many(self.model_name, texts, computed)
+            rows = {text: row for text, row in zip(texts, computed)}
+            if vectors is None:
+                vectors = np.empty((len(queries), computed.shape[1]), dtype=np.float32)
+            for index in missing:
+                vectors[index] = rows[queries[index]]
+        return vectors
+
+    def similarity_search_batch(self, queries: Sequence[str], k: Union[int, Sequence[int]] = 3) -> List[List[Document]]:
+        """
+        Performs a similarity search for several queries at once.
+        All uncached queries are embedded in one batch and looked up in one multi-query call to the collection.
+
+        Parameters:
+        - queries (Sequence[str]): The queries to search for.
+        - k (Union[int, Sequence[int]]): The number of results to return, for all queries or per query.
+
+        Returns:
+        - List[List[Document]]: For each query, the list of k documents that match it.
+        """
+        if self.db is None:
+            print("Database not initialized. Please create or load the database first.")
+            return [[] for _ in queries]
+        if not queries:
+            return []
+        ks = [k] * len(queries) if isinstance(k, int) else list(k)
+        embeddings = self.embed_queries(queries)
+        with track_stage("vector_search"):
+            if self.vector_store is not None:
+                return self.vector_store.search(embeddings, ks)
+            result = self.db._collection.query(
+                query_embeddings=embeddings.tolist(), n_results=max(ks), include=["documents", "metadatas"]
+            )
+        return [
+            [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts[:n], metadatas[:n])]
+            for texts, metadatas, n in zip(result["documents"], result["metadatas"], ks)
+        ]
 
     def save_to_disk(self):
         """
@@ -81,26 +206,435 @@ class ChromaDBHandler:
         if self.docs is None:
             print("No documents to save. Please load documents first.")
             return
+        from langchain_chroma import Chroma
         self.db = Chroma.from_documents(self.docs, self.embedding_function, persist_directory=self.persist_directory)
 
+    def ingest_files(self, file_paths: Iterable[str], batch_size: int = None, workers: int = None,
+                     sources: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """
+        Incrementally adds text files to the persisted database.
+        Files are read one at a time, so memory is bounded by the largest file rather than the corpus.
+        With more than one worker, chunks are embedded by a pool of worker processes while this process
+        stays the only writer to the collection.
+
+        Parameters:
+        - file_paths (Iterable[str]): The paths of the text files.
+        - batch_size (int): The number of chunks embedded and upserted at a time. Defaults to ingest_batch_size.
+        - workers (int): The number of embedding worker processes, 0 or 1 to embed in-process. Defaults to ingest_workers.
+        - sources (Iterable[str]): The names the files are stored under, e.g. the names of uploads kept in
+          temporary files. Defaults to the paths. Re-ingesting the same source replaces its chunks.
+
+        Returns:
+        - Dict[str, int]: The number of files and chunks processed, and of chunks added, unchanged and removed.
+        """
+        stats = {"files": 0, "chunks": 0, "added": 0, "unchanged": 0, "removed": 0}
+
+        named = ((path, path) for path in file_paths) if sources is None else zip(file_paths, sources)
+
+        def documents() -> Iterator[Tuple[str, Iterable[str]]]:
+            for file_path, source in named:
+                stats["files"] += 1
+                # Files are split while they are read, chunk texts are all that is kept
+                yield source, (chunk.text for chunk in self.text_splitter.split_file(file_path))
+
+        self._ingest(documents(), stats, batch_size, self.ingest_workers if workers is None else workers)
+        return stats
+
+    def ingest_text(self, text: str, source: str, batch_size: int = None) -> Dict[str, int]:
+        """
+        Splits a document and upserts its new or changed chunks into the persisted database.
+        Chunks are identified by a hash of their source and content, so chunks that are already stored
+        are not embedded again, and chunks that are no longer part of the source are deleted.
+
+        Parameters:
+        - text (str): The content of the document.
+        - source (str): The name of the document, e.g. its path. Re-ingesting the same source replaces its chunks.
+        - batch_size (int): The number of chunks embedded and upserted at a time. Defaults to ingest_batch_size.
+
+        Returns:
+        - Dict[str, int]: The number of chunks processed, added, unchanged and removed.
+        """
+        stats = {"chunks": 0, "added": 0, "unchanged": 0, "removed": 0}
+        self._ingest([(source, self.text_splitter.split_text(text))], stats, batch_size, workers=0)
+        return stats
+
+    def _ingest(self, documents: Iterable[Tuple[str, Iterable[str]]], stats: Dict[str, int], batch_size: int = None,
+                workers: int = 0) -> None:
+        """Embed the new chunks of the documents, in-process or in worker processes, and upsert them in order."""
+        batch_size = batch_size or self.ingest_batch_size
+        collection = self._persistent_collection()
+        # The chunks written to the collection are added to (and the deleted ones removed from) the index as
+        # well, so the index is updated in place instead of rebuilt from the collection
+        writer = self.vector_store.writer() if self.vector_store is not None else None
+        try:
+            batches = self._plan_batches(collection, documents, batch_size, stats, writer)
+            with track_stage("document_ingest"):
+                if workers > 1:
+                    # The workers load the model the same way (and with the same precision) as this process
+                    factory = self.registry.factory(self.model_name)
+                    with ParallelEmbedder(factory, workers=workers, batch_size=batch_size) as embedder:
+                        self._write(collection, embedder.map(batches), stats, writer)
+                else:
+                    embedded = ((tag, self.embedding_function.embed_documents(texts)) for tag, texts in batches)
+                    self._write(collection, embedded, stats, writer)
+        finally:
+            # Also applied after a failure, so the index holds what reached the collection
+            if stats["added"] or stats["removed"]:
+                self._refresh(writer)
+                # Local changes leave the last imported snapshot behind, deltas of it no longer apply
+                if self.snapshot_id is not None:
+                    self._write_snapshot_id(None)
+            elif writer is not None:
+                writer.discard()
+
+    def _refresh(self, writer) -> None:
+        """Apply the index change of an ingestion or import once its chunks are in the collection."""
+        if writer is not None:
+            with track_stage("vector_index_update"):
+                writer.commit()
+        # Bumped once the new chunks are searchable, so contexts cached under it are current
+        self.revision += 1
+
+    def _plan_batches(self, collection, documents: Iterable[Tuple[str, Iterable[str]]], batch_size: int,
+                      stats: Dict[str, int], writer=None) -> Iterator[Tuple[tuple, List[str]]]:
+        """
+        Yield batches of the documents' chunks that are not stored yet, tagged with their source and IDs.
+        Chunks that are no longer part of a source are deleted once all its chunks were seen.
+        """
+        for source, chunks in documents:
+            existing = set(collection.get(where={"source": source}, include=[])["ids"])
+            seen = set()
+            batch: List[Tuple[str, str]] = []
+            for chunk_id, chunk in self._chunk_ids(source, chunks):
+                stats["chunks"] += 1
+                seen.add(chunk_id)
+                if chunk_id in existing:
+                    stats["unchanged"] += 1
+                    continue
+                batch.append((chunk_id, chunk))
+                if len(batch) >= batch_size:
+                    yield self._batch(source, batch)
+                    batch = []
+            if batch:
+                yield self._batch(source, batch)
+
+            stale = list(existing - seen)
+            if stale:
+                collection.delete(ids=stale)
+                if writer is not None:
+                    writer.remove(stale)
+                stats["removed"] += len(stale)
+
+    @staticmethod
+    def _batch(source: str, batch: List[Tuple[str, str]]) -> Tuple[tuple, List[str]]:
+        """Turn (id, chunk) pairs into a ((source, ids, texts), texts) embedding job."""
+        ids = [chunk_id for chunk_id, _ in batch]
+        texts = [chunk for _, chunk in batch]
+        return (source, ids, texts), texts
+
+    @staticmethod
+    def _chunk_ids(source: str, chunks: Iterable[str]) -> Iterator[Tuple[str, str]]:
+        """Yield a content-hash ID for every chunk; repeated chunks in a source get distinct IDs."""
+        occurrences: Dict[str, int] = {}
+        for chunk in chunks:
+            occurrence = occurrences.get(chunk, 0)
+            occurrences[chunk] = occurrence + 1
+            digest = hashlib.sha256(f"{source}\0{occurrence}\0{chunk}".encode()).hexdigest()
+            yield digest, chunk
+
+    @staticmethod
+    def _write(collection, embedded: Iterable[Tuple[tuple, Sequence]], stats: Dict[str, int], writer=None) -> None:
+        """
+        Upsert embedded batches into the collection, and add them to the index change if there is one.
+        This is the only place ingestion writes chunks.
+        """
+        for (source, ids, texts), vectors in embedded:
+            metadatas = [{"source": source} for _ in ids]
+            collection.upsert(
+                ids=ids,
+                # Copies vectors out of the embedder's shared memory before the slot is reused
+                embeddings=vectors.tolist() if isinstance(vectors, np.ndarray) else vectors,
+                documents=texts,
+                metadatas=metadatas,
+            )
+            if writer is not None:
+                writer.add(ids, np.asarray(vectors, dtype=np.float32), texts, metadatas)
+            stats["added"] += len(ids)
+
+    def export_snapshot(self, path: str, base: Optional[str] = None, precision: str = "float32") -> Dict[str, Any]:
+        """
+        Write the persisted database to a snapshot directory, in full or as a delta to an earlier snapshot.
+        A delta holds the chunks added since the base and the IDs of those removed; chunk IDs are content
+        hashes, so a changed chunk is a removal plus an addition.
+
+        Parameters:
+        - path (str): The snapshot directory to create; it must not exist.
+        - base (str): The directory of an earlier snapshot (full or delta) to write a delta to, None for a full snapshot.
+        - precision (str): The storage type of the vectors, 'float32' or 'float16'.
+
+        Returns:
+        - Dict[str, Any]: The snapshot ID, and the number of records written and removed.
+
+        Raises:
+        - SnapshotError: If the base snapshot is unreadable or was made with another embedding model.
+        """
+        collection = self._persistent_collection()
+        with track_stage("snapshot_export"):
+            result = collection.get(include=["embeddings", "documents", "metadatas"])
+            ids = result["ids"]
+            rows, removed, base_id = list(range(len(ids))), [], None
+            if base is not None:
+                base_snapshot = Snapshot.open(base, verify=False)
+                if base_snapshot.model != self.model_name:
+                    raise SnapshotError(f"Snapshot {base} was made with {base_snapshot.model}, not {self.model_name}")
+                base_ids = set(base_snapshot.state_ids())
+                rows = [row for row, record_id in enumerate(ids) if record_id not in base_ids]
+                removed = sorted(base_ids.difference(ids))
+                base_id = base_snapshot.id
+            vectors = np.asarray(result["embeddings"], dtype=np.float32)
+            snapshot_id = write_snapshot(
+                path, self.model_name, [ids[row] for row in rows], vectors[rows] if len(vectors) else vectors,
+                [result["documents"][row] for row in rows], [result["metadatas"][row] for row in rows],
+                state_ids=ids, removed=removed, base=base_id, precision=precision,
+            )
+        return {"id": snapshot_id, "records": len(rows), "removed": len(removed)}
+
+    def import_snapshot(self, path: str, verify: bool = True, batch_size: int = None) -> Dict[str, int]:
+        """
+        Bring the persisted database to the state of a snapshot without embedding anything.
+        A full snapshot replaces the content of the database; a delta only applies to the database
+        state of its base snapshot. Chunks that are already stored are not written again.
+
+        Parameters:
+        - path (str): The snapshot directory.
+        - verify (bool): Check the checksums of the snapshot files first.
+        - batch_size (int): The number of chunks upserted at a time. Defaults to ingest_batch_size.
+
+        Returns:
+        - Dict[str, int]: The number of chunks added, unchanged and removed.
+
+        Raises:
+        - SnapshotError: If the snapshot is corrupt, was made with another embedding model or is a delta
+          to another state than the database's.
+        """
+        snapshot = Snapshot.open(path, verify=verify)
+        stats = {"added": 0, "unchanged": 0, "removed": 0}
+        if snapshot.model != self.model_name:
+            raise SnapshotError(f"Snapshot {path} was made with {snapshot.model}, not {self.model_name}")
+        if snapshot.id == self.snapshot_id:
+            return stats
+        if snapshot.base is not None and snapshot.base != self.snapshot_id:
+            raise SnapshotError(
+                f"Snapshot {path} is a delta to snapshot {snapshot.base}, the database is at {self.snapshot_id}"
+            )
+        collection = self._persistent_collection()
+        writer = self.vector_store.writer() if self.vector_store is not None else None
+        try:
+            with track_stage("snapshot_import"):
+                stats = self._apply_snapshot(collection, snapshot, batch_size or self.ingest_batch_size, writer)
+        except BaseException:
+            if writer is not None:
+                writer.discard()
+            raise
+        if stats["added"] or stats["removed"]:
+            self._refresh(writer)
+        elif writer is not None:
+            writer.discard()
+        self._write_snapshot_id(snapshot.id)
+        return stats
+
+    @staticmethod
+    def _apply_snapshot(collection, snapshot: Snapshot, batch_size: int, writer=None) -> Dict[str, int]:
+        """
+        Write the records of a snapshot to the collection and delete the ones its state does not hold,
+        recording both in the index change if there is one.
+        """
+        stats = {"added": 0, "unchanged": 0, "removed": 0}
+        if snapshot.base is None:
+            stale = list(set(collection.get(include=[])["ids"]).difference(snapshot.state_ids()))
+        else:
+            stale = snapshot.removed()
+        if stale:
+            collection.delete(ids=stale)
+            if writer is not None:
+                writer.remove(stale)
+            stats["removed"] += len(stale)
+        for ids, vectors, texts, metadatas in snapshot.batches(batch_size):
+            existing = set(collection.get(ids=ids, include=[])["ids"])
+            rows = [row for row, record_id in enumerate(ids) if record_id not in existing]
+            stats["unchanged"] += len(ids) - len(rows)
+            if not rows:
+                continue
+            collection.upsert(
+                ids=[ids[row] for row in rows],
+                embeddings=vectors[rows].tolist(),
+                documents=[texts[row] for row in rows],
+                metadatas=[metadatas[row] for row in rows],
+            )
+            if writer is not None:
+                writer.add([ids[row] for row in rows], vectors[rows], [texts[row] for row in rows],
+                           [metadatas[row] for row in rows])
+            stats["added"] += len(rows)
+        return stats
+
+    def import_snapshots(self, paths: Sequence[str], verify: bool = True, background_sync: bool = False) -> int:
+        """
+        Catch up with a chain of snapshots: a full snapshot followed by deltas, each to the one before.
+        Snapshots up to the one the database is already at are skipped.
+
+        Writing the records to Chroma takes time proportional to the corpus. With background_sync, the numpy
+        and sharded backends instead serve searches from the snapshots as soon as they are opened, and Chroma
+        is brought to their state in a background thread. Ingestions and exports wait for it.
+
+        Parameters:
+        - paths (Sequence[str]): The snapshot directories, oldest first.
+        - verify (bool): Check the checksums of the applied snapshots.
+        - background_sync (bool): Serve from the snapshots and write them to Chroma in the background, if the
+          backend is not Chroma and the snapshots to apply start with a full snapshot.
+
+        Returns:
+        - int: The number of snapshots applied.
+
+        Raises:
+        - SnapshotError: If a snapshot is corrupt, was made with another embedding model or does not apply
+          to the state before it.
+        """
+        ids = [Snapshot.open(path, verify=False).id for path in paths]
+        start = ids.index(self.snapshot_id) + 1 if self.snapshot_id in ids else 0
+        pending = list(paths[start:])
+        if background_sync and self.vector_store is not None and pending:
+            snapshots = [Snapshot.open(path, verify=verify) for path in pending]
+            if snapshots[0].base is None:
+                self._serve_snapshots(snapshots)
+                self._sync_thread = threading.Thread(
+                    target=self._sync_snapshots, args=(snapshots,), name="snapshot-sync", daemon=True,
+                )
+                self._sync_thread.start()
+                return len(pending)
+        for path in pending:
+            self.import_snapshot(path, verify=verify)
+        return len(pending)
+
+    def _serve_snapshots(self, snapshots: Sequence[Snapshot]) -> None:
+        """Point the vector store at the final state of a chain of snapshots that starts with a full snapshot."""
+        for previous, snapshot in zip([None] + list(snapshots), snapshots):
+            if snapshot.model != self.model_name:
+                raise SnapshotError(f"Snapshot {snapshot.path} was made with {snapshot.model}, not {self.model_name}")
+            if previous is not None and snapshot.base != previous.id:
+                raise SnapshotError(f"Snapshot {snapshot.path} is a delta to {snapshot.base}, not to {previous.id}")
+        rows = live_rows(snapshots)
+        with track_stage("snapshot_import"):
+            if isinstance(self.vector_store, VectorStore):
+                self.vector_store.serve_snapshots(snapshots, rows)
+            else:
+                # Shard processes load their own index files, so the live records are streamed to the shards
+                writer = self.vector_store.writer(replace=True)
+                try:
+                    for snapshot, live in zip(snapshots, rows):
+                        for start in range(0, len(live), EXPORT_PAGE_SIZE):
+                            page = live[start:start + EXPORT_PAGE_SIZE]
+                            records = [snapshot.record(row) for row in page]
+                            writer.add(
+                                [record["id"] for record in records],
+                                np.asarray(snapshot.vectors[page], dtype=np.float32),
+                                [record["text"] for record in records],
+                                [record["metadata"] for record in records],
+                            )
+                except BaseException:
+                    writer.discard()
+                    raise
+                writer.commit()
+        # Bumped once the snapshot records are searchable, so contexts cached under it are current
+        self.revision += 1
+        logger.info(f"Serving {len(snapshots)} snapshots while the database catches up in the background")
+
+    def _sync_snapshots(self, snapshots: Sequence[Snapshot]) -> None:
+        """Bring the collection to the state of served snapshots, then rebuild the in-process index from it."""
+        try:
+            collection = self._persistent_collection()
+            for snapshot in snapshots:
+                with track_stage("snapshot_sync"):
+                    stats = self._apply_snapshot(collection, snapshot, self.ingest_batch_size)
+                # The collection is at this snapshot now, a restart continues after it
+                self._write_snapshot_id(snapshot.id)
+                logger.info(f"Synced snapshot {snapshot.id} to the database: {stats}")
+            if isinstance(self.vector_store, VectorStore):
+                # Writes the index for the next start, with IVF for large corpora
+                with track_stage("vector_index_build"):
+                    self.vector_store.build_from_collection(collection)
+        except Exception as e:
+            logger.error(f"Syncing snapshots to the database failed: {str(e)}")
+
+    def _read_snapshot_id(self) -> Optional[str]:
+        """Read the ID of the last imported snapshot from the persist directory."""
+        path = os.path.join(self.persist_directory, SNAPSHOT_STATE_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as file:
+            return json.load(file).get("id")
+
+    def _write_snapshot_id(self, snapshot_id: Optional[str]) -> None:
+        """Record the snapshot the persisted database is at."""
+        os.makedirs(self.persist_directory, exist_ok=True)
+        path = os.path.join(self.persist_directory, SNAPSHOT_STATE_FILE)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump({"id": snapshot_id}, file)
+        os.replace(f"{path}.tmp", path)
+        self.snapshot_id = snapshot_id
+
+    def _persistent_collection(self):
+        """Return the collection of the persisted database, creating the database if necessary."""
+        sync = self._sync_thread
+        if sync is not None and sync is not threading.current_thread():
+            # Snapshots being written in the background come first, so writers see their records
+            sync.join()
+        if self.db is None:
+            self.load_from_disk()
+        return self.db._collection
+
     def load_from_disk(self):
         """
         Load Chroma DB from disk.
         """
+        from langchain_chroma import Chroma
         self.db = Chroma(persist_directory=self.persist_directory, embedding_function=self.embedding_function)
+        if self.vector_store is not None:
+            self._load_vector_store()
+
+    def _load_vector_store(self):
+        """
+        Memory-map the index (in this process or the shard processes), rebuilding it if it is missing, out of
+        sync with the collection or stored with another precision than configured.
+        """
+        collection = self.db._collection
+        # Processes starting together check (and rebuild) the index one at a time, so only the first rebuilds
+        with self.vector_store.lock():
+            if self.vector_store.exists():
+                self.vector_store.load()
+                if (self.vector_store.size == collection.count()
+                        and self.vector_store.stored_precision == self.vector_store.precision):
+                    return
+            with track_stage("vector_index_build"):
+                self.vector_store.build_from_collection(collection)
+
+    def close(self) -> None:
+        """
+        Release the vector store: stop the shard processes this process started, or close its connections
+        to shared ones.
+        """
+        if isinstance(self.vector_store, ShardedVectorStore):
+            self.vector_store.close()
 
 # Example usage
 if __name__ == "__main__":
-    handler = ChromaDBHandler()
+    handler = ChromaDBHandler(
+        model_name="all-MiniLM-L6-v2", persist_directory="./chroma_db", chunk_size=60, chunk_overlap=0
+    )
     query = "What is a group of flamingos called?"
-    # Load documents and create the database
-    handler.load_documents("./tests/sample_data /test.txt")
-    handler.create_db()
-
-    # Save to disk
-    handler.save_to_disk()
-    
-    # Load from disk and perform another similarity search
+    # Add the documents to the persisted database, only new or changed chunks are embedded
+    print(handler.ingest_files(["./tests/sample_data/test.txt"]))
+
+    # Load from disk and perform a similarity search
     handler.load_from_disk()
     docs = handler.similarity_search(query, k=3)
     for index, doc in enumerate(docs):
@@ -0,0 +1,164 @@
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Per-process state of an embedding worker
+_worker_embeddings = None
+_worker_blocks: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _init_worker(embedding_factory: Callable[[], Any], threads: int) -> None:
+    """Load the embedding model once per worker process and limit its intra-op threads."""
+    global _worker_embeddings
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_embeddings = embedding_factory()
+
+
+def _dimension() -> int:
+    """Return the length of the vectors produced by the worker's embedding model."""
+    return len(_worker_embeddings.embed_query("dimension probe"))
+
+
+def _embed_into(texts: List[str], block_name: str, shape: Tuple[int, int, int], slot: int) -> int:
+    """Embed a batch and write the vectors into a slot of the shared memory block. Returns the number of rows."""
+    block = _worker_blocks.get(block_name)
+    if block is None:
+        block = shared_memory.SharedMemory(name=block_name)
+        # The parent owns the block; keep this process's resource tracker from unlinking it on exit
+        resource_tracker.unregister(block._name, "shared_memory")
+        _worker_blocks[block_name] = block
+    vectors = np.ndarray(shape, dtype=np.float32, buffer=block.buf)
+    vectors[slot, :len(texts)] = np.asarray(_worker_embeddings.embed_documents(texts), dtype=np.float32)
+    return len(texts)
+
+
+class ParallelEmbedder:
+    """
+    A pool of embedding worker processes for bulk ingestion.
+
+    Every worker loads the embedding model once. Batches are handed to the workers through a bounded
+    in-flight window; workers write their vectors into slots of one shared memory block, so vectors are
+    not pickled on the way back. The caller consumes the vectors in submission order, which keeps a
+    single writer in charge of the database.
+
+    Attributes:
+    - workers (int): The number of worker processes.
+    - batch_size (int): The maximum number of texts per batch.
+    - dimension (int): The length of the embedding vectors, known after start().
+    """
+
+    def __init__(self, embedding_factory: Callable[[], Any], workers: int = 0, batch_size: int = 64,
+                 threads_per_worker: int = 0, start_method: str = "spawn"):
+        """
+        Initialize the ParallelEmbedder.
+
+        Parameters:
+        - embedding_factory (Callable[[], Any]): Picklable callable that creates the embedding model in a worker,
+          e.g. functools.partial(SentenceTransformerEmbeddings, model_name=...).
+        - workers (int): The number of worker processes, 0 for one per CPU core.
+        - batch_size (int): The maximum number of texts per batch.
+        - threads_per_worker (int): Intra-op threads per worker, 0 to split the CPU cores evenly between workers.
+        - start_method (str): The multiprocessing start method. 'spawn' avoids forking a process with torch threads.
+        """
+        cpus = os.cpu_count() or 1
+        self.embedding_factory = embedding_factory
+        self.workers = workers or cpus
+        self.batch_size = batch_size
+        self.threads_per_worker = threads_per_worker or max(1, cpus // self.workers)
+        self.start_method = start_method
+        self.dimension: Optional[int] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._block: Optional[shared_memory.SharedMemory] = None
+        self._vectors: Optional[np.ndarray] = None
+
+    @property
+    def slots(self) -> int:
+        """The number of batches in flight, two per worker so workers never wait for the writer."""
+        return 2 * self.workers
+
+    def start(self) -> "ParallelEmbedder":
+        """
+        Start the workers, load the model in each of them and allocate the shared memory block.
+
+        Returns:
+        - ParallelEmbedder: The started embedder.
+        """
+        if self._executor is not None:
+            return self
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=_init_worker,
+            initargs=(self.embedding_factory, self.threads_per_worker),
+        )
+        self.dimension = self._executor.submit(_dimension).result()
+        shape = (self.slots, self.batch_size, self.dimension)
+        self._block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        self._vectors = np.ndarray(shape, dtype=np.float32, buffer=self._block.buf)
+        logger.info(f"Started {self.workers} embedding workers ({self.threads_per_worker} threads each)")
+        return self
+
+    def map(self, batches: Iterable[Tuple[Any, List[str]]]) -> Iterator[Tuple[Any, np.ndarray]]:
+        """
+        Embed batches in parallel and yield their vectors in submission order.
+        The batches iterable is consumed lazily, at most `slots` batches are in flight.
+
+        Parameters:
+        - batches (Iterable[Tuple[Any, List[str]]]): Pairs of a tag (passed through) and up to batch_size texts.
+
+        Yields:
+        - Tuple[Any, np.ndarray]: The tag and a (len(texts), dimension) float32 view into shared memory.
+          The view is only valid until the next batch is requested; copy it to keep it.
+        """
+        self.start()
+        free = list(range(self.slots))
+        pending = deque()
+        batches = iter(batches)
+        exhausted = False
+        while True:
+            while free and not exhausted:
+                try:
+                    tag, texts = next(batches)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if len(texts) > self.batch_size:
+                    raise ValueError(f"Batch of {len(texts)} texts exceeds batch_size {self.batch_size}")
+                slot = free.pop()
+                future = self._executor.submit(_embed_into, list(texts), self._block.name, self._vectors.shape, slot)
+                pending.append((tag, future, slot))
+            if not pending:
+                return
+            tag, future, slot = pending.popleft()
+            rows = future.result()
+            yield tag, self._vectors[slot, :rows]
+            free.append(slot)
+
+    def close(self) -> None:
+        """Stop the workers and release the shared memory block."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._block is not None:
+            self._vectors = None
+            self._block.close()
+            self._block.unlink()
+            self._block = None
+
+    def __enter__(self) -> "ParallelEmbedder":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
@@ -0,0 +1,464 @@
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+import httpx
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Fields of a job that are returned to clients and sent to webhooks
+PUBLIC_FIELDS = ("id", "status", "priority", "created", "started", "finished", "result", "error")
+
+
+def check_webhook_url(url: str, allowed_hosts: Sequence[str] = ()) -> None:
+    """
+    Refuse webhook URLs the job workers must not call.
+    If allowed_hosts is given, only those hosts are accepted. Otherwise the host must resolve to public
+    addresses only, so clients cannot make the server POST to loopback, private or link-local services
+    (e.g. a cloud metadata endpoint). Resolving the host blocks, call it off the event loop.
+
+    Parameters:
+    - url (str): The webhook URL.
+    - allowed_hosts (Sequence[str]): Lower-case host names or addresses webhooks may be sent to, empty for any public host.
+
+    Raises:
+    - ValueError: If the URL is not allowed.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Webhook URL {url} is not an http(s) URL with a host")
+    host = parts.hostname.lower()
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise ValueError(f"Webhook host {host} is not allowed")
+        return
+    try:
+        addresses = socket.getaddrinfo(
+            host, parts.port or (443 if parts.scheme == "https" else 80), type=socket.SOCK_STREAM,
+        )
+    except socket.gaierror as e:
+        raise ValueError(f"Webhook host {host} cannot be resolved: {str(e)}")
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"Webhook host {host} resolves to the non-public address {address}")
+
+
+def job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Strip the internal fields (audio path, webhook URL, worker) from a job.
+
+    Parameters:
+    - job (Dict[str, Any]): A job as returned by JobStore.
+
+    Returns:
+    - Dict[str, Any]: The fields of the job that are shown to clients.
+    """
+    return {field: job[field] for field in PUBLIC_FIELDS}
+
+
+class JobStore:
+    """
+    A persistent priority queue of transcription jobs in a SQLite file, shared by the API process
+    that submits jobs and the worker processes that run them.
+
+    Uploads are kept in an audio directory next to the database until their job has run. Jobs are
+    claimed highest priority first, oldest first within a priority, in an immediate transaction so two
+    workers never claim the same job. Finished jobs are kept for ttl_seconds and then purged.
+
+    Attributes:
+    - directory (str): The directory holding the database and the uploads.
+    - ttl_seconds (float): How long a finished job stays available, 0 for forever.
+    - max_attempts (int): How often a job is retried after its worker died before it is marked failed.
+    - webhook_hosts (Tuple[str, ...]): The hosts webhooks may be sent to, empty for any public host.
+    """
+
+    def __init__(self, directory: str, ttl_seconds: float = 86400, max_attempts: int = 2,
+                 webhook_hosts: Sequence[str] = ()):
+        """
+        Initialize the JobStore, creating the database and the audio directory if necessary.
+
+        Parameters:
+        - directory (str): The directory holding the database and the uploads.
+        - ttl_seconds (float): How long a finished job stays available, 0 for forever.
+        - max_attempts (int): How often a job is retried after its worker died before it is marked failed.
+        - webhook_hosts (Sequence[str]): The hosts webhooks may be sent to, empty for any public host.
+        """
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_attempts = max_attempts
+        self.webhook_hosts = tuple(host.strip().lower() for host in webhook_hosts if host.strip())
+        os.makedirs(os.path.join(directory, "audio"), exist_ok=True)
+        self._lock = threading.Lock()
+        # Autocommit mode, transactions are opened explicitly where several statements must be atomic
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "jobs.sqlite3"), check_same_thread=False, isolation_level=None, timeout=30,
+        )
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL, audio_path TEXT NOT NULL, "
+            "webhook_url TEXT, created REAL NOT NULL, started REAL, finished REAL, expires REAL, "
+            "worker TEXT, attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires)")
+
+    def new_audio_path(self, filename: str = "") -> str:
+        """
+        Reserve a path for an upload, keeping the file extension so ffmpeg can detect the container.
+
+        Parameters:
+        - filename (str): The name of the uploaded file.
+
+        Returns:
+        - str: A new path in the audio directory.
+        """
+        suffix = os.path.splitext(filename or "")[1].lower()
+        return os.path.join(self.directory, "audio", f"{uuid.uuid4().hex}{suffix}")
+
+    def submit(self, audio_path: str, priority: int = 0, webhook_url: Optional[str] = None) -> str:
+        """
+        Queue a transcription job.
+
+        Parameters:
+        - audio_path (str): The stored upload, owned by the job from now on.
+        - priority (int): Jobs with a higher priority run first.
+        - webhook_url (str): Optional URL the finished job is POSTed to.
+
+        Returns:
+        - str: The ID of the job.
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO jobs (id, status, priority, audio_path, webhook_url, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, priority, audio_path, webhook_url, time.time()),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a job.
+
+        Parameters:
+        - job_id (str): The ID of the job.
+
+        Returns:
+        - Optional[Dict[str, Any]]: The job, or None if it does not exist or has expired.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (row["expires"] is not None and row["expires"] <= time.time()):
+            return None
+        return self._job(row)
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """
+        Take the next queued job and mark it as running.
+
+        Parameters:
+        - worker (str): The ID of the claiming worker, used to requeue its job if it dies.
+
+        Returns:
+        - Optional[Dict[str, Any]]: The claimed job, or None if the queue is empty.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, created LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE jobs SET status = ?, started = ?, worker = ?, attempts = attempts + 1 WHERE id = ?",
+                        (RUNNING, time.time(), worker, row["id"]),
+                    )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return None if row is None else self.get(row["id"])
+
+    def complete(self, job_id: str, result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Store the result of a job.
+
+        Parameters:
+        - job_id (str): The ID of the job.
+        - result (Dict[str, Any]): The JSON-serializable result.
+
+        Returns:
+        - Optional[Dict[str, Any]]: The finished job.
+        """
+        return self._finish(job_id, DONE, result=json.dumps(result))
+
+    def fail(self, job_id: str, error: str) -> Optional[Dict[str, Any]]:
+        """
+        Mark a job as failed.
+
+        Parameters:
+        - job_id (str): The ID of the job.
+        - error (str): The reason the job failed.
+
+        Returns:
+        - Optional[Dict[str, Any]]: The finished job.
+        """
+        return self._finish(job_id, FAILED, error=error)
+
+    def requeue(self, worker: Optional[str] = None, crashed: bool = False) -> List[str]:
+        """
+        Put running jobs back into the queue, e.g. after a restart or when their worker died.
+
+        Parameters:
+        - worker (str): Only requeue the jobs of this worker, None for all running jobs.
+        - crashed (bool): The worker died while running the job. Jobs that used up max_attempts are
+          marked failed instead, so an upload that crashes the model cannot take the workers down forever.
+
+        Returns:
+        - List[str]: The IDs of the requeued jobs.
+        """
+        query, params = "SELECT id, attempts FROM jobs WHERE status = ?", [RUNNING]
+        if worker is not None:
+            query += " AND worker = ?"
+            params.append(worker)
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        requeued = []
+        for row in rows:
+            if crashed and row["attempts"] >= self.max_attempts:
+                self._finish(row["id"], FAILED, error=f"Worker died while running the job ({row['attempts']} attempts)")
+                continue
+            with self._lock:
+                self._connection.execute(
+                    "UPDATE jobs SET status = ?, started = NULL, worker = NULL, attempts = attempts - ? "
+                    "WHERE id = ? AND status = ?",
+                    (QUEUED, 0 if crashed else 1, row["id"], RUNNING),
+                )
+            requeued.append(row["id"])
+        return requeued
+
+    def purge(self) -> int:
+        """
+        Delete the jobs whose TTL has passed.
+
+        Returns:
+        - int: The number of deleted jobs.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "DELETE FROM jobs WHERE expires IS NOT NULL AND expires <= ?", (time.time(),)
+            ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Returns:
+        - Dict[str, int]: The number of jobs per status.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
+
+    def _finish(self, job_id: str, status: str, result: Optional[str] = None,
+                error: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Record the outcome of a job, start its TTL and delete its upload."""
+        now = time.time()
+        expires = now + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            row = self._connection.execute("SELECT audio_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, expires = ?, result = ?, error = ?, worker = NULL "
+                "WHERE id = ?",
+                (status, now, expires, result, error, job_id),
+            )
+        if row is not None and os.path.exists(row["audio_path"]):
+            os.remove(row["audio_path"])
+        return self.get(job_id)
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Dict[str, Any]:
+        """Turn a database row into a job dictionary."""
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+
+def deliver_webhook(url: str, job: Dict[str, Any], timeout: float = 10, attempts: int = 3,
+                    allowed_hosts: Sequence[str] = ()) -> bool:
+    """
+    POST a finished job to its webhook URL, retrying with backoff on errors.
+    The URL is checked again before it is called, the host may resolve differently than at submission.
+
+    Parameters:
+    - url (str): The webhook URL.
+    - job (Dict[str, Any]): The finished job.
+    - timeout (float): Seconds to wait for each attempt.
+    - attempts (int): The number of attempts.
+    - allowed_hosts (Sequence[str]): The hosts webhooks may be sent to, empty for any public host.
+
+    Returns:
+    - bool: True if the webhook answered with a 2xx status.
+    """
+    try:
+        check_webhook_url(url, allowed_hosts)
+    except ValueError as e:
+        logger.warning(f"Webhook for job {job['id']} refused: {str(e)}")
+        return False
+    for attempt in range(attempts):
+        try:
+            response = httpx.post(url, json=job_view(job), timeout=timeout)
+            if response.is_success:
+                return True
+            logger.warning(f"Webhook for job {job['id']} answered {response.status_code}")
+        except httpx.HTTPError as e:
+            logger.warning(f"Webhook for job {job['id']} failed: {str(e)}")
+        if attempt + 1 < attempts:
+            time.sleep(2 ** attempt)
+    return False
+
+
+def _run_worker(directory: str, ttl_seconds: float, max_attempts: int, webhook_hosts: Sequence[str],
+                transcriber_factory: Callable[[], Any], threads: int, poll_interval: float, stop_event) -> None:
+    """Main loop of a job worker process: load the model once, then claim and run jobs until stopped."""
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    store = JobStore(directory, ttl_seconds=ttl_seconds, max_attempts=max_attempts, webhook_hosts=webhook_hosts)
+    transcriber = transcriber_factory()
+    worker = str(os.getpid())
+    while not stop_event.is_set():
+        job = store.claim(worker)
+        if job is None:
+            store.purge()
+            stop_event.wait(poll_interval)
+            continue
+        started = time.perf_counter()
+        try:
+            # Whisper decodes the stored upload itself, so the API process does no audio work for jobs
+            transcript = transcriber.transcribe(job["audio_path"])
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {str(e)}")
+            finished = store.fail(job["id"], str(e))
+        else:
+            finished = store.complete(job["id"], {"transcript": transcript})
+            logger.info(f"Job {job['id']} done after {time.perf_counter() - started:.2f}s")
+        if finished is not None and finished["webhook_url"]:
+            deliver_webhook(finished["webhook_url"], finished, allowed_hosts=store.webhook_hosts)
+    store.close()
+
+
+class JobWorkerPool:
+    """
+    A pool of worker processes that run the jobs of a JobStore.
+
+    Each worker loads the model once and polls the store for the next job by priority. A monitor thread
+    restarts workers that die and requeues the job they were running. Jobs left running by a previous
+    server process are requeued on start, so queued work survives restarts.
+
+    Attributes:
+    - workers (int): The number of worker processes.
+    - threads_per_worker (int): Intra-op threads per worker.
+    - poll_interval (float): Seconds an idle worker waits before looking for new jobs.
+    """
+
+    def __init__(self, store: JobStore, transcriber_factory: Callable[[], Any], workers: int = 1,
+                 threads_per_worker: int = 0, poll_interval: float = 0.5, stop_timeout: float = 10,
+                 start_method: str = "spawn"):
+        """
+        Initialize the JobWorkerPool.
+
+        Parameters:
+        - store (JobStore): The store the jobs are taken from.
+        - transcriber_factory (Callable[[], Any]): Picklable callable that creates the transcriber in a worker,
+          e.g. functools.partial(WhisperTranscriber, 'small').
+        - workers (int): The number of worker processes.
+        - threads_per_worker (int): Intra-op threads per worker, 0 to split the CPU cores evenly between workers.
+        - poll_interval (float): Seconds an idle worker waits before looking for new jobs.
+        - stop_timeout (float): Seconds stop() waits for running jobs before terminating the workers.
+        - start_method (str): The multiprocessing start method. 'spawn' avoids forking a process with torch threads.
+        """
+        self.store = store
+        self.transcriber_factory = transcriber_factory
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // max(1, workers))
+        self.poll_interval = poll_interval
+        self.stop_timeout = stop_timeout
+        self._context = multiprocessing.get_context(start_method)
+        self._stop_event = self._context.Event()
+        self._processes: List[multiprocessing.process.BaseProcess] = []
+        self._monitor: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Requeue jobs left running by a previous process and start the workers."""
+        if self._monitor is not None or self.workers <= 0:
+            return
+        requeued = self.store.requeue()
+        if requeued:
+            logger.info(f"Requeued {len(requeued)} interrupted jobs")
+        self._processes = [self._spawn() for _ in range(self.workers)]
+        self._monitor = threading.Thread(target=self._watch, name="job-pool-monitor", daemon=True)
+        self._monitor.start()
+        logger.info(f"Started {self.workers} job workers ({self.threads_per_worker} threads each)")
+
+    def stop(self) -> None:
+        """Stop the workers, waiting up to stop_timeout for running jobs; unfinished jobs are requeued."""
+        if self._monitor is None:
+            return
+        self._stop_event.set()
+        self._monitor.join()
+        self._monitor = None
+        deadline = time.monotonic() + self.stop_timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+                self.store.requeue(worker=str(process.pid))
+        self._processes = []
+
+    def _spawn(self) -> multiprocessing.process.BaseProcess:
+        """Start one worker process."""
+        process = self._context.Process(
+            target=_run_worker,
+            args=(self.store.directory, self.store.ttl_seconds, self.store.max_attempts, self.store.webhook_hosts,
+                  self.transcriber_factory, self.threads_per_worker, self.poll_interval, self._stop_event),
+            name="job-worker",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _watch(self) -> None:
+        """Replace workers that died and requeue the job each was running."""
+        while not self._stop_event.wait(max(self.poll_interval, 1.0)):
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or self._stop_event.is_set():
+                    continue
+                logger.error(f"Job worker {process.pid} exited with code {process.exitcode}, restarting it")
+                self.store.requeue(worker=str(process.pid), crashed=True)
+                self._processes[index] = self._spawn()
@@ -1,37 +1,393 @@
+import logging
+import os
 from configparser import ConfigParser
-from fastapi import FastAPI
-from app.models import WhisperTranscriber, OllamaChatModel
-from app.database import ChromaDBHandler
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Optional, Tuple
+from fastapi import FastAPI, HTTPException
+from app.models import WhisperTranscriber, OllamaChatModel, create_transcriber
+from app.audio import SilenceTrimmer
+from app.registry import ModelRegistry, load_embedding_model, load_whisper_model, select_device, set_torch_threads
+from app.batching import SimilarityBatcher, TranscriptionScheduler
+from app.cache import ChatResponseCache, TranscriptionCache
+from app.database import VECTOR_SHARDS_DIR, ChromaDBHandler
+from app.admission import AIMDLimiter, AdmissionController, AdmissionMiddleware
+from app.jobs import JobStore, JobWorkerPool
+from app.rag import RagPipeline
 from app.routes import router
+from app.sharding import ShardedVectorStore
+from app.prefork import PreforkServer
+from app.startup import StartupOrchestrator
+from app.metrics import (
+    ADMISSION_IN_FLIGHT, ADMISSION_LIMIT, ADMISSION_QUEUED, BATCH_IN_FLIGHT, CACHE_HITS, CACHE_HIT_RATIO,
+    CACHE_MISSES, QUEUE_DEPTH, MetricsMiddleware,
+)
 
-def create_app(config: ConfigParser) -> FastAPI:
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Endpoint groups under admission control: the paths of each group and the defaults of its
+# initial limit, maximum limit, queue size and target latency in milliseconds
+ADMISSION_GROUPS = {
+    "Transcription": (("/transcribe", "/transcribe/stream"), (4, 16, 32, 30000)),
+    "Chat": (("/chat_response", "/chat_response/stream", "/chat_response/batch", "/rag"), (8, 32, 64, 60000)),
+    "Similarity": (("/similarity", "/similarity/batch"), (64, 256, 512, 1000)),
+}
+
+def whisper_sizes(config: ConfigParser) -> list:
     """
-    Create and configure an instance of the FastAPI application.
+    List the Whisper model sizes to keep resident: the configured size first, then the extra preload sizes.
 
     Parameters:
     - config (ConfigParser): ConfigParser instance containing the configuration for the service.
 
     Returns:
-    - FastAPI: The configured FastAPI application instance.
+    - list: The model sizes.
     """
-    app = FastAPI()
-    # Include transcription service
     whisper_size = config['WhisperSize']
-    app.dependency_overrides[WhisperTranscriber] = lambda: WhisperTranscriber(whisper_size)
-    
-    # Include ollama chat model
-    ollama_model = config['OllamaModel']
-    app.dependency_overrides[OllamaChatModel] = lambda: OllamaChatModel(ollama_model)
+    return [whisper_size] + [
+        size.strip() for size in config.get('WhisperPreloadSizes', fallback='').split(',')
+        if size.strip() and size.strip() != whisper_size
+    ]
+
+def create_registries(config: ConfigParser) -> Tuple[ModelRegistry, ModelRegistry]:
+    """
+    Create the model registries of an app, with the memory budgets and precision modes of the configuration.
+
+    Parameters:
+    - config (ConfigParser): ConfigParser instance containing the configuration for the service.
+
+    Returns:
+    - Tuple[ModelRegistry, ModelRegistry]: The Whisper registry and the embedding registry.
+    """
+    whisper_registry = ModelRegistry(
+        loader=load_whisper_model,
+        memory_budget_mb=config.getfloat('WhisperMemoryBudgetMB', fallback=0),
+        max_models=config.getint('WhisperMaxModels', fallback=0),
+        precision=config.get('WhisperPrecision', fallback='fp32'),
+    )
+    embedding_registry = ModelRegistry(
+        loader=load_embedding_model, precision=config.get('EmbeddingPrecision', fallback='fp32'),
+    )
+    return whisper_registry, embedding_registry
+
+def preload_models(config: ConfigParser, registries: Tuple[ModelRegistry, ModelRegistry]) -> None:
+    """
+    Load the Whisper and embedding models into the registries, so processes forked afterwards share the
+    weights instead of loading their own copy.
+
+    Parameters:
+    - config (ConfigParser): ConfigParser instance containing the configuration for the service.
+    - registries (Tuple[ModelRegistry, ModelRegistry]): The Whisper and embedding registries, see create_registries.
+    """
+    if select_device() == 'cuda':
+        # A CUDA context does not survive fork(), so every worker loads its models itself
+        logger.warning("Not preloading models before forking, CUDA models are loaded by each worker")
+        return
+    whisper_registry, embedding_registry = registries
+    for size in whisper_sizes(config):
+        whisper_registry.get(size)
+    embedding_registry.get(config['EmbeddingModelName'])
+
+def create_admission_controllers(config: ConfigParser) -> dict:
+    """
+    Create one admission controller per endpoint group from the Admission* keys of the configuration.
+
+    Parameters:
+    - config (ConfigParser): ConfigParser instance containing the configuration for the service.
+
+    Returns:
+    - dict: The controller per request path, empty if admission control is disabled.
+    """
+    if not config.getboolean('AdmissionEnabled', fallback=True):
+        return {}
+    controllers = {}
+    for group, (paths, (limit, max_limit, queue, target_ms)) in ADMISSION_GROUPS.items():
+        initial = config.getint(f'Admission{group}Limit', fallback=limit)
+        controller = AdmissionController(
+            group.lower(),
+            AIMDLimiter(
+                initial=initial,
+                max_limit=max(initial, config.getint(f'Admission{group}MaxLimit', fallback=max_limit)),
+                target_latency=config.getfloat(f'Admission{group}TargetMs', fallback=target_ms) / 1000,
+            ),
+            max_queue=config.getint(f'Admission{group}Queue', fallback=queue),
+            queue_timeout=config.getfloat('AdmissionQueueTimeout', fallback=5),
+            retry_after=config.getfloat('AdmissionRetryAfter', fallback=1),
+        )
+        controllers.update({path: controller for path in paths})
+    return controllers
+
+def create_database(config: ConfigParser, vector_store: Optional[ShardedVectorStore] = None,
+                    registry: Optional[ModelRegistry] = None) -> ChromaDBHandler:
+    """
+    Create the database handler from the configuration.
+
+    Parameters:
+    - config (ConfigParser): ConfigParser instance containing the configuration for the service.
+    - vector_store (ShardedVectorStore): Shard processes shared with other processes, None to let the
+      handler create its vector store.
+    - registry (ModelRegistry): The registry the embedding model is taken from, None for the process-wide one.
 
-    # Include database handler
+    Returns:
+    - ChromaDBHandler: The handler, not loaded from disk yet.
+    """
     db = ChromaDBHandler(
         model_name=config['EmbeddingModelName'],
         persist_directory=config['ChromaDBPersistDir'],
         chunk_size=config['DocumentChunkSize'],
-        chunk_overlap=config['DocumentChunkOverlap']
+        chunk_overlap=config['DocumentChunkOverlap'],
+        query_cache_size=config.getint('QueryEmbeddingCacheSize', fallback=1024),
+        ingest_batch_size=config.getint('IngestBatchSize', fallback=64),
+        ingest_workers=config.getint('IngestWorkers', fallback=0),
+        vector_backend=config.get('VectorBackend', fallback='chroma'),
+        ivf_threshold=config.getint('VectorIndexIVFThreshold', fallback=10000),
+        ivf_probes=config.getint('VectorIndexProbes', fallback=8),
+        vector_precision=config.get('VectorIndexPrecision', fallback='float32'),
+        vector_shards=config.getint('VectorShards', fallback=2),
+        shard_timeout=config.getfloat('VectorShardTimeoutMs', fallback=1000) / 1000,
+        chunk_unit=config.get('DocumentChunkUnit', fallback='characters'),
+        registry=registry,
+    )
+    if vector_store is not None:
+        # Set after construction, the handler's constructor parameters are request parameters to FastAPI
+        db.vector_store = vector_store
+    return db
+
+def create_shared_shards(config: ConfigParser) -> Optional[ShardedVectorStore]:
+    """
+    Create the shards of the sharded vector backend, for the pre-fork master to start once for all workers.
+
+    Parameters:
+    - config (ConfigParser): ConfigParser instance containing the configuration for the service.
+
+    Returns:
+    - Optional[ShardedVectorStore]: The (not yet started) shards, None if VectorBackend is not 'sharded'.
+    """
+    if config.get('VectorBackend', fallback='chroma') != 'sharded':
+        return None
+    return ShardedVectorStore(
+        os.path.join(config['ChromaDBPersistDir'], VECTOR_SHARDS_DIR),
+        shards=config.getint('VectorShards', fallback=2),
+        ivf_threshold=config.getint('VectorIndexIVFThreshold', fallback=10000),
+        n_probe=config.getint('VectorIndexProbes', fallback=8),
+        precision=config.get('VectorIndexPrecision', fallback='float32'),
+        timeout=config.getfloat('VectorShardTimeoutMs', fallback=1000) / 1000,
+    )
+
+def create_job_workers(config: ConfigParser) -> Optional[JobWorkerPool]:
+    """
+    Create the job store and the pool of transcription job workers.
+
+    Parameters:
+    - config (ConfigParser): ConfigParser instance containing the configuration for the service.
+
+    Returns:
+    - Optional[JobWorkerPool]: The (not yet started) pool with its store, None if JobsDir is not set.
+    """
+    jobs_dir = config.get('JobsDir', fallback='')
+    if not jobs_dir:
+        return None
+    store = JobStore(
+        jobs_dir,
+        ttl_seconds=config.getfloat('JobResultTTL', fallback=86400),
+        max_attempts=config.getint('JobMaxAttempts', fallback=2),
+        webhook_hosts=config.get('WebhookAllowedHosts', fallback='').split(','),
+    )
+    return JobWorkerPool(
+        store,
+        partial(create_transcriber, config['WhisperSize'], config.get('WhisperPrecision', fallback='fp32')),
+        workers=config.getint('JobWorkers', fallback=1),
+        threads_per_worker=config.getint('JobWorkerThreads', fallback=0),
+        poll_interval=config.getfloat('JobPollInterval', fallback=0.5),
+    )
+
+def create_app(config: ConfigParser, start_job_workers: bool = True,
+               vector_store: Optional[ShardedVectorStore] = None,
+               registries: Optional[Tuple[ModelRegistry, ModelRegistry]] = None) -> FastAPI:
+    """
+    Create and configure an instance of the FastAPI application.
+
+    Parameters:
+    - config (ConfigParser): ConfigParser instance containing the configuration for the service.
+    - start_job_workers (bool): Start the transcription job workers with the app. The pre-fork server
+      runs them once in its master instead of once per HTTP worker.
+    - vector_store (ShardedVectorStore): Shard processes started by the pre-fork master, shared by its
+      HTTP workers. None to let the database start its own.
+    - registries (Tuple[ModelRegistry, ModelRegistry]): The Whisper and embedding registries, e.g. preloaded
+      by the pre-fork master. None to create them from the configuration.
+
+    Returns:
+    - FastAPI: The configured FastAPI application instance.
+    """
+    # Heavy services load concurrently in the background once the app starts, see /health?detail=true
+    startup = StartupOrchestrator()
+
+    # Include transcription service, the registry keeps the Whisper weights resident across requests
+    whisper_size = config['WhisperSize']
+    registry, embedding_registry = registries if registries is not None else create_registries(config)
+    preload_sizes = whisper_sizes(config)
+
+    transcriber = WhisperTranscriber(whisper_size)
+    transcriber.registry = registry
+    scheduler = TranscriptionScheduler(
+        transcriber,
+        max_batch_size=config.getint('TranscriptionMaxBatchSize', fallback=8),
+        max_wait_ms=config.getfloat('TranscriptionMaxWaitMs', fallback=10),
+        max_queue_size=config.getint('TranscriptionQueueSize', fallback=64),
+    )
+    cache_dir = config.get('TranscriptionCacheDir', fallback='')
+    transcription_cache = TranscriptionCache(
+        max_entries=config.getint('TranscriptionCacheEntries', fallback=1024),
+        max_bytes=int(config.getfloat('TranscriptionCacheMaxMB', fallback=64) * 1024 * 1024),
+        ttl_seconds=config.getfloat('TranscriptionCacheTTL', fallback=0),
+        disk_path=os.path.join(cache_dir, 'transcriptions.sqlite3') if cache_dir else None,
+        disk_max_bytes=int(config.getfloat('TranscriptionCacheDiskMaxMB', fallback=0) * 1024 * 1024),
+    )
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Load in the background so the server answers while the weights load, /ready reports when done
+        startup.start()
+        if job_pool is not None and start_job_workers:
+            job_pool.start()
+        yield
+        if job_pool is not None and start_job_workers:
+            job_pool.stop()
+        scheduler.stop()
+        similarity_batcher.stop()
+        await chat_model.aclose()
+        if startup.is_ready("database"):
+            # Stops the shard processes the database started, or leaves shared ones to the pre-fork master
+            startup.get("database").close()
+
+    app = FastAPI(lifespan=lifespan)
+    app.dependency_overrides[StartupOrchestrator] = lambda: startup
+    # Transcription requests that arrive before the model is resident wait for the load in the registry
+    startup.add("whisper", lambda: [registry.get(size) for size in preload_sizes])
+    app.dependency_overrides[WhisperTranscriber] = lambda: transcriber
+    app.dependency_overrides[TranscriptionScheduler] = lambda: scheduler
+    app.dependency_overrides[TranscriptionCache] = lambda: transcription_cache
+
+    # Optionally cut silence out of uploads before transcription, so Whisper only decodes the speech
+    trimmer = None
+    if config.getboolean('TranscriptionSilenceTrim', fallback=False):
+        trimmer = SilenceTrimmer(
+            threshold_db=config.getfloat('SilenceThresholdDb', fallback=-50),
+            min_silence_seconds=config.getfloat('SilenceMinSeconds', fallback=1.0),
+            padding_seconds=config.getfloat('SilencePaddingSeconds', fallback=0.2),
+        )
+    app.dependency_overrides[SilenceTrimmer] = lambda: trimmer
+
+    # Include the job queue for long and bulk transcriptions, run by worker processes with their own model
+    job_pool = create_job_workers(config)
+    job_store = job_pool.store if job_pool is not None else None
+    if job_store is not None:
+        app.dependency_overrides[JobStore] = lambda: job_store
+    else:
+        def jobs_disabled():
+            raise HTTPException(status_code=503, detail="The job queue is disabled, set JobsDir to enable it")
+        app.dependency_overrides[JobStore] = jobs_disabled
+    
+    # Include ollama chat model, one instance so all requests share its connection pool
+    chat_model = OllamaChatModel(
+        config['OllamaModel'],
+        base_url=config.get('OllamaBaseUrl', fallback='http://ollama:11434'),
+        max_concurrency=config.getint('OllamaMaxConcurrency', fallback=4),
+        timeout=config.getfloat('OllamaTimeout', fallback=120),
+    )
+    app.dependency_overrides[OllamaChatModel] = lambda: chat_model
+
+    # Include the embedding model, shared by the database and the semantic tier of the chat cache
+    def load_embedding():
+        embedding_function = embedding_registry.get(config['EmbeddingModelName'])
+        if config.getboolean('ChatCacheSemantic', fallback=False):
+            chat_cache.embedding_function = embedding_function
+        return embedding_function
+
+    startup.add("embedding", load_embedding)
+
+    # Include database handler, loaded in the background once the embedding model is resident;
+    # its routes answer 503 until it is ready
+    def load_database() -> ChromaDBHandler:
+        db = create_database(config, vector_store=vector_store, registry=embedding_registry)
+        db.load_from_disk()
+        snapshots = [path.strip() for path in config.get('ChromaDBSnapshots', fallback='').split(',') if path.strip()]
+        if snapshots:
+            # A new replica starts from the snapshots instead of re-embedding the documents; with the numpy
+            # or sharded backend it serves from them right away while Chroma catches up in the background
+            applied = db.import_snapshots(snapshots, background_sync=True)
+            logger.info(f"Applied {applied} of {len(snapshots)} database snapshots")
+        return db
+
+    startup.add("database", load_database, requires=("embedding",))
+    app.dependency_overrides[ChromaDBHandler] = startup.dependency("database")
+    similarity_batcher = SimilarityBatcher(
+        max_batch_size=config.getint('SimilarityMaxBatchSize', fallback=32),
+        max_wait_ms=config.getfloat('SimilarityMaxWaitMs', fallback=2),
+        max_queue_size=config.getint('SimilarityQueueSize', fallback=256),
+    )
+    app.dependency_overrides[SimilarityBatcher] = lambda: similarity_batcher
+
+    # Include chat response cache, the semantic tier is enabled once the embedding model is loaded
+    chat_cache = ChatResponseCache(
+        max_entries=config.getint('ChatCacheEntries', fallback=1024),
+        ttl_seconds=config.getfloat('ChatCacheTTL', fallback=3600),
+        similarity_threshold=config.getfloat('ChatCacheSimilarityThreshold', fallback=0.95),
+    )
+    app.dependency_overrides[ChatResponseCache] = lambda: chat_cache
+
+    # Include retrieval-augmented chat over the database, retrieved contexts are cached per question
+    rag_pipeline = RagPipeline(
+        k=config.getint('RagTopK', fallback=4),
+        max_context_tokens=config.getint('RagContextTokens', fallback=1024),
+        cache_entries=config.getint('RagContextCacheEntries', fallback=1024),
+        cache_ttl_seconds=config.getfloat('RagContextCacheTTL', fallback=300),
+        prefill=config.getboolean('RagPrefill', fallback=True),
     )
-    db.load_from_disk()
-    app.dependency_overrides[ChromaDBHandler] = lambda: db
+    app.dependency_overrides[RagPipeline] = lambda: rag_pipeline
+
+    # Export queue and cache state at scrape time, request counts and latencies are recorded by the middleware
+    batchers = {"transcription": scheduler, "similarity": similarity_batcher}
+
+    def queue_depths() -> dict:
+        depths = {(name,): batcher.queue_depth for name, batcher in batchers.items()}
+        if job_store is not None:
+            depths[("jobs",)] = job_store.counts()["queued"]
+        return depths
+
+    QUEUE_DEPTH.set_function(queue_depths)
+    BATCH_IN_FLIGHT.set_function(lambda: {(name,): batcher.in_flight for name, batcher in batchers.items()})
+
+    def cache_stats() -> dict:
+        stats = {
+            "transcription_memory": transcription_cache.memory.stats(),
+            "chat_exact": chat_cache.stats()["exact"],
+            "rag_contexts": rag_pipeline.stats(),
+        }
+        if transcription_cache.disk is not None:
+            stats["transcription_disk"] = transcription_cache.disk.stats()
+        if chat_cache.semantic is not None:
+            stats["chat_semantic"] = chat_cache.semantic.stats()
+        if startup.is_ready("database"):
+            stats["query_embeddings"] = startup.get("database").query_cache.stats()
+        return stats
+
+    CACHE_HITS.set_function(lambda: {(name,): s["hits"] for name, s in cache_stats().items()})
+    CACHE_MISSES.set_function(lambda: {(name,): s["misses"] for name, s in cache_stats().items()})
+    CACHE_HIT_RATIO.set_function(lambda: {
+        (name,): s["hits"] / (s["hits"] + s["misses"]) if s["hits"] + s["misses"] else 0.0
+        for name, s in cache_stats().items()
+    })
+    # Requests beyond the concurrency limit of their group wait in a bounded queue or get a quick 429/503,
+    # /health, /ready and /metrics are not guarded so the service stays observable under overload
+    controllers = create_admission_controllers(config)
+    groups = {controller.name: controller for controller in controllers.values()}
+    ADMISSION_LIMIT.set_function(lambda: {(name,): c.limiter.limit for name, c in groups.items()})
+    ADMISSION_IN_FLIGHT.set_function(lambda: {(name,): c.in_flight for name, c in groups.items()})
+    ADMISSION_QUEUED.set_function(lambda: {(name,): c.queue_depth for name, c in groups.items()})
+    app.add_middleware(AdmissionMiddleware, controllers=controllers)
+    app.add_middleware(MetricsMiddleware)
 
     # Add routes to service
     app.include_router(router)
@@ -51,11 +407,46 @@ def main():
     parser.add_argument('--host', type=str, default="0.0.0.0", help="Host to run the server on.")
     parser.add_argument('--port', type=int, default=8000, help="Port to run the server on.")
     parser.add_argument('--config', type=str, default="default", help="Name of configuration file during use.")
+    parser.add_argument('--workers', type=int, help="Number of HTTP worker processes (default: ServerWorkers).")
     
     args = parser.parse_args()
-    
-    app = create_app(config=config[args.config])
-    uvicorn.run(app, host=args.host, port=args.port)
+    section = config[args.config]
+    workers = args.workers or section.getint('ServerWorkers', fallback=1)
+
+    if workers <= 1:
+        set_torch_threads(section.getint('ServerWorkerThreads', fallback=0))
+        app = create_app(config=section)
+        uvicorn.run(app, host=args.host, port=args.port)
+        return
+
+    # Pre-fork: load the models and start the vector shards once, fork the HTTP workers so they share both,
+    # run job workers once
+    job_pool = create_job_workers(section)
+    shards = create_shared_shards(section)
+    registries = create_registries(section)
+
+    def preload():
+        preload_models(section, registries)
+        if shards is not None:
+            shards.start()
+
+    def stop():
+        if job_pool is not None:
+            job_pool.stop()
+        if shards is not None:
+            shards.close()
+
+    PreforkServer(
+        partial(create_app, section, start_job_workers=False, vector_store=shards, registries=registries),
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        threads_per_worker=section.getint('ServerWorkerThreads', fallback=0),
+        preload=preload,
+        on_start=job_pool.start if job_pool is not None else None,
+        on_stop=stop,
+        on_supervise=shards.revive if shards is not None else None,
+    ).run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,332 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds; spans in-process lookups (sub-millisecond) up to long transcriptions and generations
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Render a label set in the Prometheus text format."""
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    """Escape a label value."""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    """Render a sample value; integers without a trailing .0."""
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """
+    Base class of the metric types. Values are kept per label set behind a lock, so updates from
+    request handlers, worker threads and the event loop are cheap and safe.
+
+    A metric can also be computed at scrape time by a function set with set_function, which is how
+    values that already live elsewhere (queue depths, cache counters) are exported without extra bookkeeping.
+
+    Attributes:
+    - name (str): The metric name.
+    - documentation (str): The help text.
+    - labelnames (Tuple[str, ...]): The names of the labels.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        """Turn keyword labels into the key of a label set."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function: Optional[Callable[[], Dict[LabelValues, float]]]) -> None:
+        """
+        Compute the metric at scrape time instead of from recorded updates.
+
+        Parameters:
+        - function (Callable[[], Dict[Tuple[str, ...], float]]): Returns a value per label set, None to unset.
+        """
+        self._function = function
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[str, ...], LabelValues, float]]:
+        """Yield (name, label names, label values, value) for every sample of the metric."""
+        if self._function is not None:
+            values = self._function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, self.labelnames, key, value
+
+    def render(self) -> List[str]:
+        """Render the metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labelnames, key, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Increase the counter.
+
+        Parameters:
+        - amount (float): The increment.
+        - labels (str): The label values.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set the gauge to a value."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the gauge."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """Decrease the gauge."""
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Counts observations in cumulative buckets and tracks their sum, for latency percentiles
+    with histogram_quantile() in Prometheus.
+
+    Attributes:
+    - buckets (Tuple[float, ...]): The upper bounds of the buckets, without +Inf.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Record an observation.
+
+        Parameters:
+        - value (float): The observed value, e.g. seconds.
+        - labels (str): The label values.
+        """
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the wall-clock seconds spent in the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[str, ...], LabelValues, float]]:
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        bucket_labels = self.labelnames + ("le",)
+        for key, (counts, total, count) in series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", bucket_labels, key + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labelnames, key, total
+            yield f"{self.name}_count", self.labelnames, key, count
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the process and renders them for the /metrics endpoint.
+    Asking for a metric that already exists returns the existing one, so modules can declare the metrics they use.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, documentation: str, labelnames: Sequence[str], **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with another type or labels")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """Return the counter with the given name, creating it if necessary."""
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        """Return the gauge with the given name, creating it if necessary."""
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """Return the histogram with the given name, creating it if necessary."""
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        """
+        Returns:
+        - str: All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry served at /metrics
+default_metrics = MetricsRegistry()
+
+REQUESTS = default_metrics.counter(
+    "aiservice_http_requests_total", "HTTP requests by method, route template and status code.",
+    ("method", "route", "status"),
+)
+REQUEST_LATENCY = default_metrics.histogram(
+    "aiservice_http_request_duration_seconds", "Time until the response headers are sent.", ("method", "route"),
+)
+REQUESTS_IN_FLIGHT = default_metrics.gauge("aiservice_http_requests_in_flight", "HTTP requests being processed.")
+STAGE_LATENCY = default_metrics.histogram(
+    "aiservice_stage_duration_seconds", "Latency of the processing stages of a request.", ("stage",),
+)
+QUEUE_DEPTH = default_metrics.gauge("aiservice_queue_depth", "Jobs waiting in a batching queue.", ("queue",))
+BATCH_IN_FLIGHT = default_metrics.gauge("aiservice_batch_in_flight", "Jobs in the batch a worker is processing.", ("queue",))
+BATCH_SIZE = default_metrics.histogram(
+    "aiservice_transcription_batch_size", "Clips per batched Whisper decode.", buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+AUDIO_SECONDS = default_metrics.counter(
+    "aiservice_audio_seconds_processed_total",
+    "Seconds of audio transcribed; rate() of it is audio seconds per wall-clock second.",
+)
+AUDIO_SECONDS_SKIPPED = default_metrics.counter(
+    "aiservice_audio_seconds_skipped_total", "Seconds of audio cut out as silence before transcription.",
+)
+CHAT_TOKENS = default_metrics.counter("aiservice_chat_tokens_total", "Tokens generated by the chat model.", ("model",))
+CHAT_GENERATION_SECONDS = default_metrics.counter(
+    "aiservice_chat_generation_seconds_total",
+    "Seconds the chat model spent generating; tokens_total / generation_seconds_total is tokens per second.",
+    ("model",),
+)
+CACHE_HITS = default_metrics.counter("aiservice_cache_hits_total", "Cache hits.", ("cache",))
+CACHE_MISSES = default_metrics.counter("aiservice_cache_misses_total", "Cache misses.", ("cache",))
+CACHE_HIT_RATIO = default_metrics.gauge("aiservice_cache_hit_ratio", "Hits per lookup since start.", ("cache",))
+ADMISSION_LIMIT = default_metrics.gauge(
+    "aiservice_admission_limit", "Current adaptive concurrency limit of an endpoint group.", ("group",),
+)
+ADMISSION_IN_FLIGHT = default_metrics.gauge(
+    "aiservice_admission_in_flight", "Admitted requests running in an endpoint group.", ("group",),
+)
+ADMISSION_QUEUED = default_metrics.gauge(
+    "aiservice_admission_queued", "Requests waiting for admission to an endpoint group.", ("group",),
+)
+ADMISSION_REJECTED = default_metrics.counter(
+    "aiservice_admission_rejected_total", "Requests rejected or shed by admission control.", ("group", "reason"),
+)
+
+
+def track_stage(stage: str):
+    """
+    Time a processing stage into the stage latency histogram.
+
+    Parameters:
+    - stage (str): The name of the stage, e.g. 'audio_decode'.
+
+    Returns:
+    - ContextManager: Observes the time spent in the with block.
+    """
+    return STAGE_LATENCY.time(stage=stage)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that counts requests and times them per route template.
+    Plain ASGI rather than BaseHTTPMiddleware, so it adds no task or body buffering to requests.
+    Streaming responses are timed until their headers are sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+                REQUEST_LATENCY.observe(time.perf_counter() - started, method=scope["method"], route=_route(scope))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            REQUESTS.inc(method=scope["method"], route=_route(scope), status=str(status_code[0]))
+
+
+def _route(scope) -> str:
+    """The path template of the matched route, so label values stay bounded."""
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
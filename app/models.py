@@ -1,44 +1,76 @@
-import whisper
-import torch
+import asyncio
+import json
 import logging
-import ssl
-from langchain_community.llms import Ollama
+import time
+from typing import TYPE_CHECKING, AsyncIterator, List, Optional, Union
+import httpx
+import numpy as np
+from app.registry import ModelRegistry, default_registry, load_whisper_model
+from app.audio import SAMPLE_RATE
+from app.metrics import AUDIO_SECONDS, BATCH_SIZE, CHAT_GENERATION_SECONDS, CHAT_TOKENS, STAGE_LATENCY, track_stage
+
+if TYPE_CHECKING:
+    import whisper
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Decoding temperatures and quality thresholds of whisper.transcribe, batched decoding uses the same ones
+TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+def _is_silence(result) -> bool:
+    """Whether whisper.transcribe would skip a decoding result as silence."""
+    return result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD
+
+def _needs_fallback(result) -> bool:
+    """Whether whisper.transcribe would decode a clip again at the next temperature."""
+    if _is_silence(result):
+        return False
+    return result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD
+
 class WhisperTranscriber:
     """
     A class to handle transcription using the OpenAI Whisper model.
+    The instance is a cheap handle: the model weights are loaded once and kept resident by a ModelRegistry.
     
     Attributes:
-    - model (whisper.Whisper): The Whisper model instance.
-    - device (str): The device (CPU or GPU) to run the model on.
+    - model_size (str): The size of the Whisper model.
+    - registry (ModelRegistry): The registry that holds the loaded model.
     """
 
     def __init__(self, model_size: str = "small"):
         """
         Initialize the WhisperTranscriber with the specified model size.
+        The model is taken from the process-wide registry, so all handles of a size share one copy of the weights.
 
         Parameters:
         - model_size (str): The size of the Whisper model to load (e.g., 'tiny', 'base', 'small', 'medium', 'large').
         """
-        # Disable SSL verification - WARNING: NOT SAFE
-        ssl._create_default_https_context = ssl._create_unverified_context
+        self.model_size = model_size
+        self.registry: ModelRegistry = default_registry
 
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        logger.info(f"Loading Whisper model: {model_size} on {self.device}")
+    @property
+    def model(self) -> "whisper.Whisper":
+        """The resident Whisper model, loaded on first access."""
+        return self.registry.get(self.model_size)
 
-        self.model = whisper.load_model(model_size, device=self.device)
+    @property
+    def device(self) -> str:
+        """The device (CPU or GPU) the model runs on."""
+        return str(self.model.device)
 
-    def transcribe(self, audio_file_path: str) -> str:
+    def transcribe(self, audio_file_path: Union[str, np.ndarray]) -> str:
         """
         Transcribe the given audio file to text.
         ffmpeg is used to load audio. Examples are: m4a, mp3, webm, mp4, mpga, wav and mpeg.
 
         Parameters:
-        - audio_file_path (str): The path to the audio file to be transcribed.
+        - audio_file_path (Union[str, np.ndarray]): The path to the audio file to be transcribed,
+          or an already decoded 16 kHz mono float32 waveform.
 
         Returns:
         - str: The transcribed text.
@@ -47,41 +79,300 @@ class WhisperTranscriber:
         - RuntimeError: If transcription fails.
         """
         try:
-            logger.info(f"Transcribing audio file: {audio_file_path}")
-            result = self.model.transcribe(audio_file_path)
+            if isinstance(audio_file_path, str):
+                logger.info(f"Transcribing audio file: {audio_file_path}")
+            else:
+                logger.info(f"Transcribing {len(audio_file_path) / SAMPLE_RATE:.1f}s of decoded audio")
+            model = self.model
+            with track_stage("whisper_inference"):
+                result = model.transcribe(audio_file_path)
+            if not isinstance(audio_file_path, str):
+                AUDIO_SECONDS.inc(len(audio_file_path) / SAMPLE_RATE)
             return result["text"]
         except Exception as e:
             logger.error(f"Transcription failed: {str(e)}")
             raise RuntimeError(f"Transcription failed: {str(e)}")
 
+    def transcribe_segments(self, audio: np.ndarray, offset: float = 0.0) -> List[dict]:
+        """
+        Transcribe a waveform and return its timestamped segments.
+
+        Parameters:
+        - audio (np.ndarray): A 16 kHz mono float32 waveform.
+        - offset (float): Seconds added to the segment timestamps, e.g. the position of the window in the recording.
+
+        Returns:
+        - List[dict]: Segments with 'start', 'end' (seconds) and 'text'.
+
+        Raises:
+        - RuntimeError: If transcription fails.
+        """
+        try:
+            model = self.model
+            with track_stage("whisper_inference"):
+                result = model.transcribe(audio)
+            AUDIO_SECONDS.inc(len(audio) / SAMPLE_RATE)
+            return [
+                {
+                    "start": round(segment["start"] + offset, 2),
+                    "end": round(segment["end"] + offset, 2),
+                    "text": segment["text"],
+                }
+                for segment in result["segments"]
+            ]
+        except Exception as e:
+            logger.error(f"Transcription failed: {str(e)}")
+            raise RuntimeError(f"Transcription failed: {str(e)}")
+
+    def transcribe_batch(self, audio_inputs: List[Union[str, np.ndarray]]) -> List[str]:
+        """
+        Transcribe several audio inputs with as few model passes as possible.
+        Clips of up to 30 seconds are padded and decoded together in one batched encoder/decoder pass,
+        longer clips fall back to the sequential sliding-window transcription. Like whisper.transcribe,
+        clips whose result is too repetitive or too unlikely are decoded again at the next temperature
+        (together, in a smaller batch), and clips that are probably silence come back empty.
+
+        Parameters:
+        - audio_inputs (List[Union[str, np.ndarray]]): Audio file paths or 16 kHz mono float32 waveforms.
+
+        Returns:
+        - List[str]: The transcribed texts, in the order of the inputs.
+
+        Raises:
+        - RuntimeError: If transcription fails.
+        """
+        # whisper and torch are imported on first use so importing this module stays cheap
+        import torch
+        import whisper
+
+        try:
+            model = self.model
+            audios = [whisper.load_audio(audio) if isinstance(audio, str) else audio for audio in audio_inputs]
+            texts = [None] * len(audios)
+            BATCH_SIZE.observe(len(audios))
+
+            short = [index for index, audio in enumerate(audios) if len(audio) <= whisper.audio.N_SAMPLES]
+            if short:
+                logger.info(f"Decoding batch of {len(short)} clips")
+                with track_stage("whisper_inference"):
+                    mel = torch.stack([
+                        whisper.log_mel_spectrogram(whisper.pad_or_trim(audios[index]), model.dims.n_mels)
+                        for index in short
+                    ]).to(model.device)
+                    results = [None] * len(short)
+                    pending = list(range(len(short)))
+                    for temperature in TEMPERATURES:
+                        options = whisper.DecodingOptions(temperature=temperature, fp16=model.device.type == "cuda")
+                        for position, result in zip(pending, whisper.decode(model, mel[pending], options)):
+                            results[position] = result
+                        pending = [position for position in pending if _needs_fallback(results[position])]
+                        if not pending:
+                            break
+                        logger.info(f"Decoding {len(pending)} clips again above temperature {temperature}")
+                    for index, result in zip(short, results):
+                        texts[index] = "" if _is_silence(result) else result.text
+
+            for index, audio in enumerate(audios):
+                if texts[index] is None:
+                    with track_stage("whisper_inference"):
+                        texts[index] = model.transcribe(audio)["text"]
+            AUDIO_SECONDS.inc(sum(len(audio) for audio in audios) / SAMPLE_RATE)
+            return texts
+        except Exception as e:
+            logger.error(f"Transcription failed: {str(e)}")
+            raise RuntimeError(f"Transcription failed: {str(e)}")
+
+
+def create_transcriber(model_size: str, precision: str = "fp32") -> WhisperTranscriber:
+    """
+    Create a transcriber whose model is loaded with the given precision. Meant as the picklable
+    factory of worker processes, which do not share the configuration of the API process.
+
+    Parameters:
+    - model_size (str): The size of the Whisper model.
+    - precision (str): 'fp32', or 'int8' for dynamic int8 quantization on CPU.
+
+    Returns:
+    - WhisperTranscriber: A handle on a registry of its own that loads the model with the precision.
+    """
+    transcriber = WhisperTranscriber(model_size)
+    # The process-wide registry keeps its loader, so other handles are not switched to this precision
+    transcriber.registry = ModelRegistry(loader=load_whisper_model, precision=precision)
+    return transcriber
 
 class OllamaChatModel:
     """
     A class to handle OllamaChat model.
+    Requests go through pooled HTTP clients that are shared by all requests, the number of
+    concurrent generations is limited by a semaphore.
 
     Attributes:
     - model_name (str): The name of the model. Must be listed on https://ollama.com/library 
+    - base_url (str): The URL of the Ollama server.
+    - max_concurrency (int): The maximum number of concurrent generations.
+    - timeout (httpx.Timeout): The timeouts for requests to the Ollama server.
     """
 
-    def __init__(self, model_name: str, base_url: str = "http://ollama:11434"):
+    def __init__(self, model_name: str, base_url: str = "http://ollama:11434", max_concurrency: int = 4,
+                 timeout: float = 120.0, connect_timeout: float = 5.0):
         """
         Initialize the OllamaChatModel with the specified model path.
 
         Parameters:
         - model_name (str): The name of the model.
+        - base_url (str): The URL of the Ollama server.
+        - max_concurrency (int): The maximum number of concurrent generations.
+        - timeout (float): Seconds to wait for data from the server before a request fails.
+        - connect_timeout (float): Seconds to wait for a connection to the server.
         """
         self.base_url = base_url
         self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sync_client: Optional[httpx.Client] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled async HTTP client, created on first use."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self._limits)
+        return self._client
+
+    def _payload(self, prompt: str, stream: bool) -> dict:
+        """Build the body of a generate request."""
+        return {"model": self.model_name, "prompt": prompt, "stream": stream}
+
+    def _record_usage(self, body: dict, started: float, tokens: int = 0) -> None:
+        """
+        Record the generated tokens and generation time of a finished request.
+        Ollama reports both in its final message; the wall-clock time and the given token count are the fallback.
+        """
+        seconds = time.perf_counter() - started
+        STAGE_LATENCY.observe(seconds, stage="chat_generate")
+        CHAT_TOKENS.inc(body.get("eval_count", tokens), model=self.model_name)
+        CHAT_GENERATION_SECONDS.inc(body.get("eval_duration", seconds * 1e9) / 1e9, model=self.model_name)
 
     def chat(self, prompt: str) -> str:
         """
-        Generate a response to the given prompt.
+        Generate a response to the given prompt. Blocks until the response is complete.
 
         Parameters:
         - prompt (str): The prompt to generate a response for.
 
         Returns:
         - str: The generated response.
+
+        Raises:
+        - RuntimeError: If the Ollama server cannot be reached, returns an error or an invalid response.
         """
-        llm = Ollama(model=self.model_name, base_url=self.base_url)
-        return llm.invoke(prompt)
\ No newline at end of file
+        if self._sync_client is None:
+            self._sync_client = httpx.Client(base_url=self.base_url, timeout=self.timeout, limits=self._limits)
+        try:
+            started = time.perf_counter()
+            response = self._sync_client.post("/api/generate", json=self._payload(prompt, stream=False))
+            response.raise_for_status()
+            body = response.json()
+            self._record_usage(body, started)
+            return body["response"]
+        except httpx.HTTPError as e:
+            logger.error(f"Chat request failed: {str(e)}")
+            raise RuntimeError(f"Chat request failed: {str(e)}")
+        except (ValueError, KeyError) as e:
+            # Not JSON, or JSON without a response, e.g. from a proxy in front of Ollama
+            logger.error(f"Invalid chat response: {str(e)}")
+            raise RuntimeError(f"Invalid chat response: {str(e)}")
+
+    async def achat(self, prompt: str) -> str:
+        """
+        Generate a response to the given prompt without blocking the event loop.
+
+        Parameters:
+        - prompt (str): The prompt to generate a response for.
+
+        Returns:
+        - str: The generated response.
+
+        Raises:
+        - RuntimeError: If the Ollama server cannot be reached, returns an error or an invalid response.
+        """
+        async with self._semaphore:
+            try:
+                started = time.perf_counter()
+                response = await self.client.post("/api/generate", json=self._payload(prompt, stream=False))
+                response.raise_for_status()
+                body = response.json()
+                self._record_usage(body, started)
+                return body["response"]
+            except httpx.HTTPError as e:
+                logger.error(f"Chat request failed: {str(e)}")
+                raise RuntimeError(f"Chat request failed: {str(e)}")
+            except (ValueError, KeyError) as e:
+                # Not JSON, or JSON without a response, e.g. from a proxy in front of Ollama
+                logger.error(f"Invalid chat response: {str(e)}")
+                raise RuntimeError(f"Invalid chat response: {str(e)}")
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        """
+        Generate a response to the given prompt and yield the tokens as they arrive.
+
+        Parameters:
+        - prompt (str): The prompt to generate a response for.
+
+        Yields:
+        - str: The next piece of the response.
+
+        Raises:
+        - RuntimeError: If the Ollama server cannot be reached or returns an error.
+        """
+        async with self._semaphore:
+            try:
+                started = time.perf_counter()
+                tokens = 0
+                async with self.client.stream("POST", "/api/generate", json=self._payload(prompt, stream=True)) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("error"):
+                            raise RuntimeError(f"Chat request failed: {chunk['error']}")
+                        if chunk.get("response"):
+                            tokens += 1
+                            yield chunk["response"]
+                        if chunk.get("done"):
+                            self._record_usage(chunk, started, tokens)
+                            break
+            except httpx.HTTPError as e:
+                logger.error(f"Chat request failed: {str(e)}")
+                raise RuntimeError(f"Chat request failed: {str(e)}")
+
+    async def aprefill(self, prompt: str) -> None:
+        """
+        Let the Ollama server evaluate a prompt prefix ahead of the request that uses it. A later prompt that
+        starts with the same text reuses the evaluated prefix from the server's prompt cache, so its prefill
+        is shorter. Only one token is generated. Failures are logged, the later request works without it.
+
+        Parameters:
+        - prompt (str): The beginning of a prompt that is about to be sent.
+        """
+        async with self._semaphore:
+            try:
+                with track_stage("chat_prefill"):
+                    payload = self._payload(prompt, stream=False)
+                    payload["options"] = {"num_predict": 1}
+                    response = await self.client.post("/api/generate", json=payload)
+                    response.raise_for_status()
+            except httpx.HTTPError as e:
+                logger.warning(f"Prefill request failed: {str(e)}")
+
+    async def aclose(self) -> None:
+        """Close the pooled HTTP clients."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
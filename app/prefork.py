@@ -0,0 +1,204 @@
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict, Optional
+from fastapi import FastAPI
+from app.registry import set_torch_threads
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# A worker that exits sooner than this after its start is restarted with a delay, to avoid a crash loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """
+    Open the listening socket that all workers accept connections on.
+
+    Parameters:
+    - host (str): The host to bind to.
+    - port (int): The port to bind to.
+    - backlog (int): The size of the accept queue.
+
+    Returns:
+    - socket.socket: The bound, listening socket.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class PreforkServer:
+    """
+    Serves an app from several forked worker processes that share the model weights copy-on-write.
+
+    The master process loads the models once with preload() and then forks the HTTP workers. The workers
+    inherit the weights without copying them: the pages stay shared as long as nobody writes to them,
+    which inference does not. Each worker builds its own app with app_factory() after the fork, so sockets,
+    database connections and threads are never shared between processes, and serves it with uvicorn on the
+    listening socket opened by the master. The master restarts workers that die and forwards SIGTERM/SIGINT.
+
+    Forking is only safe before threads, CUDA or an OpenMP pool exist in the master. The master therefore
+    runs with one torch thread while it preloads and does no inference itself; preloading is meant for
+    CPU models (a CUDA context cannot be inherited, GPU workers must load their model after the fork).
+
+    Attributes:
+    - workers (int): The number of HTTP worker processes.
+    - threads_per_worker (int): Intra-op threads per worker.
+    """
+
+    def __init__(self, app_factory: Callable[[], FastAPI], host: str = "0.0.0.0", port: int = 8000,
+                 workers: int = 2, threads_per_worker: int = 0, preload: Optional[Callable[[], None]] = None,
+                 on_start: Optional[Callable[[], None]] = None, on_stop: Optional[Callable[[], None]] = None,
+                 on_supervise: Optional[Callable[[], None]] = None, stop_timeout: float = 30,
+                 log_level: str = "info"):
+        """
+        Initialize the PreforkServer.
+
+        Parameters:
+        - app_factory (Callable[[], FastAPI]): Builds the app in each worker, after the fork.
+        - host (str): The host to bind to.
+        - port (int): The port to bind to.
+        - workers (int): The number of HTTP worker processes.
+        - threads_per_worker (int): Intra-op threads per worker, 0 to split the CPU cores evenly between workers.
+        - preload (Callable[[], None]): Loads the shared models in the master before the first fork.
+        - on_start (Callable[[], None]): Called in the master once the workers are running, e.g. to start job workers.
+        - on_stop (Callable[[], None]): Called in the master after the workers stopped.
+        - on_supervise (Callable[[], None]): Called in the master on every supervision round, e.g. to restart
+          helper processes the workers share.
+        - stop_timeout (float): Seconds to wait for workers to finish their requests before killing them.
+        - log_level (str): The uvicorn log level of the workers.
+        """
+        if not hasattr(os, "fork"):
+            raise RuntimeError("Pre-fork serving requires os.fork(), which this platform does not provide")
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // max(1, workers))
+        self.preload = preload
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.on_supervise = on_supervise
+        self.stop_timeout = stop_timeout
+        self.log_level = log_level
+        self._children: Dict[int, float] = {}
+        self._stopping = False
+        self._socket: Optional[socket.socket] = None
+
+    def run(self) -> None:
+        """Preload the models, fork the workers and supervise them until SIGTERM or SIGINT."""
+        set_torch_threads(1)
+        if self.preload is not None:
+            started = time.perf_counter()
+            self.preload()
+            logger.info(f"Preloaded models in the master after {time.perf_counter() - started:.2f}s")
+        self._socket = bind_socket(self.host, self.port)
+        for _ in range(self.workers):
+            self._fork()
+        logger.info(f"Serving on {self.host}:{self.port} with {self.workers} workers "
+                    f"({self.threads_per_worker} threads each)")
+
+        previous = {sig: signal.signal(sig, self._handle_signal) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            if self.on_start is not None:
+                self.on_start()
+            self._supervise()
+        finally:
+            self._shutdown()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            if self.on_stop is not None:
+                self.on_stop()
+
+    def _fork(self) -> int:
+        """Fork one worker process; the child serves until it is told to stop and never returns."""
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.monotonic()
+            return pid
+
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            set_torch_threads(self.threads_per_worker)
+            import uvicorn
+            server = uvicorn.Server(uvicorn.Config(self.app_factory(), log_level=self.log_level))
+            server.run(sockets=[self._socket])
+        except BaseException:
+            logger.exception(f"Worker {os.getpid()} crashed")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _handle_signal(self, signum, frame) -> None:
+        """Start the shutdown, the supervision loop notices it."""
+        self._stopping = True
+
+    def _supervise(self) -> None:
+        """Wait for workers to exit and replace them while the server is running."""
+        while not self._stopping:
+            if self.on_supervise is not None:
+                try:
+                    self.on_supervise()
+                except Exception:
+                    logger.exception("Supervising the shared processes failed")
+            exited = self._reap()
+            if not exited:
+                time.sleep(0.2)
+            for pid, (started, status) in exited.items():
+                if self._stopping:
+                    break
+                logger.error(f"Worker {pid} exited with status {status}, restarting it")
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    time.sleep(MIN_WORKER_LIFETIME)
+                self._fork()
+
+    def _reap(self) -> Dict[int, tuple]:
+        """
+        Collect the workers that exited. Only the worker PIDs are waited for, so other child processes
+        of the master (e.g. multiprocessing job workers) are left to their owners.
+
+        Returns:
+        - Dict[int, tuple]: PID -> (start time, exit status) of the workers that exited.
+        """
+        exited = {}
+        for pid in list(self._children):
+            try:
+                waited, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                waited, status = pid, None
+            if waited:
+                exited[pid] = (self._children.pop(pid), status)
+        return exited
+
+    def _shutdown(self) -> None:
+        """Ask the workers to finish their requests and stop, kill those that do not in time."""
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.stop_timeout
+        while self._children and time.monotonic() < deadline:
+            if not self._reap():
+                time.sleep(0.1)
+        for pid in self._children:
+            logger.warning(f"Killing worker {pid} after {self.stop_timeout}s")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self._children = {}
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
@@ -0,0 +1,167 @@
+from typing import Any, Dict, List, Optional, Sequence
+from langchain_core.documents import Document
+from app.cache import ChatResponseCache, LRUCache
+
+DEFAULT_INSTRUCTIONS = (
+    "Answer the question using only the context below. "
+    "If the context does not contain the answer, say that you do not know."
+)
+
+# Rough number of characters per token of English text for BPE tokenizers, the models' tokenizers are not available
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text without the model's tokenizer.
+
+    Parameters:
+    - text (str): The text.
+
+    Returns:
+    - int: The estimated number of tokens.
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def build_context(documents: Sequence[Document], max_tokens: int) -> str:
+    """
+    Join the retrieved documents, best first, into a context that fits the token budget.
+    Duplicate documents are skipped, and documents that do not fit are left out. If not even the
+    best document fits, it is cut to the budget rather than answering without context.
+
+    Parameters:
+    - documents (Sequence[Document]): The retrieved documents, best first.
+    - max_tokens (int): The token budget of the context, 0 for unlimited.
+
+    Returns:
+    - str: The documents separated by blank lines.
+    """
+    parts: List[str] = []
+    seen = set()
+    used = 0
+    for document in documents:
+        text = document.page_content.strip()
+        if not text or text in seen:
+            continue
+        tokens = estimate_tokens(text)
+        if max_tokens and used + tokens > max_tokens:
+            if not parts:
+                parts.append(text[:max_tokens * CHARS_PER_TOKEN])
+                break
+            continue
+        seen.add(text)
+        parts.append(text)
+        used += tokens
+    return "\n\n".join(parts)
+
+
+class RagPipeline:
+    """
+    Builds retrieval-augmented prompts and caches the retrieved contexts per query.
+
+    The prompt starts with the instructions and the question and ends with the context, so its
+    beginning is known before the documents are retrieved. The chat model can evaluate this prefix
+    while the retrieval runs, and the final prompt reuses it from the model server's prompt cache.
+    Cached contexts are keyed on the revision of the database, so they are not reused after an ingestion.
+
+    Attributes:
+    - k (int): The default number of documents retrieved per question.
+    - max_context_tokens (int): The token budget of the context, 0 for unlimited.
+    - prefill (bool): Whether the prompt prefix is sent to the chat model while retrieving.
+    - instructions (str): The instructions at the start of every prompt.
+    - contexts (LRUCache): The cache of built contexts.
+    """
+
+    def __init__(self, k: int = 4, max_context_tokens: int = 1024, cache_entries: int = 1024,
+                 cache_ttl_seconds: float = 300, prefill: bool = True, instructions: str = DEFAULT_INSTRUCTIONS):
+        """
+        Initialize the RagPipeline.
+
+        Parameters:
+        - k (int): The default number of documents retrieved per question.
+        - max_context_tokens (int): The token budget of the context, 0 for unlimited.
+        - cache_entries (int): The maximum number of cached contexts, 0 for unlimited.
+        - cache_ttl_seconds (float): How long a cached context stays valid, 0 for forever.
+        - prefill (bool): Send the prompt prefix to the chat model while retrieving.
+        - instructions (str): The instructions at the start of every prompt.
+        """
+        self.k = k
+        self.max_context_tokens = max_context_tokens
+        self.prefill = prefill
+        self.instructions = instructions
+        self.contexts = LRUCache(max_entries=cache_entries, ttl_seconds=cache_ttl_seconds)
+
+    def prompt_prefix(self, question: str) -> str:
+        """
+        Build the part of the prompt that does not depend on the retrieved documents.
+
+        Parameters:
+        - question (str): The question.
+
+        Returns:
+        - str: The instructions and the question, ending where the context starts.
+        """
+        return f"{self.instructions}\n\nQuestion: {question.strip()}\n\nContext:\n"
+
+    def build_prompt(self, question: str, context: str) -> str:
+        """
+        Build the full prompt; it always starts with prompt_prefix(question).
+
+        Parameters:
+        - question (str): The question.
+        - context (str): The context built from the retrieved documents.
+
+        Returns:
+        - str: The prompt for the chat model.
+        """
+        return f"{self.prompt_prefix(question)}{context}\n\nAnswer:"
+
+    def context_key(self, db: Any, question: str, k: int) -> tuple:
+        """
+        Key a context on the database revision, the normalized question and k. Take the key before
+        retrieving, so documents retrieved during an ingestion are not cached under the new revision.
+
+        Parameters:
+        - db (ChromaDBHandler): The database the context is retrieved from.
+        - question (str): The question.
+        - k (int): The number of retrieved documents.
+
+        Returns:
+        - tuple: The cache key.
+        """
+        return db.revision, ChatResponseCache.normalize(question), k
+
+    def get_context(self, key: tuple) -> Optional[str]:
+        """
+        Look up a cached context.
+
+        Parameters:
+        - key (tuple): The key from context_key().
+
+        Returns:
+        - Optional[str]: The context, None if it is not cached.
+        """
+        return self.contexts.get(key)
+
+    def put_context(self, key: tuple, documents: Sequence[Document]) -> str:
+        """
+        Build the context from the retrieved documents and cache it.
+
+        Parameters:
+        - key (tuple): The key from context_key().
+        - documents (Sequence[Document]): The retrieved documents, best first.
+
+        Returns:
+        - str: The context.
+        """
+        context = build_context(documents, self.max_context_tokens)
+        self.contexts.put(key, context)
+        return context
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+        - Dict[str, Any]: Hits, misses, hit ratio and number of cached contexts.
+        """
+        return self.contexts.stats()
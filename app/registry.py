@@ -0,0 +1,345 @@
+import logging
+import ssl
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Callable, Dict, Optional
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "int8")
+
+
+def select_device() -> str:
+    """
+    Select the device to run models on.
+
+    Returns:
+    - str: 'cuda' if a GPU is available, otherwise 'cpu'.
+    """
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def set_torch_threads(threads: int) -> None:
+    """
+    Limit the intra-op threads of torch in this process, if torch is installed.
+
+    Parameters:
+    - threads (int): The number of threads, 0 to keep the torch default.
+    """
+    if threads <= 0:
+        return
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def quantize_linear_layers(module: Any) -> Any:
+    """
+    Apply dynamic int8 quantization to the linear layers of a torch module, in place.
+    Weights are stored as int8 and activations are quantized on the fly, which makes the matrix
+    products of transformer models about 2-4x faster on CPU and their weights 4x smaller.
+
+    Parameters:
+    - module (torch.nn.Module): The model, on the CPU.
+
+    Returns:
+    - torch.nn.Module: The quantized model.
+    """
+    import torch
+
+    for layer in module.modules():
+        # Subclasses such as Whisper's Linear only cast the weight dtype in forward() and are not
+        # recognized by quantize_dynamic, which matches exact types
+        if isinstance(layer, torch.nn.Linear) and type(layer) is not torch.nn.Linear:
+            layer.__class__ = torch.nn.Linear
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def load_whisper_model(model_size: str, precision: str = "fp32") -> Any:
+    """
+    Load a Whisper model from disk (downloading it on first use).
+
+    Parameters:
+    - model_size (str): The size of the Whisper model to load (e.g., 'tiny', 'base', 'small', 'medium', 'large').
+    - precision (str): 'fp32', or 'int8' for dynamic int8 quantization of the linear layers (CPU only).
+
+    Returns:
+    - whisper.Whisper: The loaded model.
+
+    Raises:
+    - ValueError: If the precision is unknown.
+    """
+    import whisper
+
+    _check_precision(precision)
+    # Disable SSL verification - WARNING: NOT SAFE
+    ssl._create_default_https_context = ssl._create_unverified_context
+
+    device = select_device()
+    logger.info(f"Loading Whisper model: {model_size} on {device} ({precision})")
+    model = whisper.load_model(model_size, device=device)
+    if precision == "int8":
+        if device != "cpu":
+            logger.warning("int8 quantization is only supported on CPU, keeping the fp32 Whisper model")
+        else:
+            model = quantize_linear_layers(model)
+    return model
+
+
+def load_embedding_model(model_name: str, precision: str = "fp32") -> Any:
+    """
+    Load a sentence transformer embedding model (downloading it on first use).
+
+    Parameters:
+    - model_name (str): The name of the sentence transformer model, e.g. 'all-MiniLM-L6-v2'.
+    - precision (str): 'fp32', or 'int8' for dynamic int8 quantization of the linear layers (CPU only).
+
+    Returns:
+    - SentenceTransformerEmbeddings: The LangChain wrapper around the loaded model.
+
+    Raises:
+    - ValueError: If the precision is unknown.
+    """
+    from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+
+    _check_precision(precision)
+    logger.info(f"Loading embedding model: {model_name} ({precision})")
+    embeddings = SentenceTransformerEmbeddings(model_name=model_name)
+    if precision == "int8":
+        if str(embeddings.client.device) != "cpu":
+            logger.warning("int8 quantization is only supported on CPU, keeping the fp32 embedding model")
+        else:
+            quantize_linear_layers(embeddings.client)
+    return embeddings
+
+
+def _check_precision(precision: str) -> None:
+    """Reject unknown precision modes before a model is loaded."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+
+
+def estimate_model_bytes(model: Any) -> int:
+    """
+    Estimate the memory held by a torch model from its parameters and buffers.
+
+    Parameters:
+    - model (torch.nn.Module): The model to measure.
+
+    Returns:
+    - int: The number of bytes, or 0 if the object is not a torch module.
+    """
+    # LangChain embedding wrappers keep the torch module in .client
+    model = getattr(model, "client", model)
+    total = 0
+    for attr in ("parameters", "buffers"):
+        tensors = getattr(model, attr, None)
+        if tensors is None:
+            continue
+        for tensor in tensors():
+            total += tensor.numel() * tensor.element_size()
+    # Dynamically quantized layers keep their packed int8 weight outside of parameters()
+    for layer in model.modules() if hasattr(model, "modules") else ():
+        weight = getattr(layer, "weight", None)
+        if callable(weight):
+            tensor = weight()
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelRegistry:
+    """
+    A process-wide registry that keeps loaded models resident and shares them across requests.
+
+    Each model size is loaded at most once; concurrent requests for a size that is still
+    loading wait for the same load. When a memory budget is set, the least recently used
+    models are evicted until the resident set fits the budget again. The most recently
+    requested model is never evicted, so a single model larger than the budget still works.
+
+    Attributes:
+    - loader (Callable[[str], Any]): Function that loads a model for a given size.
+    - memory_budget_bytes (int): Upper bound for resident model memory, 0 for unlimited.
+    - max_models (int): Upper bound for the number of resident models, 0 for unlimited.
+    - precision (str): The precision passed to the loader, e.g. 'fp32' or 'int8', None to use the loader's default.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], Any] = load_whisper_model,
+        memory_budget_mb: float = 0,
+        max_models: int = 0,
+        size_estimator: Callable[[Any], int] = estimate_model_bytes,
+        precision: Optional[str] = None,
+    ):
+        """
+        Initialize the ModelRegistry.
+
+        Parameters:
+        - loader (Callable[[str], Any]): Function that loads a model for a given size.
+        - memory_budget_mb (float): Memory budget in MiB for all resident models, 0 for unlimited.
+        - max_models (int): Maximum number of resident models, 0 for unlimited.
+        - size_estimator (Callable[[Any], int]): Function that returns the memory held by a model in bytes.
+        - precision (str): The precision passed to the loader, None to use the loader's default.
+        """
+        self.loader = loader
+        self.precision = precision
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self.max_models = max_models
+        self.size_estimator = size_estimator
+        self._models: "OrderedDict[str, Any]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._errors: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def configure(self, memory_budget_mb: float = 0, max_models: int = 0, precision: Optional[str] = None) -> None:
+        """
+        Update the budgets and evict models that no longer fit.
+
+        Parameters:
+        - memory_budget_mb (float): Memory budget in MiB for all resident models, 0 for unlimited.
+        - max_models (int): Maximum number of resident models, 0 for unlimited.
+        - precision (str): The precision models are loaded with from now on, None to keep the current one.
+          Resident models loaded with another precision are evicted.
+        """
+        with self._lock:
+            self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+            self.max_models = max_models
+            if precision is not None and precision != self.precision:
+                self.precision = precision
+                self._models.clear()
+                self._sizes.clear()
+            if self._models:
+                self._evict(keep=next(reversed(self._models)))
+
+    def factory(self, model_size: str) -> Callable[[], Any]:
+        """
+        Build a function that loads a model the way get() does, e.g. for worker processes with their own copy.
+
+        Parameters:
+        - model_size (str): The size of the model.
+
+        Returns:
+        - Callable[[], Any]: A picklable function that loads the model with the registry's precision.
+        """
+        if self.precision is None:
+            return partial(self.loader, model_size)
+        return partial(self.loader, model_size, precision=self.precision)
+
+    def get(self, model_size: str) -> Any:
+        """
+        Return the resident model for the given size, loading it if necessary.
+
+        Parameters:
+        - model_size (str): The size of the model.
+
+        Returns:
+        - Any: The loaded model.
+        """
+        with self._lock:
+            model = self._touch(model_size)
+            if model is not None:
+                return model
+            load_lock = self._load_locks.setdefault(model_size, threading.Lock())
+
+        # Only one thread loads a given size, the others wait for it and reuse the result
+        with load_lock:
+            with self._lock:
+                model = self._touch(model_size)
+                if model is not None:
+                    return model
+            try:
+                model = self.factory(model_size)()
+            except Exception as e:
+                with self._lock:
+                    self._errors[model_size] = str(e)
+                raise
+            nbytes = self.size_estimator(model)
+            with self._lock:
+                self._errors.pop(model_size, None)
+                self._models[model_size] = model
+                self._sizes[model_size] = nbytes
+                self._evict(keep=model_size)
+            logger.info(f"Model {model_size} resident ({nbytes / 1024 / 1024:.1f} MiB)")
+            return model
+
+    def is_ready(self, model_size: str) -> bool:
+        """
+        Check whether a model size is resident.
+
+        Parameters:
+        - model_size (str): The size of the model.
+
+        Returns:
+        - bool: True if the model is loaded.
+        """
+        with self._lock:
+            return model_size in self._models
+
+    def evict(self, model_size: str) -> None:
+        """
+        Drop a model from the registry. In-flight requests keep their reference until they finish.
+
+        Parameters:
+        - model_size (str): The size of the model.
+        """
+        with self._lock:
+            self._models.pop(model_size, None)
+            self._sizes.pop(model_size, None)
+
+    def resident_bytes(self) -> int:
+        """
+        Returns:
+        - int: The estimated memory held by all resident models.
+        """
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Report the resident models and failed loads.
+
+        Returns:
+        - Dict[str, Any]: Resident model sizes with their memory, failed loads and the memory budget.
+        """
+        with self._lock:
+            return {
+                "models": {size: {"bytes": nbytes} for size, nbytes in self._sizes.items()},
+                "errors": dict(self._errors),
+                "resident_bytes": sum(self._sizes.values()),
+                "memory_budget_bytes": self.memory_budget_bytes,
+            }
+
+    def _touch(self, model_size: str) -> Optional[Any]:
+        """Return a resident model and mark it as most recently used. Caller holds the lock."""
+        model = self._models.get(model_size)
+        if model is not None:
+            self._models.move_to_end(model_size)
+        return model
+
+    def _evict(self, keep: str) -> None:
+        """Evict least recently used models until the budgets are met. Caller holds the lock."""
+        def over_budget() -> bool:
+            if self.max_models and len(self._models) > self.max_models:
+                return True
+            return bool(self.memory_budget_bytes) and sum(self._sizes.values()) > self.memory_budget_bytes
+
+        while over_budget():
+            victim = next((size for size in self._models if size != keep), None)
+            if victim is None:
+                break
+            logger.info(f"Evicting model {victim} from registry")
+            del self._models[victim]
+            del self._sizes[victim]
+
+
+# Process-wide registry shared by all WhisperTranscriber handles that do not get their own
+default_registry = ModelRegistry()
+
+# Process-wide registry of embedding models, so every database handle of a model shares one copy
+embedding_registry = ModelRegistry(loader=load_embedding_model)
@@ -1,11 +1,26 @@
-from fastapi import APIRouter, UploadFile, File, Depends, status
+from fastapi import APIRouter, Body, UploadFile, File, Depends, HTTPException, Query, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from typing import List, Optional
 from pydantic import BaseModel
 from app.models import WhisperTranscriber, OllamaChatModel
-from app.utils import handle_transcription
+from app.audio import SilenceTrimmer
+from app.batching import QueueFullError, SimilarityBatcher, TranscriptionScheduler
+from app.cache import ChatResponseCache, TranscriptionCache
+from app.utils import (
+    handle_transcription, handle_streaming_transcription, chat_response_async, similarity_search_async,
+    handle_document_ingestion, handle_job_submission, handle_rag_response, stream_chat_batch, stream_similarity_batch,
+)
 from app.database import ChromaDBHandler
+from app.jobs import JobStore, job_view
+from app.rag import RagPipeline
+from app.startup import FAILED, LOADING, READY, StartupOrchestrator
+from app.metrics import CONTENT_TYPE, default_metrics
 
 router = APIRouter()
 
+# Upper bound for the number of items in one batch request
+MAX_BATCH_ITEMS = 10000
+
 class ChatItem(BaseModel):
     """Response model for a chat item."""
     text: str
@@ -15,23 +30,118 @@ class SimilaritySearchItem(BaseModel):
     text: str
     k: int
 
+class RagItem(BaseModel):
+    """Request model for a question answered from the database."""
+    text: str
+    k: Optional[int] = None
+
 class HealthCheck(BaseModel):
     """Response model to validate and return when performing a health check."""
     status: str = "OK"
+    services: Optional[dict] = None
+    startup_seconds: Optional[float] = None
+
+class ReadinessCheck(BaseModel):
+    """Response model to validate and return when performing a readiness check."""
+    status: str
+    models: dict
+    services: Optional[dict] = None
 
 @router.post("/transcribe")
-async def transcribe_audio(file: UploadFile = File(...), transcriber: WhisperTranscriber = Depends()):
+async def transcribe_audio(file: UploadFile = File(...), transcriber: WhisperTranscriber = Depends(),
+                           scheduler: TranscriptionScheduler = Depends(), cache: TranscriptionCache = Depends(),
+                           trimmer: Optional[SilenceTrimmer] = Depends(SilenceTrimmer)):
     """
     Endpoint to transcribe an uploaded audio file to text.
 
     Parameters:
     - file (UploadFile): The uploaded audio file.
     - transcriber (WhisperTranscriber): An instance of WhisperTranscriber to perform the transcription (injected by FastAPI).
+    - scheduler (TranscriptionScheduler): The micro-batching scheduler the transcription is queued on (injected by FastAPI).
+    - cache (TranscriptionCache): The result cache for repeated uploads (injected by FastAPI).
+    - trimmer (SilenceTrimmer): Cuts silence out before transcription, None if disabled (injected by FastAPI).
+
+    Returns:
+    - JSONResponse: A JSON response containing the transcript text, or 503 with Retry-After if the queue is full.
+    """
+    return await handle_transcription(file, transcriber, scheduler, cache, trimmer)
+
+@router.post("/transcribe/stream")
+async def transcribe_audio_stream(
+    file: UploadFile = File(...),
+    window_seconds: float = Query(30.0, gt=1, le=30, description="Maximum length of a transcription window in seconds."),
+    transcriber: WhisperTranscriber = Depends(),
+    scheduler: TranscriptionScheduler = Depends(),
+    trimmer: Optional[SilenceTrimmer] = Depends(SilenceTrimmer),
+):
+    """
+    Endpoint to transcribe an uploaded audio file and stream the segments while they are transcribed.
+
+    Parameters:
+    - file (UploadFile): The uploaded audio file.
+    - window_seconds (float): Maximum length of a transcription window in seconds.
+    - transcriber (WhisperTranscriber): An instance of WhisperTranscriber to perform the transcription (injected by FastAPI).
+    - scheduler (TranscriptionScheduler): The scheduler the windows are queued on (injected by FastAPI).
+    - trimmer (SilenceTrimmer): Cuts silence out of each window, None if disabled (injected by FastAPI).
 
     Returns:
-    - JSONResponse: A JSON response containing the transcript text.
+    - StreamingResponse: NDJSON lines with the segments ({"start", "end", "text"}), then {"done": true, "duration"}
+      (and "skipped_seconds" if silence trimming is enabled).
     """
-    return await handle_transcription(file, transcriber)
+    return await handle_streaming_transcription(file, transcriber, window_seconds, trimmer, scheduler)
+
+@router.post(
+    "/jobs/transcribe",
+    tags=["jobs"],
+    summary="Queue an audio file for transcription",
+    response_description="Return the ID of the queued job",
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def submit_transcription_job(
+    file: UploadFile = File(...),
+    priority: int = Query(0, ge=-100, le=100, description="Jobs with a higher priority run first."),
+    webhook_url: Optional[str] = Query(None, pattern=r"^https?://", description="URL the finished job is POSTed to."),
+    store: JobStore = Depends(),
+):
+    """
+    Endpoint to queue an audio file for transcription by the job workers, for long files and bulk workloads.
+    Poll GET /jobs/{job_id} for the result, or pass a webhook URL to be called when the job is finished.
+
+    Parameters:
+    - file (UploadFile): The uploaded audio file.
+    - priority (int): Jobs with a higher priority run first.
+    - webhook_url (str): Optional URL the finished job is POSTed to.
+    - store (JobStore): The persistent job queue (injected by FastAPI).
+
+    Returns:
+    - JSONResponse: 202 with the job ID and status.
+    """
+    return await handle_job_submission(file, store, priority, webhook_url)
+
+@router.get(
+    "/jobs/{job_id}",
+    tags=["jobs"],
+    summary="Get the status and result of a job",
+    response_description="Return the status, timestamps and, once finished, the result or error of the job",
+    status_code=status.HTTP_200_OK,
+    response_model=dict,
+)
+def get_job(job_id: str, store: JobStore = Depends()):
+    """
+    Endpoint to poll a transcription job.
+
+    Parameters:
+    - job_id (str): The ID returned when the job was queued.
+    - store (JobStore): The persistent job queue (injected by FastAPI).
+
+    Returns:
+    - JSONResponse: The job with status queued, running, done or failed; done jobs carry the transcript in 'result'.
+      404 if the job does not exist or its result has expired.
+    """
+    job = store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job_view(job)
 
 @router.post(
     "/chat_response",
@@ -41,20 +151,70 @@ async def transcribe_audio(file: UploadFile = File(...), transcriber: WhisperTra
     status_code=status.HTTP_200_OK,
     response_model=dict,
 )
-async def chat_model_response(prompt: ChatItem, model: OllamaChatModel = Depends()):
+async def chat_model_response(prompt: ChatItem, model: OllamaChatModel = Depends(),
+                              cache: ChatResponseCache = Depends()):
     """
     Endpoint to generate a response from the OllamaChatModel.
 
     Parameters:
     - prompt (ChatItem): The prompt to generate a response for.
     - model (OllamaChatModel): The OllamaChatModel to use for generating the response.
+    - cache (ChatResponseCache): The response cache for repeated and near-identical prompts.
 
     Returns:
     - JSONResponse: A JSON response containing the generated response.
     """
-    response = model.chat(prompt.text)
+    response = await chat_response_async(model, prompt.text, cache)
     return {"response": response}
 
+@router.post(
+    "/chat_response/stream",
+    tags=["chat"],
+    summary="Stream a response from the OllamaChatModel",
+    response_description="Stream the tokens of the response as plain text while they are generated",
+    status_code=status.HTTP_200_OK,
+)
+async def chat_model_response_stream(prompt: ChatItem, model: OllamaChatModel = Depends()):
+    """
+    Endpoint to stream a response from the OllamaChatModel token by token.
+
+    Parameters:
+    - prompt (ChatItem): The prompt to generate a response for.
+    - model (OllamaChatModel): The OllamaChatModel to use for generating the response.
+
+    Returns:
+    - StreamingResponse: The generated tokens as plain text, sent as they arrive.
+    """
+    return StreamingResponse(model.astream(prompt.text), media_type="text/plain")
+
+@router.post(
+    "/chat_response/batch",
+    tags=["chat"],
+    summary="Generate responses to many prompts",
+    response_description="Stream one NDJSON line per prompt, in request order",
+    status_code=status.HTTP_200_OK,
+)
+async def chat_model_response_batch(
+    prompts: List[ChatItem] = Body(..., max_length=MAX_BATCH_ITEMS),
+    model: OllamaChatModel = Depends(),
+    cache: ChatResponseCache = Depends(),
+):
+    """
+    Endpoint to generate responses to a list of prompts in one request.
+    Prompts run concurrently up to the model's concurrency limit, and responses are streamed back in order.
+
+    Parameters:
+    - prompts (List[ChatItem]): The prompts to generate responses for.
+    - model (OllamaChatModel): The OllamaChatModel to use for generating the responses.
+    - cache (ChatResponseCache): The response cache for repeated and near-identical prompts.
+
+    Returns:
+    - StreamingResponse: NDJSON lines {"index", "response"}, or {"index", "error"} for prompts that failed.
+    """
+    return StreamingResponse(
+        stream_chat_batch(model, [prompt.text for prompt in prompts], cache), media_type="application/x-ndjson"
+    )
+
 @router.post(
     "/similarity",
     tags=["similarity"],
@@ -63,20 +223,142 @@ async def chat_model_response(prompt: ChatItem, model: OllamaChatModel = Depends
     status_code=status.HTTP_200_OK,
     response_model=dict,
     )
-async def similarity(prompt: SimilaritySearchItem, db: ChromaDBHandler = Depends()):
+async def similarity(prompt: SimilaritySearchItem, db: ChromaDBHandler = Depends(),
+                     batcher: SimilarityBatcher = Depends()):
     """
     Endpoint to retrieve the top k similar documents from the database.
+    Concurrent queries are embedded and searched together in one batch off the event loop.
 
     Parameters:
     - prompt (SimilaritySearchItem): The prompt to search for k most similar documents.
 
     Returns:
-    - JSONResponse: A JSON response containing the top k similar documents. 
+    - JSONResponse: A JSON response containing the top k similar documents, or 503 with Retry-After if the queue is full.
+      With a sharded index, "partial" and "missing_shards" are added when shards did not answer in time.
     """
-    k_most_similar = db.similarity_search(prompt.text, k=prompt.k)
+    try:
+        k_most_similar = await similarity_search_async(db, prompt.text, prompt.k, batcher)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
     response = [{'content': doc.page_content, 'top_k': index} for index, doc in enumerate(k_most_similar)]
+    missing_shards = getattr(k_most_similar, "missing_shards", None)
+    if missing_shards:
+        return {"documents": response, "partial": True, "missing_shards": missing_shards}
     return {"documents": response}
 
+@router.post(
+    "/similarity/batch",
+    tags=["similarity"],
+    summary="Retrieve the top k most similar documents for many queries",
+    response_description="Stream one NDJSON line per query, in request order",
+    status_code=status.HTTP_200_OK,
+)
+async def similarity_batch(prompts: List[SimilaritySearchItem] = Body(..., max_length=MAX_BATCH_ITEMS),
+                           db: ChromaDBHandler = Depends()):
+    """
+    Endpoint to retrieve the top k similar documents for a list of queries in one request.
+    Queries are embedded and searched in large batches, and results are streamed back in order.
+
+    Parameters:
+    - prompts (List[SimilaritySearchItem]): The queries and their number of results.
+
+    Returns:
+    - StreamingResponse: NDJSON lines {"index", "documents"}, or {"index", "error"} for queries that failed.
+    """
+    queries = [(prompt.text, prompt.k) for prompt in prompts]
+    return StreamingResponse(stream_similarity_batch(db, queries), media_type="application/x-ndjson")
+
+@router.post(
+    "/rag",
+    tags=["rag"],
+    summary="Answer a question from the documents in the database",
+    response_description="Stream the tokens of the answer as plain text while they are generated",
+    status_code=status.HTTP_200_OK,
+)
+async def rag_response(prompt: RagItem, db: ChromaDBHandler = Depends(), model: OllamaChatModel = Depends(),
+                       pipeline: RagPipeline = Depends(), batcher: SimilarityBatcher = Depends()):
+    """
+    Endpoint to retrieve the documents most similar to a question and stream the chat model's answer to it,
+    in one request. The retrieved context is cut to the pipeline's token budget and cached per question.
+
+    Parameters:
+    - prompt (RagItem): The question, and optionally the number of documents to retrieve.
+    - db (ChromaDBHandler): The database to retrieve the documents from (injected by FastAPI).
+    - model (OllamaChatModel): The OllamaChatModel that answers (injected by FastAPI).
+    - pipeline (RagPipeline): Builds the prompt and caches the contexts (injected by FastAPI).
+    - batcher (SimilarityBatcher): The batcher the retrieval is queued on (injected by FastAPI).
+
+    Returns:
+    - StreamingResponse: The generated tokens as plain text, or 503 with Retry-After if the retrieval queue is full.
+    """
+    k = prompt.k or pipeline.k
+    return await handle_rag_response(prompt.text, k, db, model, pipeline, batcher)
+
+@router.post(
+    "/documents",
+    tags=["similarity"],
+    summary="Add text documents to the database",
+    response_description="Return how many chunks were added, unchanged and removed",
+    status_code=status.HTTP_200_OK,
+    response_model=dict,
+)
+async def ingest_documents(files: List[UploadFile] = File(...), db: ChromaDBHandler = Depends()):
+    """
+    Endpoint to add or update text documents in the database.
+    Re-uploading a file with the same name replaces its previous version; unchanged chunks are not embedded again.
+
+    Parameters:
+    - files (List[UploadFile]): The UTF-8 text files to ingest.
+
+    Returns:
+    - JSONResponse: A JSON response with the number of files and chunks processed, added, unchanged and removed.
+    """
+    return await handle_document_ingestion(files, db)
+
+@router.get(
+    "/cache/stats",
+    tags=["cache"],
+    summary="Report cache statistics",
+    response_description="Return hit/miss counters and sizes of the result caches",
+    status_code=status.HTTP_200_OK,
+    response_model=dict,
+)
+def cache_stats(transcription_cache: TranscriptionCache = Depends(), chat_cache: ChatResponseCache = Depends(),
+                pipeline: RagPipeline = Depends(), startup: StartupOrchestrator = Depends()):
+    """
+    Endpoint to report the hits, misses and sizes of the result caches.
+    Answers while the database is still loading; its query embedding cache is reported once it is ready.
+
+    Returns:
+    - JSONResponse: A JSON response with the statistics per cache.
+    """
+    stats = {
+        "transcription": transcription_cache.stats(),
+        "chat": chat_cache.stats(),
+        "rag_contexts": pipeline.stats(),
+    }
+    if startup.is_ready("database"):
+        stats["query_embeddings"] = startup.get("database").query_cache.stats()
+    return stats
+
+@router.get(
+    "/metrics",
+    tags=["monitoring"],
+    summary="Export Prometheus metrics",
+    response_description="Return the metrics in the Prometheus text exposition format",
+    status_code=status.HTTP_200_OK,
+    response_class=Response,
+)
+def metrics():
+    """
+    Endpoint to scrape request counts, per-stage latency histograms, queue depths, audio and token
+    throughput and cache hit ratios.
+
+    Returns:
+    - Response: The metrics in the Prometheus text format.
+    """
+    return Response(content=default_metrics.render(), media_type=CONTENT_TYPE)
+
 @router.get(
     "/health",
     tags=["healthcheck"],
@@ -84,12 +366,50 @@ async def similarity(prompt: SimilaritySearchItem, db: ChromaDBHandler = Depends
     response_description="Return HTTP Status Code 200 (OK)",
     status_code=status.HTTP_200_OK,
     response_model=HealthCheck,
+    response_model_exclude_none=True,
 )
-def get_health() -> HealthCheck:
+async def get_health(detail: bool = False, startup: StartupOrchestrator = Depends()) -> HealthCheck:
     """
-    Endpoint to perform a healthcheck on. 
-    
+    Endpoint to perform a healthcheck on. The service is healthy as soon as it accepts requests,
+    even while models are still loading. It is exempt from admission control and runs on the event loop,
+    so it answers even when the other endpoints are overloaded.
+
+    Parameters:
+    - detail (bool): Also report the readiness and load time of every service and the total startup time.
+
     Returns:
         HealthCheck: Returns a JSON response with the health status
     """
-    return HealthCheck(status="OK")
\ No newline at end of file
+    if not detail:
+        return HealthCheck(status="OK")
+    report = startup.status()
+    return HealthCheck(status="OK", services=report["services"], startup_seconds=report["startup_seconds"])
+
+@router.get(
+    "/ready",
+    tags=["healthcheck"],
+    summary="Perform a Readiness Check",
+    response_description="Return HTTP Status Code 200 (OK) once the models are loaded, 503 otherwise",
+    status_code=status.HTTP_200_OK,
+    response_model=ReadinessCheck,
+)
+def get_readiness(transcriber: WhisperTranscriber = Depends(), startup: StartupOrchestrator = Depends()):
+    """
+    Endpoint to check whether the transcription model and all background services are loaded
+    and requests can be served without load delay.
+
+    Returns:
+        ReadinessCheck: Returns a JSON response with the readiness status, the resident models and the services
+    """
+    registry = transcriber.registry
+    report = registry.status()
+    services = startup.status()["services"]
+    states = {service["status"] for service in services.values()}
+    if registry.is_ready(transcriber.model_size) and states <= {READY}:
+        return ReadinessCheck(status="OK", models=report["models"], services=services)
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=ReadinessCheck(
+            status=FAILED if FAILED in states else LOADING, models=report["models"], services=services
+        ).model_dump(),
+    )
\ No newline at end of file
@@ -0,0 +1,679 @@
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from multiprocessing.connection import Client, Listener
+from typing import Any, Deque, Dict, List, Optional, Sequence, Union
+import numpy as np
+from app.vector_index import STORAGE_DTYPES, VectorStore, collection_pages, directory_lock, id_hash
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "shards.json"
+
+# Commands that change a shard; they run one at a time, next to the searches
+WRITE_COMMANDS = ("begin", "add", "remove", "commit", "discard")
+
+# Write requests a writer keeps in flight per shard before it waits, to bound the data buffered for a shard
+MAX_WRITES_IN_FLIGHT = 4
+
+
+def shard_of(record_id: str, shards: int) -> int:
+    """
+    Assign a record to a shard by a stable hash of its ID, so a record stays on its shard across rebuilds.
+
+    Parameters:
+    - record_id (str): The ID of the record.
+    - shards (int): The number of shards.
+
+    Returns:
+    - int: The shard index.
+    """
+    return id_hash(record_id) % shards
+
+
+class _ShardServer:
+    """
+    The request handler of a shard worker process: a VectorStore read by searches and written by one
+    IndexWriter per change, each change identified by a token its client chose.
+    """
+
+    def __init__(self, store: VectorStore):
+        self.store = store
+        self.writes = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-writes")
+        self.writers: Dict[str, Any] = {}
+
+    def handle(self, command: str, *args) -> Any:
+        """Run one command and return its result."""
+        if command == "load":
+            if self.store.exists():
+                self.store.load()
+            return self.store.size
+        if command == "search":
+            return self.store.search_with_scores(*args)
+        if command == "begin":
+            token, replace = args
+            self.writers[token] = self.store.writer(replace=replace)
+            return None
+        if command == "add":
+            token, *records = args
+            return self.writers[token].add(*records)
+        if command == "remove":
+            token, ids = args
+            return self.writers[token].remove(ids)
+        if command == "commit":
+            self.writers.pop(args[0]).commit()
+            return self.store.size
+        if command == "discard":
+            writer = self.writers.pop(args[0], None)
+            return None if writer is None else writer.discard()
+        raise ValueError(f"Unknown shard command {command!r}")
+
+    def serve(self, conn) -> None:
+        """Answer the requests of one connection until it closes. Writes are queued, searches answered at once."""
+        send_lock = threading.Lock()
+
+        def reply(request_id: int, command: str, args: tuple) -> None:
+            try:
+                result = self.handle(command, *args)
+            except Exception as e:
+                result = e
+            with send_lock:
+                try:
+                    conn.send((request_id, result))
+                except (BrokenPipeError, OSError):
+                    pass
+
+        while True:
+            try:
+                command, request_id, *args = conn.recv()
+            except (EOFError, OSError):
+                return
+            if command in WRITE_COMMANDS:
+                self.writes.submit(reply, request_id, command, args)
+            else:
+                reply(request_id, command, args)
+
+
+def _serve_shard(directory: str, ivf_threshold: int, n_probe: int, precision: str, address: str, authkey: bytes,
+                 lifeline) -> None:
+    """
+    Serve one shard in a worker process. Every process that uses the shard connects to its address and sends
+    (command, request_id, *args) messages, answered with (request_id, result) on the same connection: 'load'
+    reloads the shard from disk and returns its size, 'search' returns the scored top k per query, and
+    'begin', 'add', 'remove', 'commit' and 'discard' write the shard's part of a change. Writes run one at a
+    time on their own thread, so searches are answered while the shard is rewritten. Errors are sent back as
+    the result. The worker stops when its owner sends None on the lifeline pipe or closes it.
+    """
+    store = VectorStore(directory, ivf_threshold=ivf_threshold, n_probe=n_probe, precision=precision)
+    server = _ShardServer(store)
+    listener = None
+    try:
+        if store.exists():
+            store.load()
+        listener = Listener(address, authkey=authkey)
+
+        def accept() -> None:
+            while True:
+                try:
+                    conn = listener.accept()
+                except OSError:
+                    return
+                except Exception as e:
+                    logger.warning(f"Rejected a connection to vector shard {directory}: {str(e)}")
+                    continue
+                threading.Thread(target=server.serve, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=accept, name="shard-accept", daemon=True).start()
+        lifeline.send(None)
+        lifeline.recv()
+    except (EOFError, OSError, KeyboardInterrupt):
+        pass
+    finally:
+        if listener is not None:
+            listener.close()
+
+
+class ShardResults(list):
+    """
+    The documents found for one query, most similar first.
+
+    Attributes:
+    - missing_shards (List[int]): The shards that did not answer in time; empty when the result is complete.
+    """
+
+    def __init__(self, documents=(), missing_shards: Sequence[int] = ()):
+        super().__init__(documents)
+        self.missing_shards = list(missing_shards)
+
+    @property
+    def partial(self) -> bool:
+        """Whether some shards are missing from the result."""
+        return bool(self.missing_shards)
+
+
+class _Shard:
+    """
+    A shard worker process and this process's connection to it.
+
+    The process is started, restarted and stopped only by the process that owns it, e.g. the pre-fork master.
+    Every process that sends requests opens its own connection, so HTTP workers forked from the owner share
+    its shard processes. A reader thread resolves the future of each request by its ID, so a reply that
+    arrives after its request timed out is dropped instead of answering the next one.
+    """
+
+    def __init__(self, index: int, directory: str, options: tuple, context, address: str, authkey: bytes):
+        self.index = index
+        self.directory = directory
+        self.address = address
+        self._options = options
+        self._context = context
+        self._authkey = authkey
+        self._process = None
+        self._lifeline = None
+        self._conn = None
+        self._conn_pid = None
+        self._pending: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        """Whether the worker process runs; only known to its owner."""
+        return self._process is not None and self._process.is_alive()
+
+    def start(self) -> None:
+        """Start the worker process; it loads its shard and listens on its address."""
+        if self.address.startswith(os.sep) and os.path.exists(self.address):
+            os.remove(self.address)
+        parent, child = self._context.Pipe()
+        process = self._context.Process(
+            target=_serve_shard, args=(self.directory, *self._options, self.address, self._authkey, child),
+            name=f"vector-shard-{self.index}", daemon=True,
+        )
+        process.start()
+        child.close()
+        self._process, self._lifeline = process, parent
+
+    def wait_ready(self, timeout: Optional[float]) -> None:
+        """Wait until the started worker listens."""
+        if not self._lifeline.poll(timeout):
+            raise TimeoutError(f"Vector shard {self.index} did not start within {timeout} seconds")
+        try:
+            self._lifeline.recv()
+        except EOFError:
+            raise ConnectionError(f"Vector shard {self.index} exited while starting") from None
+
+    def submit(self, request_id: int, command: str, *args) -> Future:
+        """Send a request to the worker. The future fails with ConnectionError if the worker is gone."""
+        future = Future()
+        with self._lock:
+            try:
+                conn = self._connect()
+                self._pending[request_id] = future
+                conn.send((command, request_id, *args))
+            except (EOFError, OSError) as e:
+                self._pending.pop(request_id, None)
+                self._disconnect()
+                future.set_exception(ConnectionError(f"Shard {self.index} is not running: {e}"))
+        return future
+
+    def forget(self, request_id: int) -> None:
+        """Stop waiting for a request, e.g. after it timed out."""
+        with self._lock:
+            self._pending.pop(request_id, None)
+
+    def _connect(self):
+        """Return this process's connection, opening it first. Connections inherited through fork are dropped."""
+        if self._conn_pid != os.getpid():
+            # Another process's connection and reader thread did not survive the fork
+            self._conn, self._conn_pid, self._pending = None, os.getpid(), {}
+        if self._conn is None:
+            conn = Client(self.address, authkey=self._authkey)
+            self._conn = conn
+            threading.Thread(target=self._read, args=(conn,), name=f"vector-shard-{self.index}-reader",
+                             daemon=True).start()
+        return self._conn
+
+    def _disconnect(self) -> None:
+        """Close this process's connection; the reader thread fails the requests still waiting."""
+        conn, self._conn = self._conn, None
+        if conn is not None and self._conn_pid == os.getpid():
+            conn.close()
+
+    def _read(self, conn) -> None:
+        """Hand replies to their waiting requests until the connection closes, then fail the rest."""
+        while True:
+            try:
+                request_id, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Shard {self.index} stopped"))
+
+    def close(self) -> None:
+        """Close this process's connection to the worker."""
+        with self._lock:
+            self._disconnect()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Ask the owned worker to exit and wait for it."""
+        self.close()
+        process, lifeline = self._process, self._lifeline
+        self._process = self._lifeline = None
+        if process is None:
+            return
+        try:
+            lifeline.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        lifeline.close()
+
+
+class ShardWriter:
+    """
+    A change to a ShardedVectorStore, written by the shard processes: every added record is sent to the shard
+    of its ID, every removed ID to the shard that holds it, and each shard commits its part to its own
+    segments. The sending process only holds a few batches in flight per shard.
+
+    Attributes:
+    - store (ShardedVectorStore): The store the change applies to.
+    - replace (bool): Replace the content of the shards instead of adding to it.
+    - shards (List[int]): The shards the change writes; records of other shards are skipped.
+    """
+
+    def __init__(self, store: "ShardedVectorStore", replace: bool = False, shards: Optional[Sequence[int]] = None):
+        self.store = store
+        self.replace = replace
+        self.shards = list(range(store.shards)) if shards is None else list(shards)
+        self.digests: Dict[int, str] = {}
+        self._token = uuid.uuid4().hex
+        self._in_flight: Dict[int, Deque[Future]] = {shard: deque() for shard in self.shards}
+        for shard in self.shards:
+            self._send(shard, "begin", replace)
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray, texts: Sequence[str],
+            metadatas: Sequence[Optional[dict]]) -> None:
+        """
+        Send records to their shards.
+
+        Parameters:
+        - ids (Sequence[str]): The IDs of the records.
+        - vectors (np.ndarray): The (n, d) embeddings of the records.
+        - texts (Sequence[str]): The texts of the records.
+        - metadatas (Sequence[Optional[dict]]): The metadata of the records.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        assignment = np.fromiter((shard_of(i, self.store.shards) for i in ids), dtype=np.int64, count=len(ids))
+        for shard in self.shards:
+            rows = np.flatnonzero(assignment == shard)
+            if len(rows):
+                self._send(shard, "add", [ids[row] for row in rows], vectors[rows],
+                           [texts[row] for row in rows], [metadatas[row] for row in rows])
+
+    def remove(self, ids: Sequence[str]) -> None:
+        """
+        Remove records from their shards. IDs the shards do not hold are ignored.
+
+        Parameters:
+        - ids (Sequence[str]): The IDs of the records.
+        """
+        by_shard: Dict[int, List[str]] = {}
+        for record_id in ids:
+            by_shard.setdefault(shard_of(record_id, self.store.shards), []).append(record_id)
+        for shard, shard_ids in by_shard.items():
+            if shard in self._in_flight:
+                self._send(shard, "remove", shard_ids)
+
+    def commit(self) -> List[int]:
+        """
+        Make every shard commit its part of the change and wait for all of them.
+
+        Returns:
+        - List[int]: The shards that were written.
+        """
+        futures = {shard: self._send(shard, "commit") for shard in self.shards}
+        for shard in self.shards:
+            # Surfaces a failed write of any earlier batch
+            for future in self._in_flight[shard]:
+                future.result()
+        self.store._committed({shard: future.result() for shard, future in futures.items()}, self.digests)
+        return self.shards
+
+    def discard(self) -> None:
+        """Drop the change on every shard."""
+        for shard in self.shards:
+            self._send(shard, "discard")
+
+    def _send(self, shard: int, command: str, *args) -> Future:
+        """Send a write to a shard, waiting for its oldest writes once too many are in flight."""
+        worker = self.store._workers[shard]
+        future = worker.submit(next(self.store._requests), command, self._token, *args)
+        in_flight = self._in_flight[shard]
+        in_flight.append(future)
+        while len(in_flight) > MAX_WRITES_IN_FLIGHT:
+            in_flight.popleft().result()
+        return future
+
+
+class ShardedVectorStore:
+    """
+    A vector index partitioned across local worker processes, searched by scatter-gather.
+
+    Records are assigned to shards by a hash of their ID. Every shard is a VectorStore in its own
+    subdirectory, memory-mapped, searched and written by its own process, so the shards score a query batch
+    in parallel, build their partitions in parallel, and no process holds the whole corpus: changes are
+    streamed to the shards in batches (see ShardWriter). The per-shard top k lists are merged with a heap.
+    Shards that do not answer within the timeout are left out and the result is marked partial.
+
+    The shard processes belong to the process that started them, which restarts those that die. Processes
+    forked from it afterwards, e.g. pre-fork HTTP workers, connect to the same shard processes instead of
+    starting their own.
+
+    Attributes:
+    - directory (str): The directory holding the shard subdirectories and the manifest.
+    - shards (int): The number of shards.
+    - ivf_threshold (int): The segment size from which a shard uses an IVF index, 0 to always search exactly.
+    - n_probe (int): The number of IVF clusters searched per query.
+    - precision (str): The storage type of newly written shards, 'float32', 'float16' or 'int8'.
+    - timeout (float): Seconds a search waits for the shards, 0 to wait for all of them.
+    - load_timeout (float): Seconds a (re)load or start waits for a shard.
+    - size (int): The number of indexed vectors across all shards.
+    - stored_precision (str): The storage type of the built shards, None if none are built.
+    """
+
+    def __init__(self, directory: str, shards: int = 2, ivf_threshold: int = 10000, n_probe: int = 8,
+                 precision: str = "float32", timeout: float = 1.0, load_timeout: float = 60.0,
+                 start_method: str = "spawn"):
+        """
+        Initialize the ShardedVectorStore. The worker processes are started by start(), load() or the first build.
+
+        Parameters:
+        - directory (str): The directory holding the shard subdirectories and the manifest.
+        - shards (int): The number of shards.
+        - ivf_threshold (int): The segment size from which a shard uses an IVF index, 0 to always search exactly.
+        - n_probe (int): The number of IVF clusters searched per query.
+        - precision (str): The storage type of newly written shards.
+        - timeout (float): Seconds a search waits for the shards, 0 to wait for all of them.
+        - load_timeout (float): Seconds a (re)load or start waits for a shard.
+        - start_method (str): The multiprocessing start method of the shard processes.
+        """
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        if precision not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown vector precision {precision!r}, expected one of {tuple(STORAGE_DTYPES)}")
+        self.directory = directory
+        self.shards = shards
+        self.ivf_threshold = ivf_threshold
+        self.n_probe = n_probe
+        self.precision = precision
+        self.timeout = timeout
+        self.load_timeout = load_timeout
+        self.start_method = start_method
+        self._workers: List[_Shard] = []
+        self._owner: Optional[int] = None
+        self._sockets: Optional[str] = None
+        self._authkey = os.urandom(16)
+        self._manifest: Dict[str, Any] = {}
+        self._requests = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return sum(self._manifest.get("sizes", ()))
+
+    @property
+    def stored_precision(self) -> Optional[str]:
+        return self._manifest.get("precision")
+
+    def shard_directory(self, index: int) -> str:
+        """Return the directory of a shard."""
+        return os.path.join(self.directory, f"shard-{index}")
+
+    def exists(self) -> bool:
+        """Check whether shards were built with the configured number of shards."""
+        manifest = self._read_manifest()
+        return manifest is not None and manifest.get("shards") == self.shards
+
+    def lock(self):
+        """
+        Hold the lock of full builds, so processes sharing the shards check and rebuild them one at a time.
+
+        Returns:
+        - ContextManager: The held lock.
+        """
+        return directory_lock(self.directory, "build.lock")
+
+    def start(self) -> None:
+        """
+        Start the shard processes, owned by this process, and wait until they listen. Call it before forking
+        so the forked processes share the shards; it starts no threads in this process.
+        """
+        with self._lock:
+            if not self._workers:
+                context = multiprocessing.get_context(self.start_method)
+                options = (self.ivf_threshold, self.n_probe, self.precision)
+                if hasattr(socket, "AF_UNIX"):
+                    self._sockets = tempfile.mkdtemp(prefix="vector-shards-")
+                    addresses = [os.path.join(self._sockets, f"shard-{i}.sock") for i in range(self.shards)]
+                else:
+                    addresses = [rf"\\.\pipe\vector-shard-{uuid.uuid4().hex}-{i}" for i in range(self.shards)]
+                self._workers = [
+                    _Shard(i, self.shard_directory(i), options, context, addresses[i], self._authkey)
+                    for i in range(self.shards)
+                ]
+                self._owner = os.getpid()
+            workers = list(self._workers) if self._owner == os.getpid() else []
+        started = [worker for worker in workers if not worker.alive]
+        for worker in started:
+            worker.stop(timeout=0)
+            worker.start()
+        for worker in started:
+            worker.wait_ready(self.load_timeout or None)
+
+    def revive(self) -> None:
+        """Restart the owned shard processes that died; they load their shard before they listen."""
+        if self._owner != os.getpid():
+            return
+        for worker in self._workers:
+            if not worker.alive:
+                logger.warning(f"Vector shard {worker.index} is not running, restarting it")
+        self.start()
+
+    def load(self) -> None:
+        """Start the shard processes if nobody did, and wait until each has (re)loaded its shard."""
+        self._manifest = self._read_manifest() or {}
+        self.start()
+        sizes = self._request(range(self.shards), "load")
+        if self._manifest:
+            self._manifest["sizes"] = [sizes[shard] for shard in range(self.shards)]
+
+    def writer(self, replace: bool = False, shards: Optional[Sequence[int]] = None) -> ShardWriter:
+        """
+        Start a change to the shards.
+
+        Parameters:
+        - replace (bool): Replace the content of the shards instead of adding to it.
+        - shards (Sequence[int]): The shards to write, all by default.
+
+        Returns:
+        - ShardWriter: The change, applied by its commit().
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.start()
+        return ShardWriter(self, replace=replace, shards=shards)
+
+    def build(self, ids: Sequence[str], vectors: np.ndarray, texts: Sequence[str],
+              metadatas: Sequence[Optional[dict]]) -> List[int]:
+        """
+        Partition the records and make the shards whose records changed replace their content.
+
+        Parameters:
+        - ids (Sequence[str]): The IDs of the records.
+        - vectors (np.ndarray): The (n, d) embeddings of the records.
+        - texts (Sequence[str]): The texts of the records.
+        - metadatas (Sequence[Optional[dict]]): The metadata of the records.
+
+        Returns:
+        - List[int]: The shards that were rebuilt.
+        """
+        previous = self._read_manifest() or {}
+        reusable = previous.get("shards") == self.shards and previous.get("precision") == self.precision
+        assignment = np.fromiter((shard_of(i, self.shards) for i in ids), dtype=np.int64, count=len(ids))
+        digests = {
+            shard: hashlib.sha256("\n".join(sorted(ids[row] for row in np.flatnonzero(assignment == shard)))
+                                  .encode("utf-8")).hexdigest()
+            for shard in range(self.shards)
+        }
+        # Shards changed in place since their last build have no digest and are rebuilt
+        changed = [shard for shard in range(self.shards)
+                   if not reusable or previous["digests"][shard] != digests[shard]]
+        writer = self.writer(replace=True, shards=changed)
+        writer.digests = digests
+        writer.add(ids, vectors, texts, metadatas)
+        return writer.commit()
+
+    def build_from_collection(self, collection) -> None:
+        """
+        Replace the shards with all embeddings, documents and metadata of a Chroma collection. The collection
+        is read page by page and every page is sent to the shards, which write their partitions themselves.
+
+        Parameters:
+        - collection (chromadb.Collection): The collection to export.
+        """
+        writer = self.writer(replace=True)
+        try:
+            for ids, vectors, texts, metadatas in collection_pages(collection):
+                writer.add(ids, vectors, texts, metadatas)
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+        logger.info(f"Built {self.shards} vector shards with {self.size} records in {self.directory}")
+
+    def search(self, queries: np.ndarray, k: Union[int, Sequence[int]]) -> List[ShardResults]:
+        """
+        Find the documents most similar to each query on all shards and merge their results.
+
+        Parameters:
+        - queries (np.ndarray): A (q, d) matrix of query embeddings.
+        - k (Union[int, Sequence[int]]): The number of results, for all queries or per query.
+
+        Returns:
+        - List[ShardResults]: For each query, up to k documents, most similar first, with the shards that
+          did not answer in time.
+        """
+        ks = [k] * len(queries) if isinstance(k, int) else list(k)
+        if not ks:
+            return []
+        queries = np.asarray(queries, dtype=np.float32)
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        request_id = next(self._requests)
+        futures = {}
+        for worker in self._running_workers():
+            futures[worker.index] = worker.submit(request_id, "search", queries, ks)
+        wait(futures.values(), timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+        found, missing = [], []
+        for worker in self._workers:
+            future = futures.get(worker.index)
+            if future is None or not future.done():
+                worker.forget(request_id)
+                missing.append(worker.index)
+                continue
+            try:
+                found.append(future.result())
+            except Exception as e:
+                logger.warning(f"Vector shard {worker.index} failed: {str(e)}")
+                missing.append(worker.index)
+        if missing:
+            logger.warning(f"Vector shards {missing} did not answer in time, returning partial results")
+
+        results = []
+        for row, n in enumerate(ks):
+            # Every shard's list is sorted by similarity, so a k-way heap merge yields the global top k
+            merged = heapq.merge(*(shard[row] for shard in found), key=lambda hit: hit[1], reverse=True)
+            results.append(ShardResults((document for document, _ in itertools.islice(merged, n)), missing))
+        return results
+
+    def close(self) -> None:
+        """Close this process's connections to the shards, and stop the shard processes if it owns them."""
+        with self._lock:
+            workers, owned = list(self._workers), self._owner == os.getpid()
+            if owned:
+                self._workers, self._owner = [], None
+        for worker in workers:
+            if owned:
+                worker.stop()
+            else:
+                worker.close()
+        if owned and self._sockets is not None:
+            shutil.rmtree(self._sockets, ignore_errors=True)
+            self._sockets = None
+
+    def _running_workers(self) -> List[_Shard]:
+        """Return the shards, restarting the owned processes that died. Shards of another owner are left to it."""
+        self.revive()
+        with self._lock:
+            return list(self._workers)
+
+    def _request(self, shards, command: str, *args) -> Dict[int, Any]:
+        """Send a command to the given shards and wait for their results."""
+        request_id = next(self._requests)
+        futures = {shard: self._workers[shard].submit(request_id, command, *args) for shard in shards}
+        done, pending = wait(futures.values(), timeout=self.load_timeout or None)
+        if pending:
+            raise TimeoutError(f"{len(pending)} vector shards did not answer within {self.load_timeout} seconds")
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def _committed(self, sizes: Dict[int, int], digests: Dict[int, str]) -> None:
+        """Record the sizes of written shards in the manifest, with the digests of their IDs where known."""
+        with directory_lock(self.directory):
+            manifest = self._read_manifest() or {}
+            if manifest.get("shards") != self.shards or manifest.get("precision") != self.precision:
+                manifest = {"shards": self.shards, "precision": self.precision,
+                            "sizes": [0] * self.shards, "digests": [None] * self.shards}
+            for shard, size in sizes.items():
+                manifest["sizes"][shard] = size
+                manifest["digests"][shard] = digests.get(shard)
+            path = os.path.join(self.directory, MANIFEST_FILE)
+            with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+                json.dump(manifest, file)
+            os.replace(f"{path}.tmp", path)
+        self._manifest = manifest
+
+    def _read_manifest(self) -> Optional[Dict[str, Any]]:
+        """Read the manifest of the built shards, None if there is none."""
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = "aiservice-vector-snapshot"
+SNAPSHOT_VERSION = 1
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+RECORDS_FILE = "records.bin"
+OFFSETS_FILE = "offsets.npy"
+STATE_FILE = "state_ids.json"
+REMOVED_FILE = "removed.json"
+SNAPSHOT_FILES = (VECTORS_FILE, RECORDS_FILE, OFFSETS_FILE, STATE_FILE, REMOVED_FILE)
+
+# Storage types of the snapshot vectors
+SNAPSHOT_PRECISIONS = {"float32": np.float32, "float16": np.float16}
+
+
+class SnapshotError(RuntimeError):
+    """Raised when a snapshot is unreadable, corrupt or does not fit the database it is applied to."""
+
+
+def _file_digest(path: str, block_size: int = 1 << 20) -> str:
+    """Return the SHA-256 hex digest of a file, read block by block."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def encode_record(record_id: str, text: str, metadata: Optional[dict]) -> bytes:
+    """Encode a record as the JSON blob stored in a records block."""
+    return json.dumps({"id": record_id, "text": text, "metadata": metadata}).encode("utf-8")
+
+
+def open_records(directory: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Memory-map the records block and its offset index in a directory.
+
+    Parameters:
+    - directory (str): The directory holding records.bin and offsets.npy.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: The records block as bytes and the n + 1 record offsets.
+    """
+    offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r")
+    path = os.path.join(directory, RECORDS_FILE)
+    # An empty file cannot be memory-mapped
+    records = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.empty(0, dtype=np.uint8)
+    return records, offsets
+
+
+def read_record(records: np.ndarray, offsets: np.ndarray, index: int) -> Dict[str, Any]:
+    """Decode record index of a records block into its 'id', 'text' and 'metadata'."""
+    start, stop = int(offsets[index]), int(offsets[index + 1])
+    return json.loads(records[start:stop].tobytes())
+
+
+def write_snapshot(path: str, model: str, ids: Sequence[str], vectors: np.ndarray, texts: Sequence[str],
+                   metadatas: Sequence[Optional[dict]], state_ids: Optional[Sequence[str]] = None,
+                   removed: Sequence[str] = (), base: Optional[str] = None, precision: str = "float32") -> str:
+    """
+    Write a snapshot directory. It is written next to the target and renamed into place when complete.
+
+    Parameters:
+    - path (str): The snapshot directory to create; it must not exist.
+    - model (str): The name of the embedding model the vectors were computed with.
+    - ids (Sequence[str]): The IDs of the records in the snapshot.
+    - vectors (np.ndarray): The (n, d) embeddings of the records.
+    - texts (Sequence[str]): The texts of the records.
+    - metadatas (Sequence[Optional[dict]]): The metadata of the records.
+    - state_ids (Sequence[str]): The IDs of all records in the database after applying the snapshot,
+      defaults to ids (a full snapshot).
+    - removed (Sequence[str]): The IDs a delta snapshot deletes from its base.
+    - base (str): The ID of the snapshot a delta applies to, None for a full snapshot.
+    - precision (str): The storage type of the vectors, 'float32' or 'float16'.
+
+    Returns:
+    - str: The ID of the snapshot.
+
+    Raises:
+    - FileExistsError: If the path exists.
+    - ValueError: If the precision is unknown.
+    """
+    if precision not in SNAPSHOT_PRECISIONS:
+        raise ValueError(f"Unknown snapshot precision {precision!r}, expected one of {tuple(SNAPSHOT_PRECISIONS)}")
+    if os.path.exists(path):
+        raise FileExistsError(f"Snapshot {path} already exists")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2:
+        vectors = vectors.reshape(len(ids), 0)
+    staging = f"{path}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    np.save(os.path.join(staging, VECTORS_FILE), np.ascontiguousarray(vectors, dtype=SNAPSHOT_PRECISIONS[precision]))
+    # Records are JSON blobs back to back; record i spans offsets[i]:offsets[i + 1] of the records block
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    with open(os.path.join(staging, RECORDS_FILE), "wb") as file:
+        for i, (record_id, text, metadata) in enumerate(zip(ids, texts, metadatas)):
+            blob = encode_record(record_id, text, metadata)
+            file.write(blob)
+            offsets[i + 1] = offsets[i] + len(blob)
+    np.save(os.path.join(staging, OFFSETS_FILE), offsets)
+    with open(os.path.join(staging, STATE_FILE), "w", encoding="utf-8") as file:
+        json.dump(list(ids if state_ids is None else state_ids), file)
+    with open(os.path.join(staging, REMOVED_FILE), "w", encoding="utf-8") as file:
+        json.dump(list(removed), file)
+
+    checksums = {name: _file_digest(os.path.join(staging, name)) for name in SNAPSHOT_FILES}
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "model": model,
+        "base": base,
+        "count": len(ids),
+        "dimension": int(vectors.shape[1]),
+        "precision": precision,
+        "checksums": checksums,
+    }
+    # The ID covers the checksums, so it identifies the exact content of the snapshot
+    manifest["id"] = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()
+    with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(staging, path)
+    return manifest["id"]
+
+
+class Snapshot:
+    """
+    A snapshot of the vector database, opened with memory maps.
+
+    A snapshot directory holds a contiguous float32 or float16 vector block, a block of JSON records
+    with an offset index, the IDs of the database state it represents, and a manifest with the SHA-256
+    checksum of every file. A full snapshot holds every record; a delta holds only the records added
+    since its base snapshot and the IDs removed since then. Opening maps the blocks without reading
+    them, so it takes milliseconds at any size; verification reads every byte once.
+
+    Attributes:
+    - path (str): The snapshot directory.
+    - manifest (Dict[str, Any]): The parsed manifest.
+    - vectors (np.ndarray): The (n, d) memory-mapped vector block.
+    """
+
+    def __init__(self, path: str, manifest: Dict[str, Any], vectors: np.ndarray, offsets: np.ndarray,
+                 records: np.ndarray):
+        self.path = path
+        self.manifest = manifest
+        self.vectors = vectors
+        self._offsets = offsets
+        self._records = records
+
+    @classmethod
+    def open(cls, path: str, verify: bool = True) -> "Snapshot":
+        """
+        Open a snapshot directory.
+
+        Parameters:
+        - path (str): The snapshot directory.
+        - verify (bool): Check the checksums of all files.
+
+        Returns:
+        - Snapshot: The opened snapshot.
+
+        Raises:
+        - SnapshotError: If the manifest is missing or of an unknown format, or a checksum does not match.
+        """
+        try:
+            with open(os.path.join(path, MANIFEST_FILE), encoding="utf-8") as file:
+                manifest = json.load(file)
+        except (OSError, json.JSONDecodeError) as e:
+            raise SnapshotError(f"Cannot read the snapshot manifest in {path}: {e}") from e
+        if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version") != SNAPSHOT_VERSION:
+            raise SnapshotError(
+                f"Unsupported snapshot format {manifest.get('format')!r} version {manifest.get('version')!r}"
+            )
+        if verify:
+            for name, checksum in manifest["checksums"].items():
+                try:
+                    matches = _file_digest(os.path.join(path, name)) == checksum
+                except OSError as e:
+                    raise SnapshotError(f"Cannot read {name} of snapshot {path}: {e}") from e
+                if not matches:
+                    raise SnapshotError(f"Checksum mismatch for {name} in snapshot {path}")
+        vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        records, offsets = open_records(path)
+        return cls(path, manifest, vectors, offsets, records)
+
+    @property
+    def id(self) -> str:
+        return self.manifest["id"]
+
+    @property
+    def base(self) -> Optional[str]:
+        """The ID of the snapshot a delta applies to, None for a full snapshot."""
+        return self.manifest["base"]
+
+    @property
+    def model(self) -> str:
+        return self.manifest["model"]
+
+    def __len__(self) -> int:
+        return self.manifest["count"]
+
+    def record(self, index: int) -> Dict[str, Any]:
+        """
+        Decode one record.
+
+        Parameters:
+        - index (int): The position of the record.
+
+        Returns:
+        - Dict[str, Any]: The record's 'id', 'text' and 'metadata'.
+        """
+        return read_record(self._records, self._offsets, index)
+
+    def ids(self) -> List[str]:
+        """Return the IDs of the records in the snapshot, in order."""
+        if self.base is None:
+            # A full snapshot records the database state in the order of its records
+            return self.state_ids()
+        return [self.record(index)["id"] for index in range(len(self))]
+
+    def state_ids(self) -> List[str]:
+        """Return the IDs of all records in the database state the snapshot represents."""
+        with open(os.path.join(self.path, STATE_FILE), encoding="utf-8") as file:
+            return json.load(file)
+
+    def removed(self) -> List[str]:
+        """Return the IDs a delta snapshot deletes from its base."""
+        with open(os.path.join(self.path, REMOVED_FILE), encoding="utf-8") as file:
+            return json.load(file)
+
+    def batches(self, batch_size: int = 1024) -> Iterator[Tuple[List[str], np.ndarray, List[str], List[Any]]]:
+        """
+        Yield the records in batches.
+
+        Parameters:
+        - batch_size (int): The number of records per batch.
+
+        Yields:
+        - Tuple[List[str], np.ndarray, List[str], List[Any]]: The IDs, float32 vectors, texts and metadata of a batch.
+        """
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            records = [self.record(index) for index in range(start, stop)]
+            yield ([record["id"] for record in records], np.asarray(self.vectors[start:stop], dtype=np.float32),
+                   [record["text"] for record in records], [record["metadata"] for record in records])
+
+
+def live_rows(snapshots: Sequence[Snapshot]) -> List[np.ndarray]:
+    """
+    Find the records of a snapshot chain that make up its final state.
+
+    Parameters:
+    - snapshots (Sequence[Snapshot]): A full snapshot followed by deltas, each to the one before.
+
+    Returns:
+    - List[np.ndarray]: For each snapshot, the positions of its records that are in the state of the last
+      snapshot and not overridden by a later one.
+    """
+    remaining = set(snapshots[-1].state_ids())
+    rows: List[np.ndarray] = []
+    # Newest first, so a record removed and added again is served from the snapshot that re-added it
+    for snapshot in reversed(snapshots):
+        live = []
+        for row, record_id in enumerate(snapshot.ids()):
+            if record_id in remaining:
+                remaining.discard(record_id)
+                live.append(row)
+        rows.append(np.asarray(live, dtype=np.int64))
+    return rows[::-1]
+
+
+def main():
+    """Export the configured database to a snapshot, or bring it to the state of snapshots."""
+    import argparse
+    from configparser import ConfigParser
+    from app.main import create_database, create_registries
+
+    parser = argparse.ArgumentParser(description="Export or import database snapshots.")
+    parser.add_argument('--config', type=str, default="default", help="Name of configuration file during use.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Write the database to a new snapshot directory.")
+    export.add_argument('path', type=str, help="Snapshot directory to create.")
+    export.add_argument('--base', type=str, help="Earlier snapshot to write a delta to (default: full snapshot).")
+    export.add_argument('--precision', type=str, default="float32", choices=tuple(SNAPSHOT_PRECISIONS),
+                        help="Storage type of the vectors.")
+    restore = commands.add_parser("import", help="Apply a full snapshot and its deltas, oldest first.")
+    restore.add_argument('paths', type=str, nargs="+", help="Snapshot directories.")
+    restore.add_argument('--no-verify', action="store_true", help="Skip the checksum verification.")
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read('config.ini')
+    section = config[args.config]
+    _, embedding_registry = create_registries(section)
+    db = create_database(section, registry=embedding_registry)
+    db.load_from_disk()
+    if args.command == "export":
+        print(json.dumps(db.export_snapshot(args.path, base=args.base, precision=args.precision)))
+    else:
+        applied = db.import_snapshots(args.paths, verify=not args.no_verify)
+        print(json.dumps({"applied": applied, "snapshot": db.snapshot_id}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import logging
+from collections import deque
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Bytes read from a file at a time
+READ_BLOCK_SIZE = 1 << 20
+
+
+class Chunk:
+    """
+    A chunk of a document and the byte range of the source lines it was built from.
+
+    Attributes:
+    - text (str): The text of the chunk.
+    - start (int): The byte offset of the chunk's first line in the source.
+    - end (int): The byte offset just after the chunk's last line.
+    - length (int): The length of the chunk as measured by the splitter, e.g. characters or tokens.
+    """
+    __slots__ = ("text", "start", "end", "length")
+
+    def __init__(self, text: str, start: int, end: int, length: int):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.length = length
+
+    def __repr__(self) -> str:
+        return f"Chunk(start={self.start}, end={self.end}, length={self.length}, text={self.text[:30]!r})"
+
+
+def tokenizer_length(embeddings: Any) -> Callable[[str], int]:
+    """
+    Build a length function that counts tokens with the tokenizer of a sentence transformer embedding model.
+
+    Parameters:
+    - embeddings (Any): The LangChain embeddings, whose client is the SentenceTransformer.
+
+    Returns:
+    - Callable[[str], int]: The number of tokens of a text, without special tokens.
+
+    Raises:
+    - ValueError: If the model has no tokenizer.
+    """
+    tokenizer = getattr(getattr(embeddings, "client", None), "tokenizer", None)
+    if tokenizer is None:
+        raise ValueError("The embedding model has no tokenizer to count tokens with")
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+class StreamingTextSplitter:
+    """
+    Splits text at line breaks and merges the lines into chunks of at most chunk_size, with chunk_overlap of
+    the previous chunk repeated. Produces the same chunks as LangChain's CharacterTextSplitter with a '\\n'
+    separator, so chunk IDs stay stable, but files are read in blocks and chunks are yielded lazily as
+    compact Chunk records, so memory is bounded by a chunk rather than the file.
+
+    Attributes:
+    - chunk_size (int): The maximum length of a chunk, unless a single line is longer.
+    - chunk_overlap (int): The maximum length of the lines a chunk repeats from the previous one.
+    - length_function (Callable[[str], int]): Measures texts, len for characters or a token counter.
+    - block_size (int): The number of bytes read from a file at a time.
+    """
+
+    def __init__(self, chunk_size: Any, chunk_overlap: Any = 0, length_function: Callable[[str], int] = len,
+                 block_size: int = READ_BLOCK_SIZE):
+        """
+        Initialize the StreamingTextSplitter.
+
+        Parameters:
+        - chunk_size (Any): The maximum length of a chunk, an int or a string of one as read from config.ini.
+        - chunk_overlap (Any): The maximum overlap between consecutive chunks, an int or a string of one.
+        - length_function (Callable[[str], int]): Measures texts, len for characters or a token counter.
+        - block_size (int): The number of bytes read from a file at a time.
+
+        Raises:
+        - ValueError: If the sizes are not integers, chunk_size is not positive or chunk_overlap is negative
+          or larger than chunk_size.
+        """
+        chunk_size = self._integer("chunk_size", chunk_size)
+        chunk_overlap = self._integer("chunk_overlap", chunk_overlap)
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+        if not 0 <= chunk_overlap <= chunk_size:
+            raise ValueError(f"chunk_overlap must be between 0 and chunk_size ({chunk_size}), got {chunk_overlap}")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length_function = length_function
+        self.block_size = block_size
+
+    @staticmethod
+    def _integer(name: str, value: Any) -> int:
+        """Convert a size to int, rejecting fractions and non-numbers."""
+        try:
+            number = int(str(value).strip())
+        except ValueError:
+            raise ValueError(f"{name} must be an integer, got {value!r}") from None
+        return number
+
+    def split_text(self, text: str) -> List[str]:
+        """
+        Split a text into chunks.
+
+        Parameters:
+        - text (str): The text.
+
+        Returns:
+        - List[str]: The chunk texts, in order.
+        """
+        return [chunk.text for chunk in self.chunks(self._text_lines(text))]
+
+    def split_file(self, path: str) -> Iterator[Chunk]:
+        """
+        Read a UTF-8 file in blocks and yield its chunks as they are complete.
+        Line breaks are recognized like in text mode: '\\n', '\\r\\n' and '\\r'.
+
+        Parameters:
+        - path (str): The path of the file.
+
+        Yields:
+        - Chunk: The chunks with their byte ranges in the file, in order.
+        """
+        with open(path, "rb") as file:
+            yield from self.chunks(self._file_lines(file))
+
+    def split_documents(self, documents: Iterable[Any]) -> List[Any]:
+        """
+        Split LangChain documents into chunk documents that keep the metadata of their document.
+
+        Parameters:
+        - documents (Iterable[Document]): The documents.
+
+        Returns:
+        - List[Document]: One document per chunk.
+        """
+        from langchain_core.documents import Document
+        return [
+            Document(page_content=text, metadata=dict(document.metadata))
+            for document in documents for text in self.split_text(document.page_content)
+        ]
+
+    def chunks(self, lines: Iterable[Tuple[str, int, int]]) -> Iterator[Chunk]:
+        """
+        Merge lines into chunks.
+
+        Parameters:
+        - lines (Iterable[Tuple[str, int, int]]): The lines without line breaks, with the byte range of each.
+
+        Yields:
+        - Chunk: The chunks, in order. Chunks that are empty after stripping whitespace are skipped.
+        """
+        measure = self.length_function
+        separator_length = measure("\n")
+        # The lines of the chunk being built as (text, start, end, length), and the chunk's length
+        current: deque = deque()
+        total = 0
+        for text, start, end in lines:
+            if not text:
+                continue
+            length = measure(text)
+            if total + length + (separator_length if current else 0) > self.chunk_size:
+                if total > self.chunk_size:
+                    logger.warning(f"Created a chunk of size {total}, which is longer than the specified {self.chunk_size}")
+                if current:
+                    chunk = self._join(current, total)
+                    if chunk is not None:
+                        yield chunk
+                    # Drop lines from the front until what is left fits the overlap and leaves room for this line
+                    while total > self.chunk_overlap or (
+                            total + length + (separator_length if current else 0) > self.chunk_size and total > 0):
+                        total -= current[0][3] + (separator_length if len(current) > 1 else 0)
+                        current.popleft()
+            current.append((text, start, end, length))
+            total += length + (separator_length if len(current) > 1 else 0)
+        chunk = self._join(current, total)
+        if chunk is not None:
+            yield chunk
+
+    @staticmethod
+    def _join(lines: deque, total: int) -> Optional[Chunk]:
+        """Join lines into a chunk, None if it is only whitespace."""
+        if not lines:
+            return None
+        text = "\n".join(line[0] for line in lines).strip()
+        if not text:
+            return None
+        return Chunk(text, lines[0][1], lines[-1][2], total)
+
+    @staticmethod
+    def _text_lines(text: str, offset: int = 0) -> Iterator[Tuple[str, int, int]]:
+        """Split a text at '\n' into lines with their byte ranges in its UTF-8 encoding, starting at offset."""
+        for line in text.split("\n"):
+            size = len(line) if line.isascii() else len(line.encode("utf-8"))
+            yield line, offset, offset + size
+            offset += size + 1
+
+    def _file_lines(self, file) -> Iterator[Tuple[str, int, int]]:
+        """
+        Read a binary file block by block and yield its lines with their byte ranges. Each block is decoded
+        at once up to its last line break, and '\r\n' and '\r' are read as '\n' like in text mode.
+        """
+        offset = 0
+        # The blocks read since the last line break, joined once the line ends so long lines are copied once
+        pending: List[bytes] = []
+        while True:
+            block = file.read(self.block_size)
+            rest = b""
+            if block:
+                cut = block.rfind(b"\n") + 1
+                if not cut:
+                    pending.append(block)
+                    continue
+                # The text after the last line break may continue in the next block
+                pending.append(block[:cut])
+                rest = block[cut:]
+            data = b"".join(pending)
+            pending = [rest] if rest else []
+            text = data.decode("utf-8")
+            if block and text:
+                text = text[:-1]
+            if "\r" in text:
+                for line, start, _ in self._text_lines(text, offset):
+                    yield from self._split_carriage_returns(line, start)
+            else:
+                yield from self._text_lines(text, offset)
+            offset += len(data)
+            if not block:
+                break
+
+    @staticmethod
+    def _split_carriage_returns(line: str, offset: int) -> Iterator[Tuple[str, int, int]]:
+        """Split a line at '\r', treating a final '\r' as part of a '\r\n' line break."""
+        if line.endswith("\r"):
+            line = line[:-1]
+        for part in line.split("\r"):
+            size = len(part) if part.isascii() else len(part.encode("utf-8"))
+            yield part, offset, offset + size
+            offset += size + 1
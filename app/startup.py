@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Sequence
+from fastapi import HTTPException, status
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+LOADING = "LOADING"
+READY = "READY"
+FAILED = "FAILED"
+
+
+class StartupOrchestrator:
+    """
+    Loads the heavy services of the app (models, database handles) concurrently in background threads.
+
+    Services are registered with a loader before startup. start() runs all loaders at once and returns
+    immediately, so the server accepts requests while the services load. A service that requires others
+    starts loading once they are ready, and fails if one of them fails. Routes get their service through
+    dependency(), which answers 503 with a Retry-After header until that particular service is ready; routes
+    whose services are ready serve right away. Load times are recorded per service for the startup report.
+
+    Attributes:
+    - retry_after (float): Seconds a client is asked to wait when a service is still loading.
+    - created_at (float): perf_counter() time the orchestrator was created, the reference for load times.
+    """
+
+    def __init__(self, retry_after: float = 5):
+        """
+        Initialize the StartupOrchestrator.
+
+        Parameters:
+        - retry_after (float): Seconds a client is asked to wait when a service is still loading.
+        """
+        self.retry_after = retry_after
+        self.created_at = time.perf_counter()
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._requires: Dict[str, Sequence[str]] = {}
+        self._loaded: Dict[str, threading.Event] = {}
+        self._values: Dict[str, Any] = {}
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    def add(self, name: str, loader: Callable[[], Any], requires: Sequence[str] = ()) -> None:
+        """
+        Register a service.
+
+        Parameters:
+        - name (str): The name of the service, e.g. 'database'.
+        - loader (Callable[[], Any]): Function that loads the service and returns it.
+        - requires (Sequence[str]): Services that must be ready before the loader runs; they can be
+          fetched with get() inside the loader.
+        """
+        with self._lock:
+            self._loaders[name] = loader
+            self._requires[name] = tuple(requires)
+            self._loaded[name] = threading.Event()
+            self._states[name] = {"status": LOADING, "seconds": None, "error": None}
+
+    def start(self) -> None:
+        """Start loading all registered services, each in its own thread."""
+        if self._started_at is not None:
+            return
+        self._started_at = time.perf_counter()
+        if not self._loaders:
+            self._finish()
+            return
+        for name, loader in self._loaders.items():
+            threading.Thread(target=self._load, args=(name, loader), name=f"startup-{name}", daemon=True).start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until all services finished loading or failed.
+
+        Parameters:
+        - timeout (float): Seconds to wait, None to wait indefinitely.
+
+        Returns:
+        - bool: True if startup is complete.
+        """
+        return self._done.wait(timeout)
+
+    def is_ready(self, name: str) -> bool:
+        """
+        Check whether a service is loaded.
+
+        Parameters:
+        - name (str): The name of the service.
+
+        Returns:
+        - bool: True if the service is ready.
+        """
+        with self._lock:
+            return name in self._values
+
+    def get(self, name: str) -> Any:
+        """
+        Return a loaded service.
+
+        Parameters:
+        - name (str): The name of the service.
+
+        Returns:
+        - Any: The value returned by the service's loader.
+
+        Raises:
+        - HTTPException: 503 with a Retry-After header if the service is still loading or failed to load.
+        """
+        with self._lock:
+            if name in self._values:
+                return self._values[name]
+            state = self._states.get(name)
+        if state is not None and state["status"] == FAILED:
+            detail = f"{name} failed to load: {state['error']}"
+        else:
+            detail = f"{name} is still loading"
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(int(self.retry_after))},
+        )
+
+    def dependency(self, name: str) -> Callable[[], Any]:
+        """
+        Build a FastAPI dependency that resolves to a loaded service.
+
+        Parameters:
+        - name (str): The name of the service.
+
+        Returns:
+        - Callable[[], Any]: A dependency for app.dependency_overrides.
+        """
+        return lambda: self.get(name)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Report the state and load time of every service.
+
+        Returns:
+        - Dict[str, Any]: Per service its status and load seconds (and error), plus the total startup seconds
+          once all services are done.
+        """
+        with self._lock:
+            services = {name: dict(state) for name, state in self._states.items()}
+        total = None
+        if self._finished_at is not None:
+            total = round(self._finished_at - self.created_at, 3)
+        return {"services": services, "startup_seconds": total}
+
+    def _load(self, name: str, loader: Callable[[], Any]) -> None:
+        """Wait for the required services, run a loader and record its outcome."""
+        for required in self._requires[name]:
+            if required in self._loaded:
+                self._loaded[required].wait()
+        # The load time of a service does not include the wait for the services it requires
+        started = time.perf_counter()
+        try:
+            for required in self._requires[name]:
+                if not self.is_ready(required):
+                    raise RuntimeError(f"it requires {required}, which is not available")
+            value = loader()
+        except Exception as e:
+            logger.error(f"Loading {name} failed: {str(e)}")
+            with self._lock:
+                self._states[name].update(status=FAILED, seconds=round(time.perf_counter() - started, 3), error=str(e))
+        else:
+            with self._lock:
+                self._values[name] = value
+                self._states[name].update(status=READY, seconds=round(time.perf_counter() - started, 3))
+            logger.info(f"{name} ready after {time.perf_counter() - started:.2f}s")
+        self._loaded[name].set()
+        with self._lock:
+            pending = any(state["status"] == LOADING for state in self._states.values())
+        if not pending:
+            self._finish()
+
+    def _finish(self) -> None:
+        """Record the end of startup and log the breakdown."""
+        with self._lock:
+            if self._finished_at is not None:
+                return
+            self._finished_at = time.perf_counter()
+            breakdown = ", ".join(f"{name} {state['seconds']}s" for name, state in self._states.items())
+        logger.info(f"Startup finished after {self._finished_at - self.created_at:.2f}s ({breakdown or 'no services'})")
+        self._done.set()
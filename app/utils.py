@@ -1,77 +1,510 @@
-import aiofiles
-import os
+import codecs
+import json
 import logging
 import asyncio
-from fastapi.responses import JSONResponse
+import os
+import tempfile
+from functools import partial
+import aiofiles
+from collections import deque
+import numpy as np
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import AsyncIterator, List, Optional, Tuple, Union
 from fastapi import UploadFile, HTTPException
 from app.models import WhisperTranscriber, OllamaChatModel
+from app.batching import QueueFullError, SimilarityBatcher, TranscriptionScheduler
+from app.database import ChromaDBHandler
+from app.audio import (
+    CHUNK_SIZE, SAMPLE_RATE, SilenceTrimmer, SpeechTimeline, decode_upload, hash_upload, iter_pcm, iter_windows,
+)
+from app.cache import ChatResponseCache, TranscriptionCache
+from app.jobs import QUEUED, JobStore, check_webhook_url
+from app.rag import RagPipeline
+from app.metrics import AUDIO_SECONDS_SKIPPED, track_stage
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
-async def handle_transcription(file: UploadFile, transcriber: WhisperTranscriber) -> JSONResponse:
+# Queries embedded and searched at a time by a batch similarity request
+SIMILARITY_BATCH_CHUNK = 256
+
+async def handle_transcription(file: UploadFile, transcriber: WhisperTranscriber,
+                               scheduler: Optional[TranscriptionScheduler] = None,
+                               cache: Optional[TranscriptionCache] = None,
+                               trimmer: Optional[SilenceTrimmer] = None) -> JSONResponse:
     """
     Handle the transcription of an uploaded audio file.
 
     Parameters:
     - file (UploadFile): The uploaded audio file.
     - transcriber (WhisperTranscriber): An instance of WhisperTranscriber to perform the transcription.
+    - scheduler (TranscriptionScheduler): Optional micro-batching scheduler to queue the transcription on.
+    - cache (TranscriptionCache): Optional result cache. The upload is hashed before it is decoded, and
+      repeated uploads of the same audio are answered from the cache without decoding it or running the model.
+    - trimmer (SilenceTrimmer): Optional silence trimmer. If given, only the speech in the audio is transcribed.
 
     Returns:
-    - JSONResponse: A JSON response containing the transcript text.
+    - JSONResponse: A JSON response containing the transcript text, and the seconds cut out as silence if a
+      trimmer is given.
 
     Raises:
-    - HTTPException: If an error occurs during transcription.
+    - HTTPException: 503 if the transcription queue is full, 500 if an error occurs during transcription.
     """
     try:
-        audio_bytes = await file.read()
-        suffix = os.path.splitext(file.filename)[-1]  # Get the file extension from the original file
-
-        async with aiofiles.tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_audio_file:
-            await temp_audio_file.write(audio_bytes)
-            temp_audio_file_path = temp_audio_file.name
-
-        transcript_text = await transcribe_async(transcriber, temp_audio_file_path)
-        
-        # Clean up the temporary file
-        os.remove(temp_audio_file_path)
-        
-        return JSONResponse(content={"transcript": transcript_text})
+        loop = asyncio.get_running_loop()
+        if cache is not None:
+            # Hash the spooled upload first, a hit needs neither decoding nor trimming
+            digest, nbytes = await hash_upload(file)
+            cache.bytes_hashed += nbytes
+            key = cache.key(digest, transcriber.model_size, trimmer.options() if trimmer is not None else None)
+            # The disk tier is SQLite, it is queried off the event loop
+            cached = await loop.run_in_executor(None, cache.get, key, nbytes)
+            if cached is not None:
+                return JSONResponse(content=cached)
+
+        # Decode the upload in memory while it streams in, the model gets the waveform directly
+        with track_stage("audio_decode"):
+            audio = await decode_upload(file)
+        content = {}
+        if trimmer is not None:
+            audio, timeline = await loop.run_in_executor(None, trim_silence, trimmer, audio)
+            content["skipped_seconds"] = round(timeline.skipped_seconds, 2)
+
+        if len(audio) or trimmer is None:
+            # Includes the wait in the scheduler queue, whisper_inference is the model time alone
+            with track_stage("transcription"):
+                transcript_text = await transcribe_async(transcriber, audio, scheduler)
+        else:
+            # Nothing but silence, Whisper would only hallucinate on it
+            transcript_text = ""
+        content = {"transcript": transcript_text, **content}
+        if cache is not None:
+            await loop.run_in_executor(None, cache.put, key, content)
+
+        return JSONResponse(content=content)
     
+    except QueueFullError as e:
+        logger.warning(f"Rejecting transcription: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
     except Exception as e:
         logger.error(f"Error during transcription: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def transcribe_async(transcriber: WhisperTranscriber, file_path: str) -> str:
+async def handle_streaming_transcription(file: UploadFile, transcriber: WhisperTranscriber,
+                                         window_seconds: float = 30.0,
+                                         trimmer: Optional[SilenceTrimmer] = None,
+                                         scheduler: Optional[TranscriptionScheduler] = None) -> StreamingResponse:
+    """
+    Handle the streaming transcription of an uploaded audio file.
+    The audio is decoded and transcribed window by window; every segment is sent to the client as a
+    JSON line as soon as its window is done. The next window is decoded while the current one is transcribed.
+
+    Parameters:
+    - file (UploadFile): The uploaded audio file.
+    - transcriber (WhisperTranscriber): An instance of WhisperTranscriber to perform the transcription.
+    - window_seconds (float): The maximum length of a transcription window in seconds.
+    - trimmer (SilenceTrimmer): Optional silence trimmer. If given, only the speech in each window is
+      transcribed; segment times still refer to the original recording.
+    - scheduler (TranscriptionScheduler): Optional scheduler. If given, the windows are queued there with
+      the other transcriptions instead of running on the default thread pool.
+
+    Returns:
+    - StreamingResponse: An NDJSON stream of segments ({"start", "end", "text"}) followed by {"done": true}
+      with the duration, and with the seconds cut out as silence if a trimmer is given.
+
+    Raises:
+    - HTTPException: If the upload cannot be decoded.
+    """
+    blocks = iter_pcm(file)
+    try:
+        # Decode the first block up front so an invalid upload still gets a proper error status
+        first_block = await blocks.__anext__()
+    except StopAsyncIteration:
+        first_block = b""
+    except Exception as e:
+        logger.error(f"Error during transcription: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def pcm_blocks() -> AsyncIterator[bytes]:
+        yield first_block
+        async for block in blocks:
+            yield block
+
+    async def segments() -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        pending = None
+        duration = 0.0
+        skipped = 0.0
+        try:
+            async for offset, window in iter_windows(pcm_blocks(), window_seconds):
+                if pending is not None:
+                    segments, window_skipped = await pending
+                    skipped += window_skipped
+                    for segment in segments:
+                        yield json.dumps(segment) + "\n"
+                duration = offset + len(window) / SAMPLE_RATE
+                if scheduler is not None:
+                    pending = scheduler.submit_nowait(partial(transcribe_window, window=window, offset=offset,
+                                                              trimmer=trimmer))
+                else:
+                    pending = loop.run_in_executor(None, transcribe_window, transcriber, window, offset, trimmer)
+            if pending is not None:
+                segments, window_skipped = await pending
+                skipped += window_skipped
+                for segment in segments:
+                    yield json.dumps(segment) + "\n"
+            done = {"done": True, "duration": round(duration, 2)}
+            if trimmer is not None:
+                done["skipped_seconds"] = round(skipped, 2)
+            yield json.dumps(done) + "\n"
+        except Exception as e:
+            # The status line is already sent, report the failure in-band
+            logger.error(f"Error during streaming transcription: {str(e)}")
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            await blocks.aclose()
+
+    return StreamingResponse(segments(), media_type="application/x-ndjson")
+
+def trim_silence(trimmer: SilenceTrimmer, audio: np.ndarray) -> Tuple[np.ndarray, SpeechTimeline]:
+    """
+    Cut the silence out of a waveform and count the skipped audio. Blocking, run it off the event loop.
+
+    Parameters:
+    - trimmer (SilenceTrimmer): The silence trimmer.
+    - audio (np.ndarray): A 16 kHz mono float32 waveform.
+
+    Returns:
+    - Tuple[np.ndarray, SpeechTimeline]: The speech, and the map of its times back to the original audio.
+    """
+    with track_stage("silence_trim"):
+        speech, timeline = trimmer.trim(audio)
+    AUDIO_SECONDS_SKIPPED.inc(timeline.skipped_seconds)
+    return speech, timeline
+
+
+def transcribe_window(transcriber: WhisperTranscriber, window: np.ndarray, offset: float,
+                      trimmer: Optional[SilenceTrimmer] = None) -> Tuple[List[dict], float]:
+    """
+    Transcribe one window of a streamed recording, only its speech if a trimmer is given. Blocking.
+
+    Parameters:
+    - transcriber (WhisperTranscriber): The transcriber.
+    - window (np.ndarray): The 16 kHz mono float32 waveform of the window.
+    - offset (float): The position of the window in the recording in seconds.
+    - trimmer (SilenceTrimmer): Optional silence trimmer.
+
+    Returns:
+    - Tuple[List[dict], float]: The segments with times in the recording, and the seconds cut out as silence.
+    """
+    if trimmer is None:
+        return transcriber.transcribe_segments(window, offset), 0.0
+    speech, timeline = trim_silence(trimmer, window)
+    if not len(speech):
+        return [], timeline.skipped_seconds
+    segments = transcriber.transcribe_segments(speech)
+    for segment in segments:
+        segment["start"] = round(timeline.to_original(segment["start"]) + offset, 2)
+        segment["end"] = round(timeline.to_original(segment["end"]) + offset, 2)
+    return segments, timeline.skipped_seconds
+
+
+async def transcribe_async(transcriber: WhisperTranscriber, audio: Union[str, np.ndarray],
+                           scheduler: Optional[TranscriptionScheduler] = None) -> str:
     """
     Perform transcription asynchronously to avoid blocking the event loop.
 
     Parameters:
     - transcriber (WhisperTranscriber): An instance of WhisperTranscriber to perform the transcription.
-    - file_path (str): The path to the temporary audio file.
+    - audio (Union[str, np.ndarray]): The path to an audio file or a decoded 16 kHz mono waveform.
+    - scheduler (TranscriptionScheduler): Optional micro-batching scheduler. If given, the audio is
+      queued there and batched with concurrent requests instead of running on the default thread pool.
 
     Returns:
     - str: The transcribed text.
+
+    Raises:
+    - QueueFullError: If the scheduler queue is full.
     """
+    if scheduler is not None:
+        return await scheduler.submit(audio)
+
     # Run the transcription in a separate thread to avoid blocking the event loop
     loop = asyncio.get_running_loop()
-    transcript_text = await loop.run_in_executor(None, transcriber.transcribe, file_path)
+    transcript_text = await loop.run_in_executor(None, transcriber.transcribe, audio)
     return transcript_text
 
 
-async def chat_response_async(model: OllamaChatModel, prompt: str) -> str:
+async def chat_response_async(model: OllamaChatModel, prompt: str,
+                              cache: Optional[ChatResponseCache] = None) -> str:
     """
     Perform chat response asynchronously to avoid blocking the event loop.
 
     Parameters:
     - model (OllamaChatModel): An instance of OllamaChatModel to perform the chat response.
     - prompt (str): The prompt to send to the chat model.
+    - cache (ChatResponseCache): Optional response cache. The exact tier is checked first, then the semantic
+      tier if the cache has an embedding model; only misses are sent to the chat model.
 
     Returns:
     - str: The chat response.
     """
-    # Run the chat response in a separate thread to avoid blocking the event loop
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(None, model.chat, prompt)
+    if cache is None:
+        # The pooled async client waits for the response without holding a thread
+        return await model.achat(prompt)
+
+    response = cache.get_exact(model.model_name, prompt)
+    if response is not None:
+        return response
+
+    vector = None
+    if cache.embedding_function is not None:
+        # Embedding the prompt runs the transformer, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        with track_stage("chat_cache_embedding"):
+            vector = await loop.run_in_executor(None, cache.embed, prompt)
+        response = cache.get_semantic(model.model_name, vector)
+        if response is not None:
+            return response
+
+    response = await model.achat(prompt)
+    cache.put(model.model_name, prompt, response, vector)
     return response
 
+
+async def similarity_search_async(db: ChromaDBHandler, query: str, k: int,
+                                  batcher: Optional[SimilarityBatcher] = None) -> List:
+    """
+    Perform a similarity search without blocking the event loop.
+
+    Parameters:
+    - db (ChromaDBHandler): The database to search.
+    - query (str): The query to search for.
+    - k (int): The number of results to return.
+    - batcher (SimilarityBatcher): Optional batcher. If given, the query is embedded and looked up
+      together with concurrent queries instead of on its own.
+
+    Returns:
+    - List[Document]: The k documents that match the query.
+
+    Raises:
+    - QueueFullError: If the batcher queue is full.
+    """
+    # Includes the wait in the batcher queue, query_embedding and vector_search are timed separately
+    with track_stage("similarity_search"):
+        if batcher is not None:
+            return await batcher.submit((db, query, k))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, db.similarity_search, query, k)
+
+
+async def stream_similarity_batch(db: ChromaDBHandler, queries: List[Tuple[str, int]],
+                                  chunk_size: int = SIMILARITY_BATCH_CHUNK) -> AsyncIterator[str]:
+    """
+    Search many queries and yield the results in order as NDJSON lines.
+    Queries are embedded and searched chunk by chunk, each chunk in one batch off the event loop;
+    the next chunk is searched while the results of the previous one are sent.
+
+    Parameters:
+    - db (ChromaDBHandler): The database to search.
+    - queries (List[Tuple[str, int]]): Pairs of query text and number of results.
+    - chunk_size (int): The number of queries embedded and searched at a time.
+
+    Yields:
+    - str: One line per query, {"index", "documents"} or {"index", "error"}; with "partial" and
+      "missing_shards" when shards of a sharded index did not answer in time.
+    """
+    loop = asyncio.get_running_loop()
+
+    def search(start: int):
+        chunk = queries[start:start + chunk_size]
+        return loop.run_in_executor(None, db.similarity_search_batch, [text for text, _ in chunk],
+                                    [k for _, k in chunk])
+
+    pending = search(0) if queries else None
+    for start in range(0, len(queries), chunk_size):
+        try:
+            with track_stage("similarity_search"):
+                results = await pending
+        except Exception as e:
+            logger.error(f"Error during batch similarity search: {str(e)}")
+            results = e
+        pending = search(start + chunk_size) if start + chunk_size < len(queries) else None
+        count = min(chunk_size, len(queries) - start)
+        for offset in range(count):
+            index = start + offset
+            if isinstance(results, Exception):
+                yield json.dumps({"index": index, "error": str(results)}) + "\n"
+                continue
+            documents = [{"content": doc.page_content, "top_k": rank} for rank, doc in enumerate(results[offset])]
+            line = {"index": index, "documents": documents}
+            missing_shards = getattr(results[offset], "missing_shards", None)
+            if missing_shards:
+                line.update(partial=True, missing_shards=missing_shards)
+            yield json.dumps(line) + "\n"
+
+
+async def stream_chat_batch(model: OllamaChatModel, prompts: List[str], cache: Optional[ChatResponseCache] = None,
+                            concurrency: int = 0) -> AsyncIterator[str]:
+    """
+    Generate responses to many prompts with bounded concurrency and yield them in order as NDJSON lines.
+    At most `concurrency` prompts are in flight; a response is sent as soon as it and all before it are done.
+
+    Parameters:
+    - model (OllamaChatModel): The chat model.
+    - prompts (List[str]): The prompts.
+    - cache (ChatResponseCache): Optional response cache, checked before each prompt is sent to the model.
+    - concurrency (int): The maximum number of prompts in flight, 0 for the model's max_concurrency.
+
+    Yields:
+    - str: One line per prompt, {"index", "response"} or {"index", "error"}.
+    """
+    concurrency = concurrency or model.max_concurrency
+    in_flight = deque()
+    upcoming = iter(enumerate(prompts))
+    try:
+        while True:
+            for index, prompt in upcoming:
+                in_flight.append((index, asyncio.ensure_future(chat_response_async(model, prompt, cache))))
+                if len(in_flight) >= concurrency:
+                    break
+            if not in_flight:
+                return
+            index, task = in_flight.popleft()
+            try:
+                yield json.dumps({"index": index, "response": await task}) + "\n"
+            except Exception as e:
+                logger.error(f"Error during batch chat response {index}: {str(e)}")
+                yield json.dumps({"index": index, "error": str(e)}) + "\n"
+    finally:
+        # The client went away or the stream ended early, do not keep generating for it
+        for _, task in in_flight:
+            task.cancel()
+
+
+async def handle_rag_response(question: str, k: int, db: ChromaDBHandler, model: OllamaChatModel,
+                              pipeline: RagPipeline, batcher: Optional[SimilarityBatcher] = None) -> StreamingResponse:
+    """
+    Answer a question from the documents in the database and stream the answer.
+    If the context of the question is not cached, the documents are retrieved while the chat model
+    evaluates the beginning of the prompt, so the retrieval and most of the prefill overlap.
+
+    Parameters:
+    - question (str): The question.
+    - k (int): The number of documents to retrieve.
+    - db (ChromaDBHandler): The database to retrieve the documents from.
+    - model (OllamaChatModel): The chat model that answers.
+    - pipeline (RagPipeline): Builds the prompt and caches the retrieved contexts.
+    - batcher (SimilarityBatcher): Optional batcher the retrieval is queued on.
+
+    Returns:
+    - StreamingResponse: The tokens of the answer as plain text, sent as they arrive.
+
+    Raises:
+    - HTTPException: 503 with Retry-After if the retrieval queue is full, 500 if the retrieval fails.
+    """
+    key = pipeline.context_key(db, question, k)
+    context = pipeline.get_context(key)
+    if context is None:
+        prefill = asyncio.ensure_future(model.aprefill(pipeline.prompt_prefix(question))) if pipeline.prefill else None
+        try:
+            documents = await similarity_search_async(db, question, k, batcher)
+        except Exception as e:
+            if prefill is not None:
+                prefill.cancel()
+            if isinstance(e, QueueFullError):
+                logger.warning(f"Rejecting retrieval: {str(e)}")
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
+            logger.error(f"Error during retrieval: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+        context = pipeline.put_context(key, documents)
+        if prefill is not None:
+            # Generation starts once the prefix is evaluated, so it lands on the cached prefix
+            await prefill
+    return StreamingResponse(model.astream(pipeline.build_prompt(question, context)), media_type="text/plain")
+
+
+async def handle_document_ingestion(files: List[UploadFile], db: ChromaDBHandler) -> JSONResponse:
+    """
+    Handle the ingestion of uploaded text documents into the database.
+    Uploads are streamed to temporary files in chunks and checked to be UTF-8 on the way, then ingested
+    off the event loop with the streaming splitter, so no upload is held in memory as a whole. Only new
+    or changed chunks are embedded.
+
+    Parameters:
+    - files (List[UploadFile]): The uploaded UTF-8 text files. The file name is used as the document source.
+    - db (ChromaDBHandler): The database to ingest the documents into.
+
+    Returns:
+    - JSONResponse: A JSON response with the number of files and chunks processed, added, unchanged and removed.
+
+    Raises:
+    - HTTPException: 400 if a file is not valid UTF-8 text, 500 if the ingestion fails.
+    """
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory(prefix="ingest-") as directory:
+        paths = []
+        for file in files:
+            path = os.path.join(directory, f"{len(paths)}.txt")
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            try:
+                async with aiofiles.open(path, "wb") as document:
+                    while chunk := await file.read(CHUNK_SIZE):
+                        decoder.decode(chunk)
+                        await document.write(chunk)
+                decoder.decode(b"", final=True)
+            except UnicodeDecodeError:
+                raise HTTPException(status_code=400, detail=f"{file.filename} is not a UTF-8 text file")
+            paths.append(path)
+        try:
+            # Embedded in-process, a worker pool per request would cost more than it saves
+            stats = await loop.run_in_executor(
+                None, partial(db.ingest_files, paths, workers=0, sources=[file.filename for file in files])
+            )
+        except Exception as e:
+            logger.error(f"Error during ingestion of {', '.join(file.filename for file in files)}: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+    return JSONResponse(content=stats)
+
+
+async def handle_job_submission(file: UploadFile, store: JobStore, priority: int = 0,
+                                webhook_url: Optional[str] = None) -> JSONResponse:
+    """
+    Store an uploaded audio file and queue it as a transcription job.
+    The upload is streamed to disk as it arrives; decoding and transcription happen in the job workers.
+
+    Parameters:
+    - file (UploadFile): The uploaded audio file.
+    - store (JobStore): The job queue.
+    - priority (int): Jobs with a higher priority run first.
+    - webhook_url (str): Optional URL the finished job is POSTed to.
+
+    Returns:
+    - JSONResponse: 202 with the ID and status of the queued job.
+
+    Raises:
+    - HTTPException: 400 if the webhook URL is not allowed, 500 if the upload cannot be stored.
+    """
+    loop = asyncio.get_running_loop()
+    if webhook_url is not None:
+        try:
+            # Resolves the host, checked before the upload is stored
+            await loop.run_in_executor(None, check_webhook_url, webhook_url, store.webhook_hosts)
+        except ValueError as e:
+            logger.warning(f"Rejecting job: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    path = store.new_audio_path(file.filename)
+    try:
+        async with aiofiles.open(path, "wb") as audio_file:
+            while chunk := await file.read(CHUNK_SIZE):
+                await audio_file.write(chunk)
+        job_id = await loop.run_in_executor(
+            None, partial(store.submit, path, priority=priority, webhook_url=webhook_url),
+        )
+    except Exception as e:
+        logger.error(f"Error while queueing a job: {str(e)}")
+        if os.path.exists(path):
+            os.remove(path)
+        raise HTTPException(status_code=500, detail=str(e))
+    return JSONResponse(status_code=202, content={"id": job_id, "status": QUEUED})
@@ -0,0 +1,917 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from array import array
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from langchain_core.documents import Document
+from app.snapshot import OFFSETS_FILE as RECORD_OFFSETS_FILE, RECORDS_FILE, encode_record, open_records, read_record
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock (Windows) writers are only serialized within a process
+    fcntl = None
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "index.json"
+LOCK_FILE = "index.lock"
+BUILD_LOCK_FILE = "build.lock"
+SEGMENT_FILE = "segment.json"
+VECTORS_FILE = "vectors.bin"
+ID_HASHES_FILE = "id_hashes.npy"
+ID_ROWS_FILE = "id_rows.npy"
+SEGMENT_PREFIX = "segment-"
+DELETED_PREFIX = "deleted-"
+CENTROIDS_FILE = "ivf_centroids.npy"
+LISTS_FILE = "ivf_lists.npy"
+OFFSETS_FILE = "ivf_offsets.npy"
+SCALES_FILE = "vector_scales.npy"
+
+# Storage types of the index vectors; float16 halves and int8 quarters the memory of float32
+STORAGE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# Rows converted to float32 at a time when scoring reduced-precision vectors
+DECODE_BLOCK = 16384
+
+# Records read from a Chroma collection at a time when the index is built from it
+EXPORT_PAGE_SIZE = 4096
+
+
+def id_hash(record_id: str) -> int:
+    """Return a stable 64-bit hash of a record ID."""
+    return int.from_bytes(hashlib.blake2b(record_id.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+@contextmanager
+def directory_lock(directory: str, name: str = LOCK_FILE) -> Iterator[None]:
+    """
+    Hold an exclusive lock on an index directory, across processes where flock is available.
+
+    Parameters:
+    - directory (str): The directory to lock; it is created if necessary.
+    - name (str): The lock file, so independent operations can use separate locks.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), "a") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def collection_pages(collection, page_size: int = EXPORT_PAGE_SIZE
+                     ) -> Iterator[Tuple[List[str], np.ndarray, List[str], List[Optional[dict]]]]:
+    """
+    Read the records of a Chroma collection page by page, so memory is bounded by a page, not the collection.
+
+    Parameters:
+    - collection (chromadb.Collection): The collection to read.
+    - page_size (int): The number of records per page.
+
+    Yields:
+    - Tuple[List[str], np.ndarray, List[str], List[Optional[dict]]]: The IDs, float32 embeddings, texts and
+      metadata of a page.
+    """
+    offset = 0
+    while True:
+        result = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        ids = result["ids"]
+        if not ids:
+            return
+        vectors = np.asarray(result["embeddings"], dtype=np.float32)
+        yield ids, vectors.reshape(len(ids), -1), result["documents"], result["metadatas"]
+        if len(ids) < page_size:
+            return
+        offset += len(ids)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale rows to unit length so a dot product is the cosine similarity.
+
+    Parameters:
+    - vectors (np.ndarray): A (n, d) matrix.
+
+    Returns:
+    - np.ndarray: A float32 matrix with unit-length rows (zero rows stay zero).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Select the k highest scores per row without sorting the whole row.
+
+    Parameters:
+    - scores (np.ndarray): A (q, n) score matrix.
+    - k (int): The number of results per row.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: (q, k) column indices and scores, best first.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(np.float32)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+
+def merge_top_k(indices: Sequence[np.ndarray], scores: Sequence[np.ndarray], k: int,
+                queries: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge the top k lists of several parts of an index into one.
+
+    Parameters:
+    - indices (Sequence[np.ndarray]): The (q, k_i) row indices found in each part, already offset to global rows.
+    - scores (Sequence[np.ndarray]): The matching scores; -inf marks padding.
+    - k (int): The number of results per query.
+    - queries (int): The number of queries, for the shape of an empty result.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: (q, k) row indices and scores, best first, padded with index -1.
+    """
+    if not indices:
+        return np.full((queries, 0), -1, dtype=np.int64), np.empty((queries, 0), dtype=np.float32)
+    best, best_scores = top_k(np.concatenate(scores, axis=1), k)
+    best = np.take_along_axis(np.concatenate(indices, axis=1), best, axis=1)
+    best[np.isneginf(best_scores)] = -1
+    return best, best_scores
+
+
+def encode_vectors(vectors: np.ndarray, precision: str = "float32") -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Convert unit-length float32 vectors to a storage type.
+
+    Parameters:
+    - vectors (np.ndarray): A (n, d) float32 matrix of unit-length rows.
+    - precision (str): 'float32', 'float16' or 'int8'.
+
+    Returns:
+    - Tuple[np.ndarray, Optional[np.ndarray]]: The stored matrix and, for int8, the float32 scale of each row
+      (a row is restored as int8 row * scale).
+
+    Raises:
+    - ValueError: If the precision is unknown.
+    """
+    if precision not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown vector precision {precision!r}, expected one of {tuple(STORAGE_DTYPES)}")
+    if precision != "int8":
+        return vectors.astype(STORAGE_DTYPES[precision]), None
+    # Symmetric quantization per row, so every row uses the full int8 range
+    scales = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.empty(0, dtype=np.float32)
+    scales[scales == 0] = 1
+    quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def decode_vectors(vectors: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Restore stored vectors to float32 for scoring.
+
+    Parameters:
+    - vectors (np.ndarray): Rows of the stored matrix.
+    - scales (np.ndarray): The matching int8 row scales, None for float types.
+
+    Returns:
+    - np.ndarray: The rows as float32.
+    """
+    if vectors.dtype == np.float32:
+        return np.asarray(vectors)
+    decoded = np.asarray(vectors, dtype=np.float32)
+    if scales is not None:
+        decoded *= np.asarray(scales)[:, None]
+    return decoded
+
+
+class BruteForceIndex:
+    """
+    Exact cosine search over a (memory-mapped) matrix of unit-length vectors.
+    One matrix product scores all queries against all vectors, argpartition selects the top k.
+    float16 and int8 matrices are converted to float32 block by block while scoring, so only the
+    compact matrix is resident. Rows flagged in dead (removed records) are never returned.
+    """
+
+    def __init__(self, vectors: np.ndarray, scales: Optional[np.ndarray] = None, dead: Optional[np.ndarray] = None):
+        self.vectors = vectors
+        self.scales = scales
+        self.dead = dead
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest vectors for each query.
+
+        Parameters:
+        - queries (np.ndarray): A (q, d) matrix of unit-length queries.
+        - k (int): The number of results per query.
+
+        Returns:
+        - Tuple[np.ndarray, np.ndarray]: (q, k) row indices and cosine similarities, best first.
+          Rows are padded with index -1 if fewer than k rows are live.
+        """
+        if self.vectors.dtype == np.float32:
+            scores = queries @ self.vectors.T
+        else:
+            scores = np.empty((len(queries), len(self.vectors)), dtype=np.float32)
+            for start in range(0, len(self.vectors), DECODE_BLOCK):
+                stop = start + DECODE_BLOCK
+                scales = None if self.scales is None else self.scales[start:stop]
+                scores[:, start:stop] = queries @ decode_vectors(self.vectors[start:stop], scales).T
+        if self.dead is None:
+            return top_k(scores, k)
+        scores[:, self.dead] = -np.inf
+        indices, scores = top_k(scores, k)
+        indices[np.isneginf(scores)] = -1
+        return indices, scores
+
+
+class IVFIndex:
+    """
+    Approximate cosine search with an inverted file index.
+
+    The vectors are clustered with k-means; each query is only compared with the vectors of the
+    n_probe clusters whose centroids are closest to it. The clustering is stored next to the
+    vectors so it is built once, not on every start. Rows flagged in dead are skipped.
+
+    Attributes:
+    - vectors (np.ndarray): The (n, d) matrix of unit-length vectors.
+    - centroids (np.ndarray): The (n_lists, d) cluster centroids.
+    - lists (np.ndarray): Row indices grouped by cluster.
+    - offsets (np.ndarray): Start of each cluster in lists, with a final entry of n.
+    - n_probe (int): The number of clusters searched per query.
+    - scales (np.ndarray): The row scales of int8 vectors, None for float types.
+    - dead (np.ndarray): Flags the rows of removed records, None if there are none.
+    """
+
+    def __init__(self, vectors: np.ndarray, centroids: np.ndarray, lists: np.ndarray, offsets: np.ndarray,
+                 n_probe: int = 8, scales: Optional[np.ndarray] = None, dead: Optional[np.ndarray] = None):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.lists = lists
+        self.offsets = offsets
+        self.n_probe = n_probe
+        self.scales = scales
+        self.dead = dead
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, n_lists: int = 0, n_probe: int = 8, iterations: int = 10,
+              sample_size: int = 65536, seed: int = 0, scales: Optional[np.ndarray] = None) -> "IVFIndex":
+        """
+        Cluster the vectors and build the inverted lists. Stored vectors are decoded block by block, so a
+        memory-mapped matrix is never converted to float32 as a whole.
+
+        Parameters:
+        - vectors (np.ndarray): The (n, d) matrix of unit-length vectors, as stored.
+        - n_lists (int): The number of clusters, 0 for about sqrt(n).
+        - n_probe (int): The number of clusters searched per query.
+        - iterations (int): The number of k-means iterations.
+        - sample_size (int): The number of vectors the centroids are trained on.
+        - seed (int): Seed for the centroid initialization and sampling.
+        - scales (np.ndarray): The row scales of int8 vectors, None for float types.
+
+        Returns:
+        - IVFIndex: The index.
+        """
+        rng = np.random.default_rng(seed)
+        n = len(vectors)
+        n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        rows = np.arange(n) if n <= sample_size else np.sort(rng.choice(n, sample_size, replace=False))
+        sample = decode_vectors(vectors[rows], None if scales is None else scales[rows])
+        centroids = np.array(sample[rng.choice(len(sample), n_lists, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(n_lists):
+                members = sample[assignment == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+
+        assignment = cls._assign(vectors, centroids, scales)
+        lists = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[lists], np.arange(n_lists + 1))
+        return cls(vectors, centroids, lists.astype(np.int64), offsets.astype(np.int64), n_probe=n_probe,
+                   scales=scales)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, scales: Optional[np.ndarray] = None,
+                block: int = 65536) -> np.ndarray:
+        """Assign every vector to its nearest centroid, in blocks to bound the score matrix."""
+        return np.concatenate([
+            np.argmax(
+                decode_vectors(vectors[start:start + block], None if scales is None else scales[start:start + block])
+                @ centroids.T, axis=1,
+            ) for start in range(0, len(vectors), block)
+        ]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find approximately the k nearest vectors for each query.
+
+        Parameters:
+        - queries (np.ndarray): A (q, d) matrix of unit-length queries.
+        - k (int): The number of results per query.
+
+        Returns:
+        - Tuple[np.ndarray, np.ndarray]: (q, k) row indices and cosine similarities, best first.
+          Rows are padded with index -1 if the probed clusters hold fewer than k vectors.
+        """
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes, _ = top_k(queries @ self.centroids.T, n_probe)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, (query, clusters) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([self.lists[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+            if self.dead is not None:
+                candidates = candidates[~self.dead[candidates]]
+            scales = None if self.scales is None else self.scales[candidates]
+            found, found_scores = top_k((decode_vectors(self.vectors[candidates], scales) @ query)[None, :], k)
+            indices[row, :found.shape[1]] = candidates[found[0]]
+            scores[row, :found.shape[1]] = found_scores[0]
+        return indices, scores
+
+
+class SnapshotIndex:
+    """
+    Exact cosine search straight over the memory-mapped vector blocks of a snapshot chain.
+
+    Snapshot vectors are stored as they came from Chroma, not normalized, so every row is scaled by its
+    inverse norm while scoring. Rows that are not part of the chain's final state are masked out. Row
+    indices run over the blocks back to back, in the order of the snapshots.
+
+    Attributes:
+    - vectors (np.ndarray): The vector block of the first snapshot, for its storage type.
+    """
+
+    def __init__(self, blocks: Sequence[np.ndarray], rows: Sequence[np.ndarray]):
+        """
+        Initialize the SnapshotIndex. Reads every vector once to compute the row norms.
+
+        Parameters:
+        - blocks (Sequence[np.ndarray]): The (n_i, d) vector blocks of the snapshots.
+        - rows (Sequence[np.ndarray]): For each block, the positions of the rows to search.
+        """
+        self.vectors = blocks[0]
+        self._parts = []
+        offset = 0
+        for block, live in zip(blocks, rows):
+            scales = np.zeros(len(block), dtype=np.float32)
+            for start in range(0, len(block), DECODE_BLOCK):
+                norms = np.linalg.norm(decode_vectors(block[start:start + DECODE_BLOCK]), axis=1)
+                norms[norms == 0] = np.inf
+                scales[start:start + DECODE_BLOCK] = 1 / norms
+            dead = np.ones(len(block), dtype=bool)
+            dead[live] = False
+            self._parts.append((block, scales, dead if dead.any() else None, offset))
+            offset += len(block)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest rows for each query.
+
+        Parameters:
+        - queries (np.ndarray): A (q, d) matrix of unit-length queries.
+        - k (int): The number of results per query.
+
+        Returns:
+        - Tuple[np.ndarray, np.ndarray]: (q, k) row indices and cosine similarities, best first.
+          Rows are padded with index -1 if fewer than k rows are searched.
+        """
+        indices, scores = [], []
+        for block, scales, dead, offset in self._parts:
+            if not len(block):
+                continue
+            part = np.empty((len(queries), len(block)), dtype=np.float32)
+            for start in range(0, len(block), DECODE_BLOCK):
+                stop = start + DECODE_BLOCK
+                part[:, start:stop] = (queries @ decode_vectors(block[start:stop]).T) * scales[start:stop]
+            if dead is not None:
+                part[:, dead] = -np.inf
+            found, found_scores = top_k(part, k)
+            indices.append(found + offset)
+            scores.append(found_scores)
+        return merge_top_k(indices, scores, k, len(queries))
+
+
+class ChainedRecords:
+    """
+    The records of a chain of parts (snapshots or index segments), decoded on access through their offset
+    indexes. Indexed over the parts back to back; the length is the number of live records.
+    """
+
+    def __init__(self, parts: Sequence[Any], size: int):
+        self._parts = list(parts)
+        self._starts = np.cumsum([0] + [len(part) for part in parts])
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        part = int(np.searchsorted(self._starts, index, side="right")) - 1
+        record = self._parts[part].record(int(index - self._starts[part]))
+        return {"id": record["id"], "text": record["text"], "metadata": record["metadata"] or {}}
+
+
+class SegmentIndex:
+    """
+    Search over the segments of a VectorStore, each with its own exact or IVF index, merging their top k.
+    Row indices run over the segments back to back.
+
+    Attributes:
+    - vectors (np.ndarray): The vectors of the first segment, for their storage type.
+    """
+
+    def __init__(self, indexes: Sequence[Union[BruteForceIndex, IVFIndex]]):
+        self.indexes = list(indexes)
+        self.vectors = self.indexes[0].vectors
+        self._offsets = np.cumsum([0] + [len(index.vectors) for index in self.indexes])
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest live rows for each query.
+
+        Parameters:
+        - queries (np.ndarray): A (q, d) matrix of unit-length queries.
+        - k (int): The number of results per query.
+
+        Returns:
+        - Tuple[np.ndarray, np.ndarray]: (q, k) row indices and cosine similarities, best first.
+          Rows are padded with index -1 if fewer than k rows are found.
+        """
+        indices, scores = [], []
+        for index, offset in zip(self.indexes, self._offsets):
+            if not len(index.vectors):
+                continue
+            found, found_scores = index.search(queries, k)
+            indices.append(found + offset)
+            scores.append(found_scores)
+        return merge_top_k(indices, scores, k, len(queries))
+
+
+class Segment:
+    """
+    An immutable part of a VectorStore, memory-mapped from its directory: the stored vectors, the records
+    as JSON blobs with an offset index, IDs hashes sorted for lookups and, for large segments, an IVF index.
+
+    Attributes:
+    - path (str): The segment directory.
+    - vectors (np.ndarray): The (n, d) stored vectors.
+    - scales (np.ndarray): The row scales of int8 vectors, None for float types.
+    - index (Union[BruteForceIndex, IVFIndex]): The index searching the segment.
+    """
+
+    def __init__(self, path: str, n_probe: int = 8):
+        self.path = path
+        with open(os.path.join(path, SEGMENT_FILE), encoding="utf-8") as file:
+            meta = json.load(file)
+        shape = (meta["size"], meta["dimension"])
+        vectors_path = os.path.join(path, VECTORS_FILE)
+        dtype = STORAGE_DTYPES[meta["precision"]]
+        self.vectors = (np.memmap(vectors_path, dtype=dtype, mode="r", shape=shape) if os.path.getsize(vectors_path)
+                        else np.empty(shape, dtype=dtype))
+        self.scales = np.load(os.path.join(path, SCALES_FILE), mmap_mode="r") if meta["precision"] == "int8" else None
+        self._records, self._offsets = open_records(path)
+        self._hashes = np.load(os.path.join(path, ID_HASHES_FILE), mmap_mode="r")
+        self._rows = np.load(os.path.join(path, ID_ROWS_FILE), mmap_mode="r")
+        if os.path.exists(os.path.join(path, CENTROIDS_FILE)):
+            self.index = IVFIndex(
+                self.vectors,
+                np.load(os.path.join(path, CENTROIDS_FILE)),
+                np.load(os.path.join(path, LISTS_FILE), mmap_mode="r"),
+                np.load(os.path.join(path, OFFSETS_FILE)),
+                n_probe=n_probe,
+                scales=self.scales,
+            )
+        else:
+            self.index = BruteForceIndex(self.vectors, self.scales)
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def record(self, index: int) -> Dict[str, Any]:
+        """Decode the record at a row into its 'id', 'text' and 'metadata'."""
+        return read_record(self._records, self._offsets, index)
+
+    def blob(self, index: int) -> bytes:
+        """Return the encoded record at a row, to copy it without decoding."""
+        return self._records[int(self._offsets[index]):int(self._offsets[index + 1])].tobytes()
+
+    def find(self, record_id: str) -> Optional[int]:
+        """Return the row of a record ID, None if the segment does not hold it."""
+        key = np.uint64(id_hash(record_id))
+        start, stop = np.searchsorted(self._hashes, key, side="left"), np.searchsorted(self._hashes, key, side="right")
+        for row in self._rows[start:stop]:
+            if self.record(int(row))["id"] == record_id:
+                return int(row)
+        return None
+
+    def row_hashes(self) -> np.ndarray:
+        """Return the ID hash of every row, in row order."""
+        hashes = np.empty(len(self._hashes), dtype=np.uint64)
+        hashes[self._rows] = self._hashes
+        return hashes
+
+
+class IndexWriter:
+    """
+    A change to a VectorStore: records to add and record IDs to remove, applied together by commit().
+
+    Added records are written to a new segment directory as they come, so memory does not grow with their
+    number. Committing resolves the removals against the committed segments, appends the new segment and
+    swaps in a new manifest, so searches and other processes see all of the change or none of it.
+
+    Attributes:
+    - store (VectorStore): The store the change applies to.
+    - replace (bool): Replace the content of the store instead of adding to it.
+    - size (int): The number of records added so far.
+    """
+
+    def __init__(self, store: "VectorStore", replace: bool = False):
+        self.store = store
+        self.replace = replace
+        self.size = 0
+        self.name = f"{SEGMENT_PREFIX}{uuid.uuid4().hex[:16]}"
+        # Staging directories end in .tmp, which cleaning up after a commit leaves to their writer
+        self._path = os.path.join(store.directory, f"{self.name}.tmp")
+        os.makedirs(self._path)
+        self._dimension: Optional[int] = None
+        self._vectors = open(os.path.join(self._path, VECTORS_FILE), "wb")
+        self._records = open(os.path.join(self._path, RECORDS_FILE), "wb")
+        self._offsets = array("q", [0])
+        self._hashes = array("Q")
+        self._scales: List[np.ndarray] = []
+        self._removed: List[str] = []
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray, texts: Sequence[str],
+            metadatas: Sequence[Optional[dict]]) -> None:
+        """
+        Add records to the new segment.
+
+        Parameters:
+        - ids (Sequence[str]): The IDs of the records.
+        - vectors (np.ndarray): The (n, d) embeddings of the records.
+        - texts (Sequence[str]): The texts of the records.
+        - metadatas (Sequence[Optional[dict]]): The metadata of the records.
+        """
+        if not len(ids):
+            return
+        stored, scales = encode_vectors(normalize_rows(vectors), self.store.precision)
+        blobs = [encode_record(i, t, m or {}) for i, t, m in zip(ids, texts, metadatas)]
+        self._append(stored, scales, blobs, [id_hash(i) for i in ids])
+
+    def remove(self, ids: Sequence[str]) -> None:
+        """
+        Remove records that were committed before. IDs the store does not hold are ignored.
+
+        Parameters:
+        - ids (Sequence[str]): The IDs of the records.
+        """
+        self._removed.extend(ids)
+
+    def commit(self) -> None:
+        """Apply the change to the store and load the result."""
+        self.store._commit(self)
+
+    def discard(self) -> None:
+        """Drop the change and the records written for it."""
+        self._vectors.close()
+        self._records.close()
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def _append(self, stored: np.ndarray, scales: Optional[np.ndarray], blobs: Sequence[bytes],
+                hashes: Sequence[int]) -> None:
+        """Write encoded rows to the segment files."""
+        if self._dimension is None:
+            self._dimension = stored.shape[1]
+        elif stored.shape[1] != self._dimension:
+            raise ValueError(f"Expected vectors of dimension {self._dimension}, got {stored.shape[1]}")
+        self._vectors.write(np.ascontiguousarray(stored, dtype=STORAGE_DTYPES[self.store.precision]).tobytes())
+        if scales is not None:
+            self._scales.append(np.asarray(scales, dtype=np.float32))
+        for blob in blobs:
+            self._records.write(blob)
+            self._offsets.append(self._offsets[-1] + len(blob))
+        self._hashes.extend(hashes)
+        self.size += len(blobs)
+
+    def _finish(self) -> Optional[str]:
+        """Write the lookup and IVF files and move the segment into place. Returns its name, None if empty."""
+        self._vectors.close()
+        self._records.close()
+        if not self.size:
+            self.discard()
+            return None
+        precision = self.store.precision
+        if precision == "int8":
+            np.save(os.path.join(self._path, SCALES_FILE), np.concatenate(self._scales))
+        np.save(os.path.join(self._path, RECORD_OFFSETS_FILE), np.frombuffer(self._offsets, dtype=np.int64))
+        hashes = np.frombuffer(self._hashes, dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable")
+        np.save(os.path.join(self._path, ID_HASHES_FILE), hashes[order])
+        np.save(os.path.join(self._path, ID_ROWS_FILE), order.astype(np.int64))
+        with open(os.path.join(self._path, SEGMENT_FILE), "w", encoding="utf-8") as file:
+            json.dump({"size": self.size, "dimension": self._dimension or 0, "precision": precision}, file)
+        if self.store.ivf_threshold and self.size >= self.store.ivf_threshold:
+            segment = Segment(self._path)
+            ivf = IVFIndex.build(segment.vectors, n_probe=self.store.n_probe, scales=segment.scales)
+            np.save(os.path.join(self._path, CENTROIDS_FILE), ivf.centroids)
+            np.save(os.path.join(self._path, LISTS_FILE), ivf.lists)
+            np.save(os.path.join(self._path, OFFSETS_FILE), ivf.offsets)
+        os.replace(self._path, os.path.join(self.store.directory, self.name))
+        return self.name
+
+
+class VectorStore:
+    """
+    An in-process vector index kept next to the Chroma database.
+
+    The index is a list of immutable segments, each a directory with its vectors, records and ID lookup,
+    memory-mapped on load. Records are stored as JSON blobs with an offset index like in snapshots, so
+    loading reads neither the records nor the vectors. Changes are written by an IndexWriter: added records
+    go to a new segment, removed ones are flagged in a deletion list, and a manifest naming the segments
+    is swapped in atomically, so a crash leaves the previous index intact. Once the appended segments and
+    removals exceed compact_ratio of the first segment, the live rows are merged into one segment and
+    its IVF index is trained again.
+
+    Segments with fewer than ivf_threshold vectors are searched exactly, larger ones with an IVF index.
+    The vectors are stored as float32, float16 or int8 (with a scale per row).
+
+    Attributes:
+    - directory (str): The directory holding the index files.
+    - ivf_threshold (int): The segment size from which the IVF index is used, 0 to always search exactly.
+    - n_probe (int): The number of IVF clusters searched per query.
+    - precision (str): The storage type of newly written segments, 'float32', 'float16' or 'int8'.
+    - compact_ratio (float): The share of appended and removed rows, relative to the first segment, from
+      which the segments are merged.
+    - max_segments (int): The number of segments from which they are merged regardless of their size.
+    - size (int): The number of indexed vectors.
+    - stored_precision (str): The storage type of the loaded index, None if none is loaded.
+    """
+
+    def __init__(self, directory: str, ivf_threshold: int = 10000, n_probe: int = 8, precision: str = "float32",
+                 compact_ratio: float = 0.2, max_segments: int = 16):
+        if precision not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown vector precision {precision!r}, expected one of {tuple(STORAGE_DTYPES)}")
+        self.directory = directory
+        self.ivf_threshold = ivf_threshold
+        self.n_probe = n_probe
+        self.precision = precision
+        self.compact_ratio = compact_ratio
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._snapshot: Tuple[Any, Any] = ([], None)
+
+    @property
+    def size(self) -> int:
+        return len(self._snapshot[0])
+
+    @property
+    def stored_precision(self) -> Optional[str]:
+        index = self._snapshot[1]
+        return None if index is None else np.dtype(index.vectors.dtype).name
+
+    def exists(self) -> bool:
+        """Check whether an index was written to the directory."""
+        return os.path.exists(os.path.join(self.directory, MANIFEST_FILE))
+
+    def lock(self):
+        """
+        Hold the lock of full builds, so processes sharing the directory check and rebuild it one at a time.
+
+        Returns:
+        - ContextManager: The held lock.
+        """
+        return directory_lock(self.directory, BUILD_LOCK_FILE)
+
+    def writer(self, replace: bool = False) -> IndexWriter:
+        """
+        Start a change to the index.
+
+        Parameters:
+        - replace (bool): Replace the content of the index instead of adding to it.
+
+        Returns:
+        - IndexWriter: The change, applied by its commit().
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        return IndexWriter(self, replace=replace)
+
+    def build(self, ids: Sequence[str], vectors: np.ndarray, texts: Sequence[str],
+              metadatas: Sequence[Optional[dict]]) -> None:
+        """
+        Replace the index with the given records and load it.
+
+        Parameters:
+        - ids (Sequence[str]): The IDs of the records.
+        - vectors (np.ndarray): The (n, d) embeddings of the records.
+        - texts (Sequence[str]): The texts of the records.
+        - metadatas (Sequence[Optional[dict]]): The metadata of the records.
+        """
+        writer = self.writer(replace=True)
+        writer.add(ids, vectors, texts, metadatas)
+        writer.commit()
+
+    def build_from_collection(self, collection) -> None:
+        """
+        Replace the index with all embeddings, documents and metadata of a Chroma collection, read page by page.
+
+        Parameters:
+        - collection (chromadb.Collection): The collection to export.
+        """
+        writer = self.writer(replace=True)
+        try:
+            for ids, vectors, texts, metadatas in collection_pages(collection):
+                writer.add(ids, vectors, texts, metadatas)
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+        logger.info(f"Built vector index with {self.size} records in {self.directory}")
+
+    def load(self) -> None:
+        """Load the index from the directory, memory-mapping the segments."""
+        manifest = self._read_manifest() or {"segments": [], "deleted": None}
+        segments = [Segment(os.path.join(self.directory, entry["name"]), self.n_probe)
+                    for entry in manifest["segments"]]
+        deleted = self._read_deleted(manifest)
+        offset = 0
+        for segment in segments:
+            local = deleted[(deleted >= offset) & (deleted < offset + len(segment))] - offset
+            if len(local):
+                segment.index.dead = np.zeros(len(segment), dtype=bool)
+                segment.index.dead[local] = True
+            offset += len(segment)
+        if not segments:
+            index = None
+        elif len(segments) == 1:
+            index = segments[0].index
+        else:
+            index = SegmentIndex([segment.index for segment in segments])
+        # Swap records and index together so concurrent searches never mix two states
+        self._snapshot = (ChainedRecords(segments, offset - len(deleted)), index)
+
+    def _commit(self, writer: IndexWriter) -> None:
+        """Apply a writer's change under the directory lock: resolve removals, append, compact, swap, load."""
+        with self._lock, directory_lock(self.directory):
+            name = writer._finish()
+            manifest = None if writer.replace else self._read_manifest()
+            entries = [] if manifest is None else list(manifest["segments"])
+            deleted = np.empty(0, dtype=np.int64) if manifest is None else self._read_deleted(manifest)
+            if writer._removed and entries:
+                deleted = np.union1d(deleted, self._find_rows(entries, writer._removed, deleted)).astype(np.int64)
+            if name is not None:
+                entries.append({"name": name, "size": writer.size})
+            if self._needs_compaction([entry["size"] for entry in entries], deleted):
+                entries, deleted = self._compact(entries, deleted), np.empty(0, dtype=np.int64)
+            deleted_name = None
+            if len(deleted):
+                deleted_name = f"{DELETED_PREFIX}{uuid.uuid4().hex[:16]}.npy"
+                np.save(os.path.join(self.directory, deleted_name), deleted)
+            path = os.path.join(self.directory, MANIFEST_FILE)
+            with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+                json.dump({"precision": self.precision, "segments": entries, "deleted": deleted_name}, file)
+            os.replace(f"{path}.tmp", path)
+            self._clean({entry["name"] for entry in entries} | {deleted_name})
+            self.load()
+
+    def _needs_compaction(self, sizes: Sequence[int], deleted: np.ndarray) -> bool:
+        """Whether the appended segments and removed rows outweigh the first segment enough to merge them."""
+        if len(sizes) > self.max_segments:
+            return True
+        if len(sizes) < 2 and not len(deleted):
+            return False
+        return sum(sizes[1:]) + len(deleted) > self.compact_ratio * sizes[0]
+
+    def _find_rows(self, entries: Sequence[Dict[str, Any]], ids: Sequence[str], deleted: np.ndarray) -> np.ndarray:
+        """Return the live global rows of the IDs held by the segments; a removed and re-added ID is in several."""
+        rows = []
+        segments = [Segment(os.path.join(self.directory, entry["name"])) for entry in entries]
+        for record_id in ids:
+            offset = 0
+            for segment in segments:
+                row = segment.find(record_id)
+                if row is not None and offset + row not in deleted:
+                    rows.append(offset + row)
+                    break
+                offset += len(segment)
+        return np.asarray(rows, dtype=np.int64)
+
+    def _compact(self, entries: Sequence[Dict[str, Any]], deleted: np.ndarray) -> List[Dict[str, Any]]:
+        """Merge the live rows of the segments into one, copying the records without decoding them."""
+        writer = IndexWriter(self, replace=True)
+        offset = 0
+        for entry in entries:
+            segment = Segment(os.path.join(self.directory, entry["name"]))
+            dead = deleted[(deleted >= offset) & (deleted < offset + len(segment))] - offset
+            live = np.setdiff1d(np.arange(len(segment)), dead)
+            hashes = segment.row_hashes()
+            for start in range(0, len(live), DECODE_BLOCK):
+                rows = live[start:start + DECODE_BLOCK]
+                stored, scales = segment.vectors[rows], None if segment.scales is None else segment.scales[rows]
+                if stored.dtype != STORAGE_DTYPES[self.precision]:
+                    stored, scales = encode_vectors(decode_vectors(stored, scales), self.precision)
+                writer._append(stored, scales, [segment.blob(row) for row in rows], hashes[rows].tolist())
+            offset += len(segment)
+        name = writer._finish()
+        logger.info(f"Compacted {len(entries)} vector index segments into {writer.size} records")
+        return [] if name is None else [{"name": name, "size": writer.size}]
+
+    def _clean(self, keep: set) -> None:
+        """
+        Remove the segments and files the manifest no longer names. Searches that still use them keep their
+        memory maps; staging directories of writers in progress are left alone.
+        """
+        for name in os.listdir(self.directory):
+            if name in keep or name.endswith(".tmp") or name in (MANIFEST_FILE, LOCK_FILE, BUILD_LOCK_FILE):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                logger.warning(f"Could not remove {path} from the vector index: {str(e)}")
+
+    def _read_manifest(self) -> Optional[Dict[str, Any]]:
+        """Read the manifest of the committed index, None if there is none."""
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+
+    def _read_deleted(self, manifest: Dict[str, Any]) -> np.ndarray:
+        """Read the sorted global rows of the removed records of a manifest."""
+        if not manifest.get("deleted"):
+            return np.empty(0, dtype=np.int64)
+        return np.load(os.path.join(self.directory, manifest["deleted"]))
+
+    def serve_snapshots(self, snapshots: Sequence[Any], rows: Sequence[np.ndarray]) -> None:
+        """
+        Answer searches straight from a snapshot chain until the next build or load, without writing
+        an index. Searches are exact, records are decoded only when they are returned.
+
+        Parameters:
+        - snapshots (Sequence[Snapshot]): A full snapshot followed by deltas, each to the one before.
+        - rows (Sequence[np.ndarray]): For each snapshot, the positions of its records in the final state.
+        """
+        index = SnapshotIndex([snapshot.vectors for snapshot in snapshots], rows)
+        self._snapshot = (ChainedRecords(snapshots, sum(len(live) for live in rows)), index)
+
+    def search(self, queries: np.ndarray, k: Union[int, Sequence[int]]) -> List[List[Document]]:
+        """
+        Find the documents most similar to each query.
+
+        Parameters:
+        - queries (np.ndarray): A (q, d) matrix of query embeddings.
+        - k (Union[int, Sequence[int]]): The number of results, for all queries or per query.
+
+        Returns:
+        - List[List[Document]]: For each query, up to k documents, most similar first.
+        """
+        return [[document for document, _ in hits] for hits in self.search_with_scores(queries, k)]
+
+    def search_with_scores(self, queries: np.ndarray,
+                           k: Union[int, Sequence[int]]) -> List[List[Tuple[Document, float]]]:
+        """
+        Find the documents most similar to each query, with their cosine similarity.
+
+        Parameters:
+        - queries (np.ndarray): A (q, d) matrix of query embeddings.
+        - k (Union[int, Sequence[int]]): The number of results, for all queries or per query.
+
+        Returns:
+        - List[List[Tuple[Document, float]]]: For each query, up to k (document, similarity) pairs, most similar first.
+        """
+        ks = [k] * len(queries) if isinstance(k, int) else list(k)
+        records, index = self._snapshot
+        if index is None or not records or not ks:
+            return [[] for _ in ks]
+        indices, scores = index.search(normalize_rows(queries), max(ks))
+        return [
+            [
+                (Document(page_content=records[i]["text"], metadata=records[i]["metadata"]), float(score))
+                for i, score in zip(row[:n], row_scores[:n]) if i >= 0
+            ]
+            for row, row_scores, n in zip(indices, scores, ks)
+        ]
@@ -0,0 +1,160 @@
+import argparse
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence
+import numpy as np
+from app.registry import load_embedding_model, load_whisper_model, set_torch_threads
+from app.vector_index import BruteForceIndex, STORAGE_DTYPES, encode_vectors, normalize_rows
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    """
+    Compute the word error rate: word substitutions, insertions and deletions per reference word.
+
+    Parameters:
+    - reference (str): The reference transcript.
+    - hypothesis (str): The transcript to score.
+
+    Returns:
+    - float: The word error rate, 0.0 for identical transcripts.
+    """
+    ref, hyp = normalize_words(reference), normalize_words(hypothesis)
+    if not ref:
+        return float(bool(hyp))
+    # Levenshtein distance over words, one row at a time
+    previous = list(range(len(hyp) + 1))
+    for i, word in enumerate(ref, 1):
+        current = [i] + [0] * len(hyp)
+        for j, other in enumerate(hyp, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (word != other))
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def normalize_words(text: str) -> List[str]:
+    """Lower-case a transcript and strip punctuation, so only word differences count."""
+    return "".join(char if char.isalnum() or char.isspace() else " " for char in text.lower()).split()
+
+
+def recall_at_k(reference: Sequence[Sequence[int]], candidate: Sequence[Sequence[int]], k: int) -> float:
+    """
+    Compute the mean share of the reference top k that is also in the candidate top k.
+
+    Parameters:
+    - reference (Sequence[Sequence[int]]): Per query, the exact result indices, best first.
+    - candidate (Sequence[Sequence[int]]): Per query, the result indices to score.
+    - k (int): The number of results compared per query.
+
+    Returns:
+    - float: The recall@k between 0.0 and 1.0.
+    """
+    recalls = [
+        len(set(ref[:k]) & set(cand[:k])) / len(ref[:k])
+        for ref, cand in zip(reference, candidate) if len(ref[:k])
+    ]
+    return float(np.mean(recalls)) if recalls else 1.0
+
+
+def check_whisper(audio: str, model_size: str, reference_text: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Transcribe a clip with the fp32 and the int8 Whisper model and compare speed and word error rate.
+
+    Parameters:
+    - audio (str): The path of the audio clip.
+    - model_size (str): The Whisper model size.
+    - reference_text (str): The correct transcript, None to score against the fp32 transcript.
+
+    Returns:
+    - Dict[str, Any]: Per precision the seconds and WER, and the int8 speedup.
+    """
+    report = {}
+    transcripts = {}
+    for precision in ("fp32", "int8"):
+        model = load_whisper_model(model_size, precision=precision)
+        model.transcribe(audio, fp16=False)  # warm-up
+        started = time.perf_counter()
+        transcripts[precision] = model.transcribe(audio, fp16=False)["text"]
+        report[precision] = {"seconds": round(time.perf_counter() - started, 3)}
+    reference = reference_text if reference_text is not None else transcripts["fp32"]
+    for precision, transcript in transcripts.items():
+        report[precision].update(wer=round(word_error_rate(reference, transcript), 4), transcript=transcript.strip())
+    report["speedup"] = round(report["fp32"]["seconds"] / report["int8"]["seconds"], 2)
+    return report
+
+
+def check_embeddings(model_name: str, documents: List[str], queries: List[str], k: int) -> Dict[str, Any]:
+    """
+    Search the documents with the fp32 and the int8 embedding model and every index storage type,
+    scoring each against the exact fp32 search.
+
+    Parameters:
+    - model_name (str): The sentence transformer model.
+    - documents (List[str]): The documents to index.
+    - queries (List[str]): The queries to search for.
+    - k (int): The number of results per query.
+
+    Returns:
+    - Dict[str, Any]: Per model precision the embedding seconds and, per storage type, the recall@k.
+    """
+    report = {}
+    reference = None
+    for precision in ("fp32", "int8"):
+        model = load_embedding_model(model_name, precision=precision)
+        started = time.perf_counter()
+        vectors = normalize_rows(model.embed_documents(documents))
+        queries_matrix = normalize_rows(model.embed_documents(queries))
+        report[precision] = {"embedding_seconds": round(time.perf_counter() - started, 3)}
+        for storage in STORAGE_DTYPES:
+            stored, scales = encode_vectors(vectors, storage)
+            indices, _ = BruteForceIndex(stored, scales).search(queries_matrix, k)
+            if reference is None:
+                reference = indices.tolist()
+            report[precision][f"recall@{k}_{storage}"] = round(recall_at_k(reference, indices.tolist(), k), 4)
+    report["speedup"] = round(report["fp32"]["embedding_seconds"] / report["int8"]["embedding_seconds"], 2)
+    return report
+
+
+def main():
+    """Compare the reduced-precision modes with fp32 and fail if they are less accurate than allowed."""
+    parser = argparse.ArgumentParser(description="Check the accuracy of the int8 and reduced-precision modes.")
+    parser.add_argument('--audio', type=str, default="tests/sample_data/test.m4a", help="Audio clip to transcribe.")
+    parser.add_argument('--reference-text', type=str, help="Correct transcript of the clip (default: fp32 output).")
+    parser.add_argument('--whisper-size', type=str, default="tiny", help="Whisper model size.")
+    parser.add_argument('--embedding-model', type=str, default="all-MiniLM-L6-v2", help="Embedding model.")
+    parser.add_argument('--documents', type=str, default="tests/sample_data/test.txt", help="Text file, one document per line.")
+    parser.add_argument('--queries', type=str, help="Text file, one query per line (default: the documents).")
+    parser.add_argument('--k', type=int, default=3, help="Number of results compared per query.")
+    parser.add_argument('--threads', type=int, default=0, help="Torch intra-op threads, 0 for the default.")
+    parser.add_argument('--max-wer', type=float, default=0.1, help="Highest accepted WER of the int8 Whisper model.")
+    parser.add_argument('--min-recall', type=float, default=0.9, help="Lowest accepted recall@k of any mode.")
+    parser.add_argument('--skip-whisper', action='store_true', help="Only check the embeddings.")
+    parser.add_argument('--skip-embeddings', action='store_true', help="Only check Whisper.")
+    args = parser.parse_args()
+
+    set_torch_threads(args.threads)
+    report = {}
+    failed = False
+    if not args.skip_whisper:
+        report["whisper"] = check_whisper(args.audio, args.whisper_size, args.reference_text)
+        failed |= report["whisper"]["int8"]["wer"] > args.max_wer
+    if not args.skip_embeddings:
+        with open(args.documents, encoding="utf-8") as file:
+            documents = [line.strip() for line in file if line.strip()]
+        queries = documents
+        if args.queries:
+            with open(args.queries, encoding="utf-8") as file:
+                queries = [line.strip() for line in file if line.strip()]
+        report["embeddings"] = check_embeddings(args.embedding_model, documents, queries, args.k)
+        failed |= any(
+            value < args.min_recall
+            for precision in ("fp32", "int8")
+            for key, value in report["embeddings"][precision].items() if key.startswith("recall@")
+        )
+    print(json.dumps(report, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+import httpx
+import numpy as np
+from benchmarks.stubs import FakeOllamaServer, make_wav
+
+SCENARIOS = ("transcribe", "chat", "chat_stream", "chat_batch", "similarity", "similarity_batch")
+
+# Metrics compared against the baseline and whether higher values are better
+COMPARED_METRICS = {"throughput_rps": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+def summarize(latencies: List[float], errors: int, wall_seconds: float) -> Dict[str, Any]:
+    """
+    Summarize the latencies of one scenario.
+
+    Parameters:
+    - latencies (List[float]): Seconds per successful request.
+    - errors (int): The number of failed requests.
+    - wall_seconds (float): The duration of the scenario.
+
+    Returns:
+    - Dict[str, Any]: Request and error counts, throughput and latency percentiles in milliseconds.
+    """
+    summary = {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(latencies) / wall_seconds, 2) if wall_seconds else 0.0,
+    }
+    if latencies:
+        p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+        summary.update(p50_ms=round(float(p50), 2), p95_ms=round(float(p95), 2), p99_ms=round(float(p99), 2),
+                       max_ms=round(max(latencies) * 1000, 2))
+    return summary
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+            tolerance: float = 0.1) -> Dict[str, Dict[str, Any]]:
+    """
+    Compare scenario results with a baseline report.
+
+    Parameters:
+    - results (Dict[str, Dict[str, Any]]): Summaries per scenario.
+    - baseline (Dict[str, Dict[str, Any]]): Summaries per scenario of the baseline run.
+    - tolerance (float): Relative change accepted before a metric counts as a regression.
+
+    Returns:
+    - Dict[str, Dict[str, Any]]: Per scenario and metric the baseline, current value, relative change and
+      whether it regressed. Scenarios missing from the baseline are skipped.
+    """
+    comparison = {}
+    for scenario, summary in results.items():
+        reference = baseline.get(scenario)
+        if not reference:
+            continue
+        metrics = {}
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = reference.get(metric), summary.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            metrics[metric] = {"baseline": old, "current": new, "change": round(change, 4), "regressed": regressed}
+        comparison[scenario] = metrics
+    return comparison
+
+
+def process_usage(pid: int) -> Optional[Dict[str, float]]:
+    """
+    Read the CPU seconds and peak resident memory of a process from /proc.
+
+    Parameters:
+    - pid (int): The process ID.
+
+    Returns:
+    - Optional[Dict[str, float]]: 'cpu_seconds' and 'peak_rss_mb', or None where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as file:
+            peak_kb = next(int(line.split()[1]) for line in file if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        return None
+    # utime and stime are fields 14 and 15 of stat, i.e. 11 and 12 after the command name
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return {"cpu_seconds": cpu_seconds, "peak_rss_mb": round(peak_kb / 1024, 1)}
+
+
+def free_port() -> int:
+    """Ask the OS for a free TCP port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request_factory(scenario: str, args: argparse.Namespace) -> Callable[[httpx.AsyncClient, int], Any]:
+    """Build the function that sends request number i of a scenario."""
+    if scenario == "transcribe":
+        audio = make_wav(args.audio_seconds)
+
+        async def send(client, i):
+            return await client.post("/transcribe", files={"file": (f"clip{i}.wav", audio, "audio/wav")})
+    elif scenario == "chat":
+        async def send(client, i):
+            # Distinct prompts, so the response cache does not answer them
+            return await client.post("/chat_response", json={"text": f"benchmark prompt {i}"})
+    elif scenario == "chat_stream":
+        async def send(client, i):
+            async with client.stream("POST", "/chat_response/stream", json={"text": f"benchmark prompt {i}"}) as response:
+                async for _ in response.aiter_raw():
+                    pass
+                return response
+    elif scenario == "chat_batch":
+        async def send(client, i):
+            prompts = [{"text": f"benchmark prompt {i * args.batch_items + j}"} for j in range(args.batch_items)]
+            return await client.post("/chat_response/batch", json=prompts)
+    elif scenario == "similarity":
+        async def send(client, i):
+            return await client.post("/similarity", json={"text": f"benchmark query {i % args.distinct_queries}", "k": 3})
+    elif scenario == "similarity_batch":
+        async def send(client, i):
+            queries = [
+                {"text": f"benchmark query {(i * args.batch_items + j) % args.distinct_queries}", "k": 3}
+                for j in range(args.batch_items)
+            ]
+            return await client.post("/similarity/batch", json=queries)
+    else:
+        raise ValueError(f"Unknown scenario {scenario!r}, expected one of {SCENARIOS}")
+    return send
+
+
+async def drive(base_url: str, send, requests: int, concurrency: int) -> Dict[str, Any]:
+    """
+    Send requests from a fixed number of concurrent clients until all are done (closed loop).
+
+    Returns:
+    - Dict[str, Any]: The scenario summary.
+    """
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    response = await send(client, i)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall_seconds = time.perf_counter() - started
+    return summarize(latencies, errors, wall_seconds)
+
+
+def wait_until_ready(base_url: str, server: subprocess.Popen, timeout: float = 120) -> None:
+    """Poll /ready until the server and its stub services are loaded."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Benchmark server exited with code {server.returncode}")
+        try:
+            if httpx.get(f"{base_url}/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Benchmark server did not become ready in time")
+
+
+def run_scenario(scenario: str, args: argparse.Namespace, ollama_url: str) -> Dict[str, Any]:
+    """
+    Start a fresh server process for a scenario, warm it up, drive the load and measure the process.
+
+    Returns:
+    - Dict[str, Any]: The scenario summary with the CPU use and peak memory of the server process.
+    """
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    command = [
+        sys.executable, "-m", "benchmarks.server", "--port", str(port), "--config-file", args.config_file,
+        "--config", args.config, "--ollama-url", ollama_url, "--realtime-factor", str(args.realtime_factor),
+        "--corpus-size", str(args.corpus_size), "--embedding-ms", str(args.embedding_ms),
+    ]
+    server = subprocess.Popen(command)
+    try:
+        wait_until_ready(base_url, server)
+        send = request_factory(scenario, args)
+        asyncio.run(drive(base_url, send, args.warmup, min(args.concurrency, max(args.warmup, 1))))
+
+        before = process_usage(server.pid)
+        summary = asyncio.run(drive(base_url, send, args.requests, args.concurrency))
+        if scenario.endswith("_batch"):
+            # Comparable with the throughput of the single-item scenarios
+            summary["items_per_second"] = round(summary["throughput_rps"] * args.batch_items, 2)
+        after = process_usage(server.pid)
+        if before and after:
+            cpu = after["cpu_seconds"] - before["cpu_seconds"]
+            summary.update(
+                cpu_seconds=round(cpu, 3),
+                cpu_percent=round(100 * cpu / summary["wall_seconds"], 1) if summary["wall_seconds"] else None,
+                peak_rss_mb=after["peak_rss_mb"],
+            )
+        return summary
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    """Run the benchmark scenarios and print the JSON report."""
+    parser = argparse.ArgumentParser(description="Benchmark the service offline with stub models.")
+    parser.add_argument('--scenarios', type=str, default=",".join(SCENARIOS), help="Comma-separated scenarios.")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of concurrent clients.")
+    parser.add_argument('--requests', type=int, default=200, help="Number of measured requests per scenario.")
+    parser.add_argument('--warmup', type=int, default=10, help="Number of unmeasured requests per scenario.")
+    parser.add_argument('--batch-items', type=int, default=100, help="Items per request of the batch scenarios.")
+    parser.add_argument('--audio-seconds', type=float, default=5.0, help="Length of the uploaded audio clips.")
+    parser.add_argument('--realtime-factor', type=float, default=0.01, help="Stub Whisper seconds per audio second.")
+    parser.add_argument('--corpus-size', type=int, default=10000, help="Number of synthetic documents to search.")
+    parser.add_argument('--distinct-queries', type=int, default=1000000, help="Distinct similarity queries, lower for cache hits.")
+    parser.add_argument('--embedding-ms', type=float, default=0.0, help="Stub embedding cost per text in milliseconds.")
+    parser.add_argument('--tokens', type=int, default=32, help="Tokens generated by the fake Ollama server.")
+    parser.add_argument('--token-ms', type=float, default=2.0, help="Milliseconds per token of the fake Ollama server.")
+    parser.add_argument('--config-file', type=str, default="config.ini", help="Path of the configuration file.")
+    parser.add_argument('--config', type=str, default="test", help="Section of the configuration file to use.")
+    parser.add_argument('--output', type=str, help="Write the report to this file as well.")
+    parser.add_argument('--baseline', type=str, help="Compare with this report and fail on regressions.")
+    parser.add_argument('--save-baseline', type=str, help="Store the report as the new baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Relative change accepted before a regression.")
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    ollama = FakeOllamaServer(tokens=args.tokens, token_delay=args.token_ms / 1000).start()
+    try:
+        results = {scenario: run_scenario(scenario, args, ollama.url) for scenario in scenarios}
+    finally:
+        ollama.stop()
+
+    report = {
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "save_baseline")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as file:
+            report["comparison"] = compare(results, json.load(file)["results"], args.tolerance)
+        regressed = any(metric["regressed"] for metrics in report["comparison"].values() for metric in metrics.values())
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as file:
+                file.write(text + "\n")
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
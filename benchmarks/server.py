@@ -0,0 +1,68 @@
+import argparse
+import tempfile
+from configparser import ConfigParser
+from fastapi import FastAPI
+from app.batching import TranscriptionScheduler
+from app.main import create_app
+from app.models import WhisperTranscriber
+from app.startup import StartupOrchestrator
+from benchmarks.stubs import StubChromaDBHandler, StubTranscriber
+
+
+def build_app(args: argparse.Namespace) -> FastAPI:
+    """
+    Create the real app from config.ini with stub models in place of Whisper, the embedding model and Chroma.
+    Everything between the HTTP layer and the models (decoding, batching, caches, vector search) is the real code.
+
+    Parameters:
+    - args (argparse.Namespace): The parsed command line options.
+
+    Returns:
+    - FastAPI: The app to benchmark.
+    """
+    config = ConfigParser()
+    config.read(args.config_file)
+    section = config[args.config]
+    section['OllamaBaseUrl'] = args.ollama_url
+    app = create_app(section)
+
+    transcriber = StubTranscriber(realtime_factor=args.realtime_factor)
+    scheduler = TranscriptionScheduler(
+        transcriber,
+        max_batch_size=section.getint('TranscriptionMaxBatchSize', fallback=8),
+        max_wait_ms=section.getfloat('TranscriptionMaxWaitMs', fallback=10),
+        max_queue_size=section.getint('TranscriptionQueueSize', fallback=64),
+    )
+    app.dependency_overrides[WhisperTranscriber] = lambda: transcriber
+    app.dependency_overrides[TranscriptionScheduler] = lambda: scheduler
+
+    # Replace the background loaders before the app starts, so the real models are never loaded
+    startup: StartupOrchestrator = app.dependency_overrides[StartupOrchestrator]()
+    index_directory = tempfile.mkdtemp(prefix="aiservice-bench-")
+    startup.add("whisper", lambda: transcriber.model)
+    startup.add("database", lambda: StubChromaDBHandler(
+        index_directory, corpus_size=args.corpus_size, seconds_per_text=args.embedding_ms / 1000,
+    ))
+    return app
+
+
+def main():
+    """Run the app with stub models for the benchmark harness."""
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the app with stub models for benchmarking.")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Host to run the server on.")
+    parser.add_argument('--port', type=int, default=8765, help="Port to run the server on.")
+    parser.add_argument('--config-file', type=str, default="config.ini", help="Path of the configuration file.")
+    parser.add_argument('--config', type=str, default="test", help="Section of the configuration file to use.")
+    parser.add_argument('--ollama-url', type=str, required=True, help="Base URL of the (fake) Ollama server.")
+    parser.add_argument('--realtime-factor', type=float, default=0.01, help="Stub Whisper seconds per audio second.")
+    parser.add_argument('--corpus-size', type=int, default=10000, help="Number of synthetic documents to search.")
+    parser.add_argument('--embedding-ms', type=float, default=0.0, help="Stub embedding cost per text in milliseconds.")
+    args = parser.parse_args()
+
+    uvicorn.run(build_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+from app.splitter import StreamingTextSplitter
+
+WORDS = ("flamingo", "flamboyance", "pink", "lagoon", "shrimp", "carotenoid", "wader", "colony", "über", "naïve")
+
+
+def make_corpus(path: str, size_mb: float, seed: int = 0) -> None:
+    """Write a text file of about size_mb of random lines, with blank lines between paragraphs."""
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    written = 0
+    with open(path, "w", encoding="utf-8") as file:
+        while written < target:
+            line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 16)))
+            line += "\n\n" if rng.random() < 0.1 else "\n"
+            file.write(line)
+            written += len(line.encode("utf-8"))
+
+
+def current_path(path: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """Split a file the previous way: load it whole with TextLoader, split into LangChain Documents."""
+    from langchain_community.document_loaders import TextLoader
+    from langchain_text_splitters import CharacterTextSplitter
+    splitter = CharacterTextSplitter(separator="\n", chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    documents = splitter.split_documents(TextLoader(path, encoding="utf-8").load())
+    return [document.page_content for document in documents]
+
+
+def streaming_path(path: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """Split a file with the streaming splitter, keeping only the chunk texts like ingestion does."""
+    splitter = StreamingTextSplitter(chunk_size, chunk_overlap)
+    return [chunk.text for chunk in splitter.split_file(path)]
+
+
+def measure(split: Callable[[str, int, int], List[str]], path: str, chunk_size: int, chunk_overlap: int,
+            repeat: int) -> Dict[str, Any]:
+    """Time the best of repeat runs, then trace the peak Python memory of one more run."""
+    best = float("inf")
+    chunks: List[str] = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        chunks = split(path, chunk_size, chunk_overlap)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    split(path, chunk_size, chunk_overlap)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size_mb = os.path.getsize(path) / (1024 * 1024)
+    return {
+        "seconds": round(best, 4),
+        "mb_per_second": round(size_mb / best, 2),
+        "chunks": len(chunks),
+        "peak_memory_mb": round(peak / (1024 * 1024), 2),
+        "_chunks": chunks,
+    }
+
+
+def main():
+    """Compare the streaming splitter with the TextLoader and CharacterTextSplitter path and print the JSON report."""
+    parser = argparse.ArgumentParser(description="Benchmark document splitting for ingestion.")
+    parser.add_argument('--documents', type=str, help="Text file to split (default: a synthetic corpus).")
+    parser.add_argument('--size-mb', type=float, default=64, help="Size of the synthetic corpus.")
+    parser.add_argument('--chunk-size', type=int, default=60, help="Maximum characters per chunk.")
+    parser.add_argument('--chunk-overlap', type=int, default=0, help="Characters of overlap between chunks.")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per path, the best is reported.")
+    args = parser.parse_args()
+    # Both splitters warn about every line longer than a chunk; logging would dominate the timings
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.documents
+        if path is None:
+            path = os.path.join(directory, "corpus.txt")
+            make_corpus(path, args.size_mb)
+        report: Dict[str, Any] = {"file_mb": round(os.path.getsize(path) / (1024 * 1024), 2)}
+        report["streaming"] = measure(streaming_path, path, args.chunk_size, args.chunk_overlap, args.repeat)
+        try:
+            report["current"] = measure(current_path, path, args.chunk_size, args.chunk_overlap, args.repeat)
+        except ImportError as e:
+            print(f"Skipping the current path, LangChain is not installed: {e}", file=sys.stderr)
+    streaming_chunks = report["streaming"].pop("_chunks")
+    if "current" in report:
+        report["identical_chunks"] = report["current"].pop("_chunks") == streaming_chunks
+        report["speedup"] = round(report["current"]["seconds"] / report["streaming"]["seconds"], 2)
+    print(json.dumps(report, indent=2))
+    if not report.get("identical_chunks", True):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
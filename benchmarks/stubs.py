@@ -0,0 +1,182 @@
+import io
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Union
+import numpy as np
+from app.audio import SAMPLE_RATE
+from app.cache import EmbeddingCache
+from app.database import ChromaDBHandler
+from app.models import WhisperTranscriber
+from app.registry import ModelRegistry
+from app.vector_index import VectorStore
+
+
+def make_wav(seconds: float, frequency: float = 440.0) -> bytes:
+    """
+    Build a 16 kHz mono 16-bit PCM WAV file with a sine tone, the format the decoder reads without ffmpeg.
+
+    Parameters:
+    - seconds (float): The duration of the audio.
+    - frequency (float): The frequency of the tone in Hz.
+
+    Returns:
+    - bytes: The WAV file.
+    """
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pcm = (np.sin(2 * np.pi * frequency * t) * 0.3 * 32767).astype("<i2").tobytes()
+    buffer = io.BytesIO()
+    buffer.write(b"RIFF" + struct.pack("<I", 36 + len(pcm)) + b"WAVE")
+    buffer.write(b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16))
+    buffer.write(b"data" + struct.pack("<I", len(pcm)) + pcm)
+    return buffer.getvalue()
+
+
+class StubWhisperModel:
+    """Stands in for a Whisper model: sleeps for a fixed fraction of the audio duration, like a GPU would."""
+
+    def __init__(self, realtime_factor: float = 0.01):
+        self.realtime_factor = realtime_factor
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        duration = len(audio) / SAMPLE_RATE
+        time.sleep(duration * self.realtime_factor)
+        text = f"{duration:.1f} seconds of audio"
+        return {"text": text, "segments": [{"start": 0.0, "end": duration, "text": text}]}
+
+
+class StubTranscriber(WhisperTranscriber):
+    """
+    A WhisperTranscriber backed by StubWhisperModel, with its own registry so the real weights are never loaded.
+    A batch costs as much as its longest clip, mirroring the padded batched decode of the real transcriber.
+    """
+
+    def __init__(self, realtime_factor: float = 0.01):
+        super().__init__("stub")
+        self.realtime_factor = realtime_factor
+        self.registry = ModelRegistry(loader=lambda size: StubWhisperModel(realtime_factor), size_estimator=lambda model: 0)
+
+    def transcribe_batch(self, audio_inputs: List[Union[str, np.ndarray]]) -> List[str]:
+        self.model  # resolved through the registry like the real transcriber
+        durations = [len(audio) / SAMPLE_RATE for audio in audio_inputs]
+        time.sleep(max(durations, default=0) * self.realtime_factor)
+        return [f"{duration:.1f} seconds of audio" for duration in durations]
+
+
+class HashEmbeddings:
+    """
+    Deterministic embeddings seeded by a checksum of the text, with an optional per-text cost
+    to stand in for the transformer.
+    """
+
+    def __init__(self, dimension: int = 384, seconds_per_text: float = 0.0):
+        self.dimension = dimension
+        self.seconds_per_text = seconds_per_text
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.seconds_per_text:
+            time.sleep(self.seconds_per_text * len(texts))
+        return [self._vector(text).tolist() for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def _vector(self, text: str) -> np.ndarray:
+        return np.random.default_rng(zlib.crc32(text.encode())).standard_normal(self.dimension).astype(np.float32)
+
+
+class StubChromaDBHandler(ChromaDBHandler):
+    """
+    A ChromaDBHandler over a synthetic corpus in the in-process vector index, with hash embeddings.
+    The query cache and search paths are the real ones; only the embedding model and Chroma are replaced.
+    """
+
+    def __init__(self, directory: str, corpus_size: int = 10000, dimension: int = 384,
+                 seconds_per_text: float = 0.0, query_cache_size: int = 1024, ivf_threshold: int = 10000):
+        self.model_name = "hash-embeddings"
+        self.persist_directory = directory
+        self.embedding_function = HashEmbeddings(dimension, seconds_per_text)
+        self.query_cache = EmbeddingCache(max_entries=query_cache_size)
+        self.ingest_batch_size = 64
+        self.ingest_workers = 0
+        self.text_splitter = None
+        self.docs = None
+        self.vector_store = VectorStore(os.path.join(directory, "vector_index"), ivf_threshold=ivf_threshold)
+        texts = [f"synthetic document {i}" for i in range(corpus_size)]
+        vectors = np.stack([self.embedding_function._vector(text) for text in texts]) if texts else np.empty((0, dimension))
+        self.vector_store.build([str(i) for i in range(corpus_size)], vectors, texts, [{"source": "synthetic"}] * corpus_size)
+        # Searches go through the vector store, db only has to be set
+        self.db = self.vector_store
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """Answers /api/generate like an Ollama server producing a fixed number of tokens at a fixed rate."""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        tokens, delay = self.server.tokens, self.server.token_delay
+        if body["stream"]:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for index in range(tokens):
+                time.sleep(delay)
+                self._write_chunk(json.dumps({"response": f"token{index} ", "done": False}) + "\n")
+            self._write_chunk(json.dumps({
+                "response": "", "done": True, "eval_count": tokens, "eval_duration": int(tokens * delay * 1e9),
+            }) + "\n")
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            time.sleep(tokens * delay)
+            payload = json.dumps({
+                "response": " ".join(f"token{index}" for index in range(tokens)), "done": True,
+                "eval_count": tokens, "eval_duration": int(tokens * delay * 1e9),
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    def _write_chunk(self, text: str) -> None:
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOllamaServer:
+    """
+    A local fake Ollama server running in a background thread.
+
+    Attributes:
+    - url (str): The base URL of the server, known after start().
+    """
+
+    def __init__(self, tokens: int = 32, token_delay: float = 0.002, host: str = "127.0.0.1", port: int = 0):
+        self._server = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+        self._server.daemon_threads = True
+        self._server.tokens = tokens
+        self._server.token_delay = token_delay
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-ollama", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,124 @@
+import asyncio
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from app.admission import (
+    PRIORITIES, AIMDLimiter, AdmissionController, AdmissionMiddleware, AdmissionRejected, request_priority,
+)
+
+def test_aimd_limiter_grows_when_used_and_backs_off_when_slow():
+    limiter = AIMDLimiter(initial=4, max_limit=8, target_latency=1.0)
+    for _ in range(40):
+        limiter.record(0.1, in_flight=limiter.limit)
+    assert limiter.limit == 8
+    limiter.record(2.0, in_flight=8)
+    assert limiter.limit == 6
+    limiter.record(0.1, failed=True, in_flight=1)
+    assert limiter.limit == 4
+
+    # An idle limit does not grow, a fixed one never changes
+    limiter.record(0.1, in_flight=1)
+    assert limiter.limit == 4
+    fixed = AIMDLimiter(initial=2, target_latency=0)
+    fixed.record(10.0, failed=True, in_flight=2)
+    assert fixed.limit == 2
+
+def test_request_priority_header():
+    assert request_priority([(b"x-priority", b" High ")]) == PRIORITIES["high"]
+    assert request_priority([(b"x-priority", b"urgent")]) == PRIORITIES["normal"]
+    assert request_priority([]) == PRIORITIES["normal"]
+
+@pytest.mark.asyncio
+async def test_controller_queues_by_priority_and_sheds():
+    controller = AdmissionController("test", AIMDLimiter(initial=1, max_limit=1), max_queue=1, queue_timeout=0)
+    await controller.acquire()
+
+    normal = asyncio.ensure_future(controller.acquire(PRIORITIES["normal"]))
+    await asyncio.sleep(0)
+    assert controller.queue_depth == 1
+
+    # A full queue rejects requests of the same or lower priority at once
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire(PRIORITIES["low"])
+    assert exc_info.value.status_code == 429
+
+    # A higher priority takes the place of the queued request, which is shed
+    high = asyncio.ensure_future(controller.acquire(PRIORITIES["high"]))
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await normal
+    assert exc_info.value.status_code == 503
+
+    controller.release(0.1)
+    await high
+    assert controller.stats() == {"limit": 1, "in_flight": 1, "queued": 0}
+
+@pytest.mark.asyncio
+async def test_controller_queue_timeout_and_cancellation():
+    controller = AdmissionController("test", AIMDLimiter(initial=1, max_limit=1), max_queue=4, queue_timeout=0.01)
+    await controller.acquire()
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire()
+    assert exc_info.value.reason == "queue timeout"
+
+    controller.queue_timeout = 0
+    waiter = asyncio.ensure_future(controller.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.sleep(0)
+    assert controller.queue_depth == 0
+    controller.release(0.1)
+    assert controller.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_middleware_rejects_overload_but_not_health():
+    release = asyncio.Event()
+    app = FastAPI()
+
+    @app.get("/work")
+    async def work():
+        await release.wait()
+        return {"done": True}
+
+    @app.get("/health")
+    async def health():
+        return {"status": "OK"}
+
+    controller = AdmissionController("work", AIMDLimiter(initial=1, max_limit=1), max_queue=0, retry_after=3)
+    app.add_middleware(AdmissionMiddleware, controllers={"/work": controller})
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        first = asyncio.ensure_future(client.get("/work"))
+        while controller.in_flight == 0:
+            await asyncio.sleep(0.001)
+
+        rejected = await client.get("/work")
+        assert rejected.status_code == 429
+        assert rejected.headers["Retry-After"] == "3"
+        assert (await client.get("/health")).status_code == 200
+
+        release.set()
+        assert (await first).json() == {"done": True}
+    assert controller.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_middleware_times_streaming_responses_to_the_first_byte():
+    app = FastAPI()
+
+    @app.get("/stream")
+    async def stream():
+        async def tokens():
+            yield b"first"
+            await asyncio.sleep(0.2)
+            yield b"last"
+        return StreamingResponse(tokens())
+
+    controller = AdmissionController("stream", AIMDLimiter(initial=2, max_limit=2, target_latency=0.1))
+    app.add_middleware(AdmissionMiddleware, controllers={"/stream": controller})
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        assert (await client.get("/stream")).content == b"firstlast"
+    # The stream took longer than the target, but it started right away, so the limit is kept
+    assert controller.limiter.limit == 2
+    assert controller.in_flight == 0
@@ -0,0 +1,144 @@
+import hashlib
+import io
+import struct
+import wave
+import numpy as np
+import pytest
+from unittest.mock import patch
+from fastapi import UploadFile
+from app.audio import (
+    AudioDecodeError, SilenceTrimmer, decode_upload, hash_upload, iter_pcm, iter_windows, parse_wav_header,
+)
+
+def make_wav(samples: np.ndarray, sample_rate: int = 16000, channels: int = 1) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+def make_upload(data: bytes, filename: str) -> UploadFile:
+    return UploadFile(file=io.BytesIO(data), filename=filename)
+
+def test_parse_wav_header():
+    data = make_wav(np.zeros(10))
+    assert parse_wav_header(data) == (44, 1, 20)
+    assert parse_wav_header(make_wav(np.zeros(10), sample_rate=44100)) is None
+    assert parse_wav_header(b"This is not an audio file") is None
+
+@pytest.mark.asyncio
+async def test_decode_mono_wav_in_process():
+    samples = np.array([0, 16384, -16384, 32767] * 1000)
+    # A small chunk size makes the decoder stitch samples across reads
+    audio = await decode_upload(make_upload(make_wav(samples), "test.wav"), chunk_size=101)
+
+    assert audio.dtype == np.float32
+    np.testing.assert_allclose(audio, samples / 32768.0)
+
+@pytest.mark.asyncio
+async def test_decode_wav_stops_at_the_end_of_the_data_chunk():
+    samples = np.arange(1000)
+    # A LIST chunk after the samples must not be decoded as audio
+    metadata = b"LIST" + struct.pack("<I", 12) + b"INFOISFT\0\0\0\0"
+    data = make_wav(samples) + metadata
+    data = data[:4] + struct.pack("<I", len(data) - 8) + data[8:]
+    audio = await decode_upload(make_upload(data, "test.wav"), chunk_size=101)
+
+    np.testing.assert_allclose(audio, samples / 32768.0)
+
+@pytest.mark.asyncio
+async def test_decode_stereo_wav_downmixes():
+    left = np.full(500, 1000)
+    right = np.full(500, 3000)
+    interleaved = np.column_stack([left, right]).ravel()
+    audio = await decode_upload(make_upload(make_wav(interleaved, channels=2), "test.wav"), chunk_size=64)
+
+    assert len(audio) == 500
+    np.testing.assert_allclose(audio, 2000 / 32768.0)
+
+@pytest.mark.asyncio
+async def test_hash_upload_rewinds_for_decoding():
+    data = make_wav(np.arange(1000))
+    upload = make_upload(data, "test.wav")
+    await upload.read(10)
+    assert await hash_upload(upload, chunk_size=101) == (hashlib.sha256(data).hexdigest(), len(data))
+
+    audio = await decode_upload(upload, chunk_size=101)
+    assert len(audio) == 1000
+
+@pytest.mark.asyncio
+async def test_decode_invalid_file():
+    with pytest.raises(AudioDecodeError):
+        await decode_upload(make_upload(b"This is not an audio file", "invalid.txt"))
+
+@pytest.mark.asyncio
+async def test_iter_pcm_retries_seekable_containers_from_a_temporary_file():
+    async def pipe_fails(file, head, chunk_size):
+        raise AudioDecodeError("moov atom not found")
+        yield
+
+    async def from_tempfile(file, suffix, chunk_size):
+        assert suffix == ".m4a"
+        assert await file.read() == b"m4a bytes"
+        yield np.arange(4, dtype=np.int16).tobytes()
+
+    with patch("app.audio._iter_ffmpeg", pipe_fails), patch("app.audio._iter_via_tempfile", from_tempfile):
+        blocks = [block async for block in iter_pcm(make_upload(b"m4a bytes", "clip.M4A"))]
+        assert blocks == [np.arange(4, dtype=np.int16).tobytes()]
+        with pytest.raises(AudioDecodeError):
+            [block async for block in iter_pcm(make_upload(b"mp3 bytes", "clip.mp3"))]
+
+async def blocks_of(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+@pytest.mark.asyncio
+async def test_iter_windows_covers_stream_within_window_size():
+    rng = np.random.default_rng(0)
+    samples = rng.integers(-8000, 8000, 16000 * 7)
+    samples[16000 * 3 - 1600:16000 * 3 - 800] = 0  # a pause shortly before the 3 s mark
+    pcm = samples.astype(np.int16).tobytes()
+
+    windows = [window async for window in iter_windows(blocks_of(pcm, 3000), window_seconds=3)]
+
+    assert all(len(audio) <= 3 * 16000 for _, audio in windows)
+    assert sum(len(audio) for _, audio in windows) == len(samples)
+    # The first window is cut inside the pause instead of at exactly 3 s
+    assert 16000 * 3 - 1600 <= len(windows[0][1]) <= 16000 * 3 - 800
+    assert windows[1][0] == len(windows[0][1]) / 16000
+    np.testing.assert_allclose(np.concatenate([audio for _, audio in windows]), samples / 32768.0)
+
+def speech_with_pauses():
+    """2 s tone, 5 s near-silence, 1 s tone, 3 s near-silence, at 16 kHz."""
+    rng = np.random.default_rng(0)
+    tone = lambda seconds: 0.3 * np.sin(np.arange(int(seconds * 16000)) * 2 * np.pi * 220 / 16000)
+    quiet = lambda seconds: 0.0005 * rng.standard_normal(int(seconds * 16000))
+    return np.concatenate([tone(2), quiet(5), tone(1), quiet(3)]).astype(np.float32)
+
+def test_silence_trimmer_keeps_speech_and_maps_times_back():
+    audio = speech_with_pauses()
+    trimmer = SilenceTrimmer(padding_seconds=0.2, gap_seconds=0.2)
+    regions = trimmer.speech_regions(audio)
+    assert len(regions) == 2
+    assert regions[0][0] == 0 and abs(regions[0][1] / 16000 - 2.2) < 0.05
+    assert abs(regions[1][0] / 16000 - 6.8) < 0.05 and abs(regions[1][1] / 16000 - 8.2) < 0.05
+
+    speech, timeline = trimmer.trim(audio)
+    assert abs(len(speech) / 16000 - 3.8) < 0.1
+    assert abs(timeline.skipped_seconds - (11 - len(speech) / 16000)) < 1e-6
+    # The start of the second tone in the trimmed audio is 7 s into the recording
+    second = timeline.pieces[1][0] / 16000 + 0.2
+    assert abs(timeline.to_original(second) - 7.0) < 0.05
+    assert timeline.to_original(0.5) == 0.5
+
+def test_silence_trimmer_edge_cases():
+    trimmer = SilenceTrimmer()
+    silent, timeline = trimmer.trim(np.zeros(16000 * 3, dtype=np.float32))
+    assert len(silent) == 0 and timeline.skipped_seconds == 3
+
+    # Continuous speech is passed through unchanged
+    tone = (0.3 * np.sin(np.arange(16000 * 3) * 0.1)).astype(np.float32)
+    speech, timeline = trimmer.trim(tone)
+    assert speech is tone and timeline.skipped_seconds == 0
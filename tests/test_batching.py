@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import pytest
+from unittest.mock import MagicMock
+from app.batching import MicroBatcher, QueueFullError, SimilarityBatcher, TranscriptionScheduler
+
+@pytest.mark.asyncio
+async def test_concurrent_jobs_are_batched():
+    batches = []
+
+    def handler(jobs):
+        batches.append(list(jobs))
+        return [job * 2 for job in jobs]
+
+    batcher = MicroBatcher(handler, max_batch_size=4, max_wait_ms=50)
+    results = await asyncio.gather(*(batcher.submit(i) for i in range(4)))
+    batcher.stop()
+
+    assert results == [0, 2, 4, 6]
+    assert batches == [[0, 1, 2, 3]]
+
+@pytest.mark.asyncio
+async def test_batch_size_is_bounded():
+    batches = []
+
+    def handler(jobs):
+        batches.append(len(jobs))
+        return jobs
+
+    batcher = MicroBatcher(handler, max_batch_size=2, max_wait_ms=50)
+    await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+    batcher.stop()
+
+    assert max(batches) <= 2
+    assert sum(batches) == 5
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_retried_per_job():
+    def handler(jobs):
+        if "bad" in jobs:
+            raise ValueError("bad input")
+        return [job.upper() for job in jobs]
+
+    batcher = MicroBatcher(handler, max_batch_size=3, max_wait_ms=50)
+    results = await asyncio.gather(
+        batcher.submit("a"), batcher.submit("bad"), batcher.submit("b"), return_exceptions=True
+    )
+    batcher.stop()
+
+    assert results[0] == "A"
+    assert isinstance(results[1], ValueError)
+    assert results[2] == "B"
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_jobs():
+    release = threading.Event()
+
+    def handler(jobs):
+        release.wait()
+        return jobs
+
+    batcher = MicroBatcher(handler, max_batch_size=1, max_wait_ms=0, max_queue_size=1, retry_after=3)
+    first = batcher.submit_nowait("first")
+    # Wait until the worker picked up the first job so the queue has room for exactly one more
+    while batcher.queue_depth:
+        await asyncio.sleep(0.001)
+    second = batcher.submit_nowait("second")
+
+    with pytest.raises(QueueFullError) as exc_info:
+        batcher.submit_nowait("third")
+    assert exc_info.value.retry_after == 3
+
+    release.set()
+    assert await first == "first"
+    assert await second == "second"
+    batcher.stop()
+
+@pytest.mark.asyncio
+async def test_transcription_scheduler_uses_transcribe_batch():
+    transcriber = MagicMock()
+    transcriber.transcribe_batch = MagicMock(side_effect=lambda audios: [f"text of {audio}" for audio in audios])
+
+    scheduler = TranscriptionScheduler(transcriber, max_batch_size=2, max_wait_ms=50)
+    results = await asyncio.gather(scheduler.submit("a.wav"), scheduler.submit("b.wav"))
+    scheduler.stop()
+
+    assert results == ["text of a.wav", "text of b.wav"]
+    transcriber.transcribe_batch.assert_called_once_with(["a.wav", "b.wav"])
+
+@pytest.mark.asyncio
+async def test_transcription_scheduler_runs_callable_jobs_with_the_transcriber():
+    transcriber = MagicMock()
+    transcriber.transcribe_batch = MagicMock(side_effect=lambda audios: [f"text of {audio}" for audio in audios])
+    transcriber.transcribe_segments = MagicMock(return_value=[{"start": 0.0, "end": 1.0, "text": "window"}])
+
+    scheduler = TranscriptionScheduler(transcriber, max_batch_size=3, max_wait_ms=50)
+    results = await asyncio.gather(
+        scheduler.submit("a.wav"),
+        scheduler.submit(lambda model: model.transcribe_segments("window")),
+        scheduler.submit("b.wav"),
+    )
+    scheduler.stop()
+
+    assert results == ["text of a.wav", [{"start": 0.0, "end": 1.0, "text": "window"}], "text of b.wav"]
+    transcriber.transcribe_batch.assert_called_once_with(["a.wav", "b.wav"])
+    transcriber.transcribe_segments.assert_called_once_with("window")
+
+@pytest.mark.asyncio
+async def test_similarity_batcher_groups_queries_per_database():
+    db_a, db_b = MagicMock(), MagicMock()
+    db_a.similarity_search_batch = MagicMock(side_effect=lambda texts, ks: [[f"a:{t}"] * k for t, k in zip(texts, ks)])
+    db_b.similarity_search_batch = MagicMock(side_effect=lambda texts, ks: [[f"b:{t}"] * k for t, k in zip(texts, ks)])
+
+    batcher = SimilarityBatcher(max_batch_size=8, max_wait_ms=50)
+    results = await asyncio.gather(
+        batcher.submit((db_a, "x", 1)), batcher.submit((db_b, "y", 2)), batcher.submit((db_a, "z", 1))
+    )
+    batcher.stop()
+
+    assert results == [["a:x"], ["b:y", "b:y"], ["a:z"]]
+    db_a.similarity_search_batch.assert_called_once_with(["x", "z"], [1, 1])
+    db_b.similarity_search_batch.assert_called_once_with(["y"], [2])
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from app.audio import parse_wav_header, pcm_to_float32
+from benchmarks.accuracy import recall_at_k, word_error_rate
+from benchmarks.run import compare, summarize
+from benchmarks.stubs import HashEmbeddings, StubChromaDBHandler, make_wav
+
+def test_summarize():
+    summary = summarize([0.01] * 98 + [0.1, 1.0], errors=2, wall_seconds=2.0)
+    assert summary["requests"] == 102
+    assert summary["throughput_rps"] == 50.0
+    assert summary["p50_ms"] == 10.0
+    assert summary["max_ms"] == 1000.0
+
+def test_compare_flags_regressions_beyond_tolerance():
+    baseline = {"chat": {"throughput_rps": 100.0, "p95_ms": 50.0}, "gone": {"throughput_rps": 1.0}}
+    results = {"chat": {"throughput_rps": 85.0, "p95_ms": 52.0}, "new": {"throughput_rps": 1.0}}
+    comparison = compare(results, baseline, tolerance=0.1)
+
+    assert set(comparison) == {"chat"}
+    assert comparison["chat"]["throughput_rps"]["regressed"]
+    assert not comparison["chat"]["p95_ms"]["regressed"]
+
+def test_make_wav_uses_the_fast_decode_path():
+    wav = make_wav(0.5)
+    offset, channels, _ = parse_wav_header(wav[:64])
+    assert channels == 1
+    assert len(pcm_to_float32(wav[offset:])) == 8000
+
+def test_stub_database_searches_synthetic_corpus(tmp_path):
+    db = StubChromaDBHandler(str(tmp_path), corpus_size=50, dimension=8)
+    docs = db.similarity_search("synthetic document 7", k=2)
+    assert docs[0].page_content == "synthetic document 7"
+    np.testing.assert_array_equal(HashEmbeddings(8).embed_query("a"), HashEmbeddings(8).embed_query("a"))
+
+def test_word_error_rate():
+    assert word_error_rate("The quick brown fox.", "the quick brown fox") == 0.0
+    assert word_error_rate("the quick brown fox", "the quick fox jumps") == 0.5
+    assert word_error_rate("", "") == 0.0
+
+def test_recall_at_k():
+    assert recall_at_k([[1, 2, 3], [4, 5, 6]], [[3, 2, 1], [4, 7, 8]], 3) == pytest.approx(2 / 3)
+    assert recall_at_k([[1, 2, 3]], [[1, 9, 2]], 1) == 1.0
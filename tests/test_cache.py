@@ -0,0 +1,127 @@
+import numpy as np
+from unittest.mock import patch
+from app.cache import ChatResponseCache, DiskCache, EmbeddingCache, LRUCache, SemanticCache, TranscriptionCache
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+def test_lru_cache_byte_limit():
+    cache = LRUCache(max_entries=0, max_bytes=10, sizeof=len)
+    cache.put("a", "12345")
+    cache.put("b", "12345")
+    cache.put("c", "123")
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 8
+    cache.put("huge", "x" * 11)
+    assert cache.get("huge") is None
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl_seconds=10)
+    with patch("app.cache.time.monotonic", return_value=100.0):
+        cache.put("a", 1)
+    with patch("app.cache.time.monotonic", return_value=105.0):
+        assert cache.get("a") == 1
+    with patch("app.cache.time.monotonic", return_value=111.0):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+def test_disk_cache_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = DiskCache(path, max_bytes=20)
+    cache.put("a", "0123456789")
+    cache.get("a")
+    cache.put("b", "0123456789")  # over the limit, the least recently accessed entry goes
+    cache.close()
+
+    reopened = DiskCache(path, max_bytes=20)
+    assert reopened.get("a") is None
+    assert reopened.get("b") == "0123456789"
+    assert reopened.stats()["entries"] == 1
+
+def test_transcription_cache_promotes_disk_hits(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    key = TranscriptionCache.key("abc", "tiny")
+    TranscriptionCache(disk_path=path).put(key, "hello")
+
+    cache = TranscriptionCache(disk_path=path)
+    assert cache.get(key, nbytes=100) == "hello"
+    assert cache.memory.get(key) == "hello"
+    assert cache.stats()["bytes_saved"] == 100
+
+def test_transcription_cache_key_includes_model_and_options():
+    assert TranscriptionCache.key("abc", "tiny") != TranscriptionCache.key("abc", "base")
+    assert TranscriptionCache.key("abc", "tiny", {"language": "en"}) != TranscriptionCache.key("abc", "tiny")
+
+class KeywordEmbeddings:
+    """Embeds a text by counting a few keywords, so similar prompts get similar vectors."""
+    keywords = ["password", "reset", "invoice", "refund"]
+
+    def embed_query(self, text):
+        return [float(text.count(keyword)) for keyword in self.keywords] + [0.1]
+
+def test_semantic_cache_threshold_and_namespace():
+    cache = SemanticCache(dimension=2, max_entries=4, threshold=0.9)
+    cache.put("model-a", np.array([1.0, 0.0]), "east")
+
+    assert cache.get("model-a", np.array([10.0, 1.0])) == "east"
+    assert cache.get("model-a", np.array([1.0, 1.0])) is None  # cosine 0.71
+    assert cache.get("model-b", np.array([1.0, 0.0])) is None
+    assert cache.stats()["hits"] == 1
+
+def test_semantic_cache_overwrites_least_recently_used():
+    cache = SemanticCache(dimension=2, max_entries=2, threshold=0.99)
+    cache.put("m", np.array([1.0, 0.0]), "east")
+    cache.put("m", np.array([0.0, 1.0]), "north")
+    cache.get("m", np.array([1.0, 0.0]))
+    cache.put("m", np.array([-1.0, 0.0]), "west")
+
+    assert len(cache) == 2
+    assert cache.get("m", np.array([0.0, 1.0])) is None
+    assert cache.get("m", np.array([1.0, 0.0])) == "east"
+
+def test_chat_cache_exact_tier_normalizes_prompt():
+    cache = ChatResponseCache()
+    cache.put("gemma:2b", "How do I  reset my password?", "Click 'Forgot password'.")
+
+    assert cache.get_exact("gemma:2b", "how do i reset my password?  ") == "Click 'Forgot password'."
+    assert cache.get_exact("llama3", "How do I reset my password?") is None
+    assert cache.embed("anything") is None
+
+def test_chat_cache_semantic_tier():
+    cache = ChatResponseCache(embedding_function=KeywordEmbeddings(), similarity_threshold=0.95)
+    prompt = "I need a password reset"
+    cache.put("gemma:2b", prompt, "Click 'Forgot password'.", cache.embed(prompt))
+
+    similar = cache.embed("please reset the password for me")
+    assert cache.get_semantic("gemma:2b", similar) == "Click 'Forgot password'."
+    assert cache.get_semantic("gemma:2b", cache.embed("where is my refund")) is None
+    assert cache.stats()["semantic"]["hits"] == 1
+
+def test_embedding_cache_lru_pool():
+    cache = EmbeddingCache(max_entries=2)
+    cache.put_many("minilm", ["a", "b"], np.array([[1, 0], [0, 1]], dtype=np.float32))
+    vectors, missing = cache.get_many("minilm", ["a", "c"])
+    assert missing == [1]
+    np.testing.assert_array_equal(vectors[0], [1, 0])
+
+    cache.put_many("minilm", ["c"], np.array([[1, 1]], dtype=np.float32))  # evicts "b"
+    _, missing = cache.get_many("minilm", ["a", "b", "c"])
+    assert missing == [1]
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["bytes"] == 2 * 2 * 4
+
+def test_embedding_cache_is_keyed_by_model():
+    cache = EmbeddingCache()
+    cache.put_many("minilm", ["a"], np.ones((1, 2), dtype=np.float32))
+    vectors, missing = cache.get_many("mpnet", ["a"])
+    assert vectors is None and missing == [0]
@@ -1,3 +1,5 @@
+import threading
+import numpy as np
 import pytest
 from unittest.mock import patch, MagicMock
 from langchain_chroma import Chroma
@@ -5,6 +7,8 @@ from langchain_community.document_loaders import TextLoader
 from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
 from langchain_text_splitters import CharacterTextSplitter
 from app.database import ChromaDBHandler
+from app.snapshot import SnapshotError
+from app.splitter import Chunk
 from configparser import ConfigParser
 
 config = ConfigParser()
@@ -70,3 +74,312 @@ def test_save_to_disk_no_documents(handler):
 def test_load_from_disk(mock_chroma_init, handler):
     handler.load_from_disk()
     mock_chroma_init.assert_called_once_with(persist_directory=handler.persist_directory, embedding_function=handler.embedding_function)
+
+
+def test_similarity_search_batch(handler):
+    handler.db = MagicMock()
+    handler.db._collection.query.return_value = {
+        "documents": [["a", "b", "c"], ["d", "e", "f"]],
+        "metadatas": [[{}, {}, {}], [None, None, None]],
+    }
+    with patch.object(handler.embedding_function, "embed_documents", return_value=[[0.1], [0.2]]) as mock_embed:
+        results = handler.similarity_search_batch(["first", "second"], [1, 3])
+
+    mock_embed.assert_called_once_with(["first", "second"])
+    query = handler.db._collection.query.call_args.kwargs
+    np.testing.assert_allclose(query["query_embeddings"], [[0.1], [0.2]])
+    assert query["n_results"] == 3
+    assert [[doc.page_content for doc in docs] for docs in results] == [["a"], ["d", "e", "f"]]
+
+def test_similarity_search_batch_no_db(handler):
+    handler.db = None
+    with patch("builtins.print"):
+        assert handler.similarity_search_batch(["a", "b"]) == [[], []]
+
+def test_embed_queries_uses_cache(handler):
+    with patch.object(handler.embedding_function, "embed_documents",
+                      side_effect=lambda texts: [[float(len(text)), 1.0] for text in texts]) as mock_embed:
+        first = handler.embed_queries(["flamingo", "group", "flamingo"])
+        second = handler.embed_queries(["group", "pink"])
+
+    assert mock_embed.call_args_list[0].args == (["flamingo", "group"],)
+    assert mock_embed.call_args_list[1].args == (["pink"],)
+    np.testing.assert_array_equal(first, [[8, 1], [5, 1], [8, 1]])
+    np.testing.assert_array_equal(second, [[5, 1], [4, 1]])
+    assert first.dtype == np.float32
+    assert handler.query_cache.stats()["hits"] == 1
+
+def test_similarity_search_uses_cached_embedding(handler):
+    handler.db = MagicMock()
+    mock_search = handler.db.similarity_search_by_vector
+    mock_search.return_value = ["doc"]
+    with patch.object(handler.embedding_function, "embed_documents", return_value=[[0.5, 0.5]]) as mock_embed:
+        assert handler.similarity_search("query", k=2) == ["doc"]
+        assert handler.similarity_search("query", k=2) == ["doc"]
+
+    mock_embed.assert_called_once_with(["query"])
+    mock_search.assert_called_with([0.5, 0.5], k=2)
+
+def test_ingest_text_upserts_only_new_chunks(handler):
+    handler.db = MagicMock()
+    collection = handler.db._collection
+    chunks = ["flamingos are pink", "a flamboyance", "flamingos are pink"]
+    ids = [chunk_id for chunk_id, _ in ChromaDBHandler._chunk_ids("birds.txt", chunks)]
+    stale_id = "0" * 64
+    collection.get.return_value = {"ids": [ids[0], stale_id]}
+
+    with patch.object(handler.text_splitter, "split_text", return_value=chunks), \
+            patch.object(handler.embedding_function, "embed_documents",
+                         side_effect=lambda texts: [[1.0] for _ in texts]) as mock_embed:
+        stats = handler.ingest_text("...", source="birds.txt", batch_size=1)
+
+    assert len(set(ids)) == 3
+    assert stats == {"chunks": 3, "added": 2, "unchanged": 1, "removed": 1}
+    collection.get.assert_called_once_with(where={"source": "birds.txt"}, include=[])
+    assert mock_embed.call_count == 2
+    upserted = [call.kwargs["ids"] for call in collection.upsert.call_args_list]
+    assert upserted == [[ids[1]], [ids[2]]]
+    assert collection.upsert.call_args.kwargs["metadatas"] == [{"source": "birds.txt"}]
+    collection.delete.assert_called_once_with(ids=[stale_id])
+
+def test_ingest_files(handler, tmp_path):
+    document = tmp_path / "doc.txt"
+    document.write_text("A group of flamingos is called a flamboyance.")
+    handler.db = MagicMock()
+    handler.db._collection.get.return_value = {"ids": []}
+    with patch.object(handler.embedding_function, "embed_documents",
+                      side_effect=lambda texts: [[1.0] for _ in texts]) as mock_embed:
+        stats = handler.ingest_files([str(document)])
+
+    mock_embed.assert_called_once_with(["A group of flamingos is called a flamboyance."])
+    assert handler.db._collection.upsert.call_args.kwargs["metadatas"] == [{"source": str(document)}]
+    assert stats == {"files": 1, "chunks": 1, "added": 1, "unchanged": 0, "removed": 0}
+
+    # A temporary copy of an upload is stored under the name of the upload
+    with patch.object(handler.embedding_function, "embed_documents", side_effect=lambda texts: [[1.0] for _ in texts]):
+        handler.ingest_files(iter([str(document)]), sources=["birds.txt"])
+    assert handler.db._collection.upsert.call_args.kwargs["metadatas"] == [{"source": "birds.txt"}]
+
+def test_ingest_files_with_workers_uses_embedding_pool(handler, tmp_path):
+    document = tmp_path / "doc.txt"
+    document.write_text("flamingos\nflamboyance")
+    handler.db = MagicMock()
+    handler.db._collection.get.return_value = {"ids": []}
+    embedder = MagicMock()
+    embedder.__enter__.return_value = embedder
+    embedder.map.side_effect = lambda batches: ((tag, np.ones((len(texts), 2), dtype=np.float32)) for tag, texts in batches)
+
+    with patch("app.database.ParallelEmbedder", return_value=embedder) as mock_pool, \
+            patch.object(handler.text_splitter, "split_file",
+                         return_value=iter([Chunk("flamingos", 0, 9, 9), Chunk("flamboyance", 10, 21, 11)])):
+        stats = handler.ingest_files([str(document)], batch_size=1, workers=2)
+
+    assert mock_pool.call_args.kwargs == {"workers": 2, "batch_size": 1}
+    upserts = handler.db._collection.upsert.call_args_list
+    assert [call.kwargs["documents"] for call in upserts] == [["flamingos"], ["flamboyance"]]
+    assert upserts[0].kwargs["embeddings"] == [[1.0, 1.0]]
+    assert stats["added"] == 2
+
+@patch.object(ChromaDBHandler, "load_from_disk")
+def test_numpy_backend_searches_in_process(mock_load_from_disk, tmp_path):
+    handler = ChromaDBHandler(
+        model_name=config['EmbeddingModelName'],
+        persist_directory=str(tmp_path),
+        chunk_size=config['DocumentChunkSize'],
+        chunk_overlap=config['DocumentChunkOverlap'],
+        vector_backend="numpy",
+    )
+    handler.db = MagicMock()
+    collection = handler.db._collection
+    collection.get.return_value = {
+        "ids": ["a", "b"], "embeddings": [[1.0, 0.0], [0.0, 1.0]], "documents": ["east", "north"], "metadatas": [None, None],
+    }
+    collection.count.return_value = 2
+    handler._load_vector_store()
+
+    with patch.object(handler.embedding_function, "embed_documents", return_value=[[0.1, 0.9]]):
+        docs = handler.similarity_search("which way is up?", k=1)
+
+    assert [doc.page_content for doc in docs] == ["north"]
+    handler.db.similarity_search_by_vector.assert_not_called()
+    collection.query.assert_not_called()
+
+@patch.object(ChromaDBHandler, "load_from_disk")
+def test_ingestion_updates_the_vector_index_in_place(mock_load_from_disk, tmp_path):
+    handler = ChromaDBHandler(
+        model_name=config['EmbeddingModelName'],
+        persist_directory=str(tmp_path),
+        chunk_size=config['DocumentChunkSize'],
+        chunk_overlap=config['DocumentChunkOverlap'],
+        vector_backend="numpy",
+    )
+    handler.db = MagicMock()
+    handler.db._collection = FakeCollection({"a": ([1.0, 0.0], "east", {"source": "old.txt"})})
+    handler._load_vector_store()
+
+    vectors = {"north": [0.0, 1.0], "west": [-1.0, 0.0]}
+    with patch.object(handler.vector_store, "build_from_collection") as mock_build, \
+            patch.object(handler.text_splitter, "split_text", side_effect=lambda text: text.split()), \
+            patch.object(handler.embedding_function, "embed_documents",
+                         side_effect=lambda texts: [vectors[text] for text in texts]):
+        handler.ingest_text("north west", source="new.txt")
+        handler.ingest_text("north", source="new.txt")
+
+    mock_build.assert_not_called()
+    assert handler.vector_store.size == len(handler.db._collection.records) == 2
+    assert handler.revision == 2
+    found = handler.vector_store.search(np.array([[0.6, -0.8], [-0.8, 0.6]]), 1)
+    assert [[doc.page_content for doc in docs] for docs in found] == [["east"], ["north"]]
+
+@patch.object(ChromaDBHandler, "load_from_disk")
+def test_sharded_backend_searches_shard_processes(mock_load_from_disk, tmp_path):
+    handler = ChromaDBHandler(
+        model_name=config['EmbeddingModelName'],
+        persist_directory=str(tmp_path),
+        chunk_size=config['DocumentChunkSize'],
+        chunk_overlap=config['DocumentChunkOverlap'],
+        vector_backend="sharded",
+        vector_shards=2,
+        shard_timeout=5,
+    )
+    handler.db = MagicMock()
+    collection = handler.db._collection
+    collection.get.return_value = {
+        "ids": ["a", "b", "c"], "embeddings": [[1.0, 0.0], [0.0, 1.0], [-1.0, 0.0]],
+        "documents": ["east", "north", "west"], "metadatas": [None, None, None],
+    }
+    collection.count.return_value = 3
+    try:
+        handler._load_vector_store()
+        with patch.object(handler.embedding_function, "embed_documents", return_value=[[0.1, 0.9], [-0.9, 0.1]]):
+            docs = handler.similarity_search_batch(["which way is up?", "where does the sun set?"], k=1)
+    finally:
+        handler.vector_store.close()
+
+    assert [[doc.page_content for doc in found] for found in docs] == [["north"], ["west"]]
+    collection.query.assert_not_called()
+
+class FakeCollection:
+    """An in-memory stand-in for the parts of a Chroma collection that snapshots use."""
+
+    def __init__(self, records=None):
+        self.records = dict(records or {})
+
+    def get(self, ids=None, where=None, include=(), limit=None, offset=0):
+        ids = [i for i in (self.records if ids is None else ids) if i in self.records]
+        if where is not None:
+            ids = [i for i in ids if all((self.records[i][2] or {}).get(k) == v for k, v in where.items())]
+        ids = ids[offset:None if limit is None else offset + limit]
+        return {
+            "ids": ids,
+            "embeddings": [self.records[i][0] for i in ids],
+            "documents": [self.records[i][1] for i in ids],
+            "metadatas": [self.records[i][2] for i in ids],
+        }
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.records.update({i: (e, d, m) for i, e, d, m in zip(ids, embeddings, documents, metadatas)})
+
+    def delete(self, ids):
+        for i in ids:
+            self.records.pop(i, None)
+
+@patch.object(ChromaDBHandler, "load_from_disk")
+def test_snapshot_export_and_delta_import(mock_load_from_disk, tmp_path):
+    def make_handler(name, collection):
+        handler = ChromaDBHandler(
+            model_name=config['EmbeddingModelName'],
+            persist_directory=str(tmp_path / name),
+            chunk_size=config['DocumentChunkSize'],
+            chunk_overlap=config['DocumentChunkOverlap'],
+        )
+        handler.db = MagicMock()
+        handler.db._collection = collection
+        return handler
+
+    primary = make_handler("primary", FakeCollection({
+        "a": ([1.0, 0.0], "east", {"source": "x"}), "b": ([0.0, 1.0], "north", {"source": "x"}),
+    }))
+    replica = make_handler("replica", FakeCollection({"stale": ([0.5, 0.5], "old", {"source": "y"})}))
+
+    full = primary.export_snapshot(str(tmp_path / "full"))
+    assert full["records"] == 2 and full["removed"] == 0
+    assert replica.import_snapshot(str(tmp_path / "full")) == {"added": 2, "unchanged": 0, "removed": 1}
+    assert replica.snapshot_id == full["id"] and replica.revision == 1
+    assert sorted(replica.db._collection.records) == ["a", "b"]
+
+    primary.db._collection.delete(["a"])
+    primary.db._collection.upsert(["c"], [[-1.0, 0.0]], ["west"], [{"source": "x"}])
+    delta = primary.export_snapshot(str(tmp_path / "delta"), base=str(tmp_path / "full"), precision="float16")
+    assert delta["records"] == 1 and delta["removed"] == 1
+
+    # Applying the chain skips the snapshot the replica already is at
+    assert replica.import_snapshots([str(tmp_path / "full"), str(tmp_path / "delta")]) == 1
+    assert replica.db._collection.records.keys() == primary.db._collection.records.keys()
+    assert replica.db._collection.records["c"][1] == "west"
+    # The position is persisted next to the database
+    assert make_handler("replica", FakeCollection()).snapshot_id == delta["id"]
+
+    # A delta only applies to its base
+    other = make_handler("other", FakeCollection())
+    with pytest.raises(SnapshotError):
+        other.import_snapshot(str(tmp_path / "delta"))
+
+@patch.object(ChromaDBHandler, "load_from_disk")
+def test_snapshot_chain_is_served_while_the_database_syncs(mock_load_from_disk, tmp_path):
+    primary = ChromaDBHandler(
+        model_name=config['EmbeddingModelName'],
+        persist_directory=str(tmp_path / "primary"),
+        chunk_size=config['DocumentChunkSize'],
+        chunk_overlap=config['DocumentChunkOverlap'],
+    )
+    primary.db = MagicMock()
+    primary.db._collection = FakeCollection({
+        "a": ([2.0, 0.0], "east", {"source": "x"}), "b": ([0.0, 3.0], "north", {"source": "x"}),
+    })
+    primary.export_snapshot(str(tmp_path / "full"))
+    primary.db._collection.delete(["b"])
+    primary.db._collection.upsert(["c"], [[-1.0, 0.0]], ["west"], [{"source": "x"}])
+    delta = primary.export_snapshot(str(tmp_path / "delta"), base=str(tmp_path / "full"))
+
+    replica = ChromaDBHandler(
+        model_name=config['EmbeddingModelName'],
+        persist_directory=str(tmp_path / "replica"),
+        chunk_size=config['DocumentChunkSize'],
+        chunk_overlap=config['DocumentChunkOverlap'],
+        vector_backend="numpy",
+    )
+    replica.db = MagicMock()
+    replica.db._collection = FakeCollection()
+    release = threading.Event()
+    upsert = replica.db._collection.upsert
+    replica.db._collection.upsert = lambda *args, **kwargs: release.wait() and upsert(*args, **kwargs)
+
+    paths = [str(tmp_path / "full"), str(tmp_path / "delta")]
+    assert replica.import_snapshots(paths, background_sync=True) == 2
+
+    # Searches are answered from the snapshots before the collection holds a single record
+    with patch.object(replica.embedding_function, "embed_documents", return_value=[[0.1, 0.9], [-0.9, 0.1]]):
+        docs = replica.similarity_search_batch(["which way is up?", "where does the sun set?"], k=2)
+    assert [[doc.page_content for doc in found] for found in docs] == [["east", "west"], ["west", "east"]]
+    assert replica.db._collection.records == {} and replica.snapshot_id is None
+
+    release.set()
+    replica._persistent_collection()
+    assert sorted(replica.db._collection.records) == ["a", "c"]
+    assert replica.snapshot_id == delta["id"]
+    assert replica.vector_store.exists() and replica.vector_store.size == 2
+
+def test_invalid_chunk_config():
+    with pytest.raises(ValueError, match="chunk_size must be an integer"):
+        ChromaDBHandler(model_name=config['EmbeddingModelName'], persist_directory=config['ChromaDBPersistDir'],
+                        chunk_size="sixty", chunk_overlap=config['DocumentChunkOverlap'])
+    with pytest.raises(ValueError, match="chunk_overlap"):
+        ChromaDBHandler(model_name=config['EmbeddingModelName'], persist_directory=config['ChromaDBPersistDir'],
+                        chunk_size="10", chunk_overlap="20")
+
+def test_unknown_vector_backend():
+    with pytest.raises(ValueError):
+        ChromaDBHandler(model_name=config['EmbeddingModelName'], persist_directory=config['ChromaDBPersistDir'],
+                        chunk_size=config['DocumentChunkSize'], chunk_overlap=config['DocumentChunkOverlap'],
+                        vector_backend="faiss")
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from functools import partial
+from app.embedding_pool import ParallelEmbedder
+
+class FakeEmbeddings:
+    """Deterministic stand-in for a sentence transformer, created inside the worker processes."""
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+
+    def embed_documents(self, texts):
+        return [[float(len(text))] * self.dimension for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def test_map_yields_vectors_in_order():
+    batches = [(index, ["x" * (index + 1)] * (index % 3 + 1)) for index in range(10)]
+    with ParallelEmbedder(partial(FakeEmbeddings, 4), workers=2, batch_size=3) as embedder:
+        assert embedder.dimension == 4
+        results = [(tag, vectors.copy()) for tag, vectors in embedder.map(batches)]
+
+    assert [tag for tag, _ in results] == list(range(10))
+    for (tag, texts), (_, vectors) in zip(batches, results):
+        assert vectors.dtype == np.float32
+        np.testing.assert_array_equal(vectors, np.full((len(texts), 4), tag + 1))
+
+def test_oversized_batch_is_rejected():
+    with ParallelEmbedder(partial(FakeEmbeddings, 2), workers=1, batch_size=1) as embedder:
+        with pytest.raises(ValueError, match="exceeds batch_size"):
+            list(embedder.map([(0, ["a", "b"])]))
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from unittest.mock import patch
+from app.jobs import (
+    DONE, FAILED, QUEUED, RUNNING, JobStore, JobWorkerPool, check_webhook_url, deliver_webhook, job_view,
+)
+
+class FakeTranscriber:
+    """Stand-in for WhisperTranscriber, created inside the worker processes."""
+
+    def transcribe(self, path):
+        with open(path, "rb") as file:
+            content = file.read().decode()
+        if content == "broken":
+            raise RuntimeError("cannot decode")
+        return content.upper()
+
+@pytest.fixture
+def store(tmp_path):
+    store = JobStore(str(tmp_path / "jobs"), ttl_seconds=60)
+    yield store
+    store.close()
+
+def add_job(store, content, **kwargs):
+    path = store.new_audio_path("clip.wav")
+    with open(path, "w") as file:
+        file.write(content)
+    return store.submit(path, **kwargs)
+
+def wait_for(store, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get(job_id)
+        if job["status"] in (DONE, FAILED):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+def test_claim_by_priority_then_age(store):
+    low = add_job(store, "a")
+    high = add_job(store, "b", priority=5)
+    second_low = add_job(store, "c")
+
+    assert [store.claim("w")["id"] for _ in range(3)] == [high, low, second_low]
+    assert store.claim("w") is None
+    assert store.counts()[RUNNING] == 3
+
+def test_complete_removes_audio_and_expires(store):
+    job_id = add_job(store, "a")
+    job = store.claim("w")
+    assert job["status"] == RUNNING and job["attempts"] == 1
+
+    finished = store.complete(job_id, {"transcript": "A"})
+    assert finished["status"] == DONE
+    assert finished["result"] == {"transcript": "A"}
+    assert finished["expires"] == pytest.approx(finished["finished"] + 60)
+    assert not os.path.exists(job["audio_path"])
+    assert set(job_view(finished)) == {"id", "status", "priority", "created", "started", "finished", "result", "error"}
+
+    store.ttl_seconds = 0.01
+    expired = add_job(store, "b")
+    store.claim("w")
+    store.fail(expired, "boom")
+    time.sleep(0.05)
+    assert store.get(expired) is None
+    assert store.purge() == 1
+
+def test_requeue_after_crash_gives_up_after_max_attempts(store):
+    job_id = add_job(store, "a")
+    store.claim("w1")
+    assert store.requeue(worker="w2", crashed=True) == []
+    assert store.requeue(worker="w1", crashed=True) == [job_id]
+    assert store.get(job_id)["status"] == QUEUED
+
+    store.claim("w1")
+    assert store.requeue(worker="w1", crashed=True) == []
+    job = store.get(job_id)
+    assert job["status"] == FAILED
+    assert "Worker died" in job["error"]
+
+def test_requeue_on_restart_does_not_count_an_attempt(store):
+    job_id = add_job(store, "a")
+    store.claim("w1")
+    assert store.requeue() == [job_id]
+    assert store.get(job_id)["attempts"] == 0
+
+def test_worker_pool_runs_jobs_and_calls_webhook(tmp_path):
+    store = JobStore(str(tmp_path / "jobs"), ttl_seconds=60, webhook_hosts=["127.0.0.1"])
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook = f"http://127.0.0.1:{server.server_port}/hook"
+
+    ok = add_job(store, "hello", webhook_url=webhook)
+    broken = add_job(store, "broken")
+    pool = JobWorkerPool(store, FakeTranscriber, workers=2, threads_per_worker=1, poll_interval=0.05)
+    pool.start()
+    try:
+        assert wait_for(store, ok)["result"] == {"transcript": "HELLO"}
+        failed = wait_for(store, broken)
+        assert failed["status"] == FAILED and "cannot decode" in failed["error"]
+        deadline = time.monotonic() + 10
+        while not received and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        pool.stop()
+        server.shutdown()
+
+    assert received == [job_view(store.get(ok))]
+    store.close()
+
+def test_check_webhook_url():
+    check_webhook_url("https://93.184.216.34/hook")
+    for url in ("http://127.0.0.1:8000/hook", "http://localhost/hook", "http://10.0.0.5/hook",
+                "http://169.254.169.254/latest/meta-data", "http://[::1]/hook", "http://[::ffff:192.168.1.1]/",
+                "ftp://93.184.216.34/hook", "http:///hook"):
+        with pytest.raises(ValueError):
+            check_webhook_url(url)
+
+    check_webhook_url("http://LOCALHOST:9000/hook", allowed_hosts=("localhost",))
+    with pytest.raises(ValueError):
+        check_webhook_url("https://93.184.216.34/hook", allowed_hosts=("hooks.example.com",))
+
+def test_deliver_webhook_refuses_private_addresses():
+    with patch("httpx.post") as post:
+        assert not deliver_webhook("http://10.0.0.5/hook", {"id": "job"})
+    post.assert_not_called()
@@ -0,0 +1,55 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+from app.metrics import MetricsMiddleware, MetricsRegistry, REQUESTS
+
+def test_counter_and_gauge_render():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests.", ("route",))
+    requests.inc(route="/a")
+    requests.inc(2, route="/a")
+    depth = registry.gauge("queue_depth", "Depth.", ("queue",))
+    depth.set_function(lambda: {("transcription",): 3})
+
+    text = registry.render()
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{route="/a"} 3' in text
+    assert 'queue_depth{queue="transcription"} 3' in text
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Latency.", ("stage",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        latency.observe(value, stage="decode")
+
+    text = registry.render()
+    assert 'latency_seconds_bucket{stage="decode",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{stage="decode",le="1"} 3' in text
+    assert 'latency_seconds_bucket{stage="decode",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{stage="decode"} 4' in text
+    assert 'latency_seconds_sum{stage="decode"} 5.65' in text
+
+def test_registry_returns_existing_metric_and_rejects_conflicts():
+    registry = MetricsRegistry()
+    assert registry.counter("x_total", "X.") is registry.counter("x_total", "X.")
+    with pytest.raises(ValueError):
+        registry.gauge("x_total", "X.")
+    with pytest.raises(ValueError):
+        registry.counter("x_total", "X.").inc(route="/a")
+
+def test_middleware_labels_requests_by_route_template():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    def item(item_id: int):
+        return {"id": item_id}
+
+    client = TestClient(app)
+    client.get("/items/1")
+    client.get("/items/2")
+    client.get("/nowhere")
+
+    counts = {key: value for _, _, key, value in REQUESTS.samples()}
+    assert counts[("GET", "/items/{item_id}", "200")] >= 2
+    assert counts[("GET", "unmatched", "404")] >= 1
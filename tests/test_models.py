@@ -0,0 +1,167 @@
+import json
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+import numpy as np
+import pytest
+from app.metrics import CHAT_GENERATION_SECONDS, CHAT_TOKENS
+from app.models import OllamaChatModel, WhisperTranscriber
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """Answers /api/generate like an Ollama server that echoes the prompt word by word."""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((body, self.client_address))
+        if body["model"] == "missing":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if body["model"] == "garbled":
+            payload = b"<html>Bad Gateway</html>" if body["prompt"] == "html" else json.dumps({"done": True}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        words = body["prompt"].split(" ")
+        if body["stream"]:
+            lines = [json.dumps({"response": word + " ", "done": False}) for word in words]
+            lines.append(json.dumps({"response": "", "done": True}))
+            payload = ("\n".join(lines) + "\n").encode()
+            content_type = "application/x-ndjson"
+        else:
+            payload = json.dumps({
+                "response": " ".join(words), "done": True, "eval_count": len(words), "eval_duration": 500_000_000,
+            }).encode()
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def ollama_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllamaHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def base_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def test_chat(ollama_server):
+    model = OllamaChatModel("gemma:2b", base_url=base_url(ollama_server))
+    assert model.chat("hello world") == "hello world"
+    assert ollama_server.requests[0][0] == {"model": "gemma:2b", "prompt": "hello world", "stream": False}
+
+@pytest.mark.asyncio
+async def test_achat_reuses_connection(ollama_server):
+    model = OllamaChatModel("gemma:2b", base_url=base_url(ollama_server))
+    assert await model.achat("first") == "first"
+    assert await model.achat("second") == "second"
+    await model.aclose()
+
+    client_ports = {address for _, address in ollama_server.requests}
+    assert len(client_ports) == 1
+
+@pytest.mark.asyncio
+async def test_astream_yields_tokens(ollama_server):
+    model = OllamaChatModel("gemma:2b", base_url=base_url(ollama_server))
+    tokens = [token async for token in model.astream("one two three")]
+    await model.aclose()
+
+    assert tokens == ["one ", "two ", "three "]
+    assert ollama_server.requests[0][0]["stream"] is True
+
+@pytest.mark.asyncio
+async def test_achat_error(ollama_server):
+    model = OllamaChatModel("missing", base_url=base_url(ollama_server))
+    with pytest.raises(RuntimeError):
+        await model.achat("hello")
+    await model.aclose()
+
+@pytest.mark.asyncio
+async def test_invalid_response_raises_runtime_error(ollama_server):
+    model = OllamaChatModel("garbled", base_url=base_url(ollama_server))
+    for prompt in ("html", "no response"):
+        with pytest.raises(RuntimeError, match="Invalid chat response"):
+            await model.achat(prompt)
+        with pytest.raises(RuntimeError, match="Invalid chat response"):
+            model.chat(prompt)
+    await model.aclose()
+
+@pytest.mark.asyncio
+async def test_token_usage_is_recorded(ollama_server):
+    model = OllamaChatModel("metrics-test", base_url=base_url(ollama_server))
+    await model.achat("one two three")
+    [token async for token in model.astream("four five")]
+    await model.aclose()
+
+    tokens = dict(((key, value) for _, _, key, value in CHAT_TOKENS.samples()))
+    seconds = dict(((key, value) for _, _, key, value in CHAT_GENERATION_SECONDS.samples()))
+    # Reported by the server for the first request, counted from the stream for the second
+    assert tokens[("metrics-test",)] == 5
+    assert seconds[("metrics-test",)] >= 0.5
+
+@pytest.mark.asyncio
+async def test_aprefill_generates_one_token(ollama_server):
+    model = OllamaChatModel("gemma:2b", base_url=base_url(ollama_server))
+    await model.aprefill("Question: why?")
+    await OllamaChatModel("missing", base_url=base_url(ollama_server)).aprefill("ignored")
+    await model.aclose()
+    body = ollama_server.requests[0][0]
+    assert body["prompt"] == "Question: why?"
+    assert body["options"] == {"num_predict": 1}
+
+class MelBatch(np.ndarray):
+    def to(self, device):
+        return self
+
+def test_transcribe_batch_falls_back_to_higher_temperatures():
+    """Clip 0 decodes fine, clip 1 repeats itself until 0.4, clip 2 is silence."""
+    decoded = []
+
+    def decode(model, mel, options):
+        decoded.append(([int(row[0]) for row in mel], options.temperature))
+        results = []
+        for row in mel:
+            clip = int(row[0])
+            repetitive = clip == 1 and options.temperature < 0.4
+            results.append(types.SimpleNamespace(
+                text=f"clip {clip} at {options.temperature}",
+                compression_ratio=3.0 if repetitive else 1.5,
+                avg_logprob=-1.5 if clip == 2 else -0.3,
+                no_speech_prob=0.9 if clip == 2 else 0.01,
+            ))
+        return results
+
+    fake_whisper = types.SimpleNamespace(
+        audio=types.SimpleNamespace(N_SAMPLES=16000 * 30),
+        load_audio=lambda path: path,
+        pad_or_trim=lambda audio: audio,
+        log_mel_spectrogram=lambda audio, n_mels: audio[:1],
+        DecodingOptions=lambda **options: types.SimpleNamespace(**options),
+        decode=decode,
+    )
+    fake_torch = types.SimpleNamespace(stack=lambda mels: np.stack(mels).view(MelBatch))
+    transcriber = WhisperTranscriber("tiny")
+    transcriber.registry = MagicMock()
+    transcriber.registry.get.return_value.device.type = "cpu"
+    clips = [np.full(16000, clip, dtype=np.float32) for clip in range(3)]
+
+    with patch.dict("sys.modules", {"whisper": fake_whisper, "torch": fake_torch}):
+        texts = transcriber.transcribe_batch(clips)
+
+    assert texts == ["clip 0 at 0.0", "clip 1 at 0.4", ""]
+    assert decoded == [([0, 1, 2], 0.0), ([1], 0.2), ([1], 0.4)]
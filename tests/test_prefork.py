@@ -0,0 +1,136 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+import httpx
+import numpy as np
+import pytest
+from app.prefork import PreforkServer, bind_socket
+from app.sharding import ShardedVectorStore
+
+SERVER = textwrap.dedent("""
+    import os, sys
+    from fastapi import FastAPI
+    from app.prefork import PreforkServer
+
+    MODEL = {}
+
+    def preload():
+        MODEL["loaded_by"] = os.getpid()
+
+    def factory():
+        app = FastAPI()
+
+        @app.get("/")
+        def whoami():
+            return {"pid": os.getpid(), "loaded_by": MODEL.get("loaded_by")}
+        return app
+
+    PreforkServer(factory, host="127.0.0.1", port=int(sys.argv[1]), workers=2, preload=preload,
+                  stop_timeout=5, log_level="warning").run()
+""")
+
+SHARDED_SERVER = textwrap.dedent("""
+    import os, sys
+    import numpy as np
+    from fastapi import FastAPI
+    from app.prefork import PreforkServer
+    from app.sharding import ShardedVectorStore
+
+    def factory():
+        app = FastAPI()
+
+        @app.get("/")
+        def search():
+            found = shards.search(np.array([[0.0, 1.0]]), 1)[0]
+            return {"pid": os.getpid(), "shards": [worker._process.pid for worker in shards._workers],
+                    "found": [doc.page_content for doc in found]}
+        return app
+
+    if __name__ == "__main__":
+        shards = ShardedVectorStore(sys.argv[2], shards=2, ivf_threshold=0, timeout=5)
+        PreforkServer(factory, host="127.0.0.1", port=int(sys.argv[1]), workers=2, preload=shards.start,
+                      on_stop=shards.close, on_supervise=shards.revive, stop_timeout=5, log_level="warning").run()
+""")
+
+def free_port():
+    sock = bind_socket("127.0.0.1", 0)
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def collect_pids(url, want, timeout=20):
+    pids, loaded_by = set(), set()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not want(pids):
+        try:
+            # A new connection per request, so the kernel hands them to different workers
+            body = httpx.get(url, timeout=2).json()
+        except httpx.HTTPError:
+            time.sleep(0.1)
+            continue
+        pids.add(body["pid"])
+        loaded_by.add(body["loaded_by"])
+    return pids, loaded_by
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork()")
+def test_workers_share_preloaded_state_and_are_restarted(tmp_path):
+    script = tmp_path / "serve.py"
+    script.write_text(SERVER)
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get("PYTHONPATH", "")]))
+    master = subprocess.Popen([sys.executable, str(script), str(port)], env=env)
+    url = f"http://127.0.0.1:{port}/"
+    try:
+        pids, loaded_by = collect_pids(url, lambda pids: len(pids) >= 2)
+        assert len(pids) == 2
+        # The model was loaded once in the master, before the workers were forked
+        assert loaded_by == {master.pid}
+        assert master.pid not in pids
+
+        victim = pids.pop()
+        os.kill(victim, signal.SIGKILL)
+        restarted, _ = collect_pids(url, lambda seen: seen - pids - {victim})
+        assert restarted - pids - {victim}
+    finally:
+        master.send_signal(signal.SIGTERM)
+        assert master.wait(timeout=30) == 0
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork()")
+def test_workers_share_the_shards_of_the_master(tmp_path):
+    script = tmp_path / "serve.py"
+    script.write_text(SHARDED_SERVER)
+    built = ShardedVectorStore(str(tmp_path / "shards"), shards=2, ivf_threshold=0)
+    built.build(["a", "b"], np.eye(2), ["east", "north"], [None, None])
+    built.close()
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get("PYTHONPATH", "")]))
+    master = subprocess.Popen([sys.executable, str(script), str(port), str(tmp_path / "shards")], env=env)
+    url = f"http://127.0.0.1:{port}/"
+    bodies = {}
+    try:
+        deadline = time.monotonic() + 30
+        while len(bodies) < 2 and time.monotonic() < deadline:
+            try:
+                body = httpx.get(url, timeout=5).json()
+            except httpx.HTTPError:
+                time.sleep(0.1)
+                continue
+            bodies[body["pid"]] = body
+        assert len(bodies) == 2
+        # Both workers search through the one set of shard processes the master started before forking
+        shard_pids = {tuple(body["shards"]) for body in bodies.values()}
+        assert len(shard_pids) == 1 and all(body["found"] == ["north"] for body in bodies.values())
+    finally:
+        master.send_signal(signal.SIGTERM)
+        assert master.wait(timeout=30) == 0
+    for pid in shard_pids.pop():
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+def test_threads_are_split_between_workers():
+    server = PreforkServer(lambda: None, workers=max(1, os.cpu_count() or 1))
+    assert server.threads_per_worker == 1
+    assert PreforkServer(lambda: None, workers=2, threads_per_worker=3).threads_per_worker == 3
@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+from langchain_core.documents import Document
+from app.rag import RagPipeline, build_context, estimate_tokens
+
+def test_build_context_keeps_best_documents_within_budget():
+    documents = [Document(page_content=text) for text in ("a" * 40, "a" * 40, "b" * 80, "c" * 20)]
+    # 10 tokens for the first, the duplicate is skipped, the third does not fit, the fourth does
+    assert build_context(documents, max_tokens=16) == "a" * 40 + "\n\n" + "c" * 20
+    assert build_context(documents, max_tokens=0).count("\n\n") == 2
+
+def test_build_context_cuts_a_single_oversized_document():
+    assert build_context([Document(page_content="x" * 100)], max_tokens=5) == "x" * 20
+    assert estimate_tokens("x" * 21) == 6
+
+def test_prompt_starts_with_the_prefix():
+    pipeline = RagPipeline()
+    prompt = pipeline.build_prompt(" What is it? ", "some context")
+    assert prompt.startswith(pipeline.prompt_prefix("What is it?"))
+    assert prompt.endswith("some context\n\nAnswer:")
+
+def test_contexts_are_cached_per_question_and_revision():
+    pipeline = RagPipeline(max_context_tokens=0)
+    db = SimpleNamespace(revision=0)
+    key = pipeline.context_key(db, "What is it?", 2)
+    assert pipeline.get_context(key) is None
+    assert pipeline.put_context(key, [Document(page_content="it")]) == "it"
+
+    assert pipeline.get_context(pipeline.context_key(db, "  what is IT? ", 2)) == "it"
+    assert pipeline.get_context(pipeline.context_key(db, "What is it?", 3)) is None
+    db.revision = 1
+    assert pipeline.get_context(pipeline.context_key(db, "What is it?", 2)) is None
+    assert pipeline.stats()["hits"] == 1
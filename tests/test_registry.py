@@ -0,0 +1,151 @@
+import threading
+import time
+import pytest
+from unittest.mock import MagicMock
+from app.registry import ModelRegistry, estimate_model_bytes, quantize_linear_layers
+
+MIB = 1024 * 1024
+
+@pytest.fixture
+def loader():
+    return MagicMock(side_effect=lambda size: f"model-{size}")
+
+def test_get_loads_once(loader):
+    registry = ModelRegistry(loader=loader, size_estimator=lambda model: MIB)
+    assert registry.get("tiny") == "model-tiny"
+    assert registry.get("tiny") == "model-tiny"
+    loader.assert_called_once_with("tiny")
+    assert registry.is_ready("tiny")
+
+def test_concurrent_get_shares_one_load():
+    calls = []
+
+    def slow_loader(size):
+        calls.append(size)
+        time.sleep(0.05)
+        return object()
+
+    registry = ModelRegistry(loader=slow_loader, size_estimator=lambda model: MIB)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("tiny"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ["tiny"]
+    assert len({id(model) for model in results}) == 1
+
+def test_lru_eviction_under_memory_budget(loader):
+    registry = ModelRegistry(loader=loader, memory_budget_mb=2, size_estimator=lambda model: MIB)
+    registry.get("tiny")
+    registry.get("base")
+    registry.get("tiny")  # base is now least recently used
+    registry.get("small")
+
+    assert registry.is_ready("tiny")
+    assert registry.is_ready("small")
+    assert not registry.is_ready("base")
+    assert registry.resident_bytes() == 2 * MIB
+
+def test_model_larger_than_budget_stays_resident(loader):
+    registry = ModelRegistry(loader=loader, memory_budget_mb=1, size_estimator=lambda model: 4 * MIB)
+    registry.get("tiny")
+    registry.get("base")
+    assert registry.is_ready("base")
+    assert not registry.is_ready("tiny")
+
+def test_max_models(loader):
+    registry = ModelRegistry(loader=loader, max_models=1, size_estimator=lambda model: MIB)
+    registry.get("tiny")
+    registry.get("base")
+    assert list(registry.status()["models"]) == ["base"]
+
+def test_failed_load_is_reported():
+    registry = ModelRegistry(loader=MagicMock(side_effect=RuntimeError("download failed")))
+    with pytest.raises(RuntimeError):
+        registry.get("tiny")
+    assert not registry.is_ready("tiny")
+    assert registry.status()["errors"] == {"tiny": "download failed"}
+
+def test_configure_shrinks_resident_set(loader):
+    registry = ModelRegistry(loader=loader, size_estimator=lambda model: MIB)
+    registry.get("tiny")
+    registry.get("base")
+    registry.configure(memory_budget_mb=1)
+    assert list(registry.status()["models"]) == ["base"]
+
+def test_precision_is_passed_to_the_loader(loader):
+    registry = ModelRegistry(loader=loader, size_estimator=lambda model: MIB)
+    registry.get("tiny")
+    loader.assert_called_once_with("tiny")
+
+    # Changing the precision drops the models loaded with the old one
+    loader.side_effect = lambda size, precision: f"model-{size}-{precision}"
+    registry.configure(precision="int8")
+    assert not registry.is_ready("tiny")
+    assert registry.get("tiny") == "model-tiny-int8"
+    assert registry.factory("base")() == "model-base-int8"
+
+def test_transcriber_factory_does_not_touch_the_default_registry():
+    from app.models import create_transcriber
+    from app.registry import default_registry
+
+    loader, precision = default_registry.loader, default_registry.precision
+    transcriber = create_transcriber("tiny", "int8")
+
+    assert transcriber.registry is not default_registry and transcriber.registry.precision == "int8"
+    assert (default_registry.loader, default_registry.precision) == (loader, precision)
+
+def test_create_app_uses_the_registries_it_is_given():
+    from configparser import ConfigParser
+    from app.main import create_app
+    from app.models import WhisperTranscriber
+    from app.registry import default_registry, embedding_registry
+
+    config = ConfigParser()
+    config.read("config.ini")
+    states = [(registry.loader, registry.precision, registry.memory_budget_bytes, registry.max_models)
+              for registry in (default_registry, embedding_registry)]
+    whisper_registry, embeddings = ModelRegistry(loader=MagicMock()), ModelRegistry(loader=MagicMock())
+    app = create_app(config['test'], start_job_workers=False, registries=(whisper_registry, embeddings))
+
+    assert app.dependency_overrides[WhisperTranscriber]().registry is whisper_registry
+    assert [(registry.loader, registry.precision, registry.memory_budget_bytes, registry.max_models)
+            for registry in (default_registry, embedding_registry)] == states
+
+def test_size_of_embedding_wrapper_is_taken_from_its_client():
+    class Tensor:
+        def numel(self):
+            return 256
+
+        def element_size(self):
+            return 4
+
+    class Module:
+        def parameters(self):
+            return [Tensor()]
+
+        def buffers(self):
+            return []
+
+    class Wrapper:
+        client = Module()
+
+    assert estimate_model_bytes(Wrapper()) == 1024
+
+def test_quantize_linear_layers_handles_subclasses():
+    pytest.importorskip("torch.ao.quantization")
+    import torch
+
+    class CastingLinear(torch.nn.Linear):
+        pass
+
+    model = torch.nn.Sequential(CastingLinear(8, 8), torch.nn.ReLU(), torch.nn.Linear(8, 2))
+    inputs = torch.randn(4, 8)
+    expected = model(inputs)
+    quantized = quantize_linear_layers(model)
+
+    assert all(not isinstance(layer, torch.nn.Linear) for layer in quantized.modules())
+    assert torch.allclose(quantized(inputs), expected, atol=0.1)
+    assert 0 < estimate_model_bytes(quantized) < 8 * 8 * 4 + 8 * 2 * 4
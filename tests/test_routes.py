@@ -1,8 +1,13 @@
+import json
+import os
 import pytest
 from fastapi.testclient import TestClient
 from app.main import create_app
 from app.models import WhisperTranscriber, OllamaChatModel
 from app.database import ChromaDBHandler
+from app.jobs import JobStore
+from app.cache import EmbeddingCache
+from app.startup import StartupOrchestrator
 from configparser import ConfigParser
 
 config = ConfigParser()
@@ -17,16 +22,38 @@ class MockWhisperTranscriber:
         return "transcribed text"
 
 class MockOllamaChatModel:
+    model_name = "mock"
+    max_concurrency = 2
+
     def chat(self, text):
         return f"response to {text}"
 
+    async def achat(self, text):
+        return self.chat(text)
+
+    async def astream(self, text):
+        for token in self.chat(text).split(" "):
+            yield token + " "
+
+    async def aprefill(self, text):
+        pass
+
 class MockChromaDBHandler:
+    revision = 0
+
     def similarity_search(self, text, k):
         class MockDocument:
             def __init__(self, content):
                 self.page_content = content
         return [MockDocument(f'document {i}') for i in range(k)]
 
+    def similarity_search_batch(self, texts, ks):
+        return [self.similarity_search(text, k) for text, k in zip(texts, ks)]
+
+    def ingest_files(self, paths, workers=None, sources=None):
+        lines = sum(len(open(path, encoding="utf-8").read().splitlines()) for path in paths)
+        return {"files": len(paths), "chunks": lines, "added": lines, "unchanged": 0, "removed": 0}
+
 @pytest.fixture
 def mock_audio_file(tmp_path):
     audio_file = tmp_path / "test_audio.wav"
@@ -43,6 +70,41 @@ def test_healthcheck():
     assert response.status_code == 200
     assert response.json() == {"status": "OK"}
 
+def test_metrics():
+    client.get("/health")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'aiservice_http_requests_total{method="GET",route="/health",status="200"}' in response.text
+    assert 'aiservice_queue_depth{queue="transcription"} 0' in response.text
+
+def test_healthcheck_detail_reports_services():
+    response = client.get("/health", params={"detail": True})
+    assert response.status_code == 200
+    assert response.json()["status"] == "OK"
+    assert set(response.json()["services"]) == {"whisper", "embedding", "database"}
+
+def test_cache_stats_answers_while_the_database_loads():
+    response = client.get("/cache/stats")
+    assert response.status_code == 200
+    assert {"transcription", "chat", "rag_contexts"} <= set(response.json())
+    assert "query_embeddings" not in response.json()
+
+    class Database:
+        query_cache = EmbeddingCache()
+
+    startup = StartupOrchestrator()
+    startup.add("database", Database)
+    startup.start()
+    assert startup.wait(timeout=5)
+    previous = app.dependency_overrides[StartupOrchestrator]
+    app.dependency_overrides[StartupOrchestrator] = lambda: startup
+    try:
+        response = client.get("/cache/stats")
+    finally:
+        app.dependency_overrides[StartupOrchestrator] = previous
+    assert response.json()["query_embeddings"]["hits"] == 0
+
 @pytest.fixture
 def mock_audio_file(tmp_path):
     audio_file = tmp_path / "test_audio.wav"
@@ -54,6 +116,11 @@ def test_chat_model_response():
     assert response.status_code == 200
     assert response.json() == {"response": "response to Hello"}
 
+def test_chat_model_response_stream():
+    response = client.post("/chat_response/stream", json={"text": "Hello"})
+    assert response.status_code == 200
+    assert response.text == "response to Hello "
+
 def test_similarity_search():
     response = client.post("/similarity", json={"text": "sample", "k": 3})
     assert response.status_code == 200
@@ -64,4 +131,77 @@ def test_similarity_search():
             {"content": "document 2", "top_k": 2},
         ]
     }
-    assert response.json() == expected_response
\ No newline at end of file
+    assert response.json() == expected_response
+
+def test_similarity_search_batch():
+    response = client.post("/similarity/batch", json=[{"text": "a", "k": 1}, {"text": "b", "k": 2}])
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {"index": 0, "documents": [{"content": "document 0", "top_k": 0}]},
+        {"index": 1, "documents": [{"content": "document 0", "top_k": 0}, {"content": "document 1", "top_k": 1}]},
+    ]
+
+def test_chat_model_response_batch():
+    response = client.post("/chat_response/batch", json=[{"text": f"prompt {i}"} for i in range(5)])
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [{"index": i, "response": f"response to prompt {i}"} for i in range(5)]
+
+def test_rag_response():
+    response = client.post("/rag", json={"text": "What is it?", "k": 2})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "Question: What is it?" in response.text
+    assert "Context:\ndocument 0\n\ndocument 1\n\nAnswer:" in response.text
+
+def test_ingest_documents():
+    response = client.post("/documents", files=[("files", ("a.txt", b"line 1\nline 2")), ("files", ("b.txt", b"line 1"))])
+    assert response.status_code == 200
+    assert response.json() == {"files": 2, "chunks": 3, "added": 3, "unchanged": 0, "removed": 0}
+
+def test_ingest_documents_rejects_binary():
+    response = client.post("/documents", files=[("files", ("a.bin", b"\xff\xfe\x00"))])
+    assert response.status_code == 400
+
+def test_transcription_job_roundtrip(tmp_path, mock_audio_file):
+    store = JobStore(str(tmp_path / "jobs"))
+    app.dependency_overrides[JobStore] = lambda: store
+    try:
+        with open(mock_audio_file, "rb") as file:
+            response = client.post("/jobs/transcribe", params={"priority": 3}, files={"file": ("a.wav", file, "audio/wav")})
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+        assert response.json()["status"] == "queued"
+
+        job = client.get(f"/jobs/{job_id}").json()
+        assert job["status"] == "queued" and job["priority"] == 3
+        assert "audio_path" not in job
+
+        store.complete(store.claim("worker")["id"], {"transcript": "transcribed text"})
+        assert client.get(f"/jobs/{job_id}").json()["result"] == {"transcript": "transcribed text"}
+        assert client.get("/jobs/unknown").status_code == 404
+    finally:
+        del app.dependency_overrides[JobStore]
+        store.close()
+
+def test_transcription_job_rejects_invalid_webhook(mock_audio_file):
+    with open(mock_audio_file, "rb") as file:
+        response = client.post("/jobs/transcribe", params={"webhook_url": "ftp://example.com"},
+                               files={"file": ("a.wav", file, "audio/wav")})
+    assert response.status_code == 422
+
+def test_transcription_job_rejects_private_webhook(tmp_path, mock_audio_file):
+    store = JobStore(str(tmp_path / "jobs"))
+    app.dependency_overrides[JobStore] = lambda: store
+    try:
+        with open(mock_audio_file, "rb") as file:
+            response = client.post("/jobs/transcribe", params={"webhook_url": "http://169.254.169.254/latest"},
+                                   files={"file": ("a.wav", file, "audio/wav")})
+        assert response.status_code == 400
+        assert store.claim("worker") is None
+        assert os.listdir(tmp_path / "jobs" / "audio") == []
+    finally:
+        del app.dependency_overrides[JobStore]
+        store.close()
@@ -0,0 +1,133 @@
+import os
+import signal
+import time
+import numpy as np
+import pytest
+from app.sharding import ShardedVectorStore, shard_of
+from app.vector_index import VectorStore, normalize_rows
+
+def random_unit_vectors(n, dimension=16, seed=0):
+    return normalize_rows(np.random.default_rng(seed).normal(size=(n, dimension)))
+
+def records(n, seed=0):
+    return ([f"id{i}" for i in range(n)], random_unit_vectors(n, seed=seed), [f"text {i}" for i in range(n)],
+            [{"source": "a.txt"}] * n)
+
+@pytest.fixture
+def sharded(tmp_path):
+    store = ShardedVectorStore(str(tmp_path / "shards"), shards=3, ivf_threshold=0, timeout=5)
+    yield store
+    store.close()
+
+def test_shard_assignment_is_stable():
+    assert [shard_of(f"id{i}", 3) for i in range(20)] == [shard_of(f"id{i}", 3) for i in range(20)]
+    assert {shard_of(f"id{i}", 3) for i in range(100)} == {0, 1, 2}
+
+def test_scatter_gather_matches_single_store(tmp_path, sharded):
+    ids, vectors, texts, metadatas = records(200)
+    single = VectorStore(str(tmp_path / "single"), ivf_threshold=0)
+    single.build(ids, vectors, texts, metadatas)
+    assert sharded.build(ids, vectors, texts, metadatas) == [0, 1, 2]
+    assert sharded.size == 200 and sharded.stored_precision == "float32"
+
+    queries = random_unit_vectors(5, seed=1)
+    results = sharded.search(queries, [1, 3, 5, 10, 0])
+    expected = single.search(queries, [1, 3, 5, 10, 0])
+    assert [[doc.page_content for doc in docs] for docs in results] == \
+        [[doc.page_content for doc in docs] for docs in expected]
+    assert not any(docs.partial for docs in results)
+
+def test_rebuild_only_touches_changed_shards(sharded):
+    ids, vectors, texts, metadatas = records(60)
+    sharded.build(ids, vectors, texts, metadatas)
+    # A new record only changes the shard it is assigned to
+    ids.append("new")
+    vectors = np.vstack([vectors, vectors[:1]])
+    assert sharded.build(ids, vectors, texts + ["new text"], metadatas + [None]) == [shard_of("new", 3)]
+    found = sharded.search(vectors[:1], 2)[0]
+    assert {doc.page_content for doc in found} == {"text 0", "new text"}
+
+def test_load_reuses_built_shards(tmp_path, sharded):
+    ids, vectors, texts, metadatas = records(30)
+    sharded.build(ids, vectors, texts, metadatas)
+    sharded.close()
+
+    reopened = ShardedVectorStore(sharded.directory, shards=3, ivf_threshold=0, timeout=5)
+    try:
+        assert reopened.exists()
+        reopened.load()
+        assert reopened.size == 30
+        assert reopened.search(vectors[4:5], 1)[0][0].page_content == "text 4"
+    finally:
+        reopened.close()
+    assert not ShardedVectorStore(sharded.directory, shards=4).exists()
+
+@pytest.mark.skipif(not hasattr(signal, "SIGSTOP"), reason="needs POSIX signals")
+def test_slow_shard_gives_partial_results(sharded):
+    ids, vectors, texts, metadatas = records(60)
+    sharded.build(ids, vectors, texts, metadatas)
+    stalled = shard_of("id0", 3)
+    process = sharded._workers[stalled]._process
+    sharded.timeout = 0.3
+    os.kill(process.pid, signal.SIGSTOP)
+    # The stop reaches the threads of the shard process asynchronously
+    time.sleep(0.2)
+    try:
+        result = sharded.search(vectors[:1], 5)[0]
+        assert result.partial and result.missing_shards == [stalled]
+        assert "text 0" not in [doc.page_content for doc in result]
+        assert len(result) == 5
+    finally:
+        os.kill(process.pid, signal.SIGCONT)
+
+    # The late reply to the timed-out request is dropped, not mistaken for the next one
+    sharded.timeout = 5
+    result = sharded.search(vectors[1:2], 1)[0]
+    assert not result.partial and result[0].page_content == "text 1"
+
+def test_dead_shard_is_restarted(sharded):
+    ids, vectors, texts, metadatas = records(60)
+    sharded.build(ids, vectors, texts, metadatas)
+    dead = shard_of("id0", 3)
+    process = sharded._workers[dead]._process
+    process.kill()
+    process.join()
+
+    assert sharded.search(vectors[:1], 1)[0][0].page_content == "text 0"
+    assert sharded._workers[dead].alive
+
+def test_writer_updates_shards_in_place(sharded):
+    ids, vectors, texts, metadatas = records(60)
+    sharded.build(ids, vectors, texts, metadatas)
+    writer = sharded.writer()
+    writer.remove(["id0", "missing"])
+    writer.add(["new"], vectors[:1], ["new text"], [None])
+    writer.commit()
+    assert sharded.size == 60
+    assert [doc.page_content for doc in sharded.search(vectors[:1], 1)[0]] == ["new text"]
+
+    reopened = ShardedVectorStore(sharded.directory, shards=3, ivf_threshold=0, timeout=5)
+    try:
+        reopened.load()
+        assert reopened.size == 60
+    finally:
+        reopened.close()
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_processes_share_shards(sharded):
+    ids, vectors, texts, metadatas = records(30)
+    sharded.build(ids, vectors, texts, metadatas)
+    pids = [worker._process.pid for worker in sharded._workers]
+    child = os.fork()
+    if child == 0:
+        try:
+            found = sharded.search(vectors[3:4], 1)[0]
+            sharded.close()
+            os._exit(0 if found[0].page_content == "text 3" and not found.partial else 1)
+        finally:
+            os._exit(2)
+    assert os.waitpid(child, 0)[1] == 0
+    # The child used the shard processes of this process and left them running
+    assert [worker._process.pid for worker in sharded._workers] == pids
+    assert all(worker.alive for worker in sharded._workers)
+    assert sharded.search(vectors[3:4], 1)[0][0].page_content == "text 3"
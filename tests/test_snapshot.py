@@ -0,0 +1,61 @@
+import os
+import numpy as np
+import pytest
+from app.snapshot import RECORDS_FILE, Snapshot, SnapshotError, live_rows, write_snapshot
+
+def write(path, n=5, **kwargs):
+    vectors = np.arange(n * 4, dtype=np.float32).reshape(n, 4)
+    ids = [f"id{i}" for i in range(n)]
+    texts = [f"text {i}" for i in range(n)]
+    metadatas = [{"source": "a.txt", "line": i} for i in range(n)]
+    return write_snapshot(str(path), "all-MiniLM-L6-v2", ids, vectors, texts, metadatas, **kwargs), vectors
+
+def test_snapshot_round_trip(tmp_path):
+    snapshot_id, vectors = write(tmp_path / "full")
+    snapshot = Snapshot.open(str(tmp_path / "full"))
+
+    assert snapshot.id == snapshot_id and snapshot.base is None and len(snapshot) == 5
+    assert isinstance(snapshot.vectors, np.memmap)
+    np.testing.assert_array_equal(snapshot.vectors, vectors)
+    assert snapshot.record(3) == {"id": "id3", "text": "text 3", "metadata": {"source": "a.txt", "line": 3}}
+    assert snapshot.state_ids() == [f"id{i}" for i in range(5)]
+    batches = list(snapshot.batches(batch_size=2))
+    assert [ids for ids, _, _, _ in batches] == [["id0", "id1"], ["id2", "id3"], ["id4"]]
+    assert batches[2][1].dtype == np.float32 and batches[2][2] == ["text 4"]
+
+def test_float16_delta_snapshot(tmp_path):
+    _, vectors = write(tmp_path / "delta", n=2, state_ids=["id0", "id1", "old"], removed=["gone"], base="abc",
+                       precision="float16")
+    snapshot = Snapshot.open(str(tmp_path / "delta"))
+
+    assert snapshot.base == "abc" and snapshot.removed() == ["gone"]
+    assert snapshot.vectors.dtype == np.float16
+    np.testing.assert_allclose(next(snapshot.batches())[1], vectors)
+
+def test_empty_snapshot(tmp_path):
+    write_snapshot(str(tmp_path / "empty"), "model", [], np.empty((0,)), [], [])
+    snapshot = Snapshot.open(str(tmp_path / "empty"))
+    assert len(snapshot) == 0 and list(snapshot.batches()) == []
+
+def test_corrupt_snapshot_is_rejected(tmp_path):
+    write(tmp_path / "full")
+    with open(os.path.join(tmp_path / "full", RECORDS_FILE), "r+b") as file:
+        file.write(b"X")
+    with pytest.raises(SnapshotError):
+        Snapshot.open(str(tmp_path / "full"))
+    # Opening without verification only maps the files
+    assert len(Snapshot.open(str(tmp_path / "full"), verify=False)) == 5
+
+def test_existing_snapshot_is_not_overwritten(tmp_path):
+    write(tmp_path / "full")
+    with pytest.raises(FileExistsError):
+        write(tmp_path / "full")
+
+def test_live_rows_of_a_chain(tmp_path):
+    full_id, _ = write(tmp_path / "full", n=3)
+    # The delta removes id1 and adds id0 back after a change, so only its copy of id0 is live
+    write(tmp_path / "delta", n=1, state_ids=["id0", "id2"], removed=["id0", "id1"], base=full_id)
+    chain = [Snapshot.open(str(tmp_path / "full")), Snapshot.open(str(tmp_path / "delta"))]
+
+    assert chain[0].ids() == ["id0", "id1", "id2"] and chain[1].ids() == ["id0"]
+    assert [rows.tolist() for rows in live_rows(chain)] == [[2], [0]]
@@ -0,0 +1,75 @@
+import pytest
+from app.splitter import Chunk, StreamingTextSplitter, tokenizer_length
+
+TEXT = "A group of flamingos\nis called a flamboyance.\n\nThey are pink\nbecause of their diet."
+
+def test_split_text_merges_lines_up_to_chunk_size():
+    splitter = StreamingTextSplitter(chunk_size=40)
+    assert splitter.split_text(TEXT) == [
+        "A group of flamingos", "is called a flamboyance.\nThey are pink", "because of their diet.",
+    ]
+
+def test_split_text_overlap_repeats_trailing_lines():
+    splitter = StreamingTextSplitter(chunk_size=30, chunk_overlap=15)
+    assert splitter.split_text("one two\nthree four\nfive six\nseven eight") == [
+        "one two\nthree four\nfive six", "five six\nseven eight",
+    ]
+
+def test_split_file_matches_split_text_with_byte_offsets(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_bytes("flamingos\r\nsont roses\r\n\r\nfin".encode("utf-8"))
+    splitter = StreamingTextSplitter(chunk_size=12, block_size=4)
+
+    chunks = list(splitter.split_file(str(path)))
+
+    assert [chunk.text for chunk in chunks] == splitter.split_text("flamingos\nsont roses\n\nfin")
+    assert [(chunk.start, chunk.end) for chunk in chunks] == [(0, 9), (11, 21), (25, 28)]
+    assert chunks[1].length == 10
+
+def test_split_file_decodes_multibyte_characters_across_blocks(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("héhé\nçà", encoding="utf-8")
+    chunks = list(StreamingTextSplitter(chunk_size=100, block_size=1).split_file(str(path)))
+    assert [chunk.text for chunk in chunks] == ["héhé\nçà"]
+    assert (chunks[0].start, chunks[0].end) == (0, 11)
+
+def test_chunks_are_compact():
+    chunk = Chunk("text", 0, 4, 4)
+    assert not hasattr(chunk, "__dict__")
+    with pytest.raises(AttributeError):
+        chunk.source = "doc.txt"
+
+def test_sizes_from_config_strings_are_validated():
+    assert StreamingTextSplitter(" 60 ", "0").chunk_size == 60
+    with pytest.raises(ValueError):
+        StreamingTextSplitter("60.5")
+    with pytest.raises(ValueError):
+        StreamingTextSplitter(0)
+    with pytest.raises(ValueError):
+        StreamingTextSplitter(10, 11)
+
+def test_token_length_uses_the_model_tokenizer():
+    class Tokenizer:
+        def encode(self, text, add_special_tokens=True):
+            return text.split()
+
+    class Client:
+        tokenizer = Tokenizer()
+
+    class Embeddings:
+        client = Client()
+
+    splitter = StreamingTextSplitter(chunk_size=4, length_function=tokenizer_length(Embeddings()))
+    assert splitter.split_text("a b c\nd e\nf") == ["a b c", "d e\nf"]
+    with pytest.raises(ValueError):
+        tokenizer_length(object())
+
+def test_split_file_joins_a_long_line_once(tmp_path):
+    path = tmp_path / "doc.txt"
+    line = "x" * 200000
+    path.write_text(f"{line}\nshort\n{line}", encoding="utf-8")
+
+    chunks = list(StreamingTextSplitter(chunk_size=10, block_size=7).split_file(str(path)))
+
+    assert [chunk.text for chunk in chunks] == [line, "short", line]
+    assert [(chunk.start, chunk.end) for chunk in chunks] == [(0, 200000), (200001, 200006), (200007, 400007)]
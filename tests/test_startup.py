@@ -0,0 +1,83 @@
+import threading
+import time
+import pytest
+from fastapi import HTTPException
+from app.startup import FAILED, LOADING, READY, StartupOrchestrator
+
+def test_services_load_concurrently():
+    startup = StartupOrchestrator()
+    startup.add("a", lambda: time.sleep(0.2) or "model a")
+    startup.add("b", lambda: time.sleep(0.2) or "model b")
+
+    started = time.perf_counter()
+    startup.start()
+    assert startup.wait(timeout=5)
+
+    assert time.perf_counter() - started < 0.35
+    assert startup.get("a") == "model a"
+    assert startup.get("b") == "model b"
+    report = startup.status()
+    assert {state["status"] for state in report["services"].values()} == {READY}
+    assert report["services"]["a"]["seconds"] >= 0.2
+    assert report["startup_seconds"] >= 0.2
+
+def test_ready_service_is_served_while_others_load():
+    release = threading.Event()
+    startup = StartupOrchestrator(retry_after=7)
+    startup.add("fast", lambda: "fast model")
+    startup.add("slow", release.wait)
+    startup.start()
+
+    while not startup.is_ready("fast"):
+        time.sleep(0.001)
+    assert startup.dependency("fast")() == "fast model"
+    with pytest.raises(HTTPException) as exc_info:
+        startup.dependency("slow")()
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "7"}
+    assert startup.status()["services"]["slow"]["status"] == LOADING
+    assert startup.status()["startup_seconds"] is None
+
+    release.set()
+    assert startup.wait(timeout=5)
+    assert startup.get("slow") is True
+
+def test_failed_service_is_reported():
+    def broken():
+        raise RuntimeError("no weights")
+
+    startup = StartupOrchestrator()
+    startup.add("broken", broken)
+    startup.start()
+    assert startup.wait(timeout=5)
+
+    assert startup.status()["services"]["broken"]["status"] == FAILED
+    assert startup.status()["services"]["broken"]["error"] == "no weights"
+    with pytest.raises(HTTPException, match="failed to load"):
+        startup.get("broken")
+
+def test_required_services_load_first():
+    order = []
+    startup = StartupOrchestrator()
+    startup.add("database", lambda: order.append("database") or startup.get("embedding") + " index", requires=("embedding",))
+    startup.add("embedding", lambda: time.sleep(0.1) or order.append("embedding") or "embedding")
+    startup.start()
+    assert startup.wait(timeout=5)
+
+    assert order == ["embedding", "database"]
+    assert startup.get("database") == "embedding index"
+    # The wait for the embedding model is not counted as load time of the database
+    assert startup.status()["services"]["database"]["seconds"] < 0.1
+
+def test_service_fails_when_its_requirement_fails():
+    def broken():
+        raise RuntimeError("no weights")
+
+    startup = StartupOrchestrator()
+    startup.add("embedding", broken)
+    startup.add("database", lambda: "index", requires=("embedding",))
+    startup.start()
+    assert startup.wait(timeout=5)
+
+    assert startup.status()["services"]["database"]["status"] == FAILED
+    assert "requires embedding" in startup.status()["services"]["database"]["error"]
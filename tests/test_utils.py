@@ -1,9 +1,19 @@
+import io
+import wave
 import pytest
 import json
+import numpy as np
 from unittest.mock import AsyncMock, patch, MagicMock
 from fastapi import UploadFile, HTTPException
 from app.models import WhisperTranscriber
-from app.utils import handle_transcription, transcribe_async  
+from app.cache import ChatResponseCache, TranscriptionCache
+from app.utils import (
+    handle_transcription, handle_streaming_transcription, transcribe_async, chat_response_async,
+    stream_chat_batch, stream_similarity_batch, handle_rag_response, transcribe_window,
+)
+from app.audio import SilenceTrimmer
+from app.batching import TranscriptionScheduler
+from app.rag import RagPipeline
 
 class AsyncContextManagerMock:
     def __init__(self, obj):
@@ -18,23 +28,19 @@ class AsyncContextManagerMock:
 @pytest.mark.asyncio
 async def test_handle_transcription_success():
     mock_file = MagicMock(spec=UploadFile)
-    mock_file.read = AsyncMock(return_value=b"fake audio data")
     mock_file.filename = "test.wav"
+    audio = np.zeros(16000, dtype=np.float32)
     
     mock_transcriber = MagicMock(spec=WhisperTranscriber)
     mock_transcriber.transcribe = MagicMock(return_value="fake transcript")
 
-    mock_tempfile = MagicMock()
-    mock_tempfile.write = AsyncMock()
-    mock_tempfile.name = "/fake/temp/path/test.wav"
-    
-    with patch('aiofiles.tempfile.NamedTemporaryFile', return_value=AsyncContextManagerMock(mock_tempfile)):
-        with patch('os.remove') as mock_remove:
+    with patch('app.utils.decode_upload', new=AsyncMock(return_value=audio)) as mock_decode:
+        with patch('aiofiles.tempfile.NamedTemporaryFile') as mock_tempfile:
             response = await handle_transcription(mock_file, mock_transcriber)
     
-            mock_file.read.assert_awaited_once()
-            mock_tempfile.write.assert_awaited_once_with(b"fake audio data")
-            mock_remove.assert_called_once_with("/fake/temp/path/test.wav")
+            mock_decode.assert_awaited_once_with(mock_file)
+            mock_tempfile.assert_not_called()
+            mock_transcriber.transcribe.assert_called_once_with(audio)
             assert response.status_code == 200
             assert json.loads(response.body) == {"transcript": "fake transcript"}
 
@@ -63,3 +69,253 @@ async def test_transcribe_async():
     
     mock_transcriber.transcribe.assert_called_once_with(file_path)
     assert transcript == "fake transcript"
+
+@pytest.mark.asyncio
+async def test_handle_streaming_transcription():
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(np.zeros(16000 * 5, dtype=np.int16).tobytes())
+    upload = UploadFile(file=io.BytesIO(buffer.getvalue()), filename="test.wav")
+
+    mock_transcriber = MagicMock(spec=WhisperTranscriber)
+    mock_transcriber.transcribe_segments = MagicMock(
+        side_effect=lambda audio, offset: [{"start": offset, "end": offset + len(audio) / 16000, "text": "text"}]
+    )
+
+    response = await handle_streaming_transcription(upload, mock_transcriber, window_seconds=2)
+    lines = [json.loads(line) async for line in response.body_iterator]
+
+    assert response.media_type == "application/x-ndjson"
+    starts = [line["start"] for line in lines[:-1]]
+    assert starts[0] == 0.0 and starts == sorted(starts)
+    assert all(line["end"] - line["start"] <= 2 for line in lines[:-1])
+    assert lines[-2]["end"] == 5.0
+    assert lines[-1] == {"done": True, "duration": 5.0}
+
+@pytest.mark.asyncio
+async def test_handle_streaming_transcription_queues_windows_on_the_scheduler():
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(np.zeros(16000 * 5, dtype=np.int16).tobytes())
+    upload = UploadFile(file=io.BytesIO(buffer.getvalue()), filename="test.wav")
+
+    mock_transcriber = MagicMock(spec=WhisperTranscriber)
+    mock_transcriber.transcribe_segments = MagicMock(
+        side_effect=lambda audio, offset: [{"start": offset, "end": offset + len(audio) / 16000, "text": "text"}]
+    )
+    scheduler = TranscriptionScheduler(mock_transcriber, max_batch_size=2, max_wait_ms=0)
+    with patch("asyncio.BaseEventLoop.run_in_executor") as run_in_executor:
+        response = await handle_streaming_transcription(upload, mock_transcriber, window_seconds=2,
+                                                        scheduler=scheduler)
+        lines = [json.loads(line) async for line in response.body_iterator]
+    scheduler.stop()
+
+    run_in_executor.assert_not_called()
+    assert mock_transcriber.transcribe_segments.call_count == len(lines) - 1
+    assert lines[-2]["end"] == 5.0
+    assert lines[-1] == {"done": True, "duration": 5.0}
+
+@pytest.mark.asyncio
+async def test_handle_streaming_transcription_invalid_file():
+    upload = UploadFile(file=io.BytesIO(b"This is not an audio file"), filename="invalid.txt")
+    with pytest.raises(HTTPException) as exc_info:
+        await handle_streaming_transcription(upload, MagicMock(spec=WhisperTranscriber))
+    assert exc_info.value.status_code == 500
+
+@pytest.mark.asyncio
+async def test_handle_transcription_cache_hit_skips_model():
+    cache = TranscriptionCache()
+    mock_transcriber = MagicMock(spec=WhisperTranscriber)
+    mock_transcriber.model_size = "tiny"
+    mock_transcriber.transcribe = MagicMock(return_value="fake transcript")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(np.zeros(16000, dtype=np.int16).tobytes())
+    data = buffer.getvalue()
+
+    for _ in range(2):
+        upload = UploadFile(file=io.BytesIO(data), filename="test.wav")
+        response = await handle_transcription(upload, mock_transcriber, cache=cache)
+        assert json.loads(response.body) == {"transcript": "fake transcript"}
+
+    mock_transcriber.transcribe.assert_called_once()
+    assert cache.stats()["memory"]["hits"] == 1
+    # Every upload is hashed, only the first one is decoded
+    assert cache.stats()["bytes_hashed"] == 2 * len(data)
+    assert cache.stats()["bytes_saved"] == len(data)
+
+@pytest.mark.asyncio
+async def test_handle_transcription_cache_hit_skips_decoding_and_trimming():
+    cache = TranscriptionCache()
+    tone = 0.3 * np.sin(np.arange(16000) * 0.1)
+    audio = np.concatenate([np.zeros(16000 * 4), tone]).astype(np.float32)
+    mock_transcriber = MagicMock(spec=WhisperTranscriber)
+    mock_transcriber.model_size = "tiny"
+    mock_transcriber.transcribe = MagicMock(return_value="hello")
+    trimmer = SilenceTrimmer(padding_seconds=0.2)
+
+    with patch('app.utils.decode_upload', new=AsyncMock(return_value=audio)) as mock_decode:
+        bodies = []
+        for _ in range(2):
+            upload = UploadFile(file=io.BytesIO(b"same upload"), filename="test.wav")
+            bodies.append(json.loads((await handle_transcription(upload, mock_transcriber, cache=cache,
+                                                                 trimmer=trimmer)).body))
+
+    assert bodies[0] == bodies[1] and bodies[0]["skipped_seconds"] > 3
+    mock_decode.assert_called_once()
+    mock_transcriber.transcribe.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_chat_response_async_uses_cache():
+    mock_model = MagicMock()
+    mock_model.model_name = "gemma:2b"
+    mock_model.achat = AsyncMock(return_value="fake response")
+    cache = ChatResponseCache()
+
+    assert await chat_response_async(mock_model, "Hello", cache) == "fake response"
+    assert await chat_response_async(mock_model, "  hello ", cache) == "fake response"
+
+    mock_model.achat.assert_awaited_once_with("Hello")
+    assert cache.stats()["hit_ratio"] == 0.5
+
+@pytest.mark.asyncio
+async def test_stream_chat_batch_keeps_order_and_bounds_concurrency():
+    import asyncio
+    running = []
+    peak = []
+
+    class SlowModel:
+        model_name = "mock"
+        max_concurrency = 2
+
+        async def achat(self, prompt):
+            running.append(prompt)
+            peak.append(len(running))
+            # Later prompts finish first
+            await asyncio.sleep(0.01 * (5 - int(prompt)))
+            running.remove(prompt)
+            if prompt == "3":
+                raise RuntimeError("generation failed")
+            return f"answer {prompt}"
+
+    lines = [json.loads(line) async for line in stream_chat_batch(SlowModel(), ["0", "1", "2", "3", "4"])]
+
+    assert [line["index"] for line in lines] == [0, 1, 2, 3, 4]
+    assert lines[1] == {"index": 1, "response": "answer 1"}
+    assert lines[3] == {"index": 3, "error": "generation failed"}
+    assert max(peak) == 2
+
+@pytest.mark.asyncio
+async def test_stream_similarity_batch_searches_in_chunks():
+    db = MagicMock()
+    db.similarity_search_batch.side_effect = lambda texts, ks: [
+        [MagicMock(page_content=f"{text}-{rank}") for rank in range(k)] for text, k in zip(texts, ks)
+    ]
+    queries = [(f"q{i}", i % 3 + 1) for i in range(5)]
+
+    lines = [json.loads(line) async for line in stream_similarity_batch(db, queries, chunk_size=2)]
+
+    assert db.similarity_search_batch.call_count == 3
+    assert [line["index"] for line in lines] == list(range(5))
+    assert lines[4]["documents"] == [{"content": "q4-0", "top_k": 0}, {"content": "q4-1", "top_k": 1}]
+
+@pytest.mark.asyncio
+async def test_stream_similarity_batch_flags_partial_results():
+    from app.sharding import ShardResults
+    db = MagicMock()
+    db.similarity_search_batch.return_value = [ShardResults([MagicMock(page_content="a")], missing_shards=[1]),
+                                               ShardResults([MagicMock(page_content="b")])]
+
+    lines = [json.loads(line) async for line in stream_similarity_batch(db, [("q0", 1), ("q1", 1)])]
+
+    assert lines[0]["partial"] is True and lines[0]["missing_shards"] == [1]
+    assert "partial" not in lines[1]
+
+@pytest.mark.asyncio
+async def test_handle_rag_response_overlaps_prefill_and_caches_context():
+    import asyncio
+    events = []
+
+    class Model:
+        async def aprefill(self, prompt):
+            events.append("prefill start")
+            await asyncio.sleep(0.02)
+            events.append("prefill done")
+
+        async def astream(self, prompt):
+            events.append(prompt)
+            yield "answer"
+
+    class Database:
+        revision = 0
+
+        def similarity_search(self, query, k):
+            events.append("retrieve")
+            return [MagicMock(page_content=f"doc {i}") for i in range(k)]
+
+    pipeline = RagPipeline()
+    db, model = Database(), Model()
+    response = await handle_rag_response("Why?", 2, db, model, pipeline)
+    assert [chunk async for chunk in response.body_iterator] == ["answer"]
+    # The retrieval ran while the prefix was being evaluated, generation waited for both
+    assert sorted(events[:2]) == ["prefill start", "retrieve"]
+    assert events[2] == "prefill done"
+    assert events[3] == pipeline.build_prompt("Why?", "doc 0\n\ndoc 1")
+
+    events.clear()
+    response = await handle_rag_response("why?", 2, db, model, pipeline)
+    [chunk async for chunk in response.body_iterator]
+    assert events == [pipeline.build_prompt("why?", "doc 0\n\ndoc 1")]
+
+@pytest.mark.asyncio
+async def test_handle_rag_response_retrieval_failure():
+    model = MagicMock()
+    model.aprefill = AsyncMock()
+    db = MagicMock(revision=0)
+    db.similarity_search.side_effect = RuntimeError("index broken")
+
+    with pytest.raises(HTTPException) as exc_info:
+        await handle_rag_response("Why?", 2, db, model, RagPipeline())
+    assert exc_info.value.status_code == 500
+
+def test_transcribe_window_only_decodes_speech():
+    tone = lambda seconds: 0.3 * np.sin(np.arange(int(seconds * 16000)) * 0.1)
+    window = np.concatenate([np.zeros(16000 * 4), tone(1), np.zeros(16000 * 5)]).astype(np.float32)
+    transcriber = MagicMock()
+    transcriber.transcribe_segments.side_effect = lambda audio: [
+        {"start": 0.2, "end": round(len(audio) / 16000 - 0.2, 2), "text": " hello"}
+    ]
+
+    segments, skipped = transcribe_window(transcriber, window, 30.0, SilenceTrimmer(padding_seconds=0.2))
+
+    decoded = transcriber.transcribe_segments.call_args[0][0]
+    assert len(decoded) / 16000 < 1.5
+    assert skipped == pytest.approx(10 - len(decoded) / 16000)
+    # Times refer to the recording, up to the 30 ms frames of the detector
+    assert segments[0]["start"] == pytest.approx(34.0, abs=0.05)
+    assert segments[0]["end"] == pytest.approx(35.0, abs=0.05)
+
+@pytest.mark.asyncio
+async def test_handle_transcription_reports_skipped_silence():
+    tone = 0.3 * np.sin(np.arange(16000) * 0.1)
+    audio = np.concatenate([np.zeros(16000 * 4), tone, np.zeros(16000 * 5)]).astype(np.float32)
+    mock_transcriber = MagicMock(spec=WhisperTranscriber)
+    mock_transcriber.transcribe = MagicMock(return_value="hello")
+
+    with patch('app.utils.decode_upload', new=AsyncMock(return_value=audio)):
+        response = await handle_transcription(MagicMock(spec=UploadFile), mock_transcriber,
+                                              trimmer=SilenceTrimmer(padding_seconds=0.2))
+
+    body = json.loads(response.body)
+    assert body["transcript"] == "hello"
+    decoded = mock_transcriber.transcribe.call_args[0][0]
+    assert body["skipped_seconds"] == pytest.approx(10 - len(decoded) / 16000, abs=0.01)
@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import pytest
+from app.vector_index import (
+    BruteForceIndex, IVFIndex, VectorStore, decode_vectors, encode_vectors, normalize_rows, top_k,
+)
+
+def random_unit_vectors(n, dimension=16, seed=0):
+    return normalize_rows(np.random.default_rng(seed).normal(size=(n, dimension)))
+
+def test_top_k_matches_full_sort():
+    scores = np.random.default_rng(1).normal(size=(3, 50)).astype(np.float32)
+    indices, values = top_k(scores, 5)
+    np.testing.assert_array_equal(indices, np.argsort(-scores, axis=1)[:, :5])
+    np.testing.assert_array_equal(values, np.take_along_axis(scores, indices, axis=1))
+    assert top_k(scores, 100)[0].shape == (3, 50)
+
+def test_brute_force_finds_exact_neighbours():
+    vectors = random_unit_vectors(200)
+    indices, scores = BruteForceIndex(vectors).search(vectors[[3, 7]], 1)
+    assert indices[:, 0].tolist() == [3, 7]
+    np.testing.assert_allclose(scores[:, 0], 1.0, rtol=1e-5)
+
+def test_ivf_recall():
+    rng = np.random.default_rng(2)
+    centers = random_unit_vectors(20, seed=3)
+    vectors = normalize_rows(np.repeat(centers, 100, axis=0) + rng.normal(scale=0.05, size=(2000, 16)))
+    queries = vectors[rng.choice(len(vectors), 50, replace=False)]
+
+    exact, _ = BruteForceIndex(vectors).search(queries, 10)
+    approximate, _ = IVFIndex.build(vectors, n_probe=4).search(queries, 10)
+
+    recall = np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approximate, exact)])
+    assert recall >= 0.9
+
+def test_vector_store_round_trip(tmp_path):
+    vectors = random_unit_vectors(30)
+    store = VectorStore(str(tmp_path), ivf_threshold=0)
+    store.build([f"id{i}" for i in range(30)], vectors * 3, [f"text {i}" for i in range(30)],
+                [{"source": "a.txt"}] + [None] * 29)
+
+    reloaded = VectorStore(str(tmp_path), ivf_threshold=0)
+    assert reloaded.exists()
+    reloaded.load()
+    assert reloaded.size == 30
+    assert isinstance(reloaded._snapshot[1].vectors, np.memmap)
+
+    results = reloaded.search(vectors[[0, 5]], [1, 2])
+    assert [[doc.page_content for doc in docs] for docs in results] == [["text 0"], ["text 5", results[1][1].page_content]]
+    assert results[0][0].metadata == {"source": "a.txt"}
+
+def test_vector_store_uses_ivf_for_large_corpora(tmp_path):
+    vectors = random_unit_vectors(100)
+    store = VectorStore(str(tmp_path), ivf_threshold=50, n_probe=100)
+    store.build([str(i) for i in range(100)], vectors, [str(i) for i in range(100)], [None] * 100)
+    assert isinstance(store._snapshot[1], IVFIndex)
+    assert store.search(vectors[[42]], 1)[0][0].page_content == "42"
+
+def test_empty_vector_store(tmp_path):
+    store = VectorStore(str(tmp_path))
+    assert store.search(np.ones((2, 4)), 3) == [[], []]
+
+def test_reduced_precision_storage_keeps_neighbours(tmp_path):
+    vectors = random_unit_vectors(500, dimension=64, seed=4)
+    queries = random_unit_vectors(20, dimension=64, seed=5)
+    exact, _ = BruteForceIndex(vectors).search(queries, 5)
+    for precision, nbytes in (("float16", 2), ("int8", 1)):
+        stored, scales = encode_vectors(vectors, precision)
+        assert stored.itemsize == nbytes
+        np.testing.assert_allclose(decode_vectors(stored, scales), vectors, atol=0.01)
+
+        store = VectorStore(str(tmp_path / precision), ivf_threshold=0, precision=precision)
+        store.build([str(i) for i in range(500)], vectors, [str(i) for i in range(500)], [None] * 500)
+        assert store.stored_precision == precision
+        found = [[int(doc.page_content) for doc in docs] for docs in store.search(queries, 5)]
+        recall = np.mean([len(set(f) & set(e)) / 5 for f, e in zip(found, exact)])
+        assert recall >= 0.95
+
+def test_int8_ivf_search(tmp_path):
+    vectors = random_unit_vectors(100)
+    store = VectorStore(str(tmp_path), ivf_threshold=50, n_probe=100, precision="int8")
+    store.build([str(i) for i in range(100)], vectors, [str(i) for i in range(100)], [None] * 100)
+    assert isinstance(store._snapshot[1], IVFIndex)
+    assert store.search(vectors[[42]], 1)[0][0].page_content == "42"
+
+def test_unknown_precision_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="Unknown vector precision"):
+        VectorStore(str(tmp_path), precision="float8")
+
+def test_writer_appends_and_removes_without_rebuilding(tmp_path):
+    vectors = random_unit_vectors(100)
+    store = VectorStore(str(tmp_path), ivf_threshold=50, n_probe=100)
+    store.build([str(i) for i in range(100)], vectors, [str(i) for i in range(100)], [None] * 100)
+    first = store._read_manifest()["segments"][0]["name"]
+
+    writer = store.writer()
+    writer.remove(["3", "missing"])
+    writer.add(["new"], vectors[[3]], ["new"], [None])
+    writer.commit()
+    # The IVF segment is kept, the new record goes to a segment of its own
+    assert [entry["name"] for entry in store._read_manifest()["segments"]][0] == first
+    assert store.size == 100
+    assert [doc.page_content for doc in store.search(vectors[[3]], 2)[0]][0] == "new"
+    assert "3" not in [doc.page_content for doc in store.search(vectors[[3]], 5)[0]]
+
+    # A removed and re-added record can be removed again
+    for ids, removed in ((["3"], []), ([], ["3"])):
+        writer = store.writer()
+        writer.add(ids, vectors[[3]][:len(ids)], ids, [None] * len(ids))
+        writer.remove(removed)
+        writer.commit()
+    reloaded = VectorStore(str(tmp_path), ivf_threshold=50, n_probe=100)
+    reloaded.load()
+    assert reloaded.size == 100
+    assert "3" not in [doc.page_content for doc in reloaded.search(vectors[[3]], 5)[0]]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+def test_writer_compacts_past_the_drift_threshold(tmp_path):
+    vectors = random_unit_vectors(100)
+    store = VectorStore(str(tmp_path), ivf_threshold=50, n_probe=100, compact_ratio=0.2)
+    store.build([str(i) for i in range(60)], vectors[:60], [str(i) for i in range(60)], [None] * 60)
+    for start in range(60, 100, 10):
+        writer = store.writer()
+        writer.add([str(i) for i in range(start, start + 10)], vectors[start:start + 10],
+                   [str(i) for i in range(start, start + 10)], [None] * 10)
+        writer.commit()
+    # Appended segments are merged into the first one, with a retrained IVF index, once they exceed 20% of it
+    segments = store._read_manifest()["segments"]
+    assert len(segments) == 1 and segments[0]["size"] == 100
+    assert isinstance(store._snapshot[1], IVFIndex)
+    assert store.search(vectors[[95]], 1)[0][0].page_content == "95"
+
+def test_discarded_writer_leaves_the_index(tmp_path):
+    vectors = random_unit_vectors(10)
+    store = VectorStore(str(tmp_path), ivf_threshold=0)
+    store.build([str(i) for i in range(10)], vectors, [str(i) for i in range(10)], [None] * 10)
+    writer = store.writer(replace=True)
+    writer.add(["new"], vectors[:1], ["new"], [None])
+    writer.discard()
+    assert store.size == 10 and VectorStore(str(tmp_path)).exists()
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]